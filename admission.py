@@ -0,0 +1,344 @@
+import os
+import json
+import math
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+import metrics
+
+# Admission control for the chat endpoints. A request is let in only if
+# (1) its session and its client IP each have a token left in their token
+# bucket, and (2) a slot is free under the in-flight cap, possibly after a
+# short wait in a bounded queue. Otherwise it is answered straight away with
+# 429 and a Retry-After header, before any Firestore read or model call.
+# A prompt the crisis screen would flag is charged like any other, but when
+# it is over a limit it gets the canned safety reply instead of a 429, still
+# without any model, Firestore or escalation-log work.
+# Bucket state lives in process memory, or with ADMISSION_STATE=sqlite in a
+# local SQLite file that every worker on the host shares. The in-flight cap
+# is per process: with N workers the host admits N * ADMISSION_MAX_IN_FLIGHT
+# (bot.py behind model_server.py also gets the model server's own limits).
+
+# --- 1. Configuration ---
+ADMISSION = os.getenv("ADMISSION", "1") == "1"
+ADMISSION_PATHS = tuple(p for p in os.getenv("ADMISSION_PATHS", "/chat,/chat/stream").split(",") if p)
+# Sustained requests per second and burst size, per session_id and per client IP
+ADMISSION_SESSION_RATE = float(os.getenv("ADMISSION_SESSION_RATE", "0.5"))
+ADMISSION_SESSION_BURST = float(os.getenv("ADMISSION_SESSION_BURST", "5"))
+ADMISSION_IP_RATE = float(os.getenv("ADMISSION_IP_RATE", "5"))
+ADMISSION_IP_BURST = float(os.getenv("ADMISSION_IP_BURST", "30"))
+# Requests inside the handlers at once, requests allowed to wait for a slot, and how long they wait
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "16"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "32"))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "5"))
+# "memory" (per process) or "sqlite" (ADMISSION_SQLITE_PATH, shared by the workers on one host;
+# data/ is git-ignored)
+ADMISSION_STATE = os.getenv("ADMISSION_STATE", "memory")
+ADMISSION_SQLITE_PATH = os.getenv("ADMISSION_SQLITE_PATH", "data/admission.sqlite3")
+# Take the client IP from X-Forwarded-For (only behind a proxy that sets it)
+ADMISSION_TRUST_PROXY = os.getenv("ADMISSION_TRUST_PROXY", "0") == "1"
+
+REJECTIONS = metrics.Counter(
+    "serenity_admission_rejections_total", "Chat requests turned away by admission control.", ("reason",))
+WAIT_SECONDS = metrics.Histogram(
+    "serenity_admission_wait_seconds", "Time admitted chat requests waited for an in-flight slot.")
+
+
+# --- 2. Token buckets ---
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+def _retry_after(tokens, rate):
+    """ Seconds until a bucket holding `tokens` has a whole token again. """
+    return (1.0 - tokens) / rate if rate > 0 else 3600.0
+
+
+class MemoryBuckets:
+    """ Token buckets in a dict, bounded by evicting the least recently used keys. """
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> [tokens, updated]
+        self._lock = threading.Lock()
+
+    def _bucket(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)  # Idle long enough to be full again, most likely
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = _refill(bucket[0], bucket[1], now, rate, burst)
+            bucket[1] = now
+        return bucket
+
+    def take(self, limits, now=None):
+        """
+        Takes one token from every (key, rate, burst) bucket in `limits`, or
+        from none of them: returns None, or (index of the first empty bucket,
+        seconds until it has a token again).
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            buckets = [self._bucket(key, rate, burst, now) for key, rate, burst in limits]
+            for index, (bucket, (_, rate, _)) in enumerate(zip(buckets, limits)):
+                if bucket[0] < 1.0:
+                    return index, _retry_after(bucket[0], rate)
+            for bucket in buckets:
+                bucket[0] -= 1.0
+            return None
+
+
+class SQLiteBuckets:
+    """
+    Token buckets in a SQLite table, so every worker process on the host
+    draws from the same buckets. Each take() is one short IMMEDIATE
+    transaction over all of its buckets; rows idle for an hour are purged now and then.
+    """
+
+    PURGE_EVERY = 1000
+    IDLE_SECONDS = 3600
+
+    def __init__(self, path=ADMISSION_SQLITE_PATH):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._connect().execute(
+            "CREATE TABLE IF NOT EXISTS admission_buckets ("
+            "key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL) WITHOUT ROWID"
+        )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")  # Losing buckets in a power cut only resets limits
+            self._local.conn = conn
+        return conn
+
+    def take(self, limits, now=None):
+        """ Same contract as MemoryBuckets.take. """
+        now = time.time() if now is None else now  # Wall clock: shared between processes
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            levels = []
+            for index, (key, rate, burst) in enumerate(limits):
+                row = conn.execute("SELECT tokens, updated FROM admission_buckets WHERE key = ?", (key,)).fetchone()
+                tokens = burst if row is None else _refill(row[0], row[1], now, rate, burst)
+                if tokens < 1.0:
+                    # Nothing is written: a refill is recomputed from the stored level next time
+                    conn.execute("COMMIT")
+                    return index, _retry_after(tokens, rate)
+                levels.append((key, tokens - 1.0, now))
+            conn.executemany(
+                "INSERT INTO admission_buckets (key, tokens, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated",
+                levels,
+            )
+            self._takes += 1
+            if self._takes % self.PURGE_EVERY == 0:
+                conn.execute("DELETE FROM admission_buckets WHERE updated < ?", (now - self.IDLE_SECONDS,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return None
+
+
+def make_buckets(state=ADMISSION_STATE):
+    if state == "sqlite":
+        return SQLiteBuckets()
+    if state != "memory":
+        print(f"--- Unknown ADMISSION_STATE {state!r}; using in-memory buckets ---")
+    return MemoryBuckets()
+
+
+# --- 3. Concurrency gate ---
+
+class ConcurrencyGate:
+    """
+    At most `max_in_flight` holders at once; up to `max_queue` more wait (for
+    at most `timeout` seconds) and the rest are refused immediately.
+    """
+
+    def __init__(self, max_in_flight=ADMISSION_MAX_IN_FLIGHT, max_queue=ADMISSION_MAX_QUEUE,
+                 timeout=ADMISSION_QUEUE_TIMEOUT_SECONDS):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._cond = threading.Condition()
+        # Moving average of how long a slot is held, for Retry-After
+        self.hold_seconds = 1.0
+
+    def acquire(self):
+        """ "ok", "queue_full" or "queue_timeout". """
+        with self._cond:
+            if self.in_flight < self.max_in_flight and not self.waiting:
+                self.in_flight += 1
+                return "ok"
+            if self.waiting >= self.max_queue:
+                return "queue_full"
+            self.waiting += 1
+            started = time.monotonic()
+            try:
+                admitted = self._cond.wait_for(lambda: self.in_flight < self.max_in_flight, self.timeout)
+            finally:
+                self.waiting -= 1
+            if not admitted:
+                return "queue_timeout"
+            self.in_flight += 1
+        WAIT_SECONDS.observe(time.monotonic() - started)
+        return "ok"
+
+    def release(self, held_seconds=None):
+        with self._cond:
+            self.in_flight -= 1
+            if held_seconds is not None:
+                self.hold_seconds += 0.1 * (held_seconds - self.hold_seconds)
+            self._cond.notify()
+
+    def retry_after(self):
+        """ Rough seconds until the queue ahead of a new request has drained. """
+        return self.hold_seconds * (self.waiting + 1) / max(1, self.max_in_flight)
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "hold_seconds": round(self.hold_seconds, 3),
+        }
+
+
+# --- 4. Admission ---
+
+class AdmissionController:
+    """ Buckets plus gate. admit() returns None (admitted; call release() when done) or (reason, retry_after). """
+
+    def __init__(self, buckets=None, gate=None,
+                 session_limit=(ADMISSION_SESSION_RATE, ADMISSION_SESSION_BURST),
+                 ip_limit=(ADMISSION_IP_RATE, ADMISSION_IP_BURST)):
+        self.buckets = buckets or make_buckets()
+        self.gate = gate or ConcurrencyGate()
+        self.session_limit = session_limit
+        self.ip_limit = ip_limit
+        self.admitted = 0
+        self.rejected = {}
+        self._lock = threading.Lock()
+
+    def admit(self, session_id=None, ip=None):
+        # Both buckets are checked before either is drawn from, so a request
+        # the session limit turns away doesn't use up the IP's tokens
+        reasons, limits = [], []
+        if ip:
+            reasons.append("ip")
+            limits.append((f"ip:{ip}",) + tuple(self.ip_limit))
+        if session_id:
+            reasons.append("session")
+            limits.append((f"session:{session_id}",) + tuple(self.session_limit))
+        refused = self.buckets.take(limits) if limits else None
+        if refused is not None:
+            index, wait = refused
+            return self._reject(reasons[index], wait)
+        outcome = self.gate.acquire()
+        if outcome != "ok":
+            return self._reject(outcome, self.gate.retry_after())
+        with self._lock:
+            self.admitted += 1
+        return None
+
+    def release(self, held_seconds=None):
+        self.gate.release(held_seconds)
+
+    def _reject(self, reason, retry_after):
+        with self._lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        REJECTIONS.inc(reason=reason)
+        return reason, max(1, math.ceil(retry_after))
+
+    def stats(self):
+        with self._lock:
+            counters = {"admitted": self.admitted, "rejected": dict(self.rejected)}
+        return {**counters, **self.gate.stats()}
+
+
+MESSAGES = {
+    "session": "Too many messages in a short time. Please wait a moment before sending another.",
+    "ip": "Too many requests from this address. Please wait a moment and try again.",
+    "queue_full": "Serenity is very busy right now. Please try again in a moment.",
+    "queue_timeout": "Serenity is very busy right now. Please try again in a moment.",
+}
+
+
+def crisis_reply(path, session_id=None):
+    """
+    (body, mimetype) of the canned safety reply in the shape `path` answers
+    with: the JSON of /chat, or the token and done events of a streaming path.
+    """
+    from crisis_screen import SAFETY_RESPONSE
+    from mood_classifier import DISTRESS
+    if path.endswith("/stream"):
+        events = [("token", {"token": SAFETY_RESPONSE}), ("done", {"mood": DISTRESS, "session_id": session_id})]
+        return "".join(f"event: {event}\ndata: {json.dumps(data)}\n\n" for event, data in events), "text/event-stream"
+    return json.dumps({"response": SAFETY_RESPONSE, "mood": DISTRESS, "session_id": session_id}), "application/json"
+
+
+def client_ip(request):
+    """ Remote address of a Flask request, or the first X-Forwarded-For hop behind a trusted proxy. """
+    if ADMISSION_TRUST_PROXY:
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.remote_addr
+
+
+def init_flask(app, controller=None):
+    """
+    Guards ADMISSION_PATHS of a Flask app. The in-flight slot is released in
+    teardown, which for a stream_with_context response is when the stream ends.
+    Prompts the crisis screen would flag are never turned away: over a limit
+    they get crisis_reply() instead of a 429.
+    """
+    if not ADMISSION:
+        return None
+    from flask import Response, g, jsonify, request
+    import crisis_screen
+
+    controller = controller or AdmissionController()
+    metrics.register_stats("admission", controller.stats)
+
+    @app.before_request
+    def _admission_check():
+        if request.path not in ADMISSION_PATHS or request.method != "POST":
+            return None
+        data = request.get_json(silent=True) or {}
+        prompt = data.get("prompt")
+        session_id = data.get("session_id")
+        session_id = session_id if isinstance(session_id, str) else None
+        rejection = controller.admit(session_id, client_ip(request))
+        if rejection is not None:
+            if isinstance(prompt, str) and crisis_screen.matches(prompt):
+                body, mimetype = crisis_reply(request.path, session_id)
+                return Response(body, mimetype=mimetype)
+            reason, retry_after = rejection
+            return jsonify({"error": MESSAGES[reason], "reason": reason}), 429, {"Retry-After": str(retry_after)}
+        g.admission_started = time.monotonic()
+        return None
+
+    @app.teardown_request
+    def _admission_release(exc):
+        started = g.pop("admission_started", None)
+        if started is not None:
+            controller.release(time.monotonic() - started)
+
+    return controller
@@ -0,0 +1,446 @@
+import os
+import sys
+import json
+import gzip
+import math
+import time
+import array
+import sqlite3
+import argparse
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+import history_codec
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    PYARROW_AVAILABLE = True
+except ImportError:
+    PYARROW_AVAILABLE = False
+
+try:
+    import numpy
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# Offline reporting across all users: mood distribution, session lengths and
+# escalation rates. Users are read either from Firestore (cursor-paginated
+# user documents, and each user's mood_logs in pages) or from a local export
+# file written by --export, one JSON record per user. Records are cut into
+# chunks and summarised in a process pool; at most two chunks per worker are
+# in flight, so memory stays flat however many users there are. Output is
+# one row per user in columnar form (Parquet with pyarrow, .npz with numpy,
+# otherwise one typed binary file per column) plus summary.json.
+# Message contents are never read or exported, only counts and moods.
+#
+#   python analytics.py --export users.jsonl.gz              # Firestore -> export file
+#   python analytics.py --input users.jsonl.gz --out report  # export file -> report/
+#   python analytics.py --out report --workers 8             # straight from Firestore
+
+MOODS = ("happy", "sad", "anxious", "seeking_community", "serious_distress")
+ESCALATION_MOOD = "serious_distress"
+
+# (column, typecode): array module typecodes; "str" columns are stored as offsets + UTF-8 bytes
+COLUMNS = (
+    [("user_id", "str"), ("created_at", "d"), ("message_count", "q"), ("sessions_completed", "q"),
+     ("days_active", "q"), ("mood_logs", "q")]
+    + [(f"mood_{mood}", "i") for mood in MOODS]
+    + [("mood_other", "i"), ("first_mood_at", "d"), ("last_mood_at", "d"), ("escalated", "b"),
+       ("crisis_escalations", "i")]
+)
+_NUMPY_TYPES = {"d": "float64", "q": "int64", "i": "int32", "b": "int8"}
+
+# User document fields kept in a record (everything else, e.g. chat_history, is dropped)
+USER_FIELDS = ("created_at", "message_count", "sessions_completed", "days_active", "mood_counts")
+
+
+# --- 1. Sources ---
+
+def _epoch(value):
+    """ Seconds since the epoch from a Firestore timestamp, datetime, ISO string or number; None if unknown. """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+def iter_mood_logs(user_ref, page_size):
+    """ Streams a user's mood logs oldest first, one cursor-paginated page at a time. """
+    query = user_ref.collection('mood_logs').order_by('timestamp').limit(page_size)
+    last_doc = None
+    while True:
+        docs = list((query.start_after(last_doc) if last_doc else query).stream())
+        yield from docs
+        if len(docs) < page_size:
+            return
+        last_doc = docs[-1]
+
+
+def user_record(doc, mood_logs=None):
+    """ Export record for one user document: selected fields and, if read, its mood logs as [mood, epoch]. """
+    data = doc.to_dict() or {}
+    fields = {key: data[key] for key in USER_FIELDS if key in data}
+    if 'message_count' not in fields:
+        fields['message_count'] = history_codec.stored_count(data)  # Array or packed layout
+    fields['created_at'] = _epoch(fields.get('created_at'))
+    record = {"id": doc.id, "data": fields}
+    if mood_logs is not None:
+        record["mood_logs"] = [
+            [log.get('mood'), _epoch(log.get('timestamp'))] for log in (d.to_dict() or {} for d in mood_logs)
+        ]
+    return record
+
+
+def firestore_records(db, page_size, mood_source="logs", fetch_threads=8):
+    """
+    Streams user records from Firestore. Mood logs of each page of users are
+    fetched by a small thread pool, since each user costs one round-trip or more.
+    With mood_source="counters" the subcollections are skipped and the mood
+    counters on the user documents are used instead.
+    """
+    from migrate_history import iter_user_docs
+
+    with ThreadPoolExecutor(max_workers=fetch_threads, thread_name_prefix="serenity-analytics") as pool:
+        for page in chunked(iter_user_docs(db, page_size), page_size):
+            if mood_source == "counters":
+                yield from (user_record(doc) for doc in page)
+                continue
+            logs = pool.map(lambda doc: list(iter_mood_logs(doc.reference, page_size)), page)
+            yield from (user_record(doc, doc_logs) for doc, doc_logs in zip(page, logs))
+
+
+def file_records(path):
+    """ Lines of an export file (JSON Lines, gzipped if the name ends in .gz), left unparsed for the workers. """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def write_export(records, path):
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "wt", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            count += 1
+    return count
+
+
+# --- 2. Per-user rows (run in the worker processes) ---
+
+def user_row(record):
+    data = record.get("data") or {}
+    logs = record.get("mood_logs")
+    counts = dict.fromkeys(MOODS, 0)
+    other = 0
+    first = last = math.nan
+    if logs is None:
+        # Counters only: no per-log timestamps
+        for mood, count in (data.get("mood_counts") or {}).items():
+            if mood in counts:
+                counts[mood] += count
+            else:
+                other += count
+        total = sum(counts.values()) + other
+    else:
+        total = len(logs)
+        for mood, at in logs:
+            if mood in counts:
+                counts[mood] += 1
+            else:
+                other += 1
+            if at is not None:
+                first = at if math.isnan(first) else min(first, at)
+                last = at if math.isnan(last) else max(last, at)
+    created_at = data.get("created_at")
+    return (
+        [record.get("id", ""), math.nan if created_at is None else float(created_at),
+         int(data.get("message_count") or 0), int(data.get("sessions_completed") or 0),
+         int(data.get("days_active") or 0), total]
+        + [counts[mood] for mood in MOODS]
+        + [other, first, last, 1 if counts[ESCALATION_MOOD] else 0, 0]
+    )
+
+
+def summarize_chunk(items):
+    """ Column lists for a chunk of records (dicts, or export lines still to be parsed). """
+    columns = [[] for _ in COLUMNS]
+    for item in items:
+        row = user_row(json.loads(item) if isinstance(item, str) else item)
+        for column, value in zip(columns, row):
+            column.append(value)
+    return columns
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run(records, workers, chunk_size, consume):
+    """
+    Summarises `records` chunk by chunk and hands each chunk's columns to
+    `consume`, in input order. workers=0 runs in this process; otherwise at
+    most 2 * workers chunks are queued at a time.
+    """
+    chunks = chunked(records, chunk_size)
+    if workers <= 0:
+        for chunk in chunks:
+            consume(summarize_chunk(chunk))
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.submit(summarize_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                consume(pending.popleft().result())
+        while pending:
+            consume(pending.popleft().result())
+
+
+# --- 3. Columnar output ---
+
+class ColumnWriter:
+    """
+    Accumulates chunks as typed arrays (8 bytes or less per value) and writes
+    them at close: Parquet, .npz, or one binary file per column ("columns":
+    native-endian array data plus schema.json; strings as int64 offsets + UTF-8).
+    Parquet and "columns" are written incrementally, so only .npz holds every row.
+    """
+
+    ROW_GROUP = 65536
+
+    def __init__(self, out_dir, fmt):
+        self.out_dir = out_dir
+        self.format = fmt
+        self.rows = 0
+        os.makedirs(out_dir, exist_ok=True)
+        self._buffer = self._empty()
+        self._parquet = None
+        self._files = None
+        if fmt == "columns":
+            self._files = {name: open(os.path.join(out_dir, f"{name}.bin"), "wb") for name, _ in COLUMNS}
+            self._offsets = open(os.path.join(out_dir, "user_id.offsets"), "wb")
+            self._bytes = 0
+            array.array("q", [0]).tofile(self._offsets)
+
+    @staticmethod
+    def _empty():
+        return [[] if code == "str" else array.array(code) for _, code in COLUMNS]
+
+    def add(self, columns):
+        for buffered, values in zip(self._buffer, columns):
+            buffered.extend(values)
+        self.rows += len(columns[0])
+        if self.format != "npz" and len(self._buffer[0]) >= self.ROW_GROUP:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer[0]:
+            return
+        if self.format == "parquet":
+            table = pyarrow.table({
+                name: pyarrow.array(values, type=pyarrow.string() if code == "str" else _NUMPY_TYPES[code])
+                for (name, code), values in zip(COLUMNS, self._buffer)
+            })
+            if self._parquet is None:
+                self._parquet = pyarrow.parquet.ParquetWriter(os.path.join(self.out_dir, "users.parquet"), table.schema)
+            self._parquet.write_table(table)
+        elif self.format == "columns":
+            for (name, code), values in zip(COLUMNS, self._buffer):
+                if code != "str":
+                    values.tofile(self._files[name])
+                    continue
+                offsets = array.array("q")
+                for value in values:
+                    encoded = value.encode("utf-8")
+                    self._files[name].write(encoded)
+                    self._bytes += len(encoded)
+                    offsets.append(self._bytes)
+                offsets.tofile(self._offsets)
+        self._buffer = self._empty()
+
+    def close(self):
+        """ Writes what is left; returns the paths written. """
+        if self.format == "npz":
+            path = os.path.join(self.out_dir, "users.npz")
+            numpy.savez(path, **{
+                name: numpy.array(values, dtype=object if code == "str" else None).astype(
+                    "U" if code == "str" else _NUMPY_TYPES[code])
+                for (name, code), values in zip(COLUMNS, self._buffer)
+            })
+            return [path]
+        self._flush()
+        if self.format == "parquet":
+            if self._parquet is not None:
+                self._parquet.close()
+            return [os.path.join(self.out_dir, "users.parquet")]
+        for f in list(self._files.values()) + [self._offsets]:
+            f.close()
+        schema = {
+            "rows": self.rows, "byteorder": sys.byteorder,
+            "columns": [{"name": name, "type": code if code == "str" else _NUMPY_TYPES[code],
+                         "file": f"{name}.bin", **({"offsets": "user_id.offsets"} if code == "str" else {})}
+                        for name, code in COLUMNS],
+        }
+        path = os.path.join(self.out_dir, "schema.json")
+        with open(path, "w") as f:
+            json.dump(schema, f, indent=2)
+        return [path] + [os.path.join(self.out_dir, f"{name}.bin") for name, _ in COLUMNS]
+
+
+def default_format():
+    return "parquet" if PYARROW_AVAILABLE else "npz" if NUMPY_AVAILABLE else "columns"
+
+
+# --- 4. Summary ---
+
+def _percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0
+
+
+class Summary:
+    """ Running totals over the chunks; session lengths are kept as one int64 array for the percentiles. """
+
+    def __init__(self, crisis_counts=None):
+        self.index = {name: i for i, (name, _) in enumerate(COLUMNS)}
+        self.crisis_counts = crisis_counts or {}
+        self.users = 0
+        self.users_with_moods = 0
+        self.escalated = 0
+        self.crisis_users = 0
+        self.mood_totals = dict.fromkeys(MOODS + ("other",), 0)
+        self.session_lengths = array.array("q")
+
+    def add(self, columns):
+        """ Folds one chunk in (filling crisis_escalations from the escalation log first). """
+        named = dict(zip(self.index, columns))
+        if self.crisis_counts:
+            crisis = named["crisis_escalations"]
+            for i, user_id in enumerate(named["user_id"]):
+                crisis[i] = self.crisis_counts.get(user_id, 0)
+                if crisis[i]:
+                    self.crisis_users += 1
+        self.users += len(named["user_id"])
+        self.users_with_moods += sum(1 for count in named["mood_logs"] if count)
+        self.escalated += sum(named["escalated"])
+        for mood in self.mood_totals:
+            self.mood_totals[mood] += sum(named[f"mood_{mood}"])
+        self.session_lengths.extend(named["message_count"])
+
+    def result(self, elapsed):
+        lengths = sorted(self.session_lengths)
+        logs = sum(self.mood_totals.values())
+        return {
+            "users": self.users,
+            "users_with_mood_logs": self.users_with_moods,
+            "messages": sum(lengths),
+            "session_length": {
+                "mean": round(sum(lengths) / len(lengths), 2) if lengths else 0,
+                "p50": _percentile(lengths, 0.5), "p90": _percentile(lengths, 0.9),
+                "p99": _percentile(lengths, 0.99), "max": lengths[-1] if lengths else 0,
+            },
+            "mood_logs": logs,
+            "mood_distribution": {mood: round(count / logs, 4) if logs else 0.0 for mood, count in self.mood_totals.items()},
+            "mood_counts": self.mood_totals,
+            "escalation": {
+                "users": self.escalated,
+                "rate": round(self.escalated / self.users, 4) if self.users else 0.0,
+                "rate_among_mood_users": round(self.escalated / self.users_with_moods, 4) if self.users_with_moods else 0.0,
+                "crisis_screen_users": self.crisis_users,
+            },
+            "elapsed_seconds": round(elapsed, 3),
+            "users_per_second": round(self.users / elapsed) if elapsed else None,
+        }
+
+
+def load_crisis_counts(path):
+    """ session_id -> crisis screen hits, from crisis_screen's escalation log. """
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        return dict(conn.execute("SELECT session_id, COUNT(*) FROM escalations GROUP BY session_id"))
+    finally:
+        conn.close()
+
+
+# --- 5. CLI ---
+
+def analyze(records, out_dir, fmt=None, workers=None, chunk_size=1000, crisis_counts=None):
+    """ Runs the pipeline; returns the summary (also written to out_dir/summary.json). """
+    fmt = fmt or default_format()
+    workers = (os.cpu_count() or 1) if workers is None else workers
+    writer = ColumnWriter(out_dir, fmt)
+    summary = Summary(crisis_counts)
+    started = time.perf_counter()
+
+    def consume(columns):
+        summary.add(columns)
+        writer.add(columns)
+
+    run(records, workers, chunk_size, consume)
+    paths = writer.close()
+    result = summary.result(time.perf_counter() - started)
+    result.update(format=fmt, workers=workers, outputs=paths)
+    with open(os.path.join(out_dir, "summary.json"), "w") as f:
+        json.dump(result, f, indent=2)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mood distribution, session lengths and escalation rates across all users.")
+    parser.add_argument("--input", help="export file (JSON Lines, .gz ok) instead of reading Firestore")
+    parser.add_argument("--export", metavar="PATH", help="write the Firestore users to an export file and stop")
+    parser.add_argument("--out", default="analytics_out", help="output directory")
+    parser.add_argument("--format", choices=("parquet", "npz", "columns"), default=None,
+                        help=f"columnar output (default: {default_format()})")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (0: in this process; default: CPUs)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="users per work chunk")
+    parser.add_argument("--page-size", type=int, default=200, help="Firestore documents read per page")
+    parser.add_argument("--mood-source", choices=("logs", "counters"), default="logs",
+                        help="read mood_logs subcollections, or only the mood counters on user documents")
+    parser.add_argument("--escalation-log", help="crisis screen escalation log (SQLite) to join in")
+    args = parser.parse_args()
+
+    if args.format == "parquet" and not PYARROW_AVAILABLE or args.format == "npz" and not NUMPY_AVAILABLE:
+        raise SystemExit(f"--format {args.format} needs {'pyarrow' if args.format == 'parquet' else 'numpy'}.")
+
+    if args.input:
+        records = file_records(args.input)
+    else:
+        import firestore_db
+        db = firestore_db.init_db()
+        if db is None:
+            raise SystemExit("Could not connect to Firestore.")
+        records = firestore_records(db, args.page_size, args.mood_source)
+
+    if args.export:
+        count = write_export(records, args.export)
+        print(f"--- Exported {count} users to {args.export} ---")
+        return
+
+    crisis_counts = load_crisis_counts(args.escalation_log) if args.escalation_log else None
+    result = analyze(records, args.out, args.format, args.workers, args.chunk_size, crisis_counts)
+    print(f"--- Analysed {result['users']} users in {result['elapsed_seconds']}s "
+          f"({result['users_per_second']} users/s); report in {args.out}/ ---")
+    print(json.dumps({key: result[key] for key in ("session_length", "mood_distribution", "escalation")}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,25 @@
-from flask import Flask, request, jsonify
+import os
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from bot import get_response
-from firestore_db import init_db, get_or_create_user, get_chat_history, save_chat_history, add_mood_log
+if os.getenv("CHAT_BACKEND", "local") == "api":
+    # Hugging Face Inference API instead of the local Phi-3 model (see llm_service.py)
+    from llm_service import get_response, stream_response, format_sse, summarize_history, is_fallback_reply
+else:
+    from bot import get_response, stream_response, format_sse, summarize_history, is_fallback_reply
+from context_builder import schedule_summary_fold
+from firestore_db import init_db, ChatTurnRepository
+import admission
+import metrics
+import write_behind
 
 # Initialize our Flask app and the database
 app = Flask(__name__)
 CORS(app)  # This allows your HTML/JS front-end to talk to this server
+metrics.init_flask(app)  # Request IDs, Server-Timing and GET /metrics
+admission.init_flask(app)  # Per-session and per-IP rate limits and the in-flight cap on /chat
 db = init_db()
+# Turns are saved to Firestore in the background once the reply is ready
+persistence = write_behind.get_queue(db)
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -17,33 +30,81 @@ def chat():
     """
     try:
         # Get data from the front-end's request
-        data = request.get_json()
-        prompt = data.get('prompt')
-        session_id = data.get('session_id')
+        with metrics.span("parse"):
+            data = request.get_json()
+            prompt = data.get('prompt')
+            session_id = data.get('session_id')
         
         if not prompt or not session_id:
             return jsonify({"error": "Prompt and session_id are required."}), 400
 
-        # Use our existing database and bot logic
-        user_ref = get_or_create_user(db, session_id)
-        history = get_chat_history(user_ref)
+        # Load the user and recent history in one pass
+        turn = ChatTurnRepository(db, session_id)
+        history = persistence.load(turn)
         
-        mood, response, updated_history = get_response(prompt, history)
+        usage = {}
+        mood, response, updated_history = get_response(prompt, history, summary=turn.summary, usage=usage, session_id=session_id)
         
-        # Save the new conversation turn and mood log
-        save_chat_history(user_ref, updated_history)
-        add_mood_log(user_ref, mood)
+        # Queue the new conversation turn and mood log; they go out in a single batched write.
+        # A canned fallback (model offline or timed out) isn't saved.
+        if not is_fallback_reply(response):
+            persistence.commit(turn, updated_history[-2:], mood)
+            schedule_summary_fold(turn, updated_history, usage.get('dropped_messages', 0), summarize_history)
         
-        # Send the bot's response and the detected mood back to the front-end
+        # Send the bot's response, the detected mood and prompt token usage back to the front-end
         return jsonify({
             "response": response,
-            "mood": mood
+            "mood": mood,
+            "usage": usage
         })
 
     except Exception as e:
         print(f"--- API Error: {e} ---")
         return jsonify({"error": "An internal server error occurred."}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """
+    Streaming variant of /chat. Tokens are forwarded as Server-Sent Events as
+    soon as the bot produces them; history and the mood log are saved once the
+    reply is complete, just before the final `done` event.
+    """
+    try:
+        with metrics.span("parse"):
+            data = request.get_json()
+            prompt = data.get('prompt')
+            session_id = data.get('session_id')
+
+        if not prompt or not session_id:
+            return jsonify({"error": "Prompt and session_id are required."}), 400
+
+        turn = ChatTurnRepository(db, session_id)
+        history = persistence.load(turn)
+
+    except Exception as e:
+        print(f"--- API Error: {e} ---")
+        return jsonify({"error": "An internal server error occurred."}), 500
+
+    def generate():
+        try:
+            usage = {}
+            for event in stream_response(prompt, history, turn.summary, usage, session_id):
+                if "token" in event:
+                    yield format_sse("token", {"token": event["token"]})
+                else:
+                    if not is_fallback_reply(event["response"]):
+                        persistence.commit(turn, history[-2:], event["mood"])
+                        schedule_summary_fold(turn, history, usage.get('dropped_messages', 0), summarize_history)
+                    yield format_sse("done", {"mood": event["mood"], "usage": usage})
+        except Exception as e:
+            print(f"--- API Stream Error: {e} ---")
+            yield format_sse("error", {"error": "An internal server error occurred."})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 if __name__ == '__main__':
     # Run the API server with debug mode OFF to prevent double-loading the model
     app.run(port=5000, debug=False)
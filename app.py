@@ -1,25 +1,43 @@
-from flask import Flask, render_template, request, jsonify
-import requests
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import json
 import time
 import random
 import os
-from typing import Dict, List
+from typing import Dict, List, Tuple
+from inference_client import get_client
+import crisis_screen
+import metrics
+from mood_lexicon import MoodLexicon
+from suggestions import SuggestionEngine, OPENING
+from conversation_store import ConversationStore, CONVERSATION_STORE
 
 app = Flask(__name__)
+metrics.init_flask(app)  # Request IDs, Server-Timing and GET /metrics
 
 class MentalHealthChatbot:
-    def __init__(self, huggingface_api_key: str):
+    # Moods that get a coping suggestion with the reply
+    SUGGESTION_MOODS = frozenset(['stressed', 'sad', 'angry'])
+
+    def __init__(self, huggingface_api_key: str, api_url: str = None):
         self.api_key = huggingface_api_key
-        self.api_url = "https://api-inference.huggingface.co/models/microsoft/DialoGPT-large"
-        self.headers = {"Authorization": f"Bearer {self.api_key}"}
+        self.api_url = api_url or "https://api-inference.huggingface.co/models/microsoft/DialoGPT-large"
+        # Pooled keep-alive session shared with the rest of the process
+        self.client = get_client(self.api_key)
         
+        # Weighted mood terms (a trailing * matches any ending), compiled once into one matcher
         self.user_mood_indicators = {
-            'stress_keywords': ['stress', 'stressed', 'overwhelmed', 'pressure', 'anxious', 'anxiety', 'worried', 'nervous'],
-            'sad_keywords': ['sad', 'depressed', 'unhappy', 'miserable', 'hopeless', 'empty', 'lonely', 'down'],
-            'anger_keywords': ['angry', 'mad', 'furious', 'irritated', 'frustrated', 'annoyed'],
-            'calm_keywords': ['better', 'good', 'calm', 'peaceful', 'relaxed', 'happy', 'great', 'fine']
+            'stressed': {'stress*': 1.0, 'overwhelmed': 1.5, 'pressure': 1.0, 'anxious': 1.5, 'anxiety': 1.5,
+                         'worried': 1.0, 'nervous': 1.0, 'panic*': 1.5},
+            'sad': {'sad': 1.0, 'depressed': 1.5, 'unhappy': 1.0, 'miserable': 1.5, 'hopeless': 1.5,
+                    'empty': 1.0, 'lonely': 1.0, 'down': 0.5},
+            'angry': {'angry': 1.0, 'mad': 1.0, 'furious': 1.5, 'irritated': 1.0, 'frustrat*': 1.0, 'annoyed': 1.0},
+            'calm': {'better': 0.5, 'good': 0.5, 'calm*': 1.0, 'peaceful': 1.0, 'relaxed': 1.0, 'happy': 1.0,
+                     'great': 1.0, 'fine': 0.5}
         }
+        self.mood_lexicon = MoodLexicon(self.user_mood_indicators)
+
+        # Openings and coping suggestions, loaded once from suggestions.json (reloaded when it changes)
+        self.suggestions = SuggestionEngine()
         
         # Fallback responses for when API is unavailable
         self.fallback_responses = [
@@ -30,11 +48,11 @@ class MentalHealthChatbot:
             "I'm listening carefully. Please continue when you feel comfortable."
         ]
 
-    def query_huggingface(self, user_input: str, conversation_history: list) -> str:
-        """Send query to Hugging Face API and get response"""
+    def query_huggingface(self, user_input: str, conversation_history: list) -> Tuple[str, bool]:
+        """Send query to Hugging Face API; returns the reply and whether the model wrote it (False for a fallback)"""
         try:
             if not self.api_key or self.api_key == "dummy_key":
-                return random.choice(self.fallback_responses)
+                return random.choice(self.fallback_responses), False
                 
             # Prepare conversation context
             past_user_inputs = [msg['user'] for msg in conversation_history[-4:] if msg['user']]
@@ -48,104 +66,49 @@ class MentalHealthChatbot:
                 }
             }
             
-            response = requests.post(self.api_url, headers=self.headers, json=payload, timeout=10)
+            # Once the client's circuit breaker opens this raises immediately,
+            # and the except below switches to the fallback responses.
+            response = self.client.post(self.api_url, payload, timeout=10)
             
             if response.status_code == 200:
                 result = response.json()
                 if isinstance(result, list) and len(result) > 0:
-                    return result[0]['generated_text']
+                    return result[0]['generated_text'], True
             
-            return random.choice(self.fallback_responses)
+            return random.choice(self.fallback_responses), False
             
         except Exception as e:
             print(f"API Error: {e}")
-            return random.choice(self.fallback_responses)
+            return random.choice(self.fallback_responses), False
 
     def analyze_user_mood(self, user_input: str) -> str:
         """Analyze user input to detect mood and emotional state"""
-        input_lower = user_input.lower()
-        
-        # Count keyword occurrences
-        stress_count = sum(1 for word in self.user_mood_indicators['stress_keywords'] if word in input_lower)
-        sad_count = sum(1 for word in self.user_mood_indicators['sad_keywords'] if word in input_lower)
-        anger_count = sum(1 for word in self.user_mood_indicators['anger_keywords'] if word in input_lower)
-        calm_count = sum(1 for word in self.user_mood_indicators['calm_keywords'] if word in input_lower)
-        
-        # Determine predominant mood
-        mood_scores = {
-            'stressed': stress_count,
-            'sad': sad_count,
-            'angry': anger_count,
-            'calm': calm_count
-        }
-        
-        predominant_mood = max(mood_scores, key=mood_scores.get)
-        
-        # Only return mood if significant indicators found
-        if mood_scores[predominant_mood] > 0:
-            return predominant_mood
-        return "neutral"
+        # One pass scores every mood; "neutral" when no (un-negated) indicator is found
+        return self.mood_lexicon.classify(user_input)
+
+    def analyze_user_moods(self, user_inputs: List[str]) -> List[str]:
+        """analyze_user_mood for a list of messages at once (offline analytics)"""
+        return self.mood_lexicon.classify_batch(user_inputs)
 
     def get_coping_suggestions(self, mood: str) -> List[str]:
         """Provide appropriate coping suggestions based on detected mood"""
-        suggestions = {
-            'stressed': [
-                "Let's try some deep breathing together. Breathe in slowly for 4 counts, hold for 4, exhale for 6.",
-                "Would you like to try a quick mindfulness exercise? Focus on 5 things you can see around you.",
-                "Sometimes breaking tasks into smaller steps can help reduce feeling overwhelmed.",
-                "A short walk in nature can do wonders for stress relief. Even 5 minutes can help.",
-                "Try placing a hand on your chest and taking three slow, deep breaths."
-            ],
-            'sad': [
-                "It's okay to feel sad. Would you like to share what's on your mind?",
-                "Listening to calming music or a favorite podcast might help lift your spirits.",
-                "Remember to be kind to yourself. You're doing the best you can.",
-                "Sometimes writing down thoughts in a journal can help process emotions.",
-                "A warm cup of tea and some gentle stretching might bring some comfort."
-            ],
-            'angry': [
-                "Let's pause for a moment. Count slowly to 10 and take some deep breaths.",
-                "Physical activity like stretching or walking can help release angry energy.",
-                "Try the 5-4-3-2-1 technique: notice 5 things you see, 4 you feel, 3 you hear, 2 you smell, 1 you taste.",
-                "Expressing your feelings through writing might help organize your thoughts.",
-                "Splash some cool water on your face and take a moment to regroup."
-            ],
-            'neutral': [
-                "I'm glad you're checking in with yourself. Maintaining this balance is wonderful.",
-                "Regular mindfulness practice can help maintain emotional equilibrium.",
-                "Remember to take breaks throughout your day for self-care.",
-                "Staying connected with supportive people can help maintain this positive state."
-            ],
-            'calm': [
-                "It's wonderful that you're feeling calm. Enjoy this peaceful moment.",
-                "This is a great time to practice gratitude or meditation.",
-                "Your calm state is something to cherish. Perhaps share what helped you reach this peace?",
-                "Consider using this peaceful time for some gentle reflection or creative expression."
-            ]
-        }
-        return suggestions.get(mood, suggestions['neutral'])
+        return list(self.suggestions.suggestions(mood))
 
-    def format_response(self, ai_response: str, mood: str, user_input: str) -> Dict:
+    def choose_opening(self, session_id: str = None) -> str:
+        """Pick a polite and calm opening phrase, not one this session just saw"""
+        return self.suggestions.pick(OPENING, session_id)
+
+    def format_response(self, ai_response: str, mood: str, user_input: str, opening: str = None,
+                        session_id: str = None) -> Dict:
         """Format the response with appropriate tone and suggestions"""
         
-        # Polite and calm opening phrases
-        calm_openings = [
-            "I understand...",
-            "Thank you for sharing...",
-            "I hear what you're saying...",
-            "That sounds challenging...",
-            "I appreciate you telling me this...",
-            "It takes courage to share that..."
-        ]
-        
         # Build response
-        formatted_response = f"{random.choice(calm_openings)} {ai_response}"
+        formatted_response = f"{opening or self.choose_opening(session_id)} {ai_response}"
         
         # Add coping suggestion if mood is detected and not calm/neutral
         coping_suggestion = ""
-        if mood in ['stressed', 'sad', 'angry']:
-            suggestions = self.get_coping_suggestions(mood)
-            coping_suggestion = random.choice(suggestions)
+        if mood in self.SUGGESTION_MOODS:
+            coping_suggestion = self.suggestions.pick(mood, session_id)
         
         return {
             'response': formatted_response,
@@ -154,9 +117,51 @@ class MentalHealthChatbot:
             'timestamp': time.strftime('%H:%M:%S')
         }
 
+    def crisis_response(self) -> Dict:
+        """The vetted safety response for a message flagged by the crisis screen"""
+        return {
+            'response': crisis_screen.SAFETY_RESPONSE,
+            'suggestion': "",
+            'mood': crisis_screen.DISTRESS,
+            'timestamp': time.strftime('%H:%M:%S')
+        }
+
 # Initialize chatbot with environment variable or default
 api_key = os.environ.get('HUGGINGFACE_API_KEY', 'dummy_key')
-chatbot = MentalHealthChatbot(api_key)
+chatbot = MentalHealthChatbot(api_key, os.environ.get('HF_DIALOG_API_URL'))
+metrics.register_stats("suggestions", chatbot.suggestions.stats)
+
+def session_key(data: Dict) -> str:
+    """Who the non-repeating suggestions are tracked for: the page's session_id, else the client address"""
+    session_id = data.get('session_id')
+    return session_id if isinstance(session_id, str) and session_id else request.remote_addr
+
+# Recent exchanges and replies per session_id, so the page sends only the new message (conversation_store.py)
+conversations = ConversationStore() if CONVERSATION_STORE else None
+metrics.register_stats("conversations", lambda: conversations.stats() if conversations else None)
+
+def begin_turn(data: Dict):
+    """A stored-conversation turn for requests with a session_id, or None (the history then comes in the body)"""
+    session_id = data.get('session_id')
+    if not conversations or not isinstance(session_id, str) or not session_id:
+        return None
+    message_id = data.get('message_id')
+    version = data.get('history_version')
+    history = data.get('history')
+    return conversations.begin(
+        session_id,
+        message_id if isinstance(message_id, str) and message_id else None,
+        version if isinstance(version, int) and not isinstance(version, bool) else None,
+        history if isinstance(history, list) else None,
+    )
+
+def turn_unavailable(turn):
+    """The response for a turn that can't be answered now: 409 asks for the history, 503 for a retry"""
+    if turn.conflict:
+        return jsonify({'error': 'history_conflict', 'history_version': turn.version}), 409
+    if turn.busy:
+        return jsonify({'error': 'This message is still being answered.'}), 503, {'Retry-After': '1'}
+    return None
 
 @app.route('/')
 def home():
@@ -164,10 +169,12 @@ def home():
 
 @app.route('/chat', methods=['POST'])
 def chat():
+    turn = None
     try:
-        data = request.get_json()
-        user_message = data.get('message', '').strip()
-        conversation_history = data.get('history', [])
+        with metrics.span("parse"):
+            data = request.get_json()
+            user_message = data.get('message', '').strip()
+            conversation_history = data.get('history', [])
         
         if not user_message:
             return jsonify({
@@ -176,16 +183,38 @@ def chat():
                 'mood': 'neutral',
                 'timestamp': time.strftime('%H:%M:%S')
             })
+
+        # A retried message gets its stored reply; otherwise the history comes from the session
+        turn = begin_turn(data)
+        if turn is not None:
+            if turn.replay is not None:
+                return jsonify(turn.replay)
+            unavailable = turn_unavailable(turn)
+            if unavailable:
+                return unavailable
+            conversation_history = turn.history
         
-        # Analyze user mood
-        mood = chatbot.analyze_user_mood(user_message)
-        
-        # Get AI response
-        ai_response = chatbot.query_huggingface(user_message, conversation_history)
-        
-        # Format final response
-        formatted_response = chatbot.format_response(ai_response, mood, user_message)
+        # High-risk messages skip the model and get helpline resources straight away
+        answered = True
+        if crisis_screen.check(user_message, session_id=session_key(data), source="app"):
+            formatted_response = chatbot.crisis_response()
+        else:
+            # Analyze user mood
+            with metrics.span("classify"):
+                mood = chatbot.analyze_user_mood(user_message)
+            
+            # Get AI response
+            with metrics.span("generate"):
+                ai_response, answered = chatbot.query_huggingface(user_message, conversation_history)
+            
+            # Format final response
+            formatted_response = chatbot.format_response(ai_response, mood, user_message, session_id=session_key(data))
         
+        # A fallback reply isn't stored, so a retry of this message asks the model again
+        if turn is not None and answered:
+            conversations.finish(turn, user_message, formatted_response)
+        if not answered:
+            formatted_response['fallback'] = True  # The page leaves it out of its own copy too
         return jsonify(formatted_response)
         
     except Exception as e:
@@ -194,8 +223,86 @@ def chat():
             'response': "I'm here to listen. Could you tell me more about how you're feeling?",
             'suggestion': "",
             'mood': 'neutral',
-            'timestamp': time.strftime('%H:%M:%S')
+            'timestamp': time.strftime('%H:%M:%S'),
+            'fallback': True
         })
+    finally:
+        if turn is not None:
+            conversations.abort(turn)  # No-op once the reply is stored
+
+def sse_event(event: str, data: Dict) -> str:
+    """Serialize one Server-Sent Event frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    """Streaming variant of /chat: sends the opening right away, then the reply, then a `done` event"""
+    data = request.get_json() or {}
+    user_message = data.get('message', '').strip()
+    conversation_history = data.get('history', [])
+    session_id = session_key(data)
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+
+    turn = begin_turn(data) if user_message else None
+    if turn is not None:
+        if turn.replay is not None:
+            return Response(sse_event('done', turn.replay), mimetype='text/event-stream', headers=headers)
+        unavailable = turn_unavailable(turn)
+        if unavailable:
+            return unavailable
+        conversation_history = turn.history
+
+    def record(reply: Dict, answered: bool = True) -> Dict:
+        if turn is not None and answered:
+            conversations.finish(turn, user_message, reply)
+        if not answered:
+            reply['fallback'] = True
+        return reply
+
+    def generate():
+        try:
+            if not user_message:
+                yield sse_event('done', {
+                    'response': "I'm here when you're ready to share. Take your time.",
+                    'suggestion': "",
+                    'mood': 'neutral',
+                    'timestamp': time.strftime('%H:%M:%S')
+                })
+                return
+
+            if crisis_screen.check(user_message, session_id=session_id, source="app"):
+                yield sse_event('done', record(chatbot.crisis_response()))
+                return
+
+            with metrics.span("classify"):
+                mood = chatbot.analyze_user_mood(user_message)
+
+            # The opening doesn't depend on the model, so it goes out before the API call
+            opening = chatbot.choose_opening(session_id)
+            yield sse_event('token', {'token': opening + " "})
+
+            with metrics.span("generate"):
+                ai_response, answered = chatbot.query_huggingface(user_message, conversation_history)
+            yield sse_event('token', {'token': ai_response})
+
+            reply = chatbot.format_response(ai_response, mood, user_message, opening, session_id)
+            yield sse_event('done', record(reply, answered))
+
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield sse_event('error', {
+                'response': "I'm here to listen. Could you tell me more about how you're feeling?"
+            })
+        finally:
+            # A failed or disconnected turn lets a retry of the same message run again
+            if turn is not None:
+                conversations.abort(turn)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+    if turn is not None:
+        # A client that leaves before the first chunk never starts generate(), so its finally never runs
+        response.call_on_close(lambda: conversations.abort(turn))
+    return response
 
 @app.route('/health')
 def health():
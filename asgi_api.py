@@ -0,0 +1,150 @@
+import os
+import asyncio
+import contextlib
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+import firestore_db
+import llm_service
+import metrics
+from context_builder import messages_to_fold
+from firestore_async import init_async_db, AsyncChatTurnRepository, get_or_create_user, get_chat_history, get_chat_history_page
+from inference_client import get_async_client
+
+# asyncio-native variant of api.py for the Hugging Face API backend
+# (llm_service). Inference goes through aiohttp and persistence through
+# Firestore's AsyncClient, so a single worker process keeps every in-flight
+# conversation on one event loop instead of one blocked thread each.
+# Run with: uvicorn asgi_api:app --port 5000   (or python asgi_api.py)
+
+# Background summary folds, kept referenced until they finish
+_background_tasks = set()
+
+
+async def _fold_summary(turn, history, dropped):
+    """ Async counterpart of context_builder.schedule_summary_fold. """
+    fold_args = messages_to_fold(turn, history, dropped)
+    if fold_args is None:
+        return
+    to_fold, covers = fold_args
+    try:
+        summary = await llm_service.summarize_history_async(turn.summary, to_fold)
+        if summary:
+            await turn.save_summary(summary, covers)
+    except Exception as e:
+        print(f"--- Rolling summary update failed: {e} ---")
+
+
+async def chat(request):
+    """ Same contract as api.py's /chat: {prompt, session_id} -> {response, mood, usage}. """
+    try:
+        with metrics.span("parse"):
+            data = await request.json()
+            prompt = data.get('prompt')
+            session_id = data.get('session_id')
+
+        if not prompt or not session_id:
+            return JSONResponse({"error": "Prompt and session_id are required."}, status_code=400)
+
+        turn = AsyncChatTurnRepository(request.app.state.db, session_id)
+        history = await turn.load()
+
+        usage = {}
+        mood, response, updated_history = await llm_service.get_response_async(
+            prompt, history, summary=turn.summary, usage=usage, session_id=session_id
+        )
+
+        # A canned fallback (API unreachable or timed out) isn't saved
+        if not llm_service.is_fallback_reply(response):
+            await turn.commit(updated_history[-2:], mood)
+            task = asyncio.ensure_future(_fold_summary(turn, updated_history, usage.get('dropped_messages', 0)))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+
+        return JSONResponse({
+            "response": response,
+            "mood": mood,
+            "usage": usage
+        })
+
+    except Exception as e:
+        print(f"--- API Error: {e} ---")
+        return JSONResponse({"error": "An internal server error occurred."}, status_code=500)
+
+
+async def history(request):
+    """ Same contract as bot.py's /history: the whole history, or one page with `limit`/`before`. """
+    try:
+        session_id = request.query_params.get('session_id')
+        if not session_id:
+            return JSONResponse({"error": "Missing session_id parameter"}, status_code=400)
+
+        limit = request.query_params.get('limit')
+        before = request.query_params.get('before')
+        limit = min(int(limit), 200) if limit and limit.isdigit() and int(limit) else None
+        before = int(before) if before and before.isdigit() else None
+
+        # The newest page of an active session comes from the session cache, with no reads
+        cached = firestore_db.get_cached_history_page(session_id, limit) if before is None else None
+        if cached:
+            page, next_before = cached
+            if limit:
+                return JSONResponse({"history": page, "next_before": next_before})
+            return JSONResponse({"history": [{'role': m['role'], 'content': m['content']} for m in page]})
+
+        user_ref = await get_or_create_user(request.app.state.db, session_id)
+        if limit:
+            page, next_before = await get_chat_history_page(user_ref, limit, before)
+            return JSONResponse({"history": page, "next_before": next_before})
+
+        return JSONResponse({"history": await get_chat_history(user_ref)})
+
+    except Exception as e:
+        print(f"An error occurred in history_endpoint: {e}")
+        return JSONResponse({"error": "Internal server error retrieving history."}, status_code=500)
+
+
+async def health(request):
+    return JSONResponse({'status': 'healthy', 'message': 'Mental Health Chatbot is running'})
+
+
+async def stats(request):
+    """ Classifier tiers, response cache and prompt token cache counters. """
+    return JSONResponse({**llm_service.stats(), "context": llm_service.context.stats()})
+
+
+async def metrics_endpoint(request):
+    return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # The async clients bind to this event loop, so they are created here
+    app.state.db = init_async_db()
+    yield
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await get_async_client(llm_service.HF_API_KEY).close()
+
+
+app = Starlette(
+    routes=[
+        Route('/chat', chat, methods=['POST']),
+        Route('/history', history, methods=['GET']),
+        Route('/health', health, methods=['GET']),
+        Route('/stats', stats, methods=['GET']),
+        Route('/metrics', metrics_endpoint, methods=['GET']),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+        Middleware(metrics.ASGIMetricsMiddleware),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv("PORT", "5000")))
@@ -0,0 +1,38 @@
+import argparse
+import firestore_db
+from migrate_history import iter_user_docs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fill in the mood counters, last mood day and monthly mood buckets from each user's mood_logs."
+    )
+    parser.add_argument("--page-size", type=int, default=200, help="user documents read per page")
+    parser.add_argument("--force", action="store_true", help="also rebuild users that were already backfilled")
+    parser.add_argument("--dry-run", action="store_true", help="only report which users would be backfilled")
+    args = parser.parse_args()
+
+    db = firestore_db.init_db()
+    if db is None:
+        raise SystemExit("Could not connect to Firestore.")
+
+    users = backfilled_users = counted_logs = 0
+    for doc in iter_user_docs(db, args.page_size):
+        users += 1
+        data = doc.to_dict() or {}
+        if data.get('mood_stats_backfilled') and not args.force:
+            continue
+        backfilled_users += 1
+        if args.dry_run:
+            continue
+        # Safe to repeat and to run while the app is serving: each user is rebuilt in one transaction
+        counted_logs += firestore_db.backfill_mood_stats(doc.reference)
+
+    if args.dry_run:
+        print(f"--- Scanned {users} users. Would backfill {backfilled_users} users. ---")
+    else:
+        print(f"--- Scanned {users} users. Backfilled {backfilled_users} users ({counted_logs} mood logs). ---")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+import metrics
+
+# torch and transformers are only imported by generate_batch, so the scheduler
+# itself (and bot.py at startup) runs without them.
+
+CLASSIFY_MAX_TOKENS = 15
+CONVERSATION_MAX_TOKENS = 128
+
+
+# --- 1. Batched generation over a local model ---
+
+class GreedyRowsLogitsProcessor:
+    """
+    Forces greedy decoding for selected rows of a sampled batch by masking every
+    logit except the row's argmax, so deterministic classification prompts can
+    share a generate call with sampled conversation prompts. A logits processor
+    is any (input_ids, scores) -> scores callable, so no transformers base class.
+    """
+
+    def __init__(self, rows):
+        self.rows = list(rows)
+
+    def __call__(self, input_ids, scores):
+        if self.rows:
+            rows = scores[self.rows]
+            best = rows.argmax(dim=-1, keepdim=True)
+            masked = rows.new_full(rows.shape, float("-inf"))
+            masked.scatter_(1, best, rows.gather(1, best))
+            scores[self.rows] = masked
+        return scores
+
+
+def generate_batch(model, tokenizer, items, max_time=None,
+                   classify_max_tokens=CLASSIFY_MAX_TOKENS,
+                   conversation_max_tokens=CONVERSATION_MAX_TOKENS):
+    """
+    Runs several prompts through a single padded model.generate call.
+    `items` is a list of (messages, is_classification) pairs; classification rows
+    decode greedily and are cut at `classify_max_tokens`, conversation rows are sampled.
+    The tokenizer must pad on the left. Returns the decoded completion for each item.
+    """
+    import torch
+    from transformers import LogitsProcessorList
+
+    texts = [
+        tokenizer.apply_chat_template(messages, add_generation_prompt=True, tokenize=False)
+        for messages, _ in items
+    ]
+    inputs = tokenizer(
+        texts, return_tensors="pt", padding=True, add_special_tokens=False
+    ).to(model.device)
+
+    greedy_rows = [i for i, (_, is_classification) in enumerate(items) if is_classification]
+    all_greedy = len(greedy_rows) == len(items)
+
+    generate_args = {
+        "max_new_tokens": classify_max_tokens if all_greedy else conversation_max_tokens,
+        "eos_token_id": tokenizer.eos_token_id,
+        "pad_token_id": tokenizer.pad_token_id,
+        "max_time": max_time,
+    }
+    if all_greedy:
+        generate_args["do_sample"] = False
+    else:
+        generate_args["do_sample"] = True
+        generate_args["temperature"] = 0.7
+        generate_args["logits_processor"] = LogitsProcessorList([GreedyRowsLogitsProcessor(greedy_rows)])
+
+    with torch.inference_mode():
+        outputs = model.generate(**inputs, **generate_args)
+
+    prompt_length = inputs["input_ids"].shape[-1]
+    results = []
+    for row, (_, is_classification) in enumerate(items):
+        response_ids = outputs[row][prompt_length:]
+        if is_classification:
+            response_ids = response_ids[:classify_max_tokens]
+        else:
+            metrics.record_tokens("completion", int((response_ids != tokenizer.pad_token_id).sum()))
+        results.append(tokenizer.decode(response_ids, skip_special_tokens=True).strip())
+    return results
+
+
+# --- 2. Dynamic micro-batching worker ---
+
+class _PendingRequest:
+    __slots__ = ("messages", "is_classification", "future", "enqueued_at")
+
+    def __init__(self, messages, is_classification):
+        self.messages = messages
+        self.is_classification = is_classification
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+
+
+class BatchScheduler:
+    """
+    Background inference worker. Requests are queued; the worker takes the first
+    pending one, keeps gathering for up to `max_wait_ms` (or until `max_batch_size`),
+    runs the whole group through `generate_fn(items)` and resolves each future.
+
+    `generate_fn` receives a list of (messages, is_classification) pairs and must
+    return one completion per pair, in order.
+    """
+
+    def __init__(self, generate_fn, max_batch_size=8, max_wait_ms=10):
+        self.generate_fn = generate_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.batches = 0
+        self.requests = 0
+        self.failed_batches = 0
+        self.last_batch_size = 0
+        self.max_batch_seen = 0
+        self.batch_size_counts = {}
+        self.total_queue_wait = 0.0
+        self.total_generate_time = 0.0
+
+        self._worker = threading.Thread(target=self._run, name="serenity-batcher", daemon=True)
+        self._worker.start()
+
+    def submit(self, messages, is_classification=False):
+        """ Queues one prompt and returns a Future that resolves to its completion. """
+        if self._stopping.is_set():
+            raise RuntimeError("BatchScheduler has been shut down")
+        pending = _PendingRequest(messages, is_classification)
+        self._queue.put(pending)
+        return pending.future
+
+    def _gather(self):
+        """ Blocks for the first request, then collects more until the window closes or the batch is full. """
+        try:
+            first = self._queue.get(timeout=0.5)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        # Drop requests whose callers already gave up
+        return [p for p in batch if p.future.set_running_or_notify_cancel()]
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._gather()
+            if not batch:
+                continue
+
+            started = time.monotonic()
+            try:
+                results = list(self.generate_fn([(p.messages, p.is_classification) for p in batch]))
+                if len(results) != len(batch):
+                    # Pairing them up would leave some futures unresolved until their callers time out
+                    raise RuntimeError(f"generate_fn returned {len(results)} results for {len(batch)} requests")
+            except Exception as e:
+                print(f"--- Batched generation failed for {len(batch)} requests: {e} ---")
+                with self._lock:
+                    self.failed_batches += 1
+                for p in batch:
+                    p.future.set_exception(e)
+                continue
+            finished = time.monotonic()
+
+            for p, result in zip(batch, results):
+                p.future.set_result(result)
+
+            with self._lock:
+                size = len(batch)
+                self.batches += 1
+                self.requests += size
+                self.last_batch_size = size
+                self.max_batch_seen = max(self.max_batch_seen, size)
+                self.batch_size_counts[size] = self.batch_size_counts.get(size, 0) + 1
+                self.total_queue_wait += sum(started - p.enqueued_at for p in batch)
+                self.total_generate_time += finished - started
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def stats(self):
+        """ Snapshot of queue depth and batch-size metrics. """
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth(),
+                "batches": self.batches,
+                "requests": self.requests,
+                "failed_batches": self.failed_batches,
+                "last_batch_size": self.last_batch_size,
+                "max_batch_size_seen": self.max_batch_seen,
+                "avg_batch_size": round(self.requests / self.batches, 2) if self.batches else 0.0,
+                "batch_size_counts": dict(sorted(self.batch_size_counts.items())),
+                "avg_queue_wait_ms": round(1000 * self.total_queue_wait / self.requests, 2) if self.requests else 0.0,
+                "avg_generate_ms": round(1000 * self.total_generate_time / self.batches, 2) if self.batches else 0.0,
+            }
+
+    def shutdown(self, wait=True):
+        """ Stops the worker; requests still queued fail with RuntimeError. """
+        self._stopping.set()
+        if wait:
+            self._worker.join()
+        while True:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending.future.set_running_or_notify_cancel():
+                pending.future.set_exception(RuntimeError("BatchScheduler has been shut down"))
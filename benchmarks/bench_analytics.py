@@ -0,0 +1,126 @@
+"""
+Offline analytics (analytics.py) on a synthetic dataset.
+
+Writes a seeded export file of --users users (default 100k), each with a
+message count, mood counters and a few dozen mood logs, then runs
+`analytics.py --input` on it once per --workers value in a fresh process,
+and reports wall time, users per second, the peak RSS of that process and
+the size of the columnar output. The summary of every run must match the
+first one, so it doubles as a check that worker count doesn't change results.
+
+    python benchmarks/bench_analytics.py
+    python benchmarks/bench_analytics.py --users 20000 --workers 0 1 4 --format columns
+"""
+import os
+import sys
+import json
+import gzip
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import analytics
+
+MOOD_WEIGHTS = {"happy": 30, "sad": 25, "anxious": 30, "seeking_community": 8, "serious_distress": 2, "angry": 5}
+START = 1735689600.0  # 2025-01-01
+
+
+def synthetic_records(users, seed):
+    rng = random.Random(seed)
+    moods, weights = list(MOOD_WEIGHTS), list(MOOD_WEIGHTS.values())
+    for user in range(users):
+        created = START + rng.random() * 300 * 86400
+        logs = [[mood, created + rng.random() * 60 * 86400]
+                for mood in rng.choices(moods, weights, k=int(rng.expovariate(1 / 20)))]
+        counts = {}
+        for mood, _ in logs:
+            counts[mood] = counts.get(mood, 0) + 1
+        yield {
+            "id": f"user-{user:07d}",
+            "data": {"created_at": created, "message_count": 2 * int(rng.expovariate(1 / 15)),
+                     "sessions_completed": rng.randint(0, 20), "days_active": rng.randint(1, 90),
+                     "mood_counts": counts},
+            "mood_logs": logs,
+        }
+
+
+def peak_rss_mb(pid):
+    """ Waits for a child and returns its peak resident set size. """
+    _, status, usage = os.wait4(pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"analytics.py exited with {os.waitstatus_to_exitcode(status)}")
+    return round(usage.ru_maxrss / 1024, 1)  # KiB on Linux
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, os.cpu_count() or 1])
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--format", choices=("parquet", "npz", "columns"), default=analytics.default_format())
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--keep", action="store_true", help="keep the export and outputs (path is printed)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="serenity-analytics-")
+    try:
+        export = os.path.join(workdir, "users.jsonl.gz")
+        with gzip.open(export, "wt", encoding="utf-8", compresslevel=1) as f:
+            for record in synthetic_records(args.users, args.seed):
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+        results, reference = [], None
+        for workers in args.workers:
+            out = os.path.join(workdir, f"out-{workers}")
+            process = subprocess.Popen(
+                [sys.executable, "analytics.py", "--input", export, "--out", out, "--format", args.format,
+                 "--workers", str(workers), "--chunk-size", str(args.chunk_size)],
+                cwd=ROOT, stdout=subprocess.DEVNULL,
+            )
+            rss = peak_rss_mb(process.pid)
+            with open(os.path.join(out, "summary.json")) as f:
+                summary = json.load(f)
+            comparable = {key: summary[key] for key in ("users", "messages", "session_length", "mood_counts", "escalation")}
+            if reference is None:
+                reference = comparable
+            elif comparable != reference:
+                raise SystemExit(f"workers={workers} produced a different summary")
+            results.append({
+                "workers": workers,
+                "seconds": summary["elapsed_seconds"],
+                "users_per_second": summary["users_per_second"],
+                "peak_rss_mb": rss,
+                "output_mb": round(sum(os.path.getsize(p) for p in summary["outputs"]) / 1e6, 2),
+            })
+
+        report = {
+            "users": args.users,
+            "format": args.format,
+            "export_mb": round(os.path.getsize(export) / 1e6, 2),
+            "runs": results,
+            "summary": reference,
+        }
+        if args.json:
+            print(json.dumps(report, indent=2))
+        else:
+            print(f"{args.users} users, export {report['export_mb']} MB, format {args.format}")
+            for run in results:
+                print(f"workers={run['workers']:<3} {run['seconds']}s {run['users_per_second']} users/s "
+                      f"peak_rss={run['peak_rss_mb']}MB output={run['output_mb']}MB")
+            print(f"escalation rate {reference['escalation']['rate']}, "
+                  f"median session {reference['session_length']['p50']} messages")
+        if args.keep:
+            print(f"kept {workdir}")
+    finally:
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
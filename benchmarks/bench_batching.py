@@ -0,0 +1,123 @@
+"""
+Throughput benchmark for the dynamic micro-batching scheduler.
+
+Loads a tiny instruction-tuned model on CPU and drives BatchScheduler with
+1/8/32 concurrent clients, each sending a mix of classification and
+conversation prompts. Every configuration runs twice: with batching
+disabled (max batch size 1) and with the scheduler's batching enabled.
+
+Run from the repository root:
+    python benchmarks/bench_batching.py --model HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+import batch_scheduler
+
+SYSTEM_CLASSIFY = {"role": "system", "content": "Reply with one tag: [mood: happy], [mood: sad], [mood: neutral]."}
+SYSTEM_CHAT = {"role": "system", "content": "You are Serenity, a supportive companion. Use less than 50 words."}
+MESSAGES = [
+    "I'm so happy today, everything is going great!",
+    "I feel a bit anxious about my exams tomorrow.",
+    "what's up",
+    "I haven't been sleeping well and I feel low.",
+]
+
+
+def load(model_id):
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    tokenizer.padding_side = "left"
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32)
+    model.eval()
+    return model, tokenizer
+
+
+def run(scheduler, clients, turns_per_client):
+    """ Each client sends `turns_per_client` turns (classification + conversation) back to back. """
+    latencies = []
+    lock = threading.Lock()
+
+    def client(index):
+        for turn in range(turns_per_client):
+            text = MESSAGES[(index + turn) % len(MESSAGES)]
+            start = time.perf_counter()
+            futures = [
+                scheduler.submit([SYSTEM_CLASSIFY, {"role": "user", "content": text}], True),
+                scheduler.submit([SYSTEM_CHAT, {"role": "user", "content": text}], False),
+            ]
+            for future in futures:
+                future.result()
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "clients": clients,
+        "turns": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "turns_per_s": round(len(latencies) / elapsed, 3),
+        "p50_ms": round(1000 * latencies[len(latencies) // 2], 1),
+        "p99_ms": round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))], 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--turns", type=int, default=2, help="turns per client")
+    parser.add_argument("--max-new-tokens", type=int, default=32)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-wait-ms", type=float, default=10)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model, tokenizer = load(args.model)
+
+    def generate_fn(items):
+        return batch_scheduler.generate_batch(
+            model, tokenizer, items, classify_max_tokens=8,
+            conversation_max_tokens=args.max_new_tokens,
+        )
+
+    results = []
+    for label, batch_size in (("unbatched", 1), ("batched", args.max_batch_size)):
+        for clients in args.clients:
+            scheduler = batch_scheduler.BatchScheduler(
+                generate_fn, max_batch_size=batch_size, max_wait_ms=args.max_wait_ms
+            )
+            result = run(scheduler, clients, args.turns)
+            stats = scheduler.stats()
+            scheduler.shutdown()
+            result.update({"mode": label, "avg_batch_size": stats["avg_batch_size"]})
+            results.append(result)
+            if not args.json:
+                print(f"{label:>9} clients={clients:>3} turns/s={result['turns_per_s']:>7} "
+                      f"p50={result['p50_ms']:>8}ms p99={result['p99_ms']:>8}ms "
+                      f"avg_batch={result['avg_batch_size']}")
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+End-to-end /chat benchmark for every server variant.
+
+Drives /chat (and /chat/stream) of api.py, bot.py and app.py (optionally the
+ASGI asgi_api.py) with synthetic multi-turn conversations. Conversation
+lengths are drawn between --min-turns and --max-turns from a seeded RNG, so two
+runs with the same arguments send the same traffic. Inference is
+benchmarks/stub_inference.py, with configurable latency and token rate: over
+HTTP for the API backends and app.py, and over the model server socket for
+bot.py, which then needs no local model. Firestore is the in-memory fake
+(FIRESTORE_BACKEND=memory).
+
+For each server, endpoint and concurrency level it reports throughput,
+p50/p95/p99 latency, time to first byte and the Firestore RPCs made (from the
+server's /metrics). Results are JSON with the commit and settings, so runs
+can be compared across commits:
+
+    python benchmarks/bench_chat.py --output results.json
+    python benchmarks/bench_chat.py --servers api bot --concurrency 1 20 --latency-ms 100 --token-ms 10
+    python benchmarks/bench_chat.py --baseline results.json --tolerance 0.15   # exits 1 on a p95 regression
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+import urllib.error
+import urllib.request
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def flask_server(module):
+    return lambda port: [sys.executable, "-c", f"import {module}; {module}.app.run(port={port}, threaded=True)"]
+
+
+# Request payload shape per server: api.py, asgi_api.py and bot.py keep the
+# history in Firestore by session_id; app.py is stateless and gets it from the client.
+SERVERS = {
+    "api": {"command": flask_server("api"), "stateless": False, "endpoints": ("chat", "stream")},
+    "bot": {"command": flask_server("bot"), "stateless": False, "endpoints": ("chat", "stream")},
+    "app": {"command": flask_server("app"), "stateless": True, "endpoints": ("chat", "stream")},
+    "asgi": {
+        "command": lambda port: [sys.executable, "-m", "uvicorn", "asgi_api:app", "--port", str(port),
+                                 "--log-level", "warning"],
+        "stateless": False,
+        "endpoints": ("chat",),
+    },
+}
+
+ENDPOINTS = {"chat": "/chat", "stream": "/chat/stream"}
+
+MESSAGES = [
+    "I have had a really long week at work",
+    "My sister and I argued again last night and I can't stop replaying it",
+    "Everything feels like it is piling up",
+    "I keep thinking about the interview tomorrow",
+    "I slept badly again",
+    "Honestly I don't know why I feel so flat lately, nothing is wrong exactly but nothing feels good either",
+    "Thanks, that helps a bit",
+    "My manager moved the deadline up by a week and I haven't told anyone how behind I am",
+]
+
+
+# --- 1. Processes ---
+
+def start(command, env, port=None, socket_path=None, timeout=60):
+    """ Starts a process and waits until it accepts HTTP requests on `port` or creates `socket_path`. """
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command} exited with {process.returncode}")
+        if socket_path:
+            if os.path.exists(socket_path):
+                return process
+            time.sleep(0.2)
+            continue
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=0.5)
+            return process
+        except urllib.error.HTTPError:
+            return process  # Listening; /health may not exist or may not be ready yet
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{command} did not start within {timeout}s")
+
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def scrape_rpcs(url):
+    """ Firestore RPC counters from the server's /metrics, by kind. """
+    counts = {}
+    try:
+        with urllib.request.urlopen(f"{url}/metrics", timeout=5) as response:
+            text = response.read().decode("utf-8")
+    except OSError:
+        return counts
+    for line in text.splitlines():
+        if line.startswith("serenity_firestore_rpcs_total{"):
+            labels, value = line.rsplit(" ", 1)
+            kind = labels.split('kind="', 1)[1].split('"', 1)[0]
+            counts[kind] = counts.get(kind, 0) + int(float(value))
+    return counts
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# --- 2. Load generation ---
+
+def conversations(users, min_turns, max_turns, seed):
+    """ One list of messages per simulated user; the same seed gives the same conversations. """
+    rng = random.Random(seed)
+    return [
+        [rng.choice(MESSAGES) for _ in range(rng.randint(min_turns, max_turns))]
+        for _ in range(users)
+    ]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(1000 * values[min(len(values) - 1, int(len(values) * q))], 1)
+
+
+async def send_turn(client, url, payload, stream):
+    """ Sends one turn. Returns (ok, time to first byte, total time, reply text). """
+    started = time.perf_counter()
+    async with client.post(url, json=payload) as response:
+        first = await response.content.readany()
+        ttfb = time.perf_counter() - started
+        body = first + await response.content.read()
+        elapsed = time.perf_counter() - started
+        if response.status != 200:
+            return False, ttfb, elapsed, None
+    text = body.decode("utf-8")
+    if not stream:
+        reply = json.loads(text).get("response")
+        return reply is not None, ttfb, elapsed, reply
+    # SSE: the reply is the concatenated token events; a done event means success
+    tokens, done = [], False
+    for frame in text.split("\n\n"):
+        event = dict(line.split(": ", 1) for line in frame.splitlines() if ": " in line)
+        if event.get("event") == "done":
+            done = True
+        elif "data" in event:
+            data = json.loads(event["data"])
+            tokens.append(data.get("token", ""))
+    return done, ttfb, elapsed, "".join(tokens)
+
+
+async def run_level(url, path, stateless, users, scripts, timeout, run_id):
+    latencies, ttfbs, errors = [], [], 0
+    connector = aiohttp.TCPConnector(limit=users)
+    stream = path.endswith("/stream")
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as client:
+        async def user(index, script):
+            nonlocal errors
+            session_id = f"bench-{run_id}-{index}"
+            history = []
+            for message in script:
+                if stateless:
+                    payload = {"message": message, "history": history}
+                else:
+                    payload = {"prompt": message, "session_id": session_id}
+                try:
+                    ok, ttfb, elapsed, reply = await send_turn(client, f"{url}{path}", payload, stream)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+                    ok = False
+                if not ok:
+                    errors += 1
+                    continue
+                latencies.append(elapsed)
+                ttfbs.append(ttfb)
+                history.append({"user": message, "bot": reply})
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(i, script) for i, script in enumerate(scripts)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "users": users,
+        "turns": sum(len(script) for script in scripts),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "ttfb_p50_ms": percentile(ttfbs, 0.50),
+        "ttfb_p95_ms": percentile(ttfbs, 0.95),
+    }
+
+
+# --- 3. Comparison ---
+
+def compare(results, baseline, tolerance):
+    """ Prints p95 and throughput changes against a baseline run; returns the regressed keys. """
+    previous = {(r["server"], r["endpoint"], r["users"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        key = (result["server"], result["endpoint"], result["users"])
+        before = previous.get(key)
+        if not before or not before["p95_ms"] or not result["p95_ms"]:
+            continue
+        p95_change = result["p95_ms"] / before["p95_ms"] - 1
+        rps_change = result["requests_per_s"] / before["requests_per_s"] - 1 if before["requests_per_s"] else 0.0
+        flag = ""
+        if p95_change > tolerance:
+            regressions.append(key)
+            flag = "  REGRESSION"
+        print(f"{key[0]:>5} {key[1]:>6} users={key[2]:>4} p95 {before['p95_ms']} -> {result['p95_ms']}ms "
+              f"({p95_change:+.1%}), req/s {rps_change:+.1%}{flag}")
+    return regressions
+
+
+# --- 4. Entry point ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", default=["api", "bot", "app"], choices=list(SERVERS))
+    parser.add_argument("--endpoints", nargs="+", default=list(ENDPOINTS), choices=list(ENDPOINTS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--min-turns", type=int, default=1, help="shortest conversation, in turns")
+    parser.add_argument("--max-turns", type=int, default=8, help="longest conversation, in turns")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--latency-ms", type=float, default=150.0, help="stub time to first token")
+    parser.add_argument("--token-ms", type=float, default=5.0, help="stub time per generated word")
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", help="write the JSON results to this file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed p95 increase over the baseline")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    stub_args = ["--latency-ms", str(args.latency_ms), "--token-ms", str(args.token_ms)]
+    stub_script = os.path.join("benchmarks", "stub_inference.py")
+    stub = start([sys.executable, stub_script, "--port", str(args.stub_port)] + stub_args,
+                 dict(os.environ), port=args.stub_port)
+    socket_path = os.path.join(tempfile.mkdtemp(prefix="serenity-bench-"), "model.sock")
+    model_stub = None
+
+    stub_url = f"http://127.0.0.1:{args.stub_port}"
+    env = dict(
+        os.environ,
+        CHAT_BACKEND="api",
+        FIRESTORE_BACKEND="memory",
+        HF_API_URL=f"{stub_url}/v1/chat/completions",
+        HF_DIALOG_API_URL=f"{stub_url}/dialog",
+        HUGGINGFACE_API_KEY=os.getenv("HUGGINGFACE_API_KEY", "stub"),
+        MODEL_SERVER_SOCKET=socket_path,
+        # Every classification goes to the (stubbed) model and nothing is cached,
+        # so repeated runs measure the same work
+        MOOD_CLASSIFIER_TIERS="llm",
+        RESPONSE_CACHE="0",
+        # One client IP drives every conversation; rate limits would cap the measurement
+        ADMISSION="0",
+    )
+
+    results = []
+    url = f"http://127.0.0.1:{args.port}"
+    try:
+        if "bot" in args.servers:
+            model_stub = start([sys.executable, stub_script, "--model-socket", socket_path] + stub_args,
+                               dict(os.environ), socket_path=socket_path)
+        for name in args.servers:
+            server = start(SERVERS[name]["command"](args.port), env, port=args.port)
+            try:
+                for endpoint in [e for e in args.endpoints if e in SERVERS[name]["endpoints"]]:
+                    for users in args.concurrency:
+                        scripts = conversations(users, args.min_turns, args.max_turns, args.seed)
+                        rpcs_before = scrape_rpcs(url)
+                        result = asyncio.run(run_level(
+                            url, ENDPOINTS[endpoint], SERVERS[name]["stateless"], users, scripts, args.timeout,
+                            run_id=f"{endpoint}-{users}-{time.time_ns()}",
+                        ))
+                        rpcs_after = scrape_rpcs(url)
+                        rpcs = {kind: count - rpcs_before.get(kind, 0) for kind, count in rpcs_after.items()}
+                        completed = result["turns"] - result["errors"]
+                        result.update({
+                            "server": name,
+                            "endpoint": endpoint,
+                            "firestore_rpcs": rpcs,
+                            "firestore_rpcs_per_turn": round(sum(rpcs.values()) / completed, 2) if completed else None,
+                        })
+                        results.append(result)
+                        if not args.json:
+                            print(f"{name:>5} {endpoint:>6} users={users:>4} turns={result['turns']:>4} "
+                                  f"req/s={result['requests_per_s']:>7} p50={result['p50_ms']}ms "
+                                  f"p95={result['p95_ms']}ms p99={result['p99_ms']}ms "
+                                  f"ttfb_p50={result['ttfb_p50_ms']}ms rpcs/turn={result['firestore_rpcs_per_turn']} "
+                                  f"errors={result['errors']}")
+            finally:
+                stop(server)
+    finally:
+        if model_stub:
+            stop(model_stub)
+        stop(stub)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "settings": {key: value for key, value in vars(args).items()
+                     if key not in ("output", "baseline", "json", "tolerance")},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
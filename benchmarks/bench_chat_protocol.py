@@ -0,0 +1,198 @@
+"""
+Request size and inference calls for app.py's /chat: the legacy protocol,
+where the page sends its whole history with every message, against sending
+only the new message with a history_version and a message_id
+(conversation_store.py).
+
+app.py runs in-process (Flask test client, one per thread) against
+benchmarks/stub_inference.py, so the model cost is the stub's latency.
+--conversations conversations of --turns messages run --concurrency at a
+time. A --duplicates fraction of messages is sent twice: half as a
+double-send while the first is still running, half as a retry after it
+answered (a reply lost on the way back). Per protocol it reports:
+  - request body bytes per message;
+  - inference calls per message, from the stub's request counter;
+  - mean and p95 turn latency.
+
+    python benchmarks/bench_chat_protocol.py --conversations 50 --turns 12 --duplicates 0.1
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import threading
+import subprocess
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORDS = (
+    "I feel so tired today work has been really hard and my boss keeps adding more things "
+    "I can't sleep well lately and I worry about my exams my family friends partner week"
+).split()
+HISTORY_TURNS = 8  # What the page keeps
+
+
+def start_stub(port, latency_ms, token_ms, timeout=30):
+    command = [sys.executable, os.path.join("benchmarks", "stub_inference.py"), "--port", str(port),
+               "--latency-ms", str(latency_ms), "--token-ms", str(token_ms)]
+    process = subprocess.Popen(command, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command} exited with {process.returncode}")
+        try:
+            stub_requests(port)
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"Stub did not start within {timeout}s")
+
+
+def stub_requests(port):
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/stats", timeout=2) as response:
+        return json.load(response)["requests"]
+
+
+def scripts(conversations, turns, duplicates, seed):
+    """ Per conversation: (message, duplicate kind or None) per turn. """
+    rng = random.Random(seed)
+    result = []
+    for _ in range(conversations):
+        script = []
+        for _ in range(turns):
+            message = " ".join(rng.choices(WORDS, k=rng.randint(6, 30)))
+            duplicate = rng.choice(["concurrent", "retry"]) if rng.random() < duplicates else None
+            script.append((message, duplicate))
+        result.append(script)
+    return result
+
+
+class Client:
+    """ The page's side of one conversation, for either protocol. """
+
+    def __init__(self, app, protocol, index):
+        self.app = app
+        self.protocol = protocol
+        self.session_id = f"bench-{protocol}-{index}"
+        self.history = []
+        self.version = None
+        self.resend = False
+
+    def body(self, message, message_id):
+        if self.protocol == "legacy":
+            return {'message': message, 'history': self.history}
+        body = {'message': message, 'message_id': message_id, 'session_id': self.session_id,
+                'history_version': self.version}
+        if self.resend:
+            body['history'] = self.history
+        return body
+
+    def post(self, message, message_id, sizes):
+        payload = json.dumps(self.body(message, message_id))
+        sizes.append(len(payload))
+        with self.app.test_client() as client:
+            response = client.post("/chat", data=payload, content_type="application/json")
+        if response.status_code == 409:
+            self.resend = True
+            return self.post(message, message_id, sizes)
+        return response.get_json()
+
+    def turn(self, message, duplicate, sizes, index):
+        message_id = f"{self.session_id}-{index}"
+        if duplicate == "concurrent":
+            second = threading.Thread(target=self.post, args=(message, message_id, sizes))
+            second.start()
+            data = self.post(message, message_id, sizes)
+            second.join()
+        else:
+            data = self.post(message, message_id, sizes)
+            if duplicate == "retry":
+                data = self.post(message, message_id, sizes)
+        if isinstance(data.get('history_version'), int):
+            self.version, self.resend = data['history_version'], False
+        self.history = (self.history + [{'user': message, 'bot': data['response']}])[-HISTORY_TURNS:]
+
+
+def run(app, protocol, conversation_scripts, concurrency, stub_port):
+    sizes, latencies = [], []
+    lock = threading.Lock()
+
+    def conversation(index, script):
+        client = Client(app, protocol, index)
+        for turn, (message, duplicate) in enumerate(script):
+            start = time.perf_counter()
+            client.turn(message, duplicate, sizes, turn)
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    before = stub_requests(stub_port)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(conversation, range(len(conversation_scripts)), conversation_scripts))
+    elapsed = time.perf_counter() - start
+    calls = stub_requests(stub_port) - before
+
+    messages = sum(len(script) for script in conversation_scripts)
+    latencies.sort()
+    return {
+        "messages": messages,
+        "requests": len(sizes),
+        "bytes_per_message": round(sum(sizes) / messages, 1),
+        "inference_calls_per_message": round(calls / messages, 3),
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 1),
+        "p95_ms": round(1000 * latencies[int(0.95 * (len(latencies) - 1))], 1),
+        "seconds": round(elapsed, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=40)
+    parser.add_argument("--turns", type=int, default=12)
+    parser.add_argument("--duplicates", type=float, default=0.1, help="fraction of messages sent twice")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="stub time to first token")
+    parser.add_argument("--token-ms", type=float, default=1.0, help="stub time per generated word")
+    parser.add_argument("--stub-port", type=int, default=8083)
+    parser.add_argument("--seed", type=int, default=25)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    stub = start_stub(args.stub_port, args.latency_ms, args.token_ms)
+    try:
+        os.environ["HF_DIALOG_API_URL"] = f"http://127.0.0.1:{args.stub_port}/dialog"
+        os.environ.setdefault("HUGGINGFACE_API_KEY", "stub")
+        os.environ["CONVERSATION_STORE"] = "1"
+        import app
+
+        conversation_scripts = scripts(args.conversations, args.turns, args.duplicates, args.seed)
+        results = {protocol: run(app.app, protocol, conversation_scripts, args.concurrency, args.stub_port)
+                   for protocol in ("legacy", "delta")}
+        results["delta"]["store"] = app.conversations.stats()
+    finally:
+        stub.send_signal(signal.SIGINT)
+        try:
+            stub.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            stub.kill()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"{'protocol':<8} {'bytes/msg':>10} {'calls/msg':>10} {'mean':>9} {'p95':>9}")
+    for protocol in ("legacy", "delta"):
+        row = results[protocol]
+        print(f"{protocol:<8} {row['bytes_per_message']:>10} {row['inference_calls_per_message']:>10} "
+              f"{row['mean_ms']:>7}ms {row['p95_ms']:>7}ms")
+    print(f"store: {results['delta']['store']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Overhead of the crisis screen (crisis_screen.py) on every chat turn.
+
+Times the screen's matcher on ordinary messages (the cost every turn pays)
+and on high-risk ones (match plus queueing the escalation), next to the
+keyword tier of the mood classifier for scale, and prints p50/p99/mean in
+microseconds. Also counts ordinary messages the screen flags and high-risk
+ones it misses. Exits 1 on a miss or when the ordinary p99 exceeds
+--budget-us, so it can also be used as a check.
+
+    python benchmarks/bench_crisis_screen.py
+    python benchmarks/bench_crisis_screen.py --iterations 20000 --csv labeled.csv   # text,label rows
+"""
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import crisis_screen
+import mood_classifier
+
+ORDINARY = [
+    "hi",
+    "I have had a really long week at work",
+    "My sister and I argued again last night and I can't stop replaying it",
+    "Everything feels like it is piling up",
+    "I keep thinking about the interview tomorrow",
+    "I slept badly again",
+    "Honestly I don't know why I feel so flat lately, nothing is wrong exactly but nothing feels good either",
+    "Thanks, that helps a bit",
+    "My manager moved the deadline up by a week and I haven't told anyone how behind I am",
+    "This exam is killing me, I've been revising all day and I still feel unprepared",
+    "I'm dying to go on holiday, I just need a break from everything",
+    " ".join(["I wanted to tell you about my day because so much happened and I'm still processing it."] * 8),
+]
+
+HIGH_RISK = [
+    "I want to kill myself",
+    "sometimes I think everyone would be better off dead without me",
+    "I've been thinking about suicide a lot",
+    "I can't go on like this anymore",
+    "I don't want to live anymore",
+    "I have been hurting myself again",
+    "I'm planning to take my own life this weekend",
+    "I wish I was dead",
+    "I've been thinking about an overdose",
+    "I overdosed last year and I think about doing it again",
+    "I keep self-harming",
+    "self harming is the only thing that helps",
+    "I can\u2019t go on",
+    "I don\u2019t want to live",
+    "I just want to disappear",
+    "I've been thinking about ending things",
+    "I want to sleep forever",
+]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def time_calls(fn, messages, iterations):
+    """ Per-call latencies in microseconds, cycling through `messages`. """
+    latencies = []
+    for i in range(iterations):
+        text = messages[i % len(messages)]
+        start = time.perf_counter_ns()
+        fn(text)
+        latencies.append((time.perf_counter_ns() - start) / 1000)
+    return {
+        "p50_us": round(percentile(latencies, 0.5), 2),
+        "p99_us": round(percentile(latencies, 0.99), 2),
+        "mean_us": round(sum(latencies) / len(latencies), 2),
+    }
+
+
+def load_csv(path):
+    """ (ordinary, high_risk) texts from a text,label CSV; serious_distress rows are high-risk. """
+    ordinary, high_risk = [], []
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            (high_risk if row["label"] == mood_classifier.DISTRESS else ordinary).append(row["text"])
+    return ordinary, high_risk
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=10000)
+    parser.add_argument("--csv", help="labeled messages (text,label) to use instead of the built-in samples")
+    parser.add_argument("--budget-us", type=float, default=100, help="maximum p99 on ordinary messages")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    ordinary, high_risk = load_csv(args.csv) if args.csv else (ORDINARY, HIGH_RISK)
+    # In-memory escalation log, so hits don't pile up in a file
+    screen = crisis_screen.CrisisScreen(log=crisis_screen.EscalationLog(""))
+    keyword_tier = mood_classifier.KeywordTier()
+
+    results = {
+        "patterns": len(crisis_screen.CRISIS_PATTERNS),
+        "ordinary": time_calls(screen.matcher.match, ordinary, args.iterations),
+        "high_risk": time_calls(
+            lambda text: screen.log.record("bench", screen.matcher.match(text), "bench"), high_risk, args.iterations
+        ) if high_risk else None,
+        "keyword_tier": time_calls(lambda text: keyword_tier.predict(text), ordinary, args.iterations),
+        "flagged_ordinary": [text for text in ordinary if screen.matcher.match(text)],
+        "missed_high_risk": [text for text in high_risk if not screen.matcher.match(text)],
+    }
+    screen.log.flush()
+    results["escalations_logged"] = screen.log.recorded
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for name in ("ordinary", "high_risk", "keyword_tier"):
+            if results[name]:
+                print(f"{name:<13} p50={results[name]['p50_us']}us p99={results[name]['p99_us']}us "
+                      f"mean={results[name]['mean_us']}us")
+        print(f"flagged ordinary: {len(results['flagged_ordinary'])}/{len(ordinary)}  "
+              f"missed high-risk: {len(results['missed_high_risk'])}/{len(high_risk)}")
+        for text in results["flagged_ordinary"] + results["missed_high_risk"]:
+            print(f"  {text[:80]!r}")
+    if results["missed_high_risk"] or results["ordinary"]["p99_us"] > args.budget_us:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+"""
+Stored size and decode time of a conversation: the legacy `chat_history`
+array against the packed bytes field (history_codec.py).
+
+For seeded conversations of 10, 100 and 1000 turns, each format is encoded
+into a real Firestore Document protobuf, the same bytes a read returns.
+For each one it reports:
+  - the document size;
+  - how long a read takes to deserialize and decode all messages;
+  - how long it takes to get only the newest --tail messages (what a prompt
+    needs; the array has to be decoded in full for that);
+  - how long a turn takes to add two messages to the stored history.
+Packed results are given per compression (zlib, zstd if installed, none).
+
+    python benchmarks/bench_history_codec.py
+    python benchmarks/bench_history_codec.py --turns 10 100 1000 5000 --tail 50 --json
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from google.cloud.firestore_v1 import _helpers
+from google.cloud.firestore_v1.types import document
+
+import history_codec
+
+WORDS = (
+    "I you we it feel feeling felt been really just so very not never always sometimes today tonight "
+    "work job boss exam school family friend partner mom dad sleep tired anxious stressed worried sad "
+    "lonely overwhelmed calm better okay fine good hard week weekend morning night time think know want "
+    "need talk help try trying breathe breathing walk notice moment thoughts body kind gentle yourself "
+    "that's it's what's can can't don't didn't about with without because when after before again "
+    "sounds understandable completely makes sense thank sharing small step let's together right now"
+).split()
+
+
+def conversation(turns, seed):
+    """ Alternating user / assistant messages, roughly 20 and 70 words long. """
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(turns):
+        messages.append({'role': 'user', 'content': " ".join(rng.choices(WORDS, k=rng.randint(5, 40))) + "."})
+        messages.append({'role': 'assistant', 'content': " ".join(rng.choices(WORDS, k=rng.randint(30, 110))) + "."})
+    return messages
+
+
+def document_bytes(fields):
+    """ A user document as Firestore serializes it on the wire. """
+    return document.Document.serialize(document.Document(fields=_helpers.encode_dict(fields)))
+
+
+def read_fields(raw):
+    return _helpers.decode_dict(document.Document.deserialize(raw).fields, None)
+
+
+def timed(fn, repeat):
+    """ Best-of-three mean microseconds per call. """
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        best = min(best, (time.perf_counter() - start) / repeat)
+    return round(best * 1e6, 1)
+
+
+def measure(messages, tail, repeat):
+    new_turn = conversation(1, 0)
+    legacy_raw = document_bytes({'chat_history': messages})
+    rows = {"array": {
+        "bytes": len(legacy_raw),
+        "decode_all_us": timed(lambda: read_fields(legacy_raw)['chat_history'], repeat),
+        "decode_tail_us": timed(lambda: read_fields(legacy_raw)['chat_history'][-tail:], repeat),
+        "append_turn_us": timed(lambda: document_bytes({'chat_history': messages + new_turn}), repeat),
+    }}
+    codecs = ["zlib"] + (["zstd"] if history_codec.ZSTD_AVAILABLE else []) + ["none"]
+    for codec in codecs:
+        blob = history_codec.encode(messages, codec)
+        raw = document_bytes({history_codec.PACKED_FIELD: blob})
+        assert history_codec.decode(read_fields(raw)[history_codec.PACKED_FIELD]) == messages
+        rows[f"packed_{codec}"] = {
+            "bytes": len(raw),
+            "decode_all_us": timed(lambda: history_codec.decode(read_fields(raw)[history_codec.PACKED_FIELD]), repeat),
+            "decode_tail_us": timed(lambda: history_codec.tail(read_fields(raw)[history_codec.PACKED_FIELD], tail), repeat),
+            "append_turn_us": timed(
+                lambda: document_bytes({history_codec.PACKED_FIELD: history_codec.append(blob, new_turn, codec)}), repeat),
+        }
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--tail", type=int, default=50, help="messages a prompt needs (PROMPT_HISTORY_LIMIT)")
+    parser.add_argument("--seed", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = {}
+    for turns in args.turns:
+        repeat = max(3, 2000 // turns)
+        results[turns] = measure(conversation(turns, args.seed), args.tail, repeat)
+
+    if args.json:
+        print(json.dumps({"block_messages": history_codec.HISTORY_CODEC_BLOCK, "tail": args.tail, "turns": results}, indent=2))
+        return
+    print(f"{'turns':>6} {'format':<12} {'bytes':>9} {'ratio':>6} {'decode all':>11} {'tail ' + str(args.tail):>9} {'append':>9}")
+    for turns, rows in results.items():
+        legacy = rows["array"]["bytes"]
+        for name, row in rows.items():
+            print(f"{turns:>6} {name:<12} {row['bytes']:>9} {legacy / row['bytes']:>5.1f}x "
+                  f"{row['decode_all_us']:>9}us {row['decode_tail_us']:>7}us {row['append_turn_us']:>7}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Load test: Flask api.py vs. the ASGI asgi_api.py against stubbed backends.
+
+Both servers run the Hugging Face API backend (llm_service) against
+benchmarks/stub_inference.py, with FIRESTORE_BACKEND=memory. Each concurrency
+level opens that many simulated users; every user sends `--turns` /chat
+requests back to back in its own session. Reports throughput, p50/p99
+latency and errors per server and level.
+
+Run from the repository root:
+    python benchmarks/bench_load.py --concurrency 10 50 200 --latency-ms 200
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import signal
+import asyncio
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVERS = {
+    # The Flask app is served the way api.py runs it: the threaded Werkzeug server
+    "flask": lambda port: [sys.executable, "-c", f"import api; api.app.run(port={port}, threaded=True)"],
+    "asgi": lambda port: [sys.executable, "-m", "uvicorn", "asgi_api:app", "--port", str(port), "--log-level", "warning"],
+}
+
+MESSAGES = [
+    "I have had a really long week at work",
+    "My sister and I argued again last night",
+    "Everything feels like it is piling up",
+    "I keep thinking about the interview tomorrow",
+]
+
+
+def start(command, env, port, timeout=60):
+    """ Starts a server process and waits until it accepts connections. """
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{command} exited with {process.returncode}")
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=0.5)
+            return process
+        except urllib.error.HTTPError:
+            return process  # Listening, just no such route
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{command} did not start within {timeout}s")
+
+
+def stop(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def run_level(url, users, turns, timeout):
+    latencies, errors = [], 0
+    connector = aiohttp.TCPConnector(limit=users)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as client:
+        async def user(index):
+            nonlocal errors
+            session_id = f"load-{uuid.uuid4().hex[:12]}"
+            for turn in range(turns):
+                payload = {"prompt": MESSAGES[(index + turn) % len(MESSAGES)], "session_id": session_id}
+                started = time.perf_counter()
+                try:
+                    async with client.post(f"{url}/chat", json=payload) as response:
+                        ok = response.status == 200 and "response" in await response.json()
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - started)
+                else:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(user(i) for i in range(users)))
+        elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    pick = lambda q: round(1000 * latencies[min(len(latencies) - 1, int(len(latencies) * q))], 1) if latencies else None
+    return {
+        "users": users,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(latencies) / elapsed, 2),
+        "p50_ms": pick(0.50),
+        "p99_ms": pick(0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers", nargs="+", default=list(SERVERS), choices=list(SERVERS))
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--turns", type=int, default=3, help="requests per simulated user")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="stub inference latency per call")
+    parser.add_argument("--stub-port", type=int, default=8081)
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    stub = start(
+        [sys.executable, os.path.join("benchmarks", "stub_inference.py"),
+         "--port", str(args.stub_port), "--latency-ms", str(args.latency_ms), "--token-ms", "0"],
+        dict(os.environ), args.stub_port,
+    )
+    env = dict(
+        os.environ,
+        CHAT_BACKEND="api",
+        FIRESTORE_BACKEND="memory",
+        HF_API_URL=f"http://127.0.0.1:{args.stub_port}/v1/chat/completions",
+        HUGGINGFACE_API_KEY=os.getenv("HUGGINGFACE_API_KEY", "stub"),
+        # Every classification goes to the (stubbed) API and nothing is cached
+        MOOD_CLASSIFIER_TIERS="llm",
+        RESPONSE_CACHE="0",
+        # One client IP drives every conversation; rate limits would cap the measurement
+        ADMISSION="0",
+    )
+
+    results = []
+    try:
+        for name in args.servers:
+            server = start(SERVERS[name](args.port), env, args.port)
+            try:
+                for users in args.concurrency:
+                    result = asyncio.run(run_level(f"http://127.0.0.1:{args.port}", users, args.turns, args.timeout))
+                    result["server"] = name
+                    results.append(result)
+                    if not args.json:
+                        print(f"{name:>5} users={users:>4} req/s={result['requests_per_s']:>8} "
+                              f"p50={result['p50_ms']}ms p99={result['p99_ms']}ms errors={result['errors']}")
+            finally:
+                stop(server)
+    finally:
+        stop(stub)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+Shared model server benchmark (model_server.py).
+
+Starts the model server with a small CPU model (MODEL_PRESET=tiny by default),
+then N worker processes that each connect like a web worker would and submit
+prompts as fast as the server accepts them. Reports throughput, per-worker
+completions and p50/p99 latency (fairness: a worker flooding the server
+should not starve the others), prompts refused by backpressure, prompts
+cancelled by a worker giving up, and the resident memory of the server versus a worker.
+
+    python benchmarks/bench_model_server.py --workers 4 --requests 50
+    python benchmarks/bench_model_server.py --workers 4 --flood 200     # worker 0 floods
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import TimeoutError as FutureTimeout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import model_server
+
+PROMPT = [{"role": "user", "content": "I have had a really long week at work"}]
+
+
+def rss_mb(pid):
+    """ Resident set size of a process, from /proc (Linux). """
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return round(int(line.split()[1]) / 1024, 1)
+    return None
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(1000 * values[min(len(values) - 1, int(len(values) * q))], 1)
+
+
+def run_worker(index, socket_path, requests, give_up_after, results):
+    """ One simulated web worker: submits everything, then collects the results. """
+    client = model_server.ModelServerClient(socket_path)
+    submitted = []
+    busy, cancelled, errors = 0, 0, 0
+    for i in range(requests):
+        try:
+            submitted.append((time.perf_counter(), client.submit(PROMPT, is_classification=(i % 2 == 0))))
+        except model_server.ModelServerError:
+            errors += 1
+
+    latencies = []
+    for started, future in submitted:
+        try:
+            future.result(timeout=give_up_after)
+            latencies.append(time.perf_counter() - started)
+        except model_server.ModelServerBusy:
+            busy += 1
+        except FutureTimeout:
+            # Giving up cancels the prompt on the server, like a timed-out HTTP request
+            future.cancel()
+            cancelled += 1
+        except Exception:
+            errors += 1
+    results.put({
+        "worker": index,
+        "completed": len(latencies),
+        "busy": busy,
+        "cancelled": cancelled,
+        "errors": errors,
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+        "rss_mb": rss_mb(os.getpid()),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50, help="prompts per worker")
+    parser.add_argument("--flood", type=int, default=0, help="prompts sent by worker 0 instead of --requests")
+    parser.add_argument("--give-up-after", type=float, default=60.0, help="seconds a worker waits per prompt")
+    parser.add_argument("--preset", default="tiny", help="MODEL_PRESET for the server")
+    parser.add_argument("--max-pending", type=int, default=model_server.MODEL_SERVER_MAX_PENDING)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(prefix="serenity-"), "model.sock")
+    # ADMISSION=0: the flood is meant to reach the model server's own limits
+    env = dict(os.environ, MODEL_PRESET=args.preset, FIRESTORE_BACKEND="memory", MODEL_WARMUP="eager", ADMISSION="0")
+    server = subprocess.Popen(
+        [sys.executable, "model_server.py", "--socket", socket_path, "--max-pending", str(args.max_pending)],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+    )
+    try:
+        client = model_server.ModelServerClient(socket_path)
+        started = time.perf_counter()
+        if not client.ensure_loaded(timeout=600):
+            raise RuntimeError(f"model server not ready: {client.state} {client.error}")
+        ready_s = round(time.perf_counter() - started, 2)
+
+        results = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=run_worker, args=(
+                i, socket_path, args.flood if i == 0 and args.flood else args.requests, args.give_up_after, results,
+            ))
+            for i in range(args.workers)
+        ]
+        started = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        per_worker = sorted((results.get() for _ in workers), key=lambda r: r["worker"])
+        for worker in workers:
+            worker.join()
+        elapsed = time.perf_counter() - started
+
+        summary = {
+            "server_ready_s": ready_s,
+            "elapsed_s": round(elapsed, 3),
+            "prompts_per_s": round(sum(r["completed"] for r in per_worker) / elapsed, 2),
+            "server_rss_mb": rss_mb(server.pid),
+            "workers": per_worker,
+            "server": client.stats().get("server"),
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=10)
+
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"server ready in {summary['server_ready_s']}s, rss {summary['server_rss_mb']} MB; "
+          f"{summary['prompts_per_s']} prompts/s over {summary['elapsed_s']}s")
+    for r in per_worker:
+        print(f"  worker {r['worker']}: completed={r['completed']} busy={r['busy']} cancelled={r['cancelled']} "
+              f"errors={r['errors']} p50={r['p50_ms']}ms p99={r['p99_ms']}ms rss={r['rss_mb']} MB")
+    print(f"  server: {summary['server']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Mood scoring in app.py: the compiled lexicon (mood_lexicon.py) against the
+substring scans it replaced.
+
+Scores a seeded corpus of chat messages three ways: the old
+analyze_user_mood (four `word in text` scans per message), the lexicon one
+message at a time, and the lexicon's batch API over the whole corpus. Prints
+microseconds per message for each, how often the old and new answers agree,
+and a few messages where they differ (e.g. "mad" inside "made", "not happy").
+
+    python benchmarks/bench_mood_lexicon.py --messages 20000
+    python benchmarks/bench_mood_lexicon.py --keywords 200   # pad the lexicon to see how each scales
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from mood_lexicon import MoodLexicon
+
+# The word lists analyze_user_mood scanned for before the lexicon
+LEGACY_INDICATORS = {
+    'stressed': ['stress', 'stressed', 'overwhelmed', 'pressure', 'anxious', 'anxiety', 'worried', 'nervous'],
+    'sad': ['sad', 'depressed', 'unhappy', 'miserable', 'hopeless', 'empty', 'lonely', 'down'],
+    'angry': ['angry', 'mad', 'furious', 'irritated', 'frustrated', 'annoyed'],
+    'calm': ['better', 'good', 'calm', 'peaceful', 'relaxed', 'happy', 'great', 'fine'],
+}
+
+FRAGMENTS = [
+    "I made dinner for my family tonight", "work has been a lot of pressure lately",
+    "I'm not happy with how things went", "I feel so lonely in the evenings",
+    "honestly I'm doing fine", "my boss made me furious today", "I keep worrying about money",
+    "the exam is stressing me out", "I had a good walk this morning", "nothing feels calm anymore",
+    "I've been down since the weekend", "my roommate is so annoying", "I never feel relaxed",
+    "we talked for a while", "it's been a long week", "I think I'm getting better",
+    "the meeting was rescheduled again", "I feel empty and hopeless", "thanks for listening",
+]
+
+
+def legacy_analyze(text, indicators=LEGACY_INDICATORS):
+    """ analyze_user_mood as it was: one substring scan per word list. """
+    text = text.lower()
+    scores = {mood: sum(1 for word in words if word in text) for mood, words in indicators.items()}
+    mood = max(scores, key=scores.get)
+    return mood if scores[mood] > 0 else "neutral"
+
+
+def corpus(count, seed):
+    rng = random.Random(seed)
+    return [". ".join(rng.sample(FRAGMENTS, rng.randint(1, 4))) for _ in range(count)]
+
+
+def padded(indicators, keywords):
+    """ Adds filler terms (never found in the corpus) until each mood has `keywords` words. """
+    return {
+        mood: words + [f"filler{mood}{i}" for i in range(max(0, keywords - len(words)))]
+        for mood, words in indicators.items()
+    }
+
+
+def per_message(fn, messages):
+    start = time.perf_counter()
+    results = [fn(text) for text in messages]
+    return results, 1e6 * (time.perf_counter() - start) / len(messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--keywords", type=int, default=0, help="pad every mood to this many keywords")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    messages = corpus(args.messages, args.seed)
+    indicators = padded(LEGACY_INDICATORS, args.keywords)
+    lexicon = MoodLexicon(indicators)
+
+    legacy, legacy_us = per_message(lambda text: legacy_analyze(text, indicators), messages)
+    single, single_us = per_message(lexicon.classify, messages)
+    start = time.perf_counter()
+    batch = lexicon.classify_batch(messages)
+    batch_us = 1e6 * (time.perf_counter() - start) / len(messages)
+    assert batch == single, "batch and per-message scoring disagree"
+
+    differences = []
+    for text, old, new in zip(messages, legacy, single):
+        if old != new and len(differences) < 5:
+            differences.append({"text": text, "legacy": old, "lexicon": new})
+    results = {
+        "messages": len(messages),
+        "keywords_per_mood": {mood: len(words) for mood, words in indicators.items()},
+        "us_per_message": {"legacy": round(legacy_us, 2), "lexicon": round(single_us, 2), "lexicon_batch": round(batch_us, 2)},
+        "agreement": round(sum(old == new for old, new in zip(legacy, single)) / len(messages), 3),
+        "differences": differences,
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        timings = results["us_per_message"]
+        print(f"legacy={timings['legacy']}us lexicon={timings['lexicon']}us batch={timings['lexicon_batch']}us "
+              f"per message; agreement {results['agreement']:.1%}")
+        for diff in results["differences"]:
+            print(f"  {diff['legacy']:>8} -> {diff['lexicon']:<8} {diff['text'][:70]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Prefill benchmark for the KV caches in kv_cache.py.
+
+Loads a tiny instruction-tuned model on CPU and measures time to the first
+generated token (prefill + one decode step) in two scenarios:
+
+  classification  the few-shot classification prompt, prefilled in full
+                  vs. continued from PrefixCache
+  conversation    turn N of a growing conversation, prefilled in full
+                  vs. continued from the session's SessionKVCache entry
+
+Run from the repository root:
+    python benchmarks/bench_prefix_cache.py --model HuggingFaceTB/SmolLM2-135M-Instruct
+"""
+import os
+import sys
+import time
+import json
+import copy
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+import kv_cache
+# The app's own system prompts; local_model.py has no Flask or Firestore side effects
+from local_model import CLASSIFICATION_PROMPT, CONVERSATION_PROMPT
+
+MESSAGES = [
+    "I feel a bit anxious about my exams tomorrow.",
+    "I haven't been sleeping well and I feel low.",
+    "My friend said something that really hurt me today.",
+    "I tried the breathing exercise and it helped a little.",
+]
+
+
+def load(model_id):
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32)
+    model.eval()
+    return model, tokenizer
+
+
+def encode(tokenizer, messages):
+    return tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors="pt")
+
+
+def first_token_ms(fn, repeats, setup=None):
+    """ Median wall time of fn() in milliseconds; setup() runs untimed before each repeat. """
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        timings.append(1000 * (time.perf_counter() - start))
+    return round(statistics.median(timings), 2)
+
+
+def bench_classification(model, tokenizer, prefix_cache, repeats):
+    args = {"max_new_tokens": 1, "do_sample": False, "pad_token_id": tokenizer.eos_token_id}
+    results = []
+    for text in MESSAGES:
+        input_ids = encode(tokenizer, [CLASSIFICATION_PROMPT, {"role": "user", "content": text}])
+        full = first_token_ms(lambda: kv_cache.generate_with_cache(model, input_ids, **args), repeats)
+        cached = first_token_ms(lambda: kv_cache.generate_with_cache(model, input_ids, prefix_cache, **args), repeats)
+        results.append({"prompt_tokens": input_ids.shape[-1], "full_ms": full, "cached_ms": cached})
+    return results
+
+
+def bench_conversation(model, tokenizer, turns, reply_tokens, repeats):
+    """ Grows one conversation turn by turn, timing each new turn's first token both ways. """
+    args = {"do_sample": False, "pad_token_id": tokenizer.eos_token_id}
+    session_cache = kv_cache.SessionKVCache(1024 * 1024 * 1024)
+    history = []
+    results = []
+    for turn in range(turns):
+        messages = [CONVERSATION_PROMPT] + history + [{"role": "user", "content": MESSAGES[turn % len(MESSAGES)]}]
+        input_ids = encode(tokenizer, messages)
+
+        full = first_token_ms(lambda: kv_cache.generate_with_cache(model, input_ids, max_new_tokens=1, **args), repeats)
+
+        # Every repeat starts from a fresh copy of the previous turn's cache
+        saved = session_cache.take("bench")
+        cached = None
+        if saved is not None:
+            cached = first_token_ms(
+                lambda: kv_cache.generate_with_cache(model, input_ids, None, session_cache, "bench", max_new_tokens=1, **args),
+                repeats,
+                setup=lambda: session_cache.put("bench", saved[0], copy.deepcopy(saved[1])),
+            )
+            session_cache.put("bench", *saved)
+
+        # Generate the real reply once, leaving its cache behind for the next turn
+        sequences = kv_cache.generate_with_cache(
+            model, input_ids, None, session_cache, "bench", max_new_tokens=reply_tokens, **args
+        )
+        reply = tokenizer.decode(sequences[0][input_ids.shape[-1]:], skip_special_tokens=True).strip()
+        history += [messages[-1], {"role": "assistant", "content": reply}]
+        results.append({"turn": turn + 1, "prompt_tokens": input_ids.shape[-1], "full_ms": full, "cached_ms": cached})
+    return results, session_cache.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="HuggingFaceTB/SmolLM2-135M-Instruct")
+    parser.add_argument("--turns", type=int, default=6, help="conversation turns to grow")
+    parser.add_argument("--reply-tokens", type=int, default=48)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model, tokenizer = load(args.model)
+    prefix_cache = kv_cache.PrefixCache(model, tokenizer)
+    prefix_cache.add("classification", CLASSIFICATION_PROMPT)
+
+    classification = bench_classification(model, tokenizer, prefix_cache, args.repeats)
+    conversation, session_stats = bench_conversation(model, tokenizer, args.turns, args.reply_tokens, args.repeats)
+
+    if args.json:
+        print(json.dumps({
+            "classification": classification,
+            "conversation": conversation,
+            "prefix_cache": prefix_cache.stats(),
+            "session_cache": session_stats,
+        }, indent=2))
+        return
+
+    print("classification (prefix cache)")
+    for row in classification:
+        print(f"  tokens={row['prompt_tokens']:>5} full={row['full_ms']:>8}ms cached={row['cached_ms']:>8}ms")
+    print("conversation (session cache)")
+    for row in conversation:
+        cached = f"{row['cached_ms']}ms" if row["cached_ms"] is not None else "-"
+        print(f"  turn={row['turn']:>2} tokens={row['prompt_tokens']:>5} "
+              f"full={row['full_ms']:>8}ms cached={cached:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Firestore reads per chat turn with and without the session cache.
+
+Replays interleaved conversations (each turn: ChatTurnRepository load +
+commit, as /chat does, optionally followed by a /history page read) against
+the in-memory Firestore fake, once with the session cache disabled and once
+enabled, and prints the RPCs per turn by kind and the cache hit ratio. Exits
+1 if the cache does not reduce reads, so it can also be used as a check.
+
+    python benchmarks/bench_session_cache.py --sessions 50 --turns 10
+    python benchmarks/bench_session_cache.py --history-every 1 --cache-mb 0.05   # tiny cache, evictions
+"""
+import os
+import sys
+import json
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ["FIRESTORE_BACKEND"] = "memory"
+
+import firestore_db
+import session_cache
+from fake_firestore import FakeClient
+
+READS = ("get", "query")
+
+
+def run(sessions, turns, history_every, cache):
+    db = FakeClient()
+    firestore_db.sessions = cache
+    for turn_index in range(turns):
+        # Round-robin over sessions, like many users chatting at once
+        for session in range(sessions):
+            session_id = f"bench-{session}"
+            turn = firestore_db.ChatTurnRepository(db, session_id)
+            turn.load()
+            turn.commit([
+                {"role": "user", "content": f"message {turn_index} from {session_id}"},
+                {"role": "assistant", "content": f"reply {turn_index} to {session_id}"},
+            ], "anxious" if turn_index % 3 == 0 else "neutral")
+            if history_every and turn_index % history_every == 0:
+                if firestore_db.get_cached_history_page(session_id, 20) is None:
+                    user_ref = firestore_db.get_or_create_user(db, session_id)
+                    firestore_db.get_chat_history_page(user_ref, 20)
+
+    total_turns = sessions * turns
+    counts = dict(db.rpc_counts)
+    return {
+        "cache": cache is not None,
+        "turns": total_turns,
+        "rpcs_per_turn": {kind: round(count / total_turns, 3) for kind, count in sorted(counts.items())},
+        "reads_per_turn": round(sum(counts.get(kind, 0) for kind in READS) / total_turns, 3),
+        "session_cache": cache.stats() if cache else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=10, help="turns per session")
+    parser.add_argument("--history-every", type=int, default=0, help="also read a /history page every N turns")
+    parser.add_argument("--cache-mb", type=float, default=session_cache.SESSION_CACHE_MB)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    results = [
+        run(args.sessions, args.turns, args.history_every, None),
+        run(args.sessions, args.turns, args.history_every, session_cache.SessionCache(max_mb=args.cache_mb)),
+    ]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print(f"cache={'on ' if result['cache'] else 'off'} reads/turn={result['reads_per_turn']} "
+                  f"rpcs/turn={result['rpcs_per_turn']}"
+                  + (f" hit_ratio={result['session_cache']['hit_ratio']} "
+                     f"evictions={result['session_cache']['evictions']}" if result["cache"] else ""))
+    if results[1]["reads_per_turn"] >= results[0]["reads_per_turn"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
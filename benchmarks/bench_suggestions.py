@@ -0,0 +1,147 @@
+"""
+Per-request formatting cost in app.py: the suggestion engine (suggestions.py)
+against rebuilding the suggestion and opening lists on every call.
+
+Runs --requests format_response calls, spread over --sessions sessions and
+the five moods, three ways:
+  - legacy: the old code, which built the nested suggestion dict and the
+    openings list on each call and used random.choice;
+  - engine without a session: weighted picks from the preloaded pools;
+  - engine per session: the same picks, minus the texts that session was
+    just shown.
+For each, prints microseconds per request and how often a session got the
+same opening or suggestion twice in a row. Also times one hot reload of the
+data file.
+
+    python benchmarks/bench_suggestions.py --requests 100000 --sessions 1000
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from suggestions import SuggestionEngine, SUGGESTIONS_PATH, OPENING
+
+MOODS = ['stressed', 'sad', 'angry', 'neutral', 'calm']
+SUGGESTION_MOODS = frozenset(['stressed', 'sad', 'angry'])
+
+
+def build_legacy(data):
+    """
+    The old methods, with the lists written out as literals so each call
+    rebuilds them as the original code did.
+    """
+    source = (
+        "def get_coping_suggestions(mood):\n"
+        f"    suggestions = {data['suggestions']!r}\n"
+        "    return suggestions.get(mood, suggestions['neutral'])\n"
+        "def choose_opening():\n"
+        f"    calm_openings = {data['openings']!r}\n"
+        "    return random.choice(calm_openings)\n"
+        "def format_response(ai_response, mood, user_input, opening=None):\n"
+        "    formatted_response = f'{opening or choose_opening()} {ai_response}'\n"
+        "    coping_suggestion = ''\n"
+        "    if mood in ['stressed', 'sad', 'angry']:\n"
+        "        coping_suggestion = random.choice(get_coping_suggestions(mood))\n"
+        "    return {'response': formatted_response, 'suggestion': coping_suggestion, 'mood': mood,\n"
+        "            'timestamp': time.strftime('%H:%M:%S')}\n"
+    )
+    namespace = {"random": random, "time": time}
+    exec(source, namespace)
+    return namespace["format_response"]
+
+
+def engine_formatter(engine):
+    """ MentalHealthChatbot.format_response on a given engine. """
+    def format_response(ai_response, mood, user_input, opening=None, session_id=None):
+        opening = opening or engine.pick(OPENING, session_id)
+        suggestion = engine.pick(mood, session_id) if mood in SUGGESTION_MOODS else ""
+        return {'response': f"{opening} {ai_response}", 'suggestion': suggestion, 'mood': mood,
+                'timestamp': time.strftime('%H:%M:%S')}
+    return format_response
+
+
+def workload(count, sessions, seed):
+    rng = random.Random(seed)
+    return [(f"session-{rng.randrange(sessions)}", rng.choice(MOODS)) for _ in range(count)]
+
+
+def run(format_response, requests, pass_session):
+    start = time.perf_counter()
+    if pass_session:
+        results = [format_response("reply", mood, "message", session_id=session_id) for session_id, mood in requests]
+    else:
+        results = [format_response("reply", mood, "message") for _, mood in requests]
+    elapsed = time.perf_counter() - start
+
+    # Same opening as the session's previous reply, or same suggestion as its previous one for that mood
+    last_opening, last_suggestion = {}, {}
+    repeats = comparisons = 0
+    for (session_id, mood), result in zip(requests, results):
+        opening = result['response']
+        if session_id in last_opening:
+            comparisons += 1
+            repeats += opening == last_opening[session_id]
+        last_opening[session_id] = opening
+        if result['suggestion']:
+            key = (session_id, mood)
+            if key in last_suggestion:
+                comparisons += 1
+                repeats += result['suggestion'] == last_suggestion[key]
+            last_suggestion[key] = result['suggestion']
+    return {
+        "us_per_request": round(1e6 * elapsed / len(requests), 2),
+        "repeat_rate": round(repeats / max(1, comparisons), 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50000)
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=5)
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    with open(SUGGESTIONS_PATH, encoding="utf-8") as f:
+        data = json.load(f)
+    requests = workload(args.requests, args.sessions, args.seed)
+    engine = SuggestionEngine(reload_seconds=0, rng=random.Random(args.seed))
+
+    results = {
+        "legacy": run(build_legacy(data), requests, pass_session=False),
+        "engine": run(engine_formatter(engine), requests, pass_session=False),
+        "engine_per_session": run(engine_formatter(engine), requests, pass_session=True),
+    }
+
+    # One hot reload: touch a copy of the data file and let the next pick find it
+    workdir = tempfile.mkdtemp(prefix="serenity-suggestions-")
+    try:
+        path = os.path.join(workdir, "suggestions.json")
+        shutil.copy(SUGGESTIONS_PATH, path)
+        reloading = SuggestionEngine(path, reload_seconds=1e-9)
+        os.utime(path, ns=(time.time_ns(), time.time_ns() + 1000))
+        start = time.perf_counter()
+        assert reloading.maybe_reload()
+        results["reload_ms"] = round(1000 * (time.perf_counter() - start), 3)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name in ("legacy", "engine", "engine_per_session"):
+        row = results[name]
+        print(f"{name:<20} {row['us_per_request']:>7}us per request  repeats {row['repeat_rate']:.1%}")
+    print(f"reload of the data file: {results['reload_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
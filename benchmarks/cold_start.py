@@ -0,0 +1,81 @@
+"""
+Cold-start timing for bot.py.
+
+Each run starts a fresh Python process that imports bot and waits for the
+model manager to report ready, then prints how long the import took, how long
+until the model was usable, and the manager's per-step timings. The first run
+fills MODEL_CACHE_DIR (download, quantized checkpoint, inductor cache); later
+runs show the warm-cache restart an autoscaled replica would see.
+
+    python benchmarks/cold_start.py --runs 3                       # configured model
+    python benchmarks/cold_start.py --runs 3 --preset tiny         # small CPU model
+    python benchmarks/cold_start.py --fresh-cache --preset tiny    # start from an empty cache
+"""
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs inside the child process; the last stdout line is the JSON result
+PROBE = """
+import json, time
+started = time.perf_counter()
+import bot
+imported = time.perf_counter() - started
+bot.models.ensure_loaded(timeout=None)
+print(json.dumps({
+    "import_s": round(imported, 3),
+    "ready_s": round(time.perf_counter() - started, 3),
+    "model": bot.models.stats(),
+}))
+"""
+
+
+def run_once(env):
+    result = subprocess.run([sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "probe failed")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--preset", help="MODEL_PRESET for the child processes (default: inherit)")
+    parser.add_argument("--warmup", default="background", choices=["background", "lazy", "eager"],
+                        help="MODEL_WARMUP for the child processes")
+    parser.add_argument("--fresh-cache", action="store_true", help="use an empty temporary MODEL_CACHE_DIR")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    env = dict(os.environ, FIRESTORE_BACKEND="memory", MODEL_WARMUP=args.warmup)
+    if args.preset:
+        env["MODEL_PRESET"] = args.preset
+    cache_dir = tempfile.mkdtemp(prefix="serenity-model-cache-") if args.fresh_cache else None
+    if cache_dir:
+        env["MODEL_CACHE_DIR"] = cache_dir
+
+    results = []
+    try:
+        for run in range(args.runs):
+            result = run_once(env)
+            results.append(result)
+            if not args.json:
+                model = result["model"]
+                print(f"run {run + 1}: import={result['import_s']}s ready={result['ready_s']}s "
+                      f"state={model['state']} disk_cache={model['from_disk_cache']} timings={model['timings']}")
+    finally:
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Offline evaluation of the tiered mood classifier (mood_classifier.py).
+
+Reads a labeled CSV (`text,label` columns, labels from mood_classifier.TAGS)
+and reports, per tier: coverage (share of messages the tier answered with
+confidence at or above the threshold), accuracy on those messages, and p50/p99
+latency. The full cascade is reported the same way, plus serious_distress
+recall, which must stay at 1.0 for every tier that claims it.
+
+The LLM tier is opt-in because it calls the Hugging Face API:
+    python benchmarks/eval_classifier.py labeled.csv
+    python benchmarks/eval_classifier.py labeled.csv --llm --model-path data/mood_tfidf.pkl
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mood_classifier
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * q))], 3)
+
+
+def evaluate(name, rows, predict, decided):
+    """
+    `predict(text)` returns a Prediction or None; the tier "answers" when
+    `decided(prediction)` is true (TieredClassifier.decides for a local tier).
+    """
+    latencies, answered, correct = [], 0, 0
+    distress_total = distress_found = 0
+    for text, label in rows:
+        start = time.perf_counter()
+        result = predict(text)
+        latencies.append(1000 * (time.perf_counter() - start))
+
+        tag = None
+        if result is not None and decided(result):
+            tag = result.tag
+            answered += 1
+            correct += tag == label
+        if label == mood_classifier.DISTRESS:
+            distress_total += 1
+            distress_found += tag == mood_classifier.DISTRESS
+
+    return {
+        "tier": name,
+        "examples": len(rows),
+        "coverage": round(answered / len(rows), 3) if rows else 0.0,
+        "accuracy": round(correct / answered, 3) if answered else None,
+        "distress_recall": round(distress_found / distress_total, 3) if distress_total else None,
+        "p50_ms": percentile(latencies, 0.50),
+        "p99_ms": percentile(latencies, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("csv", help="labeled CSV with text,label columns")
+    parser.add_argument("--model-path", default=mood_classifier.MOOD_MODEL_PATH, help="trained linear tier")
+    parser.add_argument("--threshold", type=float, default=mood_classifier.MOOD_CONFIDENCE_THRESHOLD)
+    parser.add_argument("--llm", action="store_true", help="also evaluate the Hugging Face API tier")
+    parser.add_argument("--json", action="store_true", help="print results as JSON")
+    args = parser.parse_args()
+
+    rows = mood_classifier.read_labeled_csv(args.csv)
+    keyword = mood_classifier.KeywordTier()
+    linear = mood_classifier.LinearTier.load(args.model_path)
+
+    llm_fn = None
+    if args.llm:
+        from llm_service import llm_classify_intent
+        llm_fn = llm_classify_intent
+
+    cascade = mood_classifier.TieredClassifier([keyword, linear], llm_fn, threshold=args.threshold)
+
+    def tier_decided(tier):
+        # The cascade's own rule, so coverage matches what it settles locally
+        return lambda prediction: cascade.decides(tier, prediction)
+
+    results = [evaluate("keyword", rows, keyword.predict, tier_decided(keyword))]
+    if linear is not None:
+        results.append(evaluate("linear", rows, linear.predict, tier_decided(linear)))
+    else:
+        print(f"--- No linear model at {args.model_path} (or scikit-learn missing); skipping that tier. ---")
+    if llm_fn is not None:
+        results.append(evaluate(
+            "llm", rows, lambda text: mood_classifier.Prediction(llm_fn(text, []), 1.0, "llm"), lambda _: True))
+
+    # The cascade always answers, so every message counts towards its accuracy
+    results.append(evaluate(
+        "cascade", rows, lambda text: mood_classifier.Prediction(cascade.classify(text), 1.0, "cascade"),
+        lambda _: True))
+    results[-1]["decisions"] = cascade.stats()["decisions"]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for r in results:
+        print(f"{r['tier']:>8} coverage={r['coverage']:<6} accuracy={r['accuracy']} "
+              f"distress_recall={r['distress_recall']} p50={r['p50_ms']}ms p99={r['p99_ms']}ms")
+    print(f"cascade decisions by tier: {results[-1]['decisions']}")
+
+
+if __name__ == "__main__":
+    main()
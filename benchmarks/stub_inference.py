@@ -0,0 +1,154 @@
+"""
+Stub inference servers for benchmarks.
+
+HTTP (the Hugging Face API backends): every POST gets an answer after a fixed
+simulated latency (time to first token), then `--token-ms` per generated word.
+Greedy requests (do_sample false, i.e. classification) get a mood tag, sampled
+ones a short reply, and DialoGPT-style payloads (app.py, `inputs` object) a
+[{"generated_text": ...}] list. Streaming requests get the reply as SSE
+`data:` chunks. Point the app at it with HF_API_URL=http://127.0.0.1:<port>/.
+
+Model server (bot.py): with --model-socket the same latency model is served
+over model_server.py's Unix socket protocol instead, so bot.py runs with
+MODEL_SERVER_SOCKET=<path> and no local model.
+
+    python benchmarks/stub_inference.py --port 8081 --latency-ms 200 --token-ms 5
+    python benchmarks/stub_inference.py --model-socket /tmp/stub-model.sock --latency-ms 200
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+REPLY = "That sounds like a lot to carry. I'm here with you, would you like to tell me more about it?"
+
+
+def completion(content):
+    return {"choices": [{"message": {"role": "assistant", "content": content}}]}
+
+
+def create_app(latency_ms=200.0, tag="[mood: anxious]", reply=REPLY, token_ms=5.0):
+    """ Starlette app answering any POST path after `latency_ms`. """
+    state = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+    async def complete(request):
+        body = await request.json()
+        state["requests"] += 1
+        state["in_flight"] += 1
+        state["max_in_flight"] = max(state["max_in_flight"], state["in_flight"])
+        try:
+            await asyncio.sleep(latency_ms / 1000.0)
+            if isinstance(body.get("inputs"), dict):
+                # DialoGPT conversational payload (app.py)
+                await asyncio.sleep(token_ms * len(reply.split(" ")) / 1000.0)
+                return JSONResponse([{"generated_text": reply}])
+            greedy = not body.get("parameters", {}).get("do_sample", True)
+            content = tag if greedy else reply
+            if not body.get("stream"):
+                await asyncio.sleep(token_ms * len(content.split(" ")) / 1000.0)
+                return JSONResponse(completion(content))
+        finally:
+            state["in_flight"] -= 1
+
+        async def chunks():
+            for word in content.split(" "):
+                chunk = {"choices": [{"delta": {"content": word + " "}}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                await asyncio.sleep(token_ms / 1000.0)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(chunks(), media_type="text/event-stream")
+
+    async def stats(request):
+        return JSONResponse(state)
+
+    return Starlette(routes=[
+        Route("/stats", stats, methods=["GET"]),
+        Route("/{path:path}", complete, methods=["POST"]),
+    ])
+
+
+class _StubModels:
+    """ Stands in for local_model.models: always loaded. """
+
+    state = "ready"
+    ready = True
+
+    def ensure_loaded(self, timeout=None):
+        return True
+
+    def stats(self):
+        return {"model_id": "stub", "state": self.state}
+
+
+class StubModelBackend:
+    """
+    Stands in for local_model.py behind model_server.ModelServer: every prompt takes
+    `latency_ms`, then `token_ms` per word. There is no batch scheduler, so each
+    prompt runs on its own server thread (up to the server's max_in_flight).
+    """
+
+    def __init__(self, latency_ms=200.0, tag="[mood: anxious]", reply=REPLY, token_ms=5.0):
+        self.models = _StubModels()
+        self.scheduler = None
+        self.latency_ms = latency_ms
+        self.tag = tag
+        self.reply = reply
+        self.token_ms = token_ms
+
+    def complete(self, kind, messages, session_id=None):
+        content = self.tag if kind == "classify" else self.reply
+        time.sleep((self.latency_ms + self.token_ms * len(content.split(" "))) / 1000.0)
+        return content
+
+    def complete_stream(self, messages, session_id=None, cancelled=None):
+        time.sleep(self.latency_ms / 1000.0)
+        for word in self.reply.split(" "):
+            if cancelled is not None and cancelled.is_set():
+                return
+            yield word + " "
+            time.sleep(self.token_ms / 1000.0)
+
+
+def serve_model_socket(path, latency_ms, tag, token_ms, max_in_flight):
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import model_server
+
+    server = model_server.ModelServer(
+        path, StubModelBackend(latency_ms, tag, token_ms=token_ms), max_in_flight=max_in_flight,
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--token-ms", type=float, default=5.0, help="time per generated word")
+    parser.add_argument("--tag", default="[mood: anxious]")
+    parser.add_argument("--model-socket", help="serve the model server protocol on this Unix socket instead of HTTP")
+    parser.add_argument("--max-in-flight", type=int, default=64, help="concurrent prompts (--model-socket only)")
+    args = parser.parse_args()
+
+    if args.model_socket:
+        serve_model_socket(args.model_socket, args.latency_ms, args.tag, args.token_ms, args.max_in_flight)
+        return
+
+    import uvicorn
+    app = create_app(args.latency_ms, args.tag, token_ms=args.token_ms)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,132 +1,327 @@
 import re
 import os
-import torch
-from flask import Flask, request, jsonify
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from transformers import AutoTokenizer, AutoModelForCausalLM, BitsAndBytesConfig
 import firestore_db # Assuming firestore_db.py is in the same directory
+import admission
+import context_builder
+import crisis_screen
+import local_model
+import metrics
+import model_server
+import mood_classifier
+import response_cache
+import write_behind
 
 # --- 1. Load the Local AI Model and Tokenizer ---
-MODEL_ID = "microsoft/Phi-3-mini-4k-instruct"
-
-# Using environment variables or a check for system memory might be better, but sticking to 
-# previous configuration for consistency.
-print("--- Creating 4-bit Quantization Config ---")
-quantization_config = BitsAndBytesConfig(
-    load_in_4bit=True,
-    bnb_4bit_quant_type="nf4",
-    bnb_4bit_compute_dtype=torch.float16
+# The model, its system prompts and the state built on it live in local_model.py,
+# which has no Flask or Firestore side effects (model_server.py imports it alone).
+from local_model import (
+    MODEL_ID, CLASSIFY_TIMEOUT, GENERATE_TIMEOUT,
+    CLASSIFICATION_PROMPT, CONVERSATION_PROMPT, SUMMARY_PROMPT, StreamInterrupted,
 )
 
-print("--- Loading Local Model and Tokenizer... ---")
-# Adjust device mapping if needed based on your machine
-model_load_args = {
-    "quantization_config": quantization_config,
-    "device_map": "auto",
-}
+# Concurrent orchestration: classification and conversation prompts share one
+# batched generate call. Each stage is capped at its own wall-clock budget
+# (CLASSIFY_TIMEOUT_SECONDS, GENERATE_TIMEOUT_SECONDS) and an unparsable
+# (e.g. cut-off) classification falls back to FALLBACK_MOOD.
+CONCURRENT_ORCHESTRATION = os.getenv("CONCURRENT_ORCHESTRATION", "1") == "1"
+FALLBACK_MOOD = os.getenv("FALLBACK_MOOD", "neutral")
 
-try:
-    tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
-    model = AutoModelForCausalLM.from_pretrained(MODEL_ID, **model_load_args)
+# Canned replies for when the model can't answer. They are sent to the user but
+# never saved, so they don't turn up in later prompts or summaries.
+OFFLINE_REPLY = "Sorry, the AI model is currently offline. Please try again later."
+TIMEOUT_REPLY = "Sorry, I'm taking longer than usual to respond. Please try again in a moment."
+FALLBACK_REPLIES = frozenset({OFFLINE_REPLY, TIMEOUT_REPLY})
+
+# Shared model process: with MODEL_SERVER_SOCKET set, this process never loads the
+# model and sends every prompt to model_server.py instead, so N web workers (e.g.
+# gunicorn -w N bot:app) share one copy of the weights and one batch scheduler.
+MODEL_SERVER_SOCKET = model_server.MODEL_SERVER_SOCKET
+
+# Loading happens off the import path: on a background thread right away
+# (MODEL_WARMUP=background, the default), on the first request (lazy) or before
+# the import returns (eager).
+remote = model_server.ModelServerClient(MODEL_SERVER_SOCKET) if MODEL_SERVER_SOCKET else None
+models = remote or local_model.models
+
+# Token-budgeted prompt construction; counts with the model's own tokenizer once it is loaded
+context = context_builder.ContextBuilder(context_builder.approximate_token_count)
+
+
+# --- 2. Core AI Inference Logic (Refactored to accept history) ---
+
+def model_ready():
+    """ Loads the model on first use (or waits for the warmup thread or model server); False in degraded mode. """
+    return models.ensure_loaded() and (remote is not None or local_model.model is not None)
+
+
+def is_fallback_reply(reply):
+    """ True for a canned reply sent instead of a model answer; the turn isn't persisted. """
+    return reply in FALLBACK_REPLIES
+
+
+def parse_tag(raw_response, default=FALLBACK_MOOD):
+    """ Extracts the mood/intent tag from a classification completion. """
+    match = re.search(r'\[(mood|intent):\s*([^\]]+)\]', raw_response)
+    return match.group(2).strip() if match else default
+
+
+def build_classification_messages(user_input, history):
+    """ Classification prompt: system prompt, last 4 messages of context, current message. """
+    return [CLASSIFICATION_PROMPT] + history[-4:] + [{"role": "user", "content": user_input}]
+
+
+def build_conversation_messages(user_input, history, summary=None, usage=None):
+    """
+    Conversation prompt: system prompt (plus any rolling summary), as much recent
+    history as fits CONTEXT_TOKEN_BUDGET, current message. Token accounting is
+    written into `usage` when given.
+    """
+    prompt = context.build(CONVERSATION_PROMPT, history, user_input, summary)
+    if usage is not None:
+        usage.update(prompt.usage())
+    return prompt.messages
+
+
+def complete(kind, messages, session_id=None):
+    """
+    Runs one "classify", "conversation" or "summary" prompt and returns the
+    decoded completion (local_model.complete), on the model server when one is configured.
+    """
+    if remote:
+        return remote.complete(kind, messages, session_id, timeout=CLASSIFY_TIMEOUT if kind == "classify" else GENERATE_TIMEOUT)
+    return local_model.complete(kind, messages, session_id)
+
+
+def complete_stream(messages, session_id=None, cancelled=None):
+    """
+    Streaming "conversation" completion (local_model.complete_stream), or the
+    model server's stream. Setting `cancelled` (a threading.Event) stops generation early.
+    """
+    if not remote:
+        yield from local_model.complete_stream(messages, session_id, cancelled)
+        return
+    fragments = remote.stream(messages, session_id, timeout=GENERATE_TIMEOUT)
     try:
-        model = torch.compile(model)
-        print("--- Model compiled with torch.compile for extra speed ---")
-    except Exception:
-        print("--- torch.compile not available or failed. ---")
-    print("--- Model and Tokenizer Loaded Successfully ---")
-
-except Exception as e:
-    print(f"--- Failed to load model: {e}. Running in degraded mode or exiting. ---")
-    # Set to None if loading fails
-    model = None
-    tokenizer = None
-
-
-# --- 2. Define System Prompts ---
-CLASSIFICATION_PROMPT = {
-    "role": "system",
-    "content": (
-        "You are a classification expert. Analyze the user's message and respond with ONLY ONE of the following tags that best fits the user's current emotion. Do not add any other text. "
-        "The available tags are: [mood: happy], [mood: neutral], [mood: sad], [mood: anxious], [intent: seeking_community], [intent: serious_distress]."
-        "\n\nHere are some examples:\n"
-        "User: I'm so happy today, everything is going great!\nAssistant: [mood: happy]\n"
-        "User: what's up\nAssistant: [mood: neutral]\n"
-        "Your response must strictly contain ONLY the tag, e.g., [mood: happy]."
-    )
-}
-
-# 🛠️ CHANGE APPLIED HERE: Explicitly reinforcing 'Serenity' and forbidding 'Aura'.
-CONVERSATION_PROMPT = {
-    "role": "system",
-    "content": "You are Serenity, a compassionate and supportive mental health chatbot. Never refer to yourself as Aura or any other name. You are NOT a therapist. DO NOT provide medical advice. Keep your responses concise, warm, and non-judgemental. Use less than 50 words."
-}
-
-
-# --- 3. Core AI Inference Logic (Refactored to accept history) ---
+        for text in fragments:
+            if text:
+                yield text
+    finally:
+        fragments.close()  # Cancels the prompt on the model server if we stopped early
 
-def classify_intent(user_input, history):
+
+def llm_classify_intent(user_input, history):
     """
-    First call to the AI: Classify the user's most recent message using limited history for context.
+    LLM tier of the mood classifier: classify the user's most recent message using
+    limited history for context. Returns None when the completion has no tag.
     """
-    if not model or not tokenizer:
+    if not model_ready():
         print("Model not loaded, skipping classification.")
-        return "neutral"
+        return None
         
     # Use the last 4 messages (2 user, 2 assistant) for context, plus the current prompt
-    recent_history = history[-4:]
-    messages = [CLASSIFICATION_PROMPT] + recent_history + [{"role": "user", "content": user_input}]
-    
-    input_ids = tokenizer.apply_chat_template(
-        messages, add_generation_prompt=True, return_tensors="pt"
-    ).to(model.device)
-    
-    with torch.inference_mode():
-        outputs = model.generate(
-            input_ids, max_new_tokens=15, eos_token_id=tokenizer.eos_token_id, 
-            do_sample=False, temperature=0.0 # Force deterministic output
-        )
-    
-    response_ids = outputs[0][input_ids.shape[-1]:]
-    raw_response = tokenizer.decode(response_ids, skip_special_tokens=True).strip()
-    
-    match = re.search(r'\[(mood|intent):\s*([^\]]+)\]', raw_response)
-    tag = match.group(2).strip() if match else "neutral"
-    
+    messages = build_classification_messages(user_input, history)
+    return parse_tag(complete("classify", messages), default=None)
+
+
+# Keyword and linear tiers answer most messages on the CPU; the model is only asked when they
+# are unsure, and its answers are cached for repeated messages
+classification_cache = response_cache.build_cache(namespace=f"{MODEL_ID}:")
+classifier = mood_classifier.build_classifier(llm_classify_intent, fallback=FALLBACK_MOOD, cache=classification_cache)
+
+
+def classify_intent(user_input, history):
+    """
+    First call to the AI: Classify the user's most recent message through the tiered mood classifier.
+    """
+    tag = classifier.classify(user_input, history)
     print(f"--- Classified Intent: {tag} ---")
     return tag
 
 
-def generate_conversational_response(user_input, history):
+def generate_conversational_response(user_input, history, summary=None, usage=None, session_id=None):
     """
-    Second call to the AI: Generate a conversational reply based on full history.
+    Second call to the AI: Generate a conversational reply based on recent history.
     """
-    if not model or not tokenizer:
-        return "Sorry, the AI model is currently offline. Please try again later."
-        
-    messages = [CONVERSATION_PROMPT] + history + [{"role": "user", "content": user_input}]
-    
-    input_ids = tokenizer.apply_chat_template(
-        messages, add_generation_prompt=True, return_tensors="pt"
-    ).to(model.device)
-    
-    with torch.inference_mode():
-        outputs = model.generate(
-            input_ids,
-            max_new_tokens=128,
-            temperature=0.7,
-            do_sample=True,
-            eos_token_id=tokenizer.eos_token_id,
-        )
+    if not model_ready():
+        return OFFLINE_REPLY
         
-    response_ids = outputs[0][input_ids.shape[-1]:]
-    clean_message = tokenizer.decode(response_ids, skip_special_tokens=True).strip()
-    return clean_message
+    messages = build_conversation_messages(user_input, history, summary, usage)
+    return complete("conversation", messages, session_id)
+
+
+def stream_conversational_response(user_input, history, summary=None, usage=None, session_id=None):
+    """
+    Streaming variant of generate_conversational_response: model.generate runs on
+    a background thread and decoded text is yielded through a TextIteratorStreamer.
+    """
+    if not model_ready():
+        yield OFFLINE_REPLY
+        return
+
+    messages = build_conversation_messages(user_input, history, summary, usage)
+
+    cancelled = threading.Event()
+    try:
+        yield from complete_stream(messages, session_id, cancelled)
+    finally:
+        # Also reached when the HTTP client disconnects and Flask closes the generator
+        cancelled.set()
+
 
+# Classification runs alongside a streamed reply (the streamer needs batch size 1):
+# one thread for every chat the admission controller lets in at once, so it
+# doesn't sit in the queue until CLASSIFY_TIMEOUT has passed
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ORCHESTRATION_WORKERS", str(admission.ADMISSION_MAX_IN_FLIGHT))),
+    thread_name_prefix="serenity-classify"
+)
+
+
+def stream_response(user_input, history, summary=None, usage=None, session_id=None):
+    """
+    Streaming variant of get_response. Yields {"token": text} events while the
+    reply is generated, then a final {"done": True, "mood": ..., "response": ...}
+    once history has been updated. Raises StreamInterrupted (history untouched)
+    if the reply stalls, fails or comes back empty.
+    """
+    crisis = crisis_screen.intercept(user_input, history, session_id, "bot")
+    if crisis:
+        mood, clean_message, _ = crisis
+        yield {"token": clean_message}
+        yield {"done": True, "mood": mood, "response": clean_message}
+        return
+
+    mood_future = _executor.submit(metrics.propagate(classify_intent), user_input, list(history))
 
-def get_response(user_input, history):
-    """ Orchestrates the two-step process: classify then respond. """
-    mood = classify_intent(user_input, history)
-    clean_message = generate_conversational_response(user_input, history)
+    started = time.perf_counter()
+    fragments = []
+    for text in stream_conversational_response(user_input, history, summary, usage, session_id):
+        if not fragments:
+            metrics.observe_stage("first_token", time.perf_counter() - started)
+        fragments.append(text)
+        yield {"token": text}
+    metrics.observe_stage("generate", time.perf_counter() - started)
+    clean_message = "".join(fragments).strip()
+    if not clean_message:
+        raise StreamInterrupted("empty reply")
+
+    try:
+        mood = mood_future.result(timeout=CLASSIFY_TIMEOUT)
+    except Exception as e:
+        print(f"--- Classification did not complete ({type(e).__name__}); using fallback. ---")
+        mood = FALLBACK_MOOD
+
+    history.append({"role": "user", "content": user_input})
+    history.append({"role": "assistant", "content": clean_message})
+
+    yield {"done": True, "mood": mood, "response": clean_message}
+
+
+def summarize_history(previous_summary, messages):
+    """
+    Folds `messages` (and any previous summary) into a short rolling summary.
+    None while the model is offline, so nothing is saved as covering them.
+    """
+    if not model_ready():
+        return None
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Previous summary: {previous_summary}\n\n{transcript}"
+
+    return complete("summary", [SUMMARY_PROMPT, {"role": "user", "content": transcript}])
+
+
+def format_sse(event, data):
+    """ Serialises one Server-Sent Event frame with a JSON payload. """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def get_response(user_input, history, concurrent=None, summary=None, usage=None, session_id=None):
+    """
+    Orchestrates the two-step process: classify and respond.
+    With concurrent orchestration (the default) both prompts are padded into one
+    batched generate call, so the turn pays for a single pass over the model.
+    When the batch scheduler is running, the two prompts are queued instead and
+    share a batch with whatever other requests arrive in the same window.
+    The sequential path generates one prompt at a time and reuses the KV caches.
+    """
+    if concurrent is None:
+        concurrent = CONCURRENT_ORCHESTRATION
+    # The model server batches prompts from every worker
+    scheduler = remote or local_model.scheduler
+
+    # High-risk messages get the vetted safety response without touching the model
+    crisis = crisis_screen.intercept(user_input, history, session_id, "bot")
+    if crisis:
+        return crisis
+    ready = model_ready()
+
+    # Confident local predictions skip the classification prompt altogether
+    with metrics.span("classify_local"):
+        decision, best_guess = classifier.classify_local(user_input, history) if concurrent else (None, None)
+
+    if concurrent and scheduler:
+        mood_future = None
+        try:
+            if decision is None:
+                mood_future = metrics.time_future("classify", scheduler.submit(build_classification_messages(user_input, history), True))
+                started = time.perf_counter()
+            reply_future = metrics.time_future("generate", scheduler.submit(build_conversation_messages(user_input, history, summary, usage), False))
+        except model_server.ModelServerError:
+            # The model server went away: the endpoint answers 503 rather than a fallback reply
+            if mood_future:
+                mood_future.cancel()
+            raise
+        try:
+            clean_message = reply_future.result(timeout=GENERATE_TIMEOUT)
+        except model_server.ModelServerBusy:
+            if mood_future:
+                mood_future.cancel()
+            raise
+        except Exception as e:
+            print(f"--- Generation did not complete ({type(e).__name__}); using fallback. ---")
+            reply_future.cancel()
+            clean_message = TIMEOUT_REPLY
+        if decision is not None:
+            mood = decision.tag
+        else:
+            try:
+                raw_tag = parse_tag(mood_future.result(timeout=CLASSIFY_TIMEOUT), default=None)
+            except Exception as e:
+                print(f"--- Classification did not complete ({type(e).__name__}); using fallback. ---")
+                mood_future.cancel()
+                raw_tag = None
+            mood = classifier.resolve(user_input, history, raw_tag, best_guess, started)
+        print(f"--- Classified Intent: {mood} ---")
+    elif concurrent and ready:
+        # One generate call serves both stages, so it runs under the longer budget;
+        # a classification row cut short falls back to the best local guess.
+        conversation = (build_conversation_messages(user_input, history, summary, usage), False)
+        max_time = max(CLASSIFY_TIMEOUT, GENERATE_TIMEOUT)
+        if decision is not None:
+            with metrics.span("generate"):
+                clean_message, = local_model.generate_batch([conversation], max_time=max_time)
+            mood = decision.tag
+        else:
+            started = time.perf_counter()
+            with metrics.span("generate"):
+                raw_tag, clean_message = local_model.generate_batch([
+                    (build_classification_messages(user_input, history), True),
+                    conversation,
+                ], max_time=max_time)
+            mood = classifier.resolve(user_input, history, parse_tag(raw_tag, default=None), best_guess, started)
+        print(f"--- Classified Intent: {mood} ---")
+    else:
+        with metrics.span("classify"):
+            mood = classify_intent(user_input, history)
+        with metrics.span("generate"):
+            clean_message = generate_conversational_response(user_input, history, summary, usage, session_id)
 
     # Update history for saving
     history.append({"role": "user", "content": user_input})
@@ -135,64 +330,261 @@ def get_response(user_input, history):
     return mood, clean_message, history
 
 
-# --- 4. Flask Application Setup and Routing ---
+@models.on_load
+def _count_with_tokenizer(loaded_model, loaded_tokenizer):
+    """ Prompt budgets are counted with the model's own tokenizer once it has loaded. """
+    context.set_counter(context_builder.tokenizer_counter(loaded_tokenizer))
+
+
+if not remote:
+    local_model.warm_up()
+
+
+# --- 3. Flask Application Setup and Routing ---
 app = Flask(__name__)
 CORS(app) # Enable CORS for frontend communication
+metrics.init_flask(app) # Request IDs, Server-Timing and GET /metrics
+admission.init_flask(app) # Per-session and per-IP rate limits and the in-flight cap on /chat
 DB = firestore_db.init_db() # Initialize Firestore
+# Turns are saved to Firestore in the background once the reply is ready (write_behind.py)
+persistence = write_behind.get_queue(DB)
+
+def model_loading_response():
+    """ 503 for requests that waited MODEL_LOAD_WAIT_SECONDS without the model finishing its load. """
+    return jsonify({"error": "The model is still loading. Please try again shortly."}), 503, {"Retry-After": "10"}
+
+def model_busy_response():
+    """ 503 when the model server refused the prompt because this worker already has too many queued. """
+    return jsonify({"error": "The chatbot is very busy right now. Please try again shortly."}), 503, {"Retry-After": "5"}
+
+def model_unavailable_response():
+    """ 503 when the model server can't be reached (e.g. it is restarting). """
+    return jsonify({"error": "The AI model is currently offline. Please try again shortly."}), 503, {"Retry-After": "10"}
+
+@app.route('/health', methods=['GET'])
+def health_endpoint():
+    """ Liveness: the process is up and serving, whether or not the model has loaded. """
+    return jsonify({'status': 'healthy', 'message': 'Mental Health Chatbot is running'})
+
+@app.route('/ready', methods=['GET'])
+def ready_endpoint():
+    """
+    Readiness: 200 once the model is loaded, 503 while it loads or after it
+    failed to. A probe against an idle (MODEL_WARMUP=lazy) replica starts the load.
+    """
+    models.start()
+    return jsonify(models.stats()), (200 if models.ready else 503)
 
 @app.route('/chat', methods=['POST'])
 def chat_endpoint():
     """ Handles new chat messages, persistence, and AI interaction. """
     try:
-        data = request.json
-        user_input = data.get('prompt')
-        session_id = data.get('session_id')
+        with metrics.span("parse"):
+            data = request.json
+            user_input = data.get('prompt')
+            session_id = data.get('session_id')
         
         if not user_input or not session_id:
             return jsonify({"error": "Missing prompt or session_id"}), 400
+        # A crisis message is answered even while the model is still loading
+        if not crisis_screen.matches(user_input) and not models.ensure_loaded():
+            if models.state == "loading":
+                return model_loading_response()
+            if models.state == "unavailable":
+                return model_unavailable_response()
 
-        user_ref = firestore_db.get_or_create_user(DB, session_id)
+        # One read for the user snapshot and recent history...
+        turn = firestore_db.ChatTurnRepository(DB, session_id)
+        history = persistence.load(turn)
         
-        # Load history and update daily activity before running inference
-        history = firestore_db.get_chat_history(user_ref)
-        firestore_db.update_daily_activity(user_ref) 
-        
-        mood, clean_message, updated_history = get_response(user_input, history)
+        usage = {}
+        mood, clean_message, updated_history = get_response(
+            user_input, history, summary=turn.summary, usage=usage, session_id=session_id
+        )
+        print(f"--- Prompt tokens: {usage.get('prompt_tokens')} ({usage.get('dropped_messages')} messages over budget) ---")
 
-        firestore_db.add_mood_log(user_ref, mood) 
-        firestore_db.save_chat_history(user_ref, updated_history)
+        # ...and one batched write for messages, mood log and daily activity, queued.
+        # A canned fallback isn't saved, so a retry of the message starts clean.
+        if not is_fallback_reply(clean_message):
+            persistence.commit(turn, updated_history[-2:], mood)
+            context_builder.schedule_summary_fold(turn, updated_history, usage.get('dropped_messages', 0), summarize_history)
 
         return jsonify({
             "response": clean_message, 
             "mood": mood,
-            "session_id": session_id
+            "session_id": session_id,
+            "usage": usage
         })
-    
+
+    except model_server.ModelServerBusy:
+        return model_busy_response()
+    except model_server.ModelServerError:
+        return model_unavailable_response()
     except Exception as e:
         print(f"An error occurred in chat_endpoint: {e}")
         return jsonify({"error": "Internal server error during chat processing."}), 500
 
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """
+    Streaming variant of /chat. Replies with Server-Sent Events: one `token`
+    event per generated fragment, then persistence runs and a final `done`
+    event carries the mood. Errors mid-stream are reported as an `error` event.
+    """
+    try:
+        with metrics.span("parse"):
+            data = request.json
+            user_input = data.get('prompt')
+            session_id = data.get('session_id')
+
+        if not user_input or not session_id:
+            return jsonify({"error": "Missing prompt or session_id"}), 400
+        # A crisis message is answered even while the model is still loading
+        if not crisis_screen.matches(user_input) and not models.ensure_loaded():
+            if models.state == "loading":
+                return model_loading_response()
+            if models.state == "unavailable":
+                return model_unavailable_response()
+
+        turn = firestore_db.ChatTurnRepository(DB, session_id)
+        history = persistence.load(turn)
+
+    except Exception as e:
+        print(f"An error occurred in chat_stream_endpoint: {e}")
+        return jsonify({"error": "Internal server error during chat processing."}), 500
+
+    def generate():
+        try:
+            usage = {}
+            for event in stream_response(user_input, history, turn.summary, usage, session_id):
+                if "token" in event:
+                    yield format_sse("token", {"token": event["token"]})
+                else:
+                    # The whole reply is on screen; queue it for Firestore before closing the stream
+                    if not is_fallback_reply(event["response"]):
+                        persistence.commit(turn, history[-2:], event["mood"])
+                        context_builder.schedule_summary_fold(
+                            turn, history, usage.get('dropped_messages', 0), summarize_history
+                        )
+                    yield format_sse("done", {"mood": event["mood"], "session_id": session_id, "usage": usage})
+        except Exception as e:
+            print(f"An error occurred while streaming chat: {e}")
+            yield format_sse("error", {"error": "Internal server error during chat processing."})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",  # Stop reverse proxies from buffering the stream
+    })
+
+@app.route('/stats', methods=['GET'])
+def stats_endpoint():
+    """ Runtime statistics: model load and cold-start timings, batch scheduler queue depth and batch sizes, mood classifier tiers and response cache, prompt token and KV caches. """
+    return jsonify({
+        "model": models.stats(),
+        "batching": local_model.scheduler.stats() if local_model.scheduler else None,
+        "classifier": classifier.stats(),
+        "response_cache": classification_cache.stats() if classification_cache else None,
+        "context": context.stats(),
+        "kv_cache": {
+            "prefix": local_model.prefix_cache.stats() if local_model.prefix_cache else None,
+            "sessions": local_model.session_kv_cache.stats() if local_model.session_kv_cache else None,
+        },
+    })
+
+# Component counters (model load, batch sizes, classifier tiers, cache hits) on /metrics
+metrics.register_stats("model", lambda: models.stats())
+metrics.register_stats("batching", lambda: local_model.scheduler.stats() if local_model.scheduler else None)
+metrics.register_stats("classifier", classifier.stats)
+metrics.register_stats("response_cache", lambda: classification_cache.stats() if classification_cache else None)
+metrics.register_stats("context", context.stats)
+metrics.register_stats("kv_prefix", lambda: local_model.prefix_cache.stats() if local_model.prefix_cache else None)
+metrics.register_stats("kv_sessions", lambda: local_model.session_kv_cache.stats() if local_model.session_kv_cache else None)
+
 @app.route('/history', methods=['GET'])
 def history_endpoint():
-    """ Endpoint to retrieve the entire chat history. """
+    """
+    Endpoint to retrieve chat history. Without `limit` the entire history is
+    returned; with `limit` (and optionally `before`, a sequence number taken
+    from the previous page's `next_before`) it returns one page, newest first.
+    """
     try:
         session_id = request.args.get('session_id')
         if not session_id:
             return jsonify({"error": "Missing session_id parameter"}), 400
 
-        user_ref = firestore_db.get_or_create_user(DB, session_id)
-        history = firestore_db.get_chat_history(user_ref)
-        
-        # The history format is suitable for the frontend (role: user/assistant, content: text)
+        limit = request.args.get('limit', type=int)
+        limit = min(limit, 200) if limit else None
+        before = request.args.get('before', type=int)
+
+        # The history format is suitable for the frontend (role: user/assistant, content: text).
+        # The newest page of an active session comes from the session cache, with no reads.
+        cached = firestore_db.get_cached_history_page(session_id, limit) if before is None else None
+        if cached:
+            page, next_before = cached
+        else:
+            user_ref = firestore_db.get_or_create_user(DB, session_id)
+            if limit:
+                page, next_before = firestore_db.get_chat_history_page(user_ref, limit, before)
+            else:
+                page = [dict(m, seq=seq) for seq, m in enumerate(firestore_db.get_chat_history(user_ref))]
+                next_before = None
+
+        # Turns still queued for Firestore are added to the newest messages
+        if before is None:
+            queued = persistence.pending_messages(session_id, page[-1]['seq'] if page else -1)
+            if queued:
+                page = (page + queued)[-limit:] if limit else page + queued
+                next_before = page[0]['seq'] if limit and page[0]['seq'] > 0 else None
+
+        if limit:
+            return jsonify({"history": page, "next_before": next_before})
+        history = [{'role': m['role'], 'content': m['content']} for m in page]
         return jsonify({"history": history})
         
     except Exception as e:
         print(f"An error occurred in history_endpoint: {e}")
         return jsonify({"error": "Internal server error retrieving history."}), 500
 
+@app.route('/mood-trend', methods=['GET'])
+def mood_trend_endpoint():
+    """
+    Mood counts per week or month (`period`, default week) for the last `count`
+    periods, plus the all-time counts and the current streak. Served from the
+    aggregate counters and monthly buckets; the mood logs are never scanned.
+    """
+    try:
+        session_id = request.args.get('session_id')
+        if not session_id:
+            return jsonify({"error": "Missing session_id parameter"}), 400
+        period = request.args.get('period', 'week')
+        if period not in ('week', 'month'):
+            return jsonify({"error": "period must be 'week' or 'month'"}), 400
+        count = max(1, min(request.args.get('count', 12, type=int), 104 if period == 'week' else 48))
+
+        user_ref = DB.collection('users').document(session_id)
+        cached = firestore_db.sessions.get(session_id, 0) if firestore_db.sessions else None
+        if cached:
+            data = cached[0]
+        else:
+            snapshot = user_ref.get()
+            data = snapshot.to_dict() if snapshot.exists else {}
+
+        return jsonify({
+            "period": period,
+            "series": firestore_db.get_mood_trend(user_ref, period, count),
+            "counts": data.get('mood_counts', {}),
+            "total": data.get('mood_total', 0),
+            "streak": firestore_db.get_mood_streak(user_ref, data),
+        })
+
+    except Exception as e:
+        print(f"An error occurred in mood_trend_endpoint: {e}")
+        return jsonify({"error": "Internal server error retrieving the mood trend."}), 500
+
 
 if __name__ == '__main__':
     # Ensure your firestore-credentials.json is in the config/ directory
     # Run with: python bot.py
     # Debug mode is helpful but may cause issues with model loading on some systems
-    app.run(host='0.0.0.0', port=5000)
\ No newline at end of file
+    # threaded=True lets concurrent requests reach the batch scheduler together
+    app.run(host='0.0.0.0', port=5000, threaded=True)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# --- Configuration ---
+# Prompt budget for conversation requests (system prompt + summary + history +
+# the new message). Phi-3-mini has a 4k context; the default leaves room for
+# the 128 generated tokens and template overhead.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+# Fold turns that fall out of the budget into a rolling summary on the user document
+ROLLING_SUMMARY = os.getenv("ROLLING_SUMMARY", "0") == "1"
+# Role markers and separators the chat template adds around each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def approximate_token_count(text):
+    """ Rough count (~4 characters per token) for when no tokenizer is available. """
+    return max(1, len(text) // 4) if text else 0
+
+
+def tokenizer_counter(tokenizer):
+    """ Returns a count_tokens(text) function backed by a Hugging Face tokenizer. """
+    if tokenizer is None:
+        return approximate_token_count
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False))
+
+
+class PromptContext:
+    """ Result of ContextBuilder.build(): the messages to send plus accounting. """
+
+    __slots__ = ("messages", "prompt_tokens", "kept", "dropped")
+
+    def __init__(self, messages, prompt_tokens, kept, dropped):
+        self.messages = messages
+        self.prompt_tokens = prompt_tokens
+        self.kept = kept
+        self.dropped = dropped
+
+    def usage(self):
+        return {
+            "prompt_tokens": self.prompt_tokens,
+            "history_messages": self.kept,
+            "dropped_messages": self.dropped,
+        }
+
+
+class ContextBuilder:
+    """
+    Builds conversation prompts that fit a token budget. The newest history
+    messages are kept until the budget runs out; older ones are dropped (and
+    can be folded into a rolling summary). Per-message token counts are cached,
+    so each message is only tokenized once across turns.
+    """
+
+    def __init__(self, count_tokens, budget=CONTEXT_TOKEN_BUDGET, cache_size=10000):
+        self.count_tokens = count_tokens
+        self.budget = budget
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def set_counter(self, count_tokens):
+        """ Switches to another token counter (e.g. once the model's tokenizer has loaded). """
+        with self._lock:
+            self.count_tokens = count_tokens
+            self._cache.clear()
+
+    def message_tokens(self, message):
+        """ Token count of one message including template overhead (LRU-cached). """
+        key = (message.get("role"), message.get("content") or "")
+        with self._lock:
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return count
+            self.cache_misses += 1
+
+        count = self.count_tokens(key[1]) + MESSAGE_OVERHEAD_TOKENS
+        with self._lock:
+            self._cache[key] = count
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return count
+
+    def build(self, system_prompt, history, user_input, summary=None):
+        """
+        Returns a PromptContext with [system] + newest history that fits + [user].
+        A stored summary of older turns is appended to the system prompt.
+        """
+        system = dict(system_prompt)
+        if summary:
+            system["content"] = f"{system['content']}\n\nSummary of the earlier conversation: {summary}"
+        user_message = {"role": "user", "content": user_input}
+
+        used = self.message_tokens(system) + self.message_tokens(user_message)
+        kept = 0
+        for message in reversed(history):
+            tokens = self.message_tokens(message)
+            if used + tokens > self.budget:
+                break
+            used += tokens
+            kept += 1
+
+        kept_history = history[len(history) - kept:] if kept else []
+        metrics.record_tokens("prompt", used)
+        return PromptContext([system] + kept_history + [user_message], used, kept, len(history) - kept)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "cached_messages": len(self._cache),
+                "cache_hits": self.cache_hits,
+                "cache_misses": self.cache_misses,
+            }
+
+
+# --- Rolling summary ---
+# One background worker: summaries are for the next turn, never on the reply path.
+_summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="serenity-summary")
+
+
+def messages_to_fold(turn, history, dropped):
+    """
+    The history messages that fell out of the budget and are not yet covered by
+    the user's stored summary, as (messages, covers) where `covers` is the new
+    summary's coverage count. Returns None if there is nothing to fold.
+    `turn` is the ChatTurnRepository the history came from and `dropped` the
+    number of leading `history` messages left out of the prompt.
+    """
+    if not ROLLING_SUMMARY or not dropped:
+        return None
+
+    offset = turn.history_offset
+    start = max(0, turn.summary_covers - offset)
+    if start >= dropped:
+        return None
+    return history[start:dropped], offset + dropped
+
+
+def schedule_summary_fold(turn, history, dropped, summarize_fn):
+    """
+    Folds the messages picked by messages_to_fold into the user's stored
+    summary in the background. `summarize_fn(previous_summary, messages)`
+    returns the new summary text. Returns the Future, or None if there was
+    nothing to fold.
+    """
+    fold_args = messages_to_fold(turn, history, dropped)
+    if fold_args is None:
+        return None
+    to_fold, covers = fold_args
+    previous = turn.summary
+
+    def fold():
+        try:
+            summary = summarize_fn(previous, to_fold)
+            if summary:
+                turn.save_summary(summary, covers)
+        except Exception as e:
+            print(f"--- Rolling summary update failed: {e} ---")
+
+    return _summary_executor.submit(fold)
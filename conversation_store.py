@@ -0,0 +1,187 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Server-side conversation state for app.py, so the page only sends the new
+# message instead of its whole history on every turn. Each session_id keeps
+# the last CONVERSATION_HISTORY_TURNS exchanges and a history_version that
+# goes up by one per reply. The client echoes back the version it last
+# received. If it doesn't match (the server restarted, the session expired or
+# another worker served it), the request gets 409 and the client sends its
+# history once to re-seed the store.
+# Each message also carries a message_id (idempotency key). A retried or
+# double-sent message gets the reply stored for that id. A copy that arrives
+# while the first is still running waits for it. Either way inference runs
+# only once. State is per process and bounded: least recently used sessions
+# are dropped past CONVERSATION_MAX_SESSIONS, idle ones after
+# CONVERSATION_TTL_SECONDS.
+
+# --- Configuration ---
+CONVERSATION_STORE = os.getenv("CONVERSATION_STORE", "1") == "1"
+# Exchanges kept per session (the page keeps the same number)
+CONVERSATION_HISTORY_TURNS = int(os.getenv("CONVERSATION_HISTORY_TURNS", "8"))
+CONVERSATION_TTL_SECONDS = float(os.getenv("CONVERSATION_TTL_SECONDS", "3600"))
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "10000"))
+# Replies remembered per session for retries, and how long a duplicate waits for the original
+IDEMPOTENCY_KEYS_PER_SESSION = int(os.getenv("IDEMPOTENCY_KEYS_PER_SESSION", "16"))
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "30"))
+
+
+class _Conversation:
+    __slots__ = ("history", "version", "replies", "pending", "expires_at")
+
+    def __init__(self, history, version, ttl):
+        self.history = history
+        self.version = version
+        self.replies = OrderedDict()  # message_id -> reply
+        self.pending = {}  # message_id -> Event, set when that turn finishes or fails
+        self.expires_at = time.monotonic() + ttl
+
+
+class Turn:
+    """
+    Result of ConversationStore.begin(). Exactly one of: `replay` (the stored
+    reply for this message_id), `conflict` (the client must resend its
+    history), `busy` (the same message is still being answered; retry later),
+    or `history` to generate from, in which case the caller must end with
+    finish() or abort().
+    """
+
+    __slots__ = ("session_id", "message_id", "history", "version", "replay", "conflict", "busy")
+
+    def __init__(self, session_id, message_id, history=None, version=None, replay=None, conflict=False, busy=False):
+        self.session_id = session_id
+        self.message_id = message_id
+        self.history = history
+        self.version = version
+        self.replay = replay
+        self.conflict = conflict
+        self.busy = busy
+
+
+class ConversationStore:
+    """ session_id -> recent exchanges, history_version and replies by message_id. """
+
+    def __init__(self, history_turns=CONVERSATION_HISTORY_TURNS, ttl=CONVERSATION_TTL_SECONDS,
+                 max_sessions=CONVERSATION_MAX_SESSIONS, keys_per_session=IDEMPOTENCY_KEYS_PER_SESSION,
+                 wait_seconds=IDEMPOTENCY_WAIT_SECONDS):
+        self.history_turns = history_turns
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.keys_per_session = keys_per_session
+        self.wait_seconds = wait_seconds
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        # Metrics
+        self.turns = 0
+        self.replays = 0
+        self.conflicts = 0
+        self.resyncs = 0
+
+    def _get(self, session_id, now):
+        conversation = self._sessions.get(session_id)
+        if conversation is not None and conversation.expires_at <= now:
+            del self._sessions[session_id]
+            conversation = None
+        if conversation is not None:
+            self._sessions.move_to_end(session_id)
+            conversation.expires_at = now + self.ttl
+        return conversation
+
+    def begin(self, session_id, message_id, version, history=None):
+        """
+        Starts a turn. `version` is the history_version the client last
+        received (None for a new conversation). `history` is the client's own
+        copy, sent to re-seed the store after a conflict.
+        """
+        deadline = time.monotonic() + self.wait_seconds
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                conversation = self._get(session_id, now)
+                if conversation is not None and message_id:
+                    reply = conversation.replies.get(message_id)
+                    if reply is not None:
+                        self.replays += 1
+                        return Turn(session_id, message_id, replay=reply)
+                    waiting = conversation.pending.get(message_id)
+                else:
+                    waiting = None
+                if waiting is None:
+                    return self._start(session_id, message_id, version, history, conversation)
+            # The same message is being answered by another request: wait for its reply
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not waiting.wait(remaining):
+                return Turn(session_id, message_id, busy=True)
+
+    def _start(self, session_id, message_id, version, history, conversation):
+        if history is not None:
+            # The client's copy wins: re-seed (or create) the session from it
+            turns = [turn for turn in history if isinstance(turn, dict)][-self.history_turns:]
+            if conversation is None:
+                conversation = self._sessions[session_id] = _Conversation(turns, version or 0, self.ttl)
+                self._evict()
+            else:
+                conversation.history, conversation.version = turns, version or 0
+            self.resyncs += 1
+        elif conversation is None:
+            if version:
+                self.conflicts += 1
+                return Turn(session_id, message_id, conflict=True)
+            conversation = self._sessions[session_id] = _Conversation([], 0, self.ttl)
+            self._evict()
+        elif version != conversation.version:
+            self.conflicts += 1
+            return Turn(session_id, message_id, version=conversation.version, conflict=True)
+        if message_id:
+            conversation.pending[message_id] = threading.Event()
+        return Turn(session_id, message_id, history=list(conversation.history), version=conversation.version)
+
+    def _evict(self):
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def finish(self, turn, user_message, reply):
+        """
+        Records the exchange and stores `reply` for the turn's message_id.
+        Returns the new history_version (which is also set on `reply`).
+        """
+        with self._lock:
+            conversation = self._sessions.get(turn.session_id)
+            if conversation is None:
+                # Evicted while generating: start over from this exchange
+                conversation = self._sessions[turn.session_id] = _Conversation([], 0, self.ttl)
+                self._evict()
+            conversation.history.append({'user': user_message, 'bot': reply.get('response', '')})
+            del conversation.history[:-self.history_turns]
+            conversation.version += 1
+            reply['history_version'] = conversation.version
+            if turn.message_id:
+                conversation.replies[turn.message_id] = reply
+                while len(conversation.replies) > self.keys_per_session:
+                    conversation.replies.popitem(last=False)
+                event = conversation.pending.pop(turn.message_id, None)
+                if event is not None:
+                    event.set()
+            self.turns += 1
+            return conversation.version
+
+    def abort(self, turn):
+        """ Gives up a started turn without a reply; a waiting duplicate then runs it itself. No-op after finish(). """
+        if not turn.message_id or turn.history is None:
+            return
+        with self._lock:
+            conversation = self._sessions.get(turn.session_id)
+            event = conversation.pending.pop(turn.message_id, None) if conversation else None
+        if event is not None:
+            event.set()
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "turns": self.turns,
+            "replays": self.replays,
+            "conflicts": self.conflicts,
+            "resyncs": self.resyncs,
+        }
@@ -0,0 +1,218 @@
+import os
+import re
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+import metrics
+from mood_classifier import KEYWORDS, DISTRESS
+
+# Crisis screen ahead of the LLM. Every prompt is matched against one
+# precompiled alternation of high-risk phrases before any model call; on a
+# match the turn is answered at once with a fixed, reviewed safety message
+# and helpline resources, tagged serious_distress, and neither the
+# classification nor the conversation prompt is sent. Matching deliberately
+# ignores negation ("I'm not suicidal" is still answered with resources):
+# a false positive costs one canned reply, a miss costs far more.
+# Each hit is appended to an escalation log (SQLite, indexed by session and
+# time) by a background thread so the request never waits on the disk.
+
+# --- 1. Configuration ---
+CRISIS_SCREEN = os.getenv("CRISIS_SCREEN", "1") == "1"
+# "" keeps the escalation log in memory only (metrics still count hits); data/ is git-ignored
+CRISIS_LOG_PATH = os.getenv(
+    "CRISIS_LOG_PATH", "" if os.getenv("FIRESTORE_BACKEND") == "memory" else "data/crisis_escalations.sqlite3"
+)
+CRISIS_HELPLINES = os.getenv(
+    "CRISIS_HELPLINES",
+    "If you are in the US, you can call or text 988 (Suicide & Crisis Lifeline), any time. "
+    "In the UK and Ireland, Samaritans are on 116 123. "
+    "Anywhere else, findahelpline.com lists free, confidential services in your country. "
+    "If you are in immediate danger, please call your local emergency number."
+)
+
+SAFETY_RESPONSE = (
+    "I'm really sorry you're going through this, and I'm glad you told me. "
+    "You deserve support from a real person right now, and you don't have to face this alone. "
+    + CRISIS_HELPLINES +
+    " I'm still here if you want to keep talking."
+)
+
+# The classifier's distress keywords plus phrases that only matter here. Patterns
+# are lowercase and matched as whole words, so stems end in \w* ("overdos\w*"
+# for overdose, overdosed, overdosing).
+CRISIS_PATTERNS = KEYWORDS[DISTRESS] + [
+    r"tak(e|ing) my (own )?life", r"hang(ing)? myself",
+    r"jump(ing)? off (a|the) (bridge|building|roof)", r"(plan|planning|going) to (die|kill)",
+    r"not (want|wanting) to (wake up|be alive)", r"wish i (was|were) dead", r"no point (in )?living",
+    r"(want(ed)? to|going to) vanish",
+]
+
+ESCALATIONS = metrics.Counter(
+    "serenity_crisis_escalations_total", "Prompts answered by the crisis screen instead of the LLM.")
+
+
+# --- 2. Matcher ---
+
+class CrisisMatcher:
+    """
+    One compiled alternation over every (lowercase) pattern; search() stops at
+    the first hit. Lowercasing the text up front is about twice as fast as
+    re.IGNORECASE. Curly apostrophes (as phone keyboards send) become straight ones.
+    """
+
+    def __init__(self, patterns=CRISIS_PATTERNS):
+        self.regex = re.compile(r"\b(?:" + "|".join(f"(?:{p})" for p in patterns) + r")\b")
+
+    def match(self, text):
+        """ The matched phrase, or None. """
+        found = self.regex.search(text.lower().replace("\u2019", "'"))
+        return found.group(0) if found else None
+
+
+# --- 3. Escalation log ---
+
+class EscalationLog:
+    """
+    Append-only record of crisis hits: session, time, matched phrase and the
+    server that answered. Rows are queued and written by one daemon thread.
+    """
+
+    def __init__(self, path=CRISIS_LOG_PATH):
+        self.path = path or ":memory:"
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        if path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        if path:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS escalations ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, created_at REAL NOT NULL, "
+            "phrase TEXT NOT NULL, source TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS escalations_session ON escalations (session_id, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS escalations_time ON escalations (created_at)")
+        self.recorded = 0
+        self.failed = 0
+        threading.Thread(target=self._run, daemon=True, name="serenity-escalations").start()
+
+    def record(self, session_id, phrase, source):
+        self._queue.put((session_id, time.time(), phrase, source))
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            while True:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    self._conn.executemany(
+                        "INSERT INTO escalations (session_id, created_at, phrase, source) VALUES (?, ?, ?, ?)", rows
+                    )
+                self.recorded += len(rows)
+            except Exception as e:
+                self.failed += len(rows)
+                print(f"--- Escalation log write failed: {e} ---")
+            for _ in rows:
+                self._queue.task_done()
+
+    def flush(self):
+        """ Blocks until every recorded hit has been written. """
+        self._queue.join()
+
+    def recent(self, session_id=None, limit=50):
+        """ Newest escalations first, optionally for one session: dicts with session_id, created_at, phrase, source. """
+        self.flush()
+        sql = "SELECT session_id, created_at, phrase, source FROM escalations"
+        args = ()
+        if session_id is not None:
+            sql += " WHERE session_id = ?"
+            args = (session_id,)
+        with self._lock:
+            rows = self._conn.execute(sql + " ORDER BY created_at DESC LIMIT ?", args + (limit,)).fetchall()
+        return [dict(zip(("session_id", "created_at", "phrase", "source"), row)) for row in rows]
+
+
+# --- 4. Screen ---
+
+class CrisisScreen:
+    """ Matcher plus escalation log; intercept() is what the chat paths call before any LLM work. """
+
+    def __init__(self, matcher=None, log=None):
+        self.matcher = matcher or CrisisMatcher()
+        self.log = log or EscalationLog()
+        self.screened = 0
+        self.hits = 0
+
+    def check(self, text, session_id=None, source=None):
+        """ The matched phrase (after logging the escalation), or None for an ordinary message. """
+        self.screened += 1
+        phrase = self.matcher.match(text)
+        if phrase is None:
+            return None
+        self.hits += 1
+        ESCALATIONS.inc()
+        self.log.record(session_id, phrase.lower(), source)
+        print(f"--- Crisis screen: escalation for session {session_id} ---")
+        return phrase
+
+    def intercept(self, user_input, history, session_id=None, source=None):
+        """
+        get_response's contract for a crisis turn: (serious_distress, safety
+        response, history with the turn appended), or None when the prompt
+        doesn't match and the normal LLM path should run.
+        """
+        if self.check(user_input, session_id, source) is None:
+            return None
+        history.append({"role": "user", "content": user_input})
+        history.append({"role": "assistant", "content": SAFETY_RESPONSE})
+        return DISTRESS, SAFETY_RESPONSE, history
+
+    def stats(self):
+        return {
+            "screened": self.screened,
+            "hits": self.hits,
+            "logged": self.log.recorded,
+            "log_failures": self.log.failed,
+        }
+
+
+_screen = None
+_screen_lock = threading.Lock()
+
+
+def get_screen():
+    """ Process-wide CrisisScreen, or None with CRISIS_SCREEN=0. """
+    global _screen
+    if _screen is not None or not CRISIS_SCREEN:
+        return _screen
+    with _screen_lock:
+        if _screen is None:
+            _screen = CrisisScreen()
+            metrics.register_stats("crisis_screen", _screen.stats)
+            atexit.register(_screen.log.flush)
+    return _screen
+
+
+def intercept(user_input, history, session_id=None, source=None):
+    """ CrisisScreen.intercept on the shared screen; None when disabled. """
+    screen = get_screen()
+    return screen.intercept(user_input, history, session_id, source) if screen else None
+
+
+def check(text, session_id=None, source=None):
+    """ CrisisScreen.check on the shared screen: the matched phrase (logged), or None. """
+    screen = get_screen()
+    return screen.check(text, session_id, source) if screen else None
+
+
+def matches(user_input):
+    """ True if the prompt would be intercepted (no logging), e.g. to answer before the model has loaded. """
+    screen = get_screen()
+    return screen is not None and screen.matcher.match(user_input) is not None
@@ -0,0 +1,585 @@
+import copy
+import uuid
+import operator
+import threading
+from datetime import datetime, timezone, timedelta
+from google.api_core import exceptions
+from google.cloud.firestore_v1 import transforms
+
+# In-memory stand-in for the subset of the Firestore client API this project
+# uses: documents and subcollections, transforms (SERVER_TIMESTAMP,
+# DELETE_FIELD, Increment, ArrayUnion), ordered/filtered/limited queries with
+# cursors, write batches, last_update_time preconditions and
+# @firestore.transactional transactions.
+# Every simulated network call is counted in `rpc_counts`, so callers can
+# assert how many round-trips a code path makes.
+# Enable with FIRESTORE_BACKEND=memory (see firestore_db.init_db).
+
+DOCUMENT_ID = "__name__"
+
+_COMPARISONS = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+}
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+def _get_path(data, dotted):
+    value = data
+    for part in dotted.split("."):
+        if not isinstance(value, dict) or part not in value:
+            raise KeyError(dotted)
+        value = value[part]
+    return value
+
+
+def _apply_value(target, key, value):
+    """ Applies one field write, resolving Firestore transform sentinels. """
+    if value is transforms.DELETE_FIELD:
+        target.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        target[key] = _now()
+    elif isinstance(value, transforms.Increment):
+        current = target.get(key, 0)
+        target[key] = (current if isinstance(current, (int, float)) else 0) + value.value
+    elif isinstance(value, transforms.ArrayUnion):
+        current = list(target.get(key) or [])
+        target[key] = current + [v for v in value.values if v not in current]
+    elif isinstance(value, transforms.ArrayRemove):
+        target[key] = [v for v in (target.get(key) or []) if v not in value.values]
+    elif isinstance(value, dict):
+        target[key] = _resolve(value)
+    else:
+        target[key] = copy.deepcopy(value)
+
+
+def _resolve(data):
+    resolved = {}
+    for key, value in data.items():
+        _apply_value(resolved, key, value)
+    return resolved
+
+
+def _merge(target, data):
+    for key, value in data.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            _merge(target[key], value)
+        else:
+            _apply_value(target, key, value)
+
+
+def _update(target, data):
+    """ update() semantics: dotted keys address nested fields. """
+    for key, value in data.items():
+        parts = key.split(".")
+        node = target
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        _apply_value(node, parts[-1], value)
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+        self.exists = data is not None
+        self.update_time = update_time
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        if self._data is None:
+            return None
+        try:
+            return copy.deepcopy(_get_path(self._data, field_path))
+        except KeyError:
+            raise KeyError(field_path)
+
+
+class FakeDocumentReference:
+    def __init__(self, client, path):
+        self._client = client
+        self.path = path
+        self.id = path.rsplit("/", 1)[-1]
+
+    @property
+    def firestore(self):
+        return self._client
+
+    @property
+    def parent(self):
+        return FakeCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return FakeCollectionReference(self._client, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._count("get")
+        return self._client._snapshot(self)
+
+    def set(self, data, merge=False):
+        self._client._count("commit")
+        self._client._apply([("set", self, data, merge)])
+
+    def create(self, data):
+        self._client._count("commit")
+        self._client._apply([("create", self, data, False)])
+
+    def update(self, data, option=None):
+        self._client._count("commit")
+        self._client._apply([("update", self, data, option)])
+
+    def delete(self):
+        self._client._count("commit")
+        self._client._apply([("delete", self, None, False)])
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeDocumentReference) and other.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+class FakeQuery:
+    DESCENDING = "DESCENDING"
+    ASCENDING = "ASCENDING"
+
+    def __init__(self, client, path, filters=(), orders=(), limit=None, start_after=None):
+        self._client = client
+        self._path = path
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+
+    def _copy(self, **changes):
+        args = {
+            "filters": self._filters, "orders": self._orders,
+            "limit": self._limit, "start_after": self._start_after,
+        }
+        args.update(changes)
+        return FakeQuery(self._client, self._path, **args)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document):
+        return self._copy(start_after=document)
+
+    @staticmethod
+    def _field(snapshot, field_path):
+        if field_path == DOCUMENT_ID:
+            return snapshot.id
+        try:
+            return _get_path(snapshot._data, field_path)
+        except KeyError:
+            return None
+
+    def _matches(self, snapshot):
+        for field_path, op, value in self._filters:
+            actual = self._field(snapshot, field_path)
+            if op == "array_contains":
+                if not isinstance(actual, list) or value not in actual:
+                    return False
+                continue
+            if op == "in":
+                if actual not in value:
+                    return False
+                continue
+            if actual is None or not _COMPARISONS[op](actual, value):
+                return False
+        return True
+
+    def _sort_key(self, snapshot):
+        return tuple(self._field(snapshot, f) for f, _ in self._orders)
+
+    def _source(self):
+        return self._client._collection_snapshots(self._path)
+
+    def _run(self):
+        snapshots = [s for s in self._source() if self._matches(s)]
+        # Firestore only returns documents that have every ordered field
+        snapshots = [s for s in snapshots if all(self._field(s, f) is not None for f, _ in self._orders)]
+        for field_path, direction in reversed(self._orders or ((DOCUMENT_ID, self.ASCENDING),)):
+            snapshots.sort(key=lambda s: self._field(s, field_path), reverse=direction == self.DESCENDING)
+        if self._start_after is not None:
+            keys = [s.reference.path for s in snapshots]
+            cursor = self._start_after.reference.path
+            snapshots = snapshots[keys.index(cursor) + 1:] if cursor in keys else [
+                s for s in snapshots if self._sort_key(s) > self._sort_key(self._start_after)
+            ]
+        if self._limit is not None:
+            snapshots = snapshots[:self._limit]
+        return snapshots
+
+    def stream(self, transaction=None):
+        self._client._count("query")
+        return iter(self._run())
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction=transaction))
+
+    def count(self):
+        return _FakeAggregation(self)
+
+
+class _FakeAggregation:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self):
+        self._query._client._count("query")
+        return [[_FakeAggregationResult(len(self._query._run()))]]
+
+
+class _FakeAggregationResult:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, path):
+        super().__init__(client, path)
+        self.id = path.rsplit("/", 1)[-1]
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    def add(self, data, document_id=None):
+        ref = self.document(document_id)
+        ref.create(data)
+        return _now(), ref
+
+    def list_documents(self):
+        self._client._count("query")
+        return [s.reference for s in self._client._collection_snapshots(self._path)]
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(("set", reference, data, merge))
+
+    def create(self, reference, data):
+        self._writes.append(("create", reference, data, False))
+
+    def update(self, reference, data, option=None):
+        self._writes.append(("update", reference, data, option))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self):
+        self._client._count("commit")
+        writes, self._writes = self._writes, []
+        self._client._apply(writes)
+        return writes
+
+    def __len__(self):
+        return len(self._writes)
+
+
+class FakeTransaction(FakeWriteBatch):
+    """ Duck-types the private hooks used by @firestore.transactional. """
+
+    _read_only = False
+    _max_attempts = 5
+
+    def __init__(self, client):
+        super().__init__(client)
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._count("begin")
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        # Transactions serialise on the client lock, like a pessimistic lock on every doc
+        self.commit()
+        self._id = None
+
+    def _rollback(self):
+        if self._id is not None:
+            self._client._count("rollback")
+        self._clean_up()
+
+    def get(self, ref_or_query):
+        if isinstance(ref_or_query, FakeDocumentReference):
+            return iter([ref_or_query.get(transaction=self)])
+        # As in the real client, a collection reference is not a Query
+        if isinstance(ref_or_query, FakeCollectionReference) or not isinstance(ref_or_query, FakeQuery):
+            raise ValueError('Value for argument "ref_or_query" must be a DocumentReference or a Query.')
+        return ref_or_query.stream(transaction=self)
+
+
+class _FakeWriteOption:
+    """ A last_update_time precondition (Client.write_option). """
+
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeClient:
+    """ Thread-safe in-memory Firestore client with per-RPC counters. """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._collections = {}
+        self._update_times = {}  # path -> time of the last write, always increasing
+        self._clock = None
+        self._watchers = {}
+        self.rpc_counts = {}
+
+    # --- Instrumentation ---
+    def _count(self, kind):
+        with self._lock:
+            self.rpc_counts[kind] = self.rpc_counts.get(kind, 0) + 1
+
+    @property
+    def rpc_count(self):
+        with self._lock:
+            return sum(self.rpc_counts.values())
+
+    def reset_rpc_counts(self):
+        with self._lock:
+            self.rpc_counts = {}
+
+    # --- Public client API ---
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeDocumentReference(self, path)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def collection_group(self, collection_id):
+        return _FakeCollectionGroup(self, collection_id)
+
+    @staticmethod
+    def write_option(last_update_time=None, **kwargs):
+        if last_update_time is None or kwargs:
+            raise NotImplementedError("Only last_update_time preconditions are supported")
+        return _FakeWriteOption(last_update_time)
+
+    # --- Storage ---
+    def _snapshot(self, ref):
+        parent, doc_id = ref.path.rsplit("/", 1)
+        with self._lock:
+            data = self._collections.get(parent, {}).get(doc_id)
+            return FakeSnapshot(ref, copy.deepcopy(data) if data is not None else None,
+                                self._update_times.get(ref.path))
+
+    def _collection_snapshots(self, path):
+        with self._lock:
+            docs = list(self._collections.get(path, {}).items())
+            return [FakeSnapshot(FakeDocumentReference(self, f"{path}/{doc_id}"), copy.deepcopy(data),
+                                 self._update_times.get(f"{path}/{doc_id}"))
+                    for doc_id, data in docs]
+
+    def _tick(self):
+        """ A write time later than any before it, even within one clock tick. """
+        now = _now()
+        if self._clock is not None and now <= self._clock:
+            now = self._clock + timedelta(microseconds=1)
+        self._clock = now
+        return now
+
+    def _apply(self, writes):
+        """
+        Applies a list of (op, ref, data, extra) writes atomically; nothing
+        changes if any write fails. `extra` is merge for set() and the write
+        option (or None) for update().
+        """
+        with self._lock:
+            staged = {}
+            for op, ref, data, extra in writes:
+                parent, doc_id = ref.path.rsplit("/", 1)
+                key = (parent, doc_id)
+                if key not in staged:
+                    current = self._collections.get(parent, {}).get(doc_id)
+                    staged[key] = copy.deepcopy(current) if current is not None else None
+                current = staged[key]
+                if op == "create":
+                    if current is not None:
+                        raise exceptions.AlreadyExists(f"Document already exists: {ref.path}")
+                    staged[key] = _resolve(data)
+                elif op == "set":
+                    if extra and current is not None:
+                        _merge(current, data)
+                    else:
+                        staged[key] = _resolve(data)
+                elif op == "update":
+                    if current is None:
+                        raise exceptions.NotFound(f"No document to update: {ref.path}")
+                    if extra is not None and self._update_times.get(ref.path) != extra.last_update_time:
+                        raise exceptions.FailedPrecondition(f"Document changed since it was read: {ref.path}")
+                    _update(current, data)
+                elif op == "delete":
+                    staged[key] = None
+
+            written = self._tick()
+            for (parent, doc_id), data in staged.items():
+                if data is None:
+                    self._collections.get(parent, {}).pop(doc_id, None)
+                    self._update_times.pop(f"{parent}/{doc_id}", None)
+                else:
+                    self._collections.setdefault(parent, {})[doc_id] = data
+                    self._update_times[f"{parent}/{doc_id}"] = written
+            changed = [f"{parent}/{doc_id}" for parent, doc_id in staged]
+
+        for path in changed:
+            for callback in list(self._watchers.get(path, ())):
+                callback([self._snapshot(FakeDocumentReference(self, path))], [], _now())
+
+    def _watch(self, ref, callback):
+        with self._lock:
+            self._watchers.setdefault(ref.path, []).append(callback)
+        callback([self._snapshot(ref)], [], _now())
+        return _FakeWatch(self, ref.path, callback)
+
+
+class _FakeWatch:
+    def __init__(self, client, path, callback):
+        self._client = client
+        self._path = path
+        self._callback = callback
+
+    def unsubscribe(self):
+        with self._client._lock:
+            callbacks = self._client._watchers.get(self._path, [])
+            if self._callback in callbacks:
+                callbacks.remove(self._callback)
+
+
+class _FakeCollectionGroup(FakeQuery):
+    """ Queries every collection whose final path segment is `collection_id`. """
+
+    def __init__(self, client, collection_id, **kwargs):
+        super().__init__(client, collection_id, **kwargs)
+        self._collection_id = collection_id
+
+    def _copy(self, **changes):
+        args = {
+            "filters": self._filters, "orders": self._orders,
+            "limit": self._limit, "start_after": self._start_after,
+        }
+        args.update(changes)
+        return _FakeCollectionGroup(self._client, self._collection_id, **args)
+
+    def _source(self):
+        with self._client._lock:
+            paths = [p for p in self._client._collections if p.rsplit("/", 1)[-1] == self._collection_id]
+        snapshots = []
+        for path in paths:
+            snapshots.extend(self._client._collection_snapshots(path))
+        return snapshots
+
+
+# --- Async client ---
+# Mirrors the google.cloud.firestore.AsyncClient surface used by
+# firestore_async.py: the same storage and counters, with awaitable RPCs.
+
+class FakeAsyncDocumentReference(FakeDocumentReference):
+    @property
+    def parent(self):
+        return FakeAsyncCollectionReference(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, name):
+        return FakeAsyncCollectionReference(self._client, f"{self.path}/{name}")
+
+    async def get(self, field_paths=None, transaction=None):
+        return super().get(field_paths, transaction)
+
+    async def set(self, data, merge=False):
+        return super().set(data, merge)
+
+    async def create(self, data):
+        return super().create(data)
+
+    async def update(self, data, option=None):
+        return super().update(data, option)
+
+    async def delete(self):
+        return super().delete()
+
+
+class FakeAsyncQuery(FakeQuery):
+    def _copy(self, **changes):
+        args = {
+            "filters": self._filters, "orders": self._orders,
+            "limit": self._limit, "start_after": self._start_after,
+        }
+        args.update(changes)
+        return FakeAsyncQuery(self._client, self._path, **args)
+
+    async def stream(self, transaction=None):
+        for snapshot in super().stream(transaction):
+            yield snapshot
+
+    async def get(self, transaction=None):
+        return [snapshot async for snapshot in self.stream(transaction)]
+
+
+class FakeAsyncCollectionReference(FakeAsyncQuery, FakeCollectionReference):
+    def document(self, document_id=None):
+        return FakeAsyncDocumentReference(self._client, f"{self._path}/{document_id or uuid.uuid4().hex[:20]}")
+
+    async def add(self, data, document_id=None):
+        ref = self.document(document_id)
+        await ref.create(data)
+        return _now(), ref
+
+
+class FakeAsyncWriteBatch(FakeWriteBatch):
+    async def commit(self):
+        return super().commit()
+
+
+class FakeAsyncClient(FakeClient):
+    """ In-memory stand-in for firestore.AsyncClient (no transactions). """
+
+    def collection(self, name):
+        return FakeAsyncCollectionReference(self, name)
+
+    def document(self, path):
+        return FakeAsyncDocumentReference(self, path)
+
+    def batch(self):
+        return FakeAsyncWriteBatch(self)
+
+    def transaction(self, **kwargs):
+        raise NotImplementedError("FakeAsyncClient does not support transactions")
+
+    def collection_group(self, collection_id):
+        raise NotImplementedError("FakeAsyncClient does not support collection group queries")
@@ -0,0 +1,189 @@
+import os
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud import firestore as gcloud_firestore
+import metrics
+import firestore_db
+import history_codec
+from firestore_db import (
+    HISTORY_LAYOUT, MIGRATION_BATCH_SIZE, ChatTurnRepository,
+    _new_user_data, _plain_message, _write_messages,
+)
+
+# asyncio counterparts of the firestore_db helpers used by the chat endpoints,
+# on google.cloud.firestore.AsyncClient. Document layout and write batches are
+# exactly the same; only the RPCs are awaited.
+
+# Global async DB instance (bound to the event loop of the first caller)
+async_db = None
+
+def init_async_db():
+    """
+    Initializes the Firestore AsyncClient, honouring the same FIRESTORE_BACKEND
+    and FIRESTORE_EMULATOR_HOST settings as firestore_db.init_db.
+    """
+    global async_db
+    if async_db is not None:
+        return async_db
+    if os.getenv("FIRESTORE_BACKEND") == "memory":
+        from fake_firestore import FakeAsyncClient
+        async_db = FakeAsyncClient()
+        print("--- In-Memory Async Firestore DB Initialized ---")
+    elif os.getenv("FIRESTORE_EMULATOR_HOST"):
+        async_db = gcloud_firestore.AsyncClient(project=os.getenv("GOOGLE_CLOUD_PROJECT", "serenity-local"))
+        print(f"--- Async Firestore Emulator DB Initialized ({os.getenv('FIRESTORE_EMULATOR_HOST')}) ---")
+    else:
+        try:
+            from google.oauth2 import service_account
+            cred = service_account.Credentials.from_service_account_file("config/firestore-credentials.json")
+            async_db = gcloud_firestore.AsyncClient(project=cred.project_id, credentials=cred)
+            print("--- Async Firestore DB Initialized Successfully ---")
+        except Exception as e:
+            print(f"ERROR: Could not initialize the async Firestore client. Check 'config/firestore-credentials.json' file path and content. {e}")
+            return None
+    return async_db
+
+async def get_or_create_user(db, session_id):
+    """ Async firestore_db.get_or_create_user. """
+    user_ref = db.collection('users').document(session_id)
+    sessions = firestore_db.sessions
+    if sessions and sessions.get(session_id, 0):
+        return user_ref
+    if not (await user_ref.get()).exists:
+        print(f"--- Creating new user document ---")
+        await user_ref.set(_new_user_data(session_id))
+    return user_ref
+
+async def get_chat_history(user_ref):
+    """ Async firestore_db.get_chat_history for the whole conversation, oldest first. """
+    if firestore_db.HISTORY_LAYOUT != 'messages':
+        user_doc = await user_ref.get()
+        data = (user_doc.to_dict() or {}) if user_doc.exists else {}
+        if not data.get('message_count'):
+            return history_codec.stored_history(data)
+    docs = [doc async for doc in user_ref.collection('messages').order_by('seq').stream()]
+    if docs:
+        return [_plain_message(doc.to_dict()) for doc in docs]
+    user_doc = await user_ref.get()
+    return history_codec.stored_history(user_doc.to_dict() or {}) if user_doc.exists else []
+
+async def get_chat_history_page(user_ref, page_size=50, before_seq=None):
+    """ Async firestore_db.get_chat_history_page: (messages, next_before_seq). """
+    data = None
+    if firestore_db.HISTORY_LAYOUT != 'messages':
+        data = (await user_ref.get()).to_dict() or {}
+    docs = []
+    if data is None or data.get('message_count'):
+        query = user_ref.collection('messages').order_by('seq', direction=gcloud_firestore.Query.DESCENDING)
+        if before_seq is not None:
+            query = query.where('seq', '<', before_seq)
+        docs = [doc async for doc in query.limit(page_size).stream()]
+
+    if not docs:
+        if data is None:
+            data = (await user_ref.get()).to_dict() or {}
+        total = 0 if 'message_count' in data else history_codec.stored_count(data)
+        end = total if before_seq is None else min(before_seq, total)
+        start = max(0, end - page_size)
+        page = [dict(msg, seq=seq) for seq, msg in enumerate(history_codec.stored_history(data, start, end), start)]
+        return page, (start if start > 0 else None)
+
+    docs.reverse()
+    page = [dict(_plain_message(doc.to_dict()), seq=doc.get('seq')) for doc in docs]
+    next_before = page[0]['seq'] if page and page[0]['seq'] > 0 else None
+    return page, next_before
+
+
+class AsyncChatTurnRepository(ChatTurnRepository):
+    """
+    ChatTurnRepository on an AsyncClient: load(), save_summary() and commit()
+    are coroutines with the same RPC budget (get, query, commit). A legacy
+    array too large for one batch is copied in chunks ahead of the turn's
+    batch, which then writes the remainder and switches the document over.
+    """
+
+    # The async client has no on_snapshot; cached sessions rely on the TTL
+    WATCHABLE = False
+
+    async def load(self, refresh=False):
+        """ Loads the user snapshot and the recent history used for the prompt (session cache first). """
+        sessions = firestore_db.sessions
+        cached = sessions.get(self.session_id, self.history_limit) if sessions and not refresh else None
+        if cached is not None:
+            self.data, self.history, total = cached
+            self.history_offset = total - len(self.history)
+            return self.history
+
+        self._rpc('get')
+        with metrics.span("user_lookup"):
+            snapshot = await self.user_ref.get()
+        self.data = snapshot.to_dict() if snapshot.exists else None
+        self.update_time = snapshot.update_time if snapshot.exists else None
+
+        if self.exists and self.data.get('message_count'):
+            self._rpc('query')
+            query = (
+                self.user_ref.collection('messages')
+                .order_by('seq', direction=gcloud_firestore.Query.DESCENDING)
+                .limit(self.history_limit)
+            )
+            with metrics.span("history_load"):
+                docs = [doc async for doc in query.stream()]
+            docs.reverse()
+            self.history = [_plain_message(doc.to_dict()) for doc in docs]
+            total = self.data['message_count']
+        else:
+            self.history, total = history_codec.stored_tail(self.data or {}, self.history_limit)
+        self.history_offset = total - len(self.history)
+        if sessions and self.exists and 'message_count' in self.data:
+            sessions.put(self.session_id, self.data, self.history, total)
+        return self.history
+
+    async def save_summary(self, summary, covers):
+        self._rpc('commit')
+        await self.user_ref.update({'history_summary': summary, 'summary_covers': covers})
+        if firestore_db.sessions:
+            firestore_db.sessions.update(self.session_id, {'history_summary': summary, 'summary_covers': covers})
+
+    async def _copy_legacy(self):
+        """ Copies all but the newest INLINE_MIGRATION_LIMIT legacy messages to the subcollection. """
+        data = self.data or {}
+        if 'message_count' in data or HISTORY_LAYOUT != 'messages':
+            return
+        end = history_codec.stored_count(data) - self.INLINE_MIGRATION_LIMIT
+        if end <= self._legacy_copied:
+            return
+        # Deterministic document IDs make a repeated copy harmless
+        for start in range(self._legacy_copied, end, MIGRATION_BATCH_SIZE):
+            batch = self.db.batch()
+            chunk = history_codec.stored_history(data, start, min(end, start + MIGRATION_BATCH_SIZE))
+            _write_messages(batch, self.user_ref, chunk, start)
+            self._rpc('commit')
+            await batch.commit()
+        self._legacy_copied = end
+
+    async def commit(self, new_messages, mood):
+        """ Atomically saves the turn; retries once if a concurrent turn committed first. """
+        sessions = firestore_db.sessions
+        await self._copy_legacy()
+        for attempt in range(2):
+            try:
+                self._rpc('commit')
+                with metrics.span("persist"):
+                    await self._build_batch(new_messages, [mood]).commit()
+                break
+            except (gcp_exceptions.AlreadyExists, gcp_exceptions.FailedPrecondition):
+                if attempt:
+                    if sessions:
+                        sessions.invalidate(self.session_id)
+                    raise
+                print("--- Concurrent turn detected; reloading and retrying commit. ---")
+                await self.load(refresh=True)
+                await self._copy_legacy()
+            except Exception:
+                if sessions:
+                    sessions.invalidate(self.session_id)
+                raise
+
+        if sessions:
+            self._cache_committed(new_messages, [mood])
+        print(f"--- Chat turn committed ({self.rpc_count} Firestore RPCs). ---")
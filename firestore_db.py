@@ -1,17 +1,46 @@
+import os
+import re
 import firebase_admin
 from firebase_admin import credentials, firestore
-from datetime import datetime, timezone
-from google.cloud.firestore import Transaction, Increment
+from datetime import datetime, timezone, timedelta
+from google.api_core import exceptions as gcp_exceptions
+from google.cloud.firestore import Transaction, Increment, DELETE_FIELD
+import metrics
+import session_cache
+import history_codec
 
 # Global DB instance for use across the application
 db = None
 
+# Chat history layout. 'messages' keeps one document per message in a
+# users/{id}/messages subcollection (append-only, sequence-numbered);
+# 'array' is the original single `chat_history` array on the user document;
+# 'packed' keeps the whole conversation in one compressed bytes field on the
+# user document (history_codec.py). Every layout reads the others' documents.
+HISTORY_LAYOUT = os.getenv("HISTORY_LAYOUT", "messages")
+# How many of the most recent messages are loaded to build a prompt
+PROMPT_HISTORY_LIMIT = int(os.getenv("PROMPT_HISTORY_LIMIT", "50"))
+
+# Recently active sessions: user document and message tail (see session_cache.py)
+sessions = session_cache.SessionCache() if session_cache.SESSION_CACHE else None
+metrics.register_stats("session_cache", lambda: sessions.stats() if sessions else None)
+
 def init_db():
     """
     Initializes the Firestore database connection using credentials.
     Returns the database client instance.
     """
     global db
+    if db is None and os.getenv("FIRESTORE_BACKEND") == "memory":
+        # In-process fake for local runs and benchmarks; nothing is persisted
+        from fake_firestore import FakeClient
+        db = FakeClient()
+        print("--- In-Memory Firestore DB Initialized ---")
+    if db is None and os.getenv("FIRESTORE_EMULATOR_HOST"):
+        # The emulator needs no service account; the client connects anonymously
+        from google.cloud import firestore as gcloud_firestore
+        db = gcloud_firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "serenity-local"))
+        print(f"--- Firestore Emulator DB Initialized ({os.getenv('FIRESTORE_EMULATOR_HOST')}) ---")
     if db is None:
         if not firebase_admin._apps:
             # IMPORTANT: Replace "config/firestore-credentials.json" with the actual path 
@@ -34,43 +63,347 @@ def get_or_create_user(db, session_id):
     """
     user_ref = db.collection('users').document(session_id)
     
-    # Check if user exists, if not, create initial profile data
+    # Check if user exists, if not, create initial profile data (a cached session exists)
+    if sessions and sessions.get(session_id, 0):
+        return user_ref
     if not user_ref.get().exists:
         print(f"--- Creating new user document ---")
-        user_ref.set({
-            'created_at': firestore.SERVER_TIMESTAMP,
-            'chat_history': [],
-            'sessions_completed': 0,
-            'days_active': 0,
-            'progress_score': 0,
-            'last_active': None,
-            'name': 'Serenity User',
-            'email': f'user_{session_id[:8]}@serenity.app'
-        })
+        user_ref.set(_new_user_data(session_id))
     return user_ref
 
-def get_chat_history(user_ref):
+def _new_user_data(session_id):
+    """ Initial profile data for a new user document. """
+    return {
+        'created_at': firestore.SERVER_TIMESTAMP,
+        **({'message_count': 0} if HISTORY_LAYOUT == 'messages'
+           else {history_codec.PACKED_FIELD: history_codec.encode([])} if HISTORY_LAYOUT == 'packed'
+           else {'chat_history': []}),
+        'sessions_completed': 0,
+        'days_active': 0,
+        'progress_score': 0,
+        'last_active': None,
+        'name': 'Serenity User',
+        'email': f'user_{session_id[:8]}@serenity.app'
+    }
+
+def _message_doc_id(seq):
+    """ Zero-padded so document IDs sort in sequence order. """
+    return f"{seq:010d}"
+
+def _plain_message(data):
+    return {'role': data.get('role'), 'content': data.get('content')}
+
+def _history_updates(data, new_messages):
+    """
+    Field updates that append `new_messages` to a user document in the
+    'array' or 'packed' layout. A document in the other format is converted.
     """
-    Retrieves the chat history for a given user.
+    packed = data.get(history_codec.PACKED_FIELD)
+    if HISTORY_LAYOUT == 'packed':
+        if packed or not data.get('chat_history'):
+            return {history_codec.PACKED_FIELD: history_codec.append(packed, new_messages)}
+        return {
+            history_codec.PACKED_FIELD: history_codec.encode(list(data['chat_history']) + list(new_messages)),
+            'chat_history': DELETE_FIELD,
+        }
+    updates = {'chat_history': history_codec.stored_history(data) + list(new_messages)}
+    if packed:
+        updates[history_codec.PACKED_FIELD] = DELETE_FIELD
+    return updates
+
+def _drop_stored_history(data):
+    """ Updates removing a document's legacy array and packed history, once they live in the subcollection. """
+    return {field: DELETE_FIELD for field in ('chat_history', history_codec.PACKED_FIELD) if field in data}
+
+def get_chat_history(user_ref, limit=None):
     """
+    Retrieves the chat history for a given user, oldest first.
+    With `limit`, only the most recent `limit` messages are returned (used
+    for prompt construction). Reads the messages subcollection, falling back
+    to the legacy `chat_history` array for documents not yet migrated. In the
+    array and packed layouts the document is read first, and the
+    subcollection is only queried for a document that still has messages there.
+    """
+    if HISTORY_LAYOUT != 'messages':
+        user_doc = user_ref.get()
+        data = (user_doc.to_dict() or {}) if user_doc.exists else {}
+        if not data.get('message_count'):
+            return history_codec.stored_tail(data, limit)[0] if limit else history_codec.stored_history(data)
+    messages_ref = user_ref.collection('messages')
+    if limit is None:
+        docs = list(messages_ref.order_by('seq').stream())
+    else:
+        docs = list(messages_ref.order_by('seq', direction=firestore.Query.DESCENDING).limit(limit).stream())
+        docs.reverse()
+    if docs:
+        return [_plain_message(doc.to_dict()) for doc in docs]
+
     user_doc = user_ref.get()
-    return user_doc.to_dict().get('chat_history', []) if user_doc.exists else []
+    data = (user_doc.to_dict() or {}) if user_doc.exists else {}
+    return history_codec.stored_tail(data, limit)[0] if limit else history_codec.stored_history(data)
+
+def get_chat_history_page(user_ref, page_size=50, before_seq=None):
+    """
+    Returns one page of history, newest page first, for the /history endpoint.
+    The page is ordered oldest to newest and each message carries its `seq`.
+    Returns (messages, next_before_seq); pass next_before_seq back in to get
+    the previous page. It is None once the beginning has been reached.
+    """
+    data = None
+    if HISTORY_LAYOUT != 'messages':
+        # Array or packed layout: the document holds the history unless it still has messages
+        data = user_ref.get().to_dict() or {}
+    docs = []
+    if data is None or data.get('message_count'):
+        query = user_ref.collection('messages').order_by('seq', direction=firestore.Query.DESCENDING)
+        if before_seq is not None:
+            query = query.where('seq', '<', before_seq)
+        docs = list(query.limit(page_size).stream())
+
+    if not docs:
+        # Array or packed layout: decode only the requested page
+        if data is None:
+            data = user_ref.get().to_dict() or {}
+        total = 0 if 'message_count' in data else history_codec.stored_count(data)
+        end = total if before_seq is None else min(before_seq, total)
+        start = max(0, end - page_size)
+        page = [dict(msg, seq=seq) for seq, msg in enumerate(history_codec.stored_history(data, start, end), start)]
+        return page, (start if start > 0 else None)
+
+    docs.reverse()
+    page = [dict(_plain_message(doc.to_dict()), seq=doc.get('seq')) for doc in docs]
+    next_before = page[0]['seq'] if page and page[0]['seq'] > 0 else None
+    return page, next_before
+
+def get_cached_history_page(session_id, limit=None):
+    """
+    The newest `limit` messages (all of them without a limit) from the session
+    cache, shaped like get_chat_history_page's result, or None if the cache
+    doesn't hold that much of the conversation.
+    """
+    if not sessions:
+        return None
+    cached = sessions.get(session_id, limit or 0)
+    if cached is None:
+        return None
+    _, history, total = cached
+    count = total if limit is None else min(limit, total)
+    if count > len(history):
+        return None
+    first = total - count
+    page = [dict(message, seq=seq) for seq, message in enumerate(history[len(history) - count:], first)]
+    return page, (first if first > 0 else None)
+
+def _write_messages(writer, user_ref, messages, first_seq):
+    """ Queues one message document per entry on a transaction or batch, numbered from `first_seq`. """
+    messages_ref = user_ref.collection('messages')
+    for offset, message in enumerate(messages):
+        seq = first_seq + offset
+        writer.set(messages_ref.document(_message_doc_id(seq)), {
+            'seq': seq,
+            'role': message.get('role'),
+            'content': message.get('content'),
+            'timestamp': firestore.SERVER_TIMESTAMP,
+        })
+
+def append_chat_messages(user_ref, new_messages):
+    """
+    Appends messages to the user's chat history. In the 'messages' layout
+    this writes only the new message documents and bumps `message_count`
+    (migrating a legacy array first); in the 'array' and 'packed' layouts it
+    rewrites the history field.
+    """
+    @firestore.transactional
+    def transaction_append(transaction: Transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        data = snapshot.to_dict() or {}
+
+        if 'message_count' not in data:
+            if HISTORY_LAYOUT != 'messages':
+                transaction.update(ref, _history_updates(data, new_messages))
+                return True
+            if history_codec.stored_count(data):
+                return False  # Needs migrating first
+        next_seq = data.get('message_count', 0)
+        _write_messages(transaction, ref, new_messages, next_seq)
+        transaction.update(ref, {'message_count': next_seq + len(new_messages)})
+        return True
+
+    if not transaction_append(user_ref.firestore.transaction(), user_ref):
+        migrate_user_history(user_ref)
+        transaction_append(user_ref.firestore.transaction(), user_ref)
+    print(f"--- Appended {len(new_messages)} chat messages. ---")
+
+# Firestore allows 500 writes per commit; leave headroom for the user doc update
+MIGRATION_BATCH_SIZE = 400
+
+def migrate_user_history(user_ref):
+    """
+    Migrates one user's legacy `chat_history` array (or packed history) into
+    the messages subcollection. Messages are copied in batches (document IDs are
+    deterministic, so an interrupted run can simply be repeated), then a
+    transaction switches the document over and drops the array.
+    Returns the number of messages moved (0 if there was nothing to migrate).
+    """
+    snapshot = user_ref.get()
+    data = snapshot.to_dict() or {}
+    if not snapshot.exists or 'message_count' in data:
+        return 0
+
+    legacy = history_codec.stored_history(data)
+    for start in range(0, len(legacy), MIGRATION_BATCH_SIZE):
+        batch = user_ref.firestore.batch()
+        _write_messages(batch, user_ref, legacy[start:start + MIGRATION_BATCH_SIZE], start)
+        batch.commit()
+
+    @firestore.transactional
+    def transaction_switch(transaction: Transaction, ref):
+        current = (ref.get(transaction=transaction).to_dict() or {})
+        if 'message_count' in current:
+            return 0
+        # Pick up anything a legacy writer appended while we were copying
+        history = history_codec.stored_history(current)
+        _write_messages(transaction, ref, history[len(legacy):], len(legacy))
+        transaction.update(ref, {'message_count': len(history), **_drop_stored_history(current)})
+        return len(history)
+
+    moved = transaction_switch(user_ref.firestore.transaction(), user_ref)
+    if sessions:
+        sessions.invalidate(user_ref.id)
+    print(f"--- Migrated {moved} chat messages for user {user_ref.id}. ---")
+    return moved
 
 def save_chat_history(user_ref, updated_history):
     """
-    Saves the entire updated chat history to the user's document.
+    Saves the entire updated chat history to the user's document
+    ('array' and 'packed' layouts; new code should use append_chat_messages).
     """
-    user_ref.update({'chat_history': updated_history})
+    if HISTORY_LAYOUT == 'packed':
+        updates = {history_codec.PACKED_FIELD: history_codec.encode(updated_history), 'chat_history': DELETE_FIELD}
+    else:
+        updates = {'chat_history': updated_history, history_codec.PACKED_FIELD: DELETE_FIELD}
+    with metrics.span("persist"):
+        user_ref.update(updates)
     print("--- Chat history saved successfully. ---")
 
+def _utc_today():
+    return datetime.now(timezone.utc).date()
+
+def _logged_moods(moods):
+    """ The moods that get a mood log: neutral (and empty) ones are not recorded. """
+    return [re.sub(r'[^A-Za-z0-9_]', '_', mood) for mood in moods if mood and mood != 'neutral']
+
+def _stat_days(user_ref, month):
+    """ Days (dates) of `month` ('YYYY-MM') with at least one mood log, from its mood_stats bucket. """
+    snapshot = user_ref.collection('mood_stats').document(month).get()
+    year, number = map(int, month.split('-'))
+    return {datetime(year, number, int(day)).date()
+            for day, counts in ((snapshot.to_dict() or {}).get('days') or {}).items() if any(counts.values())}
+
+def get_mood_streak(user_ref, data=None, today=None):
+    """
+    Consecutive days with a mood log, ending today or yesterday (0 once a day
+    has been missed), counted from the monthly mood_stats buckets. The buckets
+    only ever take increments, so overlapping turns can't leave the streak
+    wrong. With the user document's `data`, a broken streak costs no read.
+    """
+    today = today or _utc_today()
+    yesterday = today - timedelta(days=1)
+    if data is not None and data.get('mood_last_day') not in (today.isoformat(), yesterday.isoformat()):
+        return 0
+    days, months, streak, day = set(), set(), 0, today
+    while True:
+        month = day.strftime('%Y-%m')
+        if month not in months:
+            months.add(month)
+            days |= _stat_days(user_ref, month)
+        if day in days:
+            streak += 1
+        elif day != today:  # Today may just not have a log yet
+            return streak
+        day -= timedelta(days=1)
+
+def _mood_stats_updates(moods, today):
+    """
+    User document updates (update() field paths) that record `moods` (already
+    filtered by _logged_moods) in the aggregate counters: per-mood counts, the
+    total and the day of the latest log. All of them are increments or plain
+    values, so a stale snapshot can't skew them; the streak is counted from the
+    daily buckets (get_mood_streak).
+    """
+    updates = {'mood_total': Increment(len(moods))}
+    for mood in set(moods):
+        updates[f'mood_counts.{mood}'] = Increment(moods.count(mood))
+    updates['mood_last_day'] = today.isoformat()
+    return updates
+
+def _apply_mood_stats(data, moods, today):
+    """ `data` as it reads after _mood_stats_updates has been committed (for the session cache). """
+    counts = dict(data.get('mood_counts') or {})
+    for mood in moods:
+        counts[mood] = counts.get(mood, 0) + 1
+    return dict(
+        data, mood_counts=counts, mood_total=data.get('mood_total', 0) + len(moods),
+        mood_last_day=today.isoformat(),
+    )
+
+def _nest(fields):
+    """ update() field paths ('a.b') as nested maps, for set() and create(). """
+    nested = {}
+    for path, value in fields.items():
+        *parents, leaf = path.split('.')
+        node = nested
+        for part in parents:
+            node = node.setdefault(part, {})
+        node[leaf] = value
+    return nested
+
+def _write_mood_logs(writer, user_ref, moods, today):
+    """
+    Queues one mood log per mood plus the increments to its daily bucket on a
+    batch or transaction. Buckets live in one mood_stats document per month
+    (`days.DD.<mood>`), so a trend query reads a handful of small documents.
+    """
+    for mood in moods:
+        writer.set(user_ref.collection('mood_logs').document(), {
+            'mood': mood, 'timestamp': firestore.SERVER_TIMESTAMP
+        })
+    day = {mood: Increment(moods.count(mood)) for mood in set(moods)}
+    writer.set(user_ref.collection('mood_stats').document(today.strftime('%Y-%m')), {
+        'month': today.strftime('%Y-%m'), 'days': {today.strftime('%d'): day},
+    }, merge=True)
+
 def add_mood_log(user_ref, mood):
     """
-    Adds a new mood entry to a 'mood_logs' subcollection for the user.
+    Adds a new mood entry to a 'mood_logs' subcollection for the user, and
+    updates the mood counters in the same transaction.
     """
-    if mood and mood != 'neutral':
-        mood_logs_ref = user_ref.collection('mood_logs')
-        mood_logs_ref.add({'mood': mood, 'timestamp': firestore.SERVER_TIMESTAMP})
-        print(f"--- Mood log added: {mood} ---")
+    moods = _logged_moods([mood])
+    if not moods:
+        return
+
+    @firestore.transactional
+    def transaction_log(transaction: Transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        today = _utc_today()
+        _write_mood_logs(transaction, ref, moods, today)
+        updates = _mood_stats_updates(moods, today)
+        if snapshot.exists:
+            transaction.update(ref, updates)
+        else:
+            transaction.set(ref, _nest(updates), merge=True)
+
+    with metrics.span("mood_log"):
+        transaction_log(user_ref.firestore.transaction(), user_ref)
+    if sessions:
+        sessions.invalidate(user_ref.id)
+    print(f"--- Mood log added: {mood} ---")
+
+def _was_active_today(last_active):
+    """ True if `last_active` falls on today's date (UTC). """
+    if last_active and isinstance(last_active, datetime):
+        return last_active.astimezone(timezone.utc).date() == datetime.now(timezone.utc).date()
+    return False
 
 def update_daily_activity(user_ref):
     """
@@ -81,16 +414,7 @@ def update_daily_activity(user_ref):
     def transaction_update(transaction: Transaction, ref):
         snapshot = ref.get(transaction=transaction)
         
-        last_active = snapshot.get('last_active')
-        
-        today_utc = datetime.now(timezone.utc).date()
-        was_active_today = False
-        
-        if last_active and isinstance(last_active, datetime):
-            if last_active.astimezone(timezone.utc).date() == today_utc:
-                was_active_today = True
-
-        if not was_active_today:
+        if not _was_active_today(snapshot.get('last_active')):
             updates = {
                 'days_active': Increment(1),
                 'last_active': firestore.SERVER_TIMESTAMP
@@ -110,7 +434,7 @@ def update_daily_activity(user_ref):
 
 def get_mood_logs(user_ref):
     """
-    Retrieves all mood logs for a user, ordered by timestamp.
+    Retrieves the 10 most recent mood logs for a user, newest first.
     """
     mood_logs_ref = user_ref.collection('mood_logs').order_by(
         'timestamp', direction=firestore.Query.DESCENDING
@@ -120,7 +444,95 @@ def get_mood_logs(user_ref):
     for doc in mood_logs_ref.stream():
         logs.append(doc.to_dict())
     return logs
-    
+
+def _week_start(day):
+    return day - timedelta(days=day.weekday())
+
+def _month_start(day, months_back=0):
+    month = day.year * 12 + day.month - 1 - months_back
+    return day.replace(year=month // 12, month=month % 12 + 1, day=1)
+
+def get_mood_trend(user_ref, period='week', count=12, today=None):
+    """
+    Mood counts per week (Monday to Sunday) or per calendar month for the last
+    `count` periods, oldest first, from the monthly mood_stats buckets: one
+    query, however many mood logs the user has. Each point is
+    {"period", "start", "total", "counts": {mood: n}}.
+    """
+    today = today or _utc_today()
+    if period == 'week':
+        starts = [_week_start(today) - timedelta(weeks=n) for n in range(count - 1, -1, -1)]
+    elif period == 'month':
+        starts = [_month_start(today, n) for n in range(count - 1, -1, -1)]
+    else:
+        raise ValueError(f"Unknown trend period: {period}")
+
+    first_month = starts[0].strftime('%Y-%m')
+    buckets = {}
+    for doc in user_ref.collection('mood_stats').where('month', '>=', first_month).stream():
+        data = doc.to_dict() or {}
+        year, month = map(int, data['month'].split('-'))
+        for day, counts in (data.get('days') or {}).items():
+            buckets[datetime(year, month, int(day)).date()] = counts
+
+    series = []
+    for index, start in enumerate(starts):
+        end = starts[index + 1] if index + 1 < len(starts) else today + timedelta(days=1)
+        counts = {}
+        for day, day_counts in buckets.items():
+            if start <= day < end:
+                for mood, n in day_counts.items():
+                    counts[mood] = counts.get(mood, 0) + n
+        if period == 'week':
+            year, week, _ = start.isocalendar()
+            label = f"{year}-W{week:02d}"
+        else:
+            label = start.strftime('%Y-%m')
+        series.append({"period": label, "start": start.isoformat(), "total": sum(counts.values()), "counts": counts})
+    return series
+
+def backfill_mood_stats(user_ref):
+    """
+    Rebuilds a user's mood counters, last mood day and monthly buckets from the
+    mood_logs subcollection, in one transaction (so turns committed meanwhile
+    are neither lost nor counted twice). Returns the number of logs counted.
+    """
+    @firestore.transactional
+    def transaction_backfill(transaction: Transaction, ref):
+        snapshot = ref.get(transaction=transaction)
+        if not snapshot.exists:
+            return 0
+        # A CollectionReference isn't a Query: transaction.get() only takes the latter
+        logs = list(transaction.get(ref.collection('mood_logs').order_by('timestamp')))
+        counts, months, days = {}, {}, set()
+        for log in logs:
+            data = log.to_dict() or {}
+            moods, timestamp = _logged_moods([data.get('mood')]), data.get('timestamp')
+            if not moods or not isinstance(timestamp, datetime):
+                continue
+            mood, day = moods[0], timestamp.astimezone(timezone.utc).date()
+            counts[mood] = counts.get(mood, 0) + 1
+            bucket = months.setdefault(day.strftime('%Y-%m'), {}).setdefault(day.strftime('%d'), {})
+            bucket[mood] = bucket.get(mood, 0) + 1
+            days.add(day)
+
+        last_day = max(days) if days else None
+        for month, month_days in months.items():
+            transaction.set(ref.collection('mood_stats').document(month), {'month': month, 'days': month_days})
+        transaction.update(ref, {
+            'mood_counts': counts,
+            'mood_total': sum(counts.values()),
+            'mood_streak': DELETE_FIELD,  # Stored by older versions; now counted from the buckets
+            'mood_last_day': last_day.isoformat() if last_day else None,
+            'mood_stats_backfilled': True,
+        })
+        return sum(counts.values())
+
+    counted = transaction_backfill(user_ref.firestore.transaction(), user_ref)
+    if sessions:
+        sessions.invalidate(user_ref.id)
+    return counted
+
 # This function is not currently integrated into the backend but provides
 # the necessary structure for the profile feature later.
 def get_user_profile(user_ref):
@@ -131,8 +543,8 @@ def get_user_profile(user_ref):
         
     data = user_doc.to_dict()
     
-    # Placeholder for calculating mood entries count (needs a more efficient query if many users)
-    # For now, we rely on data stored in the main document or simple stream count.
+    # Mood figures come from the counters kept on the user document
+    # (backfill_mood_stats.py fills them in for users who predate them)
     
     if 'created_at' in data and data['created_at']:
         data['joinDate'] = data['created_at'].strftime('%B %Y')
@@ -143,6 +555,223 @@ def get_user_profile(user_ref):
         'joinDate': data.get('joinDate', 'Unknown'),
         'sessionsCompleted': data.get('sessions_completed', 0),
         'daysActive': data.get('days_active', 0),
-        'moodEntries': len(get_mood_logs(user_ref)), # Re-fetch count
+        'moodEntries': data.get('mood_total', 0),
+        'moodCounts': data.get('mood_counts', {}),
+        'moodStreak': get_mood_streak(user_ref, data),
         'progress': data.get('progress_score', 0)
     }
+
+
+class ChatTurnRepository:
+    """
+    Persistence for one /chat turn with as few round-trips as possible.
+
+    load() reads the user document once (plus one tail query for the message
+    subcollection) and keeps the snapshot; history and the daily-activity check
+    both come from it. commit() then writes the new messages, the mood log,
+    the activity increment and (for a new user) the profile in a single
+    WriteBatch. Each network call is counted in `rpc_count`, so a normal turn
+    for an existing user is exactly 3 RPCs: get, query, commit. While the
+    session is in the session cache, load() makes no RPCs and commit() writes
+    the new state through, so a follow-up turn costs a single commit.
+    """
+
+    # Legacy arrays up to this size are migrated inside the turn's own batch
+    INLINE_MIGRATION_LIMIT = 400
+    # Whether user_ref supports on_snapshot, for SESSION_CACHE_LISTEN
+    WATCHABLE = True
+
+    def __init__(self, db, session_id, history_limit=PROMPT_HISTORY_LIMIT):
+        self.db = db
+        self.session_id = session_id
+        self.history_limit = history_limit
+        self.user_ref = db.collection('users').document(session_id)
+        self.data = None
+        # When the loaded user document was last written (None if cached or missing)
+        self.update_time = None
+        self.history = []
+        self.history_offset = 0
+        # Leading legacy messages already copied to the subcollection ahead of commit
+        self._legacy_copied = 0
+        self.rpc_count = 0
+        self.rpc_log = []
+
+    def _rpc(self, kind):
+        self.rpc_count += 1
+        self.rpc_log.append(kind)
+        metrics.record_rpc(kind)
+
+    @property
+    def exists(self):
+        return self.data is not None
+
+    @property
+    def active_today(self):
+        return self.exists and _was_active_today(self.data.get('last_active'))
+
+    @property
+    def summary(self):
+        """ Rolling summary of turns older than the prompt window, if any. """
+        return (self.data or {}).get('history_summary')
+
+    @property
+    def summary_covers(self):
+        """ How many messages, from the start of the conversation, the summary covers. """
+        return (self.data or {}).get('summary_covers', 0)
+
+    def load(self, refresh=False):
+        """
+        Loads the user snapshot and the recent history used for the prompt,
+        from the session cache when it has them (unless `refresh`).
+        """
+        cached = sessions.get(self.session_id, self.history_limit) if sessions and not refresh else None
+        if cached is not None:
+            self.data, self.history, total = cached
+            self.history_offset = total - len(self.history)
+            return self.history
+
+        self._rpc('get')
+        with metrics.span("user_lookup"):
+            snapshot = self.user_ref.get()
+        self.data = snapshot.to_dict() if snapshot.exists else None
+        self.update_time = snapshot.update_time if snapshot.exists else None
+
+        if self.exists and self.data.get('message_count'):
+            self._rpc('query')
+            with metrics.span("history_load"):
+                docs = list(
+                    self.user_ref.collection('messages')
+                    .order_by('seq', direction=firestore.Query.DESCENDING)
+                    .limit(self.history_limit)
+                    .stream()
+                )
+            docs.reverse()
+            self.history = [_plain_message(doc.to_dict()) for doc in docs]
+            total = self.data['message_count']
+        else:
+            # Array or packed layout: only the blocks holding the tail are decoded
+            self.history, total = history_codec.stored_tail(self.data or {}, self.history_limit)
+        # Absolute position of history[0] within the whole conversation
+        self.history_offset = total - len(self.history)
+        if sessions and self.exists and 'message_count' in self.data:
+            sessions.put(self.session_id, self.data, self.history, total, self.user_ref)
+        return self.history
+
+    def save_summary(self, summary, covers):
+        """ Stores the rolling summary and how many messages it covers. """
+        self._rpc('commit')
+        self.user_ref.update({'history_summary': summary, 'summary_covers': covers})
+        if sessions:
+            sessions.update(self.session_id, {'history_summary': summary, 'summary_covers': covers})
+
+    def _build_batch(self, new_messages, moods):
+        batch = self.db.batch()
+        data = self.data or {}
+        updates = {}
+        option = None
+
+        if HISTORY_LAYOUT != 'messages' and 'message_count' not in data:
+            updates.update(_history_updates(data, new_messages))
+            if self.update_time is not None:
+                # The whole history is rewritten from the snapshot: fail if another turn wrote since
+                option = self.db.write_option(last_update_time=self.update_time)
+        else:
+            next_seq = data.get('message_count', 0)
+            legacy_count = 0 if 'message_count' in data else history_codec.stored_count(data)
+            if legacy_count:
+                legacy = history_codec.stored_history(data, self._legacy_copied)
+                _write_messages(batch, self.user_ref, legacy, self._legacy_copied)
+                updates.update(_drop_stored_history(data))
+                next_seq = legacy_count
+            messages_ref = self.user_ref.collection('messages')
+            for offset, message in enumerate(new_messages):
+                seq = next_seq + offset
+                # create() fails the whole batch if a concurrent turn took this seq
+                batch.create(messages_ref.document(_message_doc_id(seq)), {
+                    'seq': seq,
+                    'role': message.get('role'),
+                    'content': message.get('content'),
+                    'timestamp': firestore.SERVER_TIMESTAMP,
+                })
+            updates['message_count'] = next_seq + len(new_messages)
+
+        if not self.active_today:
+            updates['days_active'] = Increment(1)
+            updates['last_active'] = firestore.SERVER_TIMESTAMP
+
+        logged = _logged_moods(moods)
+        if logged:
+            # Mood logs, the daily bucket and the counters all go in this batch
+            today = _utc_today()
+            _write_mood_logs(batch, self.user_ref, logged, today)
+            updates.update(_mood_stats_updates(logged, today))
+
+        if self.exists:
+            batch.update(self.user_ref, updates, option=option)
+        else:
+            batch.create(self.user_ref, {**_new_user_data(self.session_id), **_nest(updates)})
+        return batch
+
+    def commit(self, new_messages, mood):
+        """
+        Atomically saves the turn: new messages, mood log and activity update.
+        `mood` may also be a list, one per turn, when several turns for the
+        session are written together (write_behind.py). If another turn for the
+        same session committed first (a message seq taken, or for the array and
+        packed layouts the user document changed since load()), the snapshot is
+        reloaded and the batch rebuilt once.
+        """
+        moods = mood if isinstance(mood, (list, tuple)) else [mood]
+        data = self.data or {}
+        if ('message_count' not in data and HISTORY_LAYOUT == 'messages'
+                and history_codec.stored_count(data) > self.INLINE_MIGRATION_LIMIT):
+            # Too large for one batch: migrate separately (once per legacy user)
+            migrate_user_history(self.user_ref)
+            self.load()
+
+        for attempt in range(2):
+            try:
+                self._rpc('commit')
+                # Messages, mood log and activity go out in this one batch
+                with metrics.span("persist"):
+                    self._build_batch(new_messages, moods).commit()
+                break
+            except (gcp_exceptions.AlreadyExists, gcp_exceptions.FailedPrecondition):
+                if attempt:
+                    if sessions:
+                        sessions.invalidate(self.session_id)
+                    raise
+                print("--- Concurrent turn detected; reloading and retrying commit. ---")
+                self.load(refresh=True)
+            except Exception:
+                # Unknown outcome: the next turn has to read what actually landed
+                if sessions:
+                    sessions.invalidate(self.session_id)
+                raise
+
+        if sessions:
+            self._cache_committed(new_messages, moods)
+        print(f"--- Chat turn committed ({self.rpc_count} Firestore RPCs). ---")
+
+    def _cache_committed(self, new_messages, moods):
+        """ Writes the state after commit() through to the session cache. """
+        data = self.data or {}
+        if HISTORY_LAYOUT != 'messages' and 'message_count' not in data:
+            sessions.invalidate(self.session_id)
+            return
+        next_seq = data.get('message_count') if 'message_count' in data else history_codec.stored_count(data)
+        now = datetime.now(timezone.utc)
+        committed = dict(data) if self.exists else {**_new_user_data(self.session_id), 'created_at': now}
+        committed.pop('chat_history', None)
+        committed.pop(history_codec.PACKED_FIELD, None)
+        committed['message_count'] = next_seq + len(new_messages)
+        if not self.active_today:
+            committed['days_active'] = committed.get('days_active', 0) + 1
+            committed['last_active'] = now
+        logged = _logged_moods(moods)
+        if logged:
+            committed = _apply_mood_stats(committed, logged, now.date())
+        # self.history may already hold this turn (callers append to it), so cut at next_seq
+        history = self.history[:max(0, next_seq - self.history_offset)] + list(new_messages)
+        sessions.put(self.session_id, committed, history[-self.history_limit:], committed['message_count'],
+                     self.user_ref if self.WATCHABLE else None)
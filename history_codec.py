@@ -0,0 +1,241 @@
+import os
+import json
+import zlib
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Compact encoding of a whole conversation as one Firestore bytes field
+# (HISTORY_LAYOUT=packed in firestore_db.py), instead of an array of
+# {"role", "content"} maps. Messages are cut into blocks of
+# HISTORY_CODEC_BLOCK. A block holds one role byte and one length per message,
+# then all of their text, and is compressed on its own (zstd if the zstandard
+# package is installed, else zlib). An index in front of the blocks lets
+# count(), tail() and decode_range() inflate only the blocks they need, and
+# append() re-encodes only the last, partly filled block. Documents that still
+# hold the legacy `chat_history` array are read through the same stored_*
+# helpers, so callers never need to know which format a user is on.
+#
+#   blob  = MAGIC | varint blocks | per block: method byte, varint messages, varint bytes | payloads
+#   block = role byte per message | varint length (in characters) per message | UTF-8 text
+
+# --- Configuration ---
+# Compression for new blocks: "zstd" (needs zstandard), "zlib" or "none"
+HISTORY_CODEC = os.getenv("HISTORY_CODEC", "zstd" if ZSTD_AVAILABLE else "zlib")
+# Messages per block; a 50-message prompt tail then inflates at most two blocks
+HISTORY_CODEC_BLOCK = int(os.getenv("HISTORY_CODEC_BLOCK", "64"))
+
+if HISTORY_CODEC == "zstd" and not ZSTD_AVAILABLE:
+    print("--- HISTORY_CODEC=zstd but zstandard is not installed; using zlib ---")
+    HISTORY_CODEC = "zlib"
+
+MAGIC = b"SRH\x01"
+# Document field holding the blob; 'chat_history' is the legacy array
+PACKED_FIELD = 'chat_history_packed'
+
+_METHODS = {"none": 0, "zlib": 1, "zstd": 2}
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+# Blocks smaller than this are stored uncompressed
+MIN_COMPRESS_BYTES = 64
+
+_ROLE_CODES = {'user': 1, 'assistant': 2, 'system': 3}
+_ROLE_NAMES = {code: role for role, code in _ROLE_CODES.items()}
+# Anything else (unknown role, extra keys, non-text content) is kept as JSON
+_JSON = 0xFF
+
+
+# --- 1. Varints and compression ---
+
+def _put_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _compress(raw, codec):
+    if codec == "none" or len(raw) < MIN_COMPRESS_BYTES:
+        return 0, raw
+    if codec == "zstd":
+        packed = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    elif codec == "zlib":
+        packed = zlib.compress(raw, ZLIB_LEVEL)
+    else:
+        raise ValueError(f"Unknown history codec {codec!r}")
+    return (_METHODS[codec], packed) if len(packed) < len(raw) else (0, raw)
+
+
+def _decompress(method, payload):
+    if method == 0:
+        return bytes(payload)
+    if method == 1:
+        return zlib.decompress(payload)
+    if method == 2:
+        if not ZSTD_AVAILABLE:
+            raise ValueError("Chat history is zstd-compressed but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"Unknown chat history block method {method}")
+
+
+# --- 2. Blocks ---
+
+def _pack_block(messages, codec):
+    """ (method, message count, payload) for one block. """
+    roles, lengths, texts = bytearray(), bytearray(), []
+    for message in messages:
+        role = _ROLE_CODES.get(message.get('role'))
+        content = message.get('content')
+        if role is None or not isinstance(content, str) or len(message) != 2:
+            role, content = _JSON, json.dumps(message, ensure_ascii=False, separators=(",", ":"), default=str)
+        roles.append(role)
+        _put_varint(lengths, len(content))
+        texts.append(content)
+    raw = bytes(roles) + bytes(lengths) + "".join(texts).encode("utf-8", "surrogatepass")
+    method, payload = _compress(raw, codec)
+    return method, len(messages), payload
+
+
+def _unpack_block(method, count, payload):
+    raw = _decompress(method, payload)
+    pos = count
+    lengths = []
+    for _ in range(count):
+        length, pos = _get_varint(raw, pos)
+        lengths.append(length)
+    text = raw[pos:].decode("utf-8", "surrogatepass")
+    messages, start = [], 0
+    for role, length in zip(raw[:count], lengths):
+        content = text[start:start + length]
+        start += length
+        messages.append(json.loads(content) if role == _JSON else {'role': _ROLE_NAMES[role], 'content': content})
+    return messages
+
+
+def _pack_blocks(messages, codec, block_messages):
+    return [_pack_block(messages[i:i + block_messages], codec) for i in range(0, len(messages), block_messages)]
+
+
+def _assemble(blocks):
+    out = bytearray(MAGIC)
+    _put_varint(out, len(blocks))
+    for method, count, payload in blocks:
+        out.append(method)
+        _put_varint(out, count)
+        _put_varint(out, len(payload))
+    for _, _, payload in blocks:
+        out += payload
+    return bytes(out)
+
+
+def _index(blob):
+    """ (method, message count, payload start, payload end) for each block of a blob. """
+    if bytes(blob[:len(MAGIC)]) != MAGIC:
+        raise ValueError("Not a packed chat history")
+    blocks, pos = _get_varint(blob, len(MAGIC))
+    entries = []
+    for _ in range(blocks):
+        method = blob[pos]
+        count, pos = _get_varint(blob, pos + 1)
+        length, pos = _get_varint(blob, pos)
+        entries.append((method, count, length))
+    index = []
+    for method, count, length in entries:
+        index.append((method, count, pos, pos + length))
+        pos += length
+    if pos != len(blob):
+        raise ValueError("Packed chat history is truncated")
+    return index
+
+
+# --- 3. Public API ---
+
+def encode(messages, codec=None, block_messages=None):
+    """ Packs a list of {"role", "content"} messages into bytes. """
+    return _assemble(_pack_blocks(list(messages), codec or HISTORY_CODEC, block_messages or HISTORY_CODEC_BLOCK))
+
+
+def append(blob, messages, codec=None, block_messages=None):
+    """ `blob` with `messages` added; only the last block is re-encoded. """
+    if not blob:
+        return encode(messages, codec, block_messages)
+    codec, block_messages = codec or HISTORY_CODEC, block_messages or HISTORY_CODEC_BLOCK
+    view = memoryview(blob)
+    blocks = [(method, count, view[start:end]) for method, count, start, end in _index(blob)]
+    carried = []
+    if blocks and blocks[-1][1] < block_messages:
+        carried = _unpack_block(*blocks.pop())
+    return _assemble(blocks + _pack_blocks(carried + list(messages), codec, block_messages))
+
+
+def count(blob):
+    """ Number of messages in a blob, from its index alone. """
+    return sum(entry[1] for entry in _index(blob)) if blob else 0
+
+
+def decode_range(blob, start=0, end=None):
+    """ Messages [start:end) of a blob (non-negative bounds), inflating only the blocks they fall in. """
+    if not blob:
+        return []
+    view = memoryview(blob)
+    messages, offset = [], 0
+    for method, block_count, payload_start, payload_end in _index(blob):
+        block_end = offset + block_count
+        if block_end > start and (end is None or offset < end):
+            block = _unpack_block(method, block_count, view[payload_start:payload_end])
+            messages += block[max(0, start - offset):None if end is None else end - offset]
+        offset = block_end
+        if end is not None and offset >= end:
+            break
+    return messages
+
+
+def decode(blob):
+    """ All messages of a blob, oldest first. """
+    return decode_range(blob)
+
+
+def tail(blob, limit):
+    """ (the newest `limit` messages, total message count). """
+    total = count(blob)
+    return decode_range(blob, max(0, total - limit)), total
+
+
+# --- 4. Stored history (either format) ---
+
+def stored_count(data):
+    """ Messages held on a user document, packed or in the legacy array. """
+    packed = data.get(PACKED_FIELD)
+    return count(packed) if packed else len(data.get('chat_history') or [])
+
+
+def stored_history(data, start=0, end=None):
+    """ Messages [start:end) held on a user document, packed or in the legacy array. """
+    packed = data.get(PACKED_FIELD)
+    if packed:
+        return decode_range(packed, start, end)
+    return list((data.get('chat_history') or [])[start:end])
+
+
+def stored_tail(data, limit):
+    """ (the newest `limit` messages on a user document, total message count). """
+    packed = data.get(PACKED_FIELD)
+    if packed:
+        return tail(packed, limit)
+    legacy = data.get('chat_history') or []
+    return list(legacy[max(0, len(legacy) - limit):]), len(legacy)
+
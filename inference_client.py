@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+import contextvars
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+    # Transport, timeout and HTTP status errors raised by AsyncInferenceClient
+    ASYNC_HTTP_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+except ImportError:
+    aiohttp = None
+    ASYNC_HTTP_ERRORS = ()
+
+# --- Configuration ---
+# Every value can be tuned from the environment (.env is loaded by the callers).
+POOL_SIZE = int(os.getenv("HF_POOL_SIZE", "10"))
+# Connections are cheap for the async client; it is not limited by a thread pool
+ASYNC_POOL_SIZE = int(os.getenv("HF_ASYNC_POOL_SIZE", "200"))
+REQUEST_TIMEOUT = float(os.getenv("HF_REQUEST_TIMEOUT_SECONDS", "30"))
+MAX_RETRIES = int(os.getenv("HF_MAX_RETRIES", "3"))
+BACKOFF_BASE = float(os.getenv("HF_BACKOFF_BASE_SECONDS", "0.5"))
+BACKOFF_MAX = float(os.getenv("HF_BACKOFF_MAX_SECONDS", "30"))
+BREAKER_THRESHOLD = int(os.getenv("HF_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("HF_BREAKER_COOLDOWN_SECONDS", "30"))
+
+# 429 (rate limited) and 503 (model loading / overloaded) are worth waiting out
+RETRY_STATUSES = (429, 503)
+
+# Time (time.monotonic()) by which the current stage must be answered; set by
+# run_with_deadline() so retries never outlive the caller's stage timeout.
+_deadline = contextvars.ContextVar("inference_deadline", default=None)
+
+
+def run_with_deadline(deadline, fn, *args, **kwargs):
+    """ Calls fn(*args, **kwargs) with every post() it makes bounded by `deadline` (time.monotonic()). """
+    token = _deadline.set(deadline)
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _deadline.reset(token)
+
+
+async def run_with_deadline_async(deadline, awaitable):
+    """ Awaits `awaitable` with every async post() it makes bounded by `deadline`; run it as its own task. """
+    token = _deadline.set(deadline)
+    try:
+        return await awaitable
+    finally:
+        _deadline.reset(token)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    """ Raised instead of sending a request while the circuit breaker is open. """
+
+
+class CircuitBreaker:
+    """
+    Counts consecutive failed calls. After `threshold` failures the circuit opens
+    and calls are refused for `cooldown` seconds; the first call after that is let
+    through as a probe and either closes the circuit again or re-opens it.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                return "half_open"
+            return "open"
+
+    def allow(self):
+        """ Returns True if a call may be attempted now. """
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.cooldown:
+                # Half-open: let this probe through and hold off everyone else
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    print(f"--- Inference circuit opened after {self.failures} failures ---")
+                self.opened_at = time.monotonic()
+
+
+class _RetryPolicy:
+    """ Retry, backoff and circuit-breaker settings shared by the sync and async clients. """
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, timeout=REQUEST_TIMEOUT, breaker=None):
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+
+    def _retry_delay(self, attempt, response=None):
+        """
+        Full-jitter exponential backoff. A 503 from a loading model reports
+        `estimated_time` and a 429 may send Retry-After; either one sets a floor.
+        """
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if response is not None:
+            hint = None
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    hint = float(retry_after)
+                except ValueError:
+                    pass
+            try:
+                body = response.json()
+                if isinstance(body, dict) and body.get("estimated_time") is not None:
+                    hint = float(body["estimated_time"])
+            except (ValueError, TypeError):
+                pass
+            if hint is not None:
+                delay = max(delay, min(hint, self.backoff_max))
+        return delay
+
+    @staticmethod
+    def _attempt_timeout(timeout, deadline):
+        """ Per-attempt timeout: the configured one, cut to what is left of the stage deadline. """
+        if deadline is None:
+            return timeout
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise requests.exceptions.Timeout("Stage deadline passed before the inference call")
+        return min(timeout, remaining)
+
+    @staticmethod
+    def _can_wait(delay, deadline):
+        return deadline is None or time.monotonic() + delay < deadline
+
+    def _record_status(self, status_code):
+        if status_code in RETRY_STATUSES or status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+
+class InferenceClient(_RetryPolicy):
+    """
+    Pooled, keep-alive HTTP client for the Hugging Face Inference API.
+    One instance is shared per API key so every chat turn reuses warm TCP/TLS
+    connections instead of paying for a new handshake on each call.
+    """
+
+    def __init__(self, api_key=None, pool_size=POOL_SIZE, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 timeout=REQUEST_TIMEOUT, breaker=None):
+        super().__init__(max_retries, backoff_base, backoff_max, timeout, breaker)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Connection": "keep-alive",
+        })
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def post(self, url, payload, stream=False, timeout=None):
+        """
+        POSTs `payload` as JSON, retrying connection errors, 429 and 503 with backoff.
+        Read timeouts are not retried: the API has the request and is just slow,
+        so asking again would only add load. Inside run_with_deadline() no attempt
+        or backoff runs past the deadline.
+        Returns the final requests.Response (the caller checks its status).
+        Raises CircuitOpenError while the breaker is open, or the last
+        RequestException once retries are exhausted.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open; skipping call to {url}")
+
+        timeout = timeout or self.timeout
+        deadline = _deadline.get()
+        attempt = 0
+        while True:
+            try:
+                attempt_timeout = self._attempt_timeout(timeout, deadline)
+                response = self.session.post(url, json=payload, stream=stream, timeout=attempt_timeout)
+            except requests.exceptions.ReadTimeout:
+                self.breaker.record_failure()
+                raise
+            except requests.exceptions.RequestException:
+                delay = self._retry_delay(attempt)
+                if attempt >= self.max_retries or not self._can_wait(delay, deadline):
+                    self.breaker.record_failure()
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response)
+                if not self._can_wait(delay, deadline):
+                    self._record_status(response.status_code)
+                    return response
+                print(f"--- Inference API returned {response.status_code}; retrying in {delay:.1f}s ---")
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self._record_status(response.status_code)
+            return response
+
+    def post_json(self, url, payload, timeout=None):
+        """ Like post(), but raises for HTTP errors and returns the decoded JSON body. """
+        response = self.post(url, payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+class _BufferedResponse:
+    """ Status, headers and body of an aiohttp response, read in full before the connection is released. """
+
+    def __init__(self, response, content):
+        self.status_code = response.status
+        self.headers = response.headers
+        self.content = content
+        self._response = response
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        self._response.raise_for_status()
+
+
+class AsyncInferenceClient(_RetryPolicy):
+    """
+    asyncio counterpart of InferenceClient on an aiohttp connection pool: same
+    retries, backoff and circuit breaker, but waiting on the API never blocks
+    a thread, so one event loop can keep hundreds of calls in flight. The
+    session is opened on first use, inside the caller's event loop.
+    Raises CircuitOpenError while the breaker is open, requests' Timeout once
+    the stage deadline has passed, and aiohttp errors otherwise.
+    """
+
+    def __init__(self, api_key=None, pool_size=ASYNC_POOL_SIZE, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX,
+                 timeout=REQUEST_TIMEOUT, breaker=None):
+        if aiohttp is None:
+            raise RuntimeError("aiohttp is required for AsyncInferenceClient")
+        super().__init__(max_retries, backoff_base, backoff_max, timeout, breaker)
+        self.pool_size = pool_size
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.session = None
+
+    def _session(self):
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                headers=self.headers,
+                connector=aiohttp.TCPConnector(limit=self.pool_size),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def post(self, url, payload, timeout=None):
+        """
+        POSTs `payload` as JSON with the same retry rules as InferenceClient.post:
+        transport errors, 429 and 503 are retried with backoff, timeouts are not,
+        and inside run_with_deadline_async() no attempt or backoff runs past the deadline.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError(f"Circuit open; skipping call to {url}")
+
+        timeout = timeout or self.timeout
+        deadline = _deadline.get()
+        attempt = 0
+        while True:
+            request_timeout = aiohttp.ClientTimeout(total=self._attempt_timeout(timeout, deadline))
+            try:
+                async with self._session().post(url, json=payload, timeout=request_timeout) as raw:
+                    response = _BufferedResponse(raw, await raw.read())
+            except asyncio.TimeoutError:
+                self.breaker.record_failure()
+                raise
+            except aiohttp.ClientError:
+                delay = self._retry_delay(attempt)
+                if attempt >= self.max_retries or not self._can_wait(delay, deadline):
+                    self.breaker.record_failure()
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, response)
+                if not self._can_wait(delay, deadline):
+                    self._record_status(response.status_code)
+                    return response
+                print(f"--- Inference API returned {response.status_code}; retrying in {delay:.1f}s ---")
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            self._record_status(response.status_code)
+            return response
+
+    async def post_json(self, url, payload, timeout=None):
+        """ Like post(), but raises for HTTP errors and returns the decoded JSON body. """
+        response = await self.post(url, payload, timeout=timeout)
+        response.raise_for_status()
+        return response.json()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+# --- Shared clients, one per API key ---
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key=None):
+    """ Returns the process-wide InferenceClient for `api_key`, creating it on first use. """
+    with _clients_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            client = InferenceClient(api_key)
+            _clients[api_key] = client
+        return client
+
+
+_async_clients = {}
+
+
+def get_async_client(api_key=None):
+    """ Returns the process-wide AsyncInferenceClient for `api_key` (use from one event loop). """
+    with _clients_lock:
+        client = _async_clients.get(api_key)
+        if client is None:
+            client = AsyncInferenceClient(api_key)
+            _async_clients[api_key] = client
+        return client
@@ -0,0 +1,205 @@
+import copy
+import threading
+from collections import OrderedDict
+
+# torch and transformers are imported where they are used, so importing this
+# module (bot.py does at startup) doesn't pay for them before the model loads.
+
+
+# --- 1. Helpers ---
+
+def cache_nbytes(cache):
+    """ Memory held by a DynamicCache's key/value tensors. """
+    layers = getattr(cache, "layers", None)
+    if layers is not None:
+        tensors = [t for layer in layers for t in (getattr(layer, "keys", None), getattr(layer, "values", None))]
+    else:
+        tensors = list(cache.key_cache) + list(cache.value_cache)
+    return sum(t.element_size() * t.nelement() for t in tensors if t is not None)
+
+
+def common_prefix_length(a, b):
+    """ Number of leading positions at which two 1-D token id tensors agree. """
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    mismatch = (a[:n] != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def _as_dynamic_cache(past_key_values):
+    from transformers import DynamicCache
+    if isinstance(past_key_values, DynamicCache):
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+# --- 2. Fixed system-prompt prefixes ---
+
+class PrefixCache:
+    """
+    past_key_values for the fixed system-prompt prefix of each prompt type,
+    computed once at startup. A prompt that starts with a cached prefix only
+    needs its suffix prefilled; lookup() hands out a private copy because
+    generate() extends the cache in place.
+    """
+
+    def __init__(self, model, tokenizer):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, name, system_message):
+        """ Prefills and stores the token prefix every prompt built on `system_message` shares. """
+        # The prefix is whatever two prompts with unrelated user turns have in common;
+        # the last shared token is dropped in case it merges with the user text.
+        probes = [
+            self.tokenizer.apply_chat_template(
+                [system_message, {"role": "user", "content": text}],
+                add_generation_prompt=True, return_tensors="pt"
+            )[0]
+            for text in ("Hello.", "I have had a long week")
+        ]
+        length = max(0, common_prefix_length(*probes) - 1)
+        if length == 0:
+            return
+        prefix_ids = probes[0][:length]
+
+        import torch
+        with torch.inference_mode():
+            outputs = self.model(prefix_ids.unsqueeze(0).to(self.model.device), use_cache=True)
+        self.entries[name] = (prefix_ids, _as_dynamic_cache(outputs.past_key_values))
+        print(f"--- Cached {length}-token prefix for the {name} prompt ---")
+
+    def lookup(self, input_ids):
+        """ Returns (prefix_length, cache copy) for the longest matching prefix, or (0, None). """
+        import torch
+        best = None
+        for prefix_ids, cache in self.entries.values():
+            length = len(prefix_ids)
+            if length < len(input_ids) and torch.equal(input_ids[:length], prefix_ids):
+                if best is None or length > best[0]:
+                    best = (length, cache)
+        with self._lock:
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if best is None:
+            return 0, None
+        return best[0], copy.deepcopy(best[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                "prefixes": {name: len(ids) for name, (ids, _) in self.entries.items()},
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+# --- 3. Per-session conversation caches ---
+
+class SessionKVCache:
+    """
+    The KV cache left over from each session's last conversation turn, so the
+    next turn only prefills the new messages. Entries are LRU-evicted to stay
+    under `max_bytes`. take() removes the entry (generation mutates it) and the
+    caller put()s back the extended cache afterwards.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def take(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.bytes -= entry[2]
+            return entry[0], entry[1]
+
+    def put(self, session_id, token_ids, cache):
+        size = cache_nbytes(cache)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(session_id, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[session_id] = (token_ids, cache, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted[2]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# --- 4. Generation on top of the caches ---
+
+def generate_with_cache(model, input_ids, prefix_cache=None, session_cache=None, session_id=None, **generate_args):
+    """
+    model.generate for a single sequence (`input_ids` of shape (1, n)) that
+    starts from the longest reusable KV cache: the session's previous turn if
+    its tokens still prefix this prompt, else a cached system-prompt prefix.
+    When `session_cache` and `session_id` are given, the cache is stored again
+    for the next turn. Returns the output sequences like model.generate.
+    """
+    import torch
+    prompt_ids = input_ids[0].cpu()
+    cache = None
+
+    store = session_cache is not None and session_id is not None
+    if store:
+        entry = session_cache.take(session_id)
+        if entry is not None:
+            cached_ids, cached = entry
+            # Keep at least one prompt token to prefill, and stay within what the cache holds
+            reuse = min(common_prefix_length(cached_ids, prompt_ids), len(prompt_ids) - 1, cached.get_seq_length())
+            if reuse > 0:
+                cached.crop(reuse)
+                cache = cached
+
+    if cache is None and prefix_cache is not None:
+        _, cache = prefix_cache.lookup(prompt_ids)
+
+    if cache is not None:
+        generate_args["past_key_values"] = cache
+
+    with torch.inference_mode():
+        outputs = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            return_dict_in_generate=store,
+            **generate_args
+        )
+
+    if not store:
+        return outputs
+
+    # The final generated token is never fed back, so the cache is one short of the sequence
+    past = _as_dynamic_cache(outputs.past_key_values)
+    session_cache.put(session_id, outputs.sequences[0][:past.get_seq_length()].cpu(), past)
+    return outputs.sequences
@@ -1,7 +1,18 @@
 import re
 import os
+import json
+import time
+import asyncio
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from inference_client import get_client, get_async_client, run_with_deadline, run_with_deadline_async, ASYNC_HTTP_ERRORS
+import admission
+import context_builder
+import crisis_screen
+import metrics
+import mood_classifier
+import response_cache
 
 # Load environment variables from .env file (ensures key is available)
 load_dotenv()
@@ -13,7 +24,56 @@ HF_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 HF_MODEL_ID = os.getenv("HF_MODEL_ID", "mistralai/Mistral-7B-Instruct-v0.2")
 
 # Construct the API URL using the model ID from the .env file
-API_URL = f"https://api-inference.huggingface.co/models/{HF_MODEL_ID}" 
+# (HF_API_URL overrides it, e.g. to point at a local stub server)
+API_URL = os.getenv("HF_API_URL", f"https://api-inference.huggingface.co/models/{HF_MODEL_ID}")
+
+# Concurrent orchestration: classification and generation run side by side.
+# Each stage gets its own timeout; a classification that misses its deadline
+# falls back to FALLBACK_MOOD instead of holding up the reply.
+CONCURRENT_ORCHESTRATION = os.getenv("CONCURRENT_ORCHESTRATION", "1") == "1"
+CLASSIFY_TIMEOUT = float(os.getenv("CLASSIFY_TIMEOUT_SECONDS", "10"))
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT_SECONDS", "30"))
+FALLBACK_MOOD = os.getenv("FALLBACK_MOOD", "neutral")
+# Canned replies for when the API can't answer. They are sent to the user but
+# never saved, so they don't turn up in later prompts or summaries.
+TIMEOUT_MESSAGE = "The external AI service is currently unreachable or timed out."
+MISSING_KEY_MESSAGE = "API service is unavailable due to missing key."
+INVALID_RESPONSE_MESSAGE = "Could not generate a valid response from the API."
+INTERNAL_ERROR_MESSAGE = "An internal error occurred while processing the AI response."
+FALLBACK_MESSAGES = frozenset({TIMEOUT_MESSAGE, MISSING_KEY_MESSAGE, INVALID_RESPONSE_MESSAGE, INTERNAL_ERROR_MESSAGE})
+
+# Shared pool for the two stages of each turn: two threads for every chat the
+# admission controller lets in at once, so a stage doesn't sit in the queue
+# until its deadline (counted from the request) has passed. A stage the turn
+# gave up on is cancelled if still queued; if running, the client stops at the
+# deadline and frees the thread.
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ORCHESTRATION_WORKERS", str(2 * admission.ADMISSION_MAX_IN_FLIGHT))),
+    thread_name_prefix="serenity-llm"
+)
+
+def _load_token_counter():
+    """ Counts with HF_MODEL_ID's tokenizer when transformers is installed, else approximates. """
+    try:
+        from transformers import AutoTokenizer
+        return context_builder.tokenizer_counter(AutoTokenizer.from_pretrained(HF_MODEL_ID))
+    except Exception as e:
+        print(f"--- Tokenizer for {HF_MODEL_ID} unavailable ({e}); approximating token counts. ---")
+        return context_builder.approximate_token_count
+
+# Token-budgeted prompt construction (the tokenizer is only loaded on first use)
+_token_counter = None
+
+def _count_tokens(text):
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = _load_token_counter()
+    return _token_counter(text)
+
+context = context_builder.ContextBuilder(_count_tokens)
+
+# Classification tags and deterministic completions are reused for repeated messages
+cache = response_cache.build_cache(namespace=f"{HF_MODEL_ID}:")
 
 if not HF_API_KEY:
     print("--- WARNING: HUGGINGFACE_API_KEY environment variable not set. API calls will fail. ---")
@@ -36,22 +96,21 @@ CONVERSATION_PROMPT = {
     "content": "You are Serenity, a compassionate and supportive mental health chatbot. Never refer to yourself as Aura or any other name. You are NOT a therapist. DO NOT provide medical advice. Keep your responses concise, warm, and non-judgemental. Use less than 50 words."
 }
 
+SUMMARY_PROMPT = {
+    "role": "system",
+    "content": "Summarize the conversation below between a user and Serenity, a supportive mental health chatbot, in under 80 words. Keep the user's main concerns, feelings and anything they asked to remember. If a previous summary is given, merge it in."
+}
+
 
 # --- 3. Core API Inference Logic ---
 
-def make_hf_api_call(messages, is_classification=False):
-    """
-    Makes an authenticated POST request to the Hugging Face Chat Completion API.
-    """
-    if not HF_API_KEY:
-        return "API service is unavailable due to missing key."
+def is_fallback_reply(reply):
+    """ True for a canned reply sent instead of an API answer; the turn isn't persisted. """
+    return reply in FALLBACK_MESSAGES
 
-    headers = {
-        "Authorization": f"Bearer {HF_API_KEY}",
-        "Content-Type": "application/json"
-    }
-    
-    # Configure parameters based on task type
+
+def build_payload(messages, is_classification=False, stream=False):
+    """ Builds the request body, configuring generation parameters based on task type. """
     if is_classification:
         params = {
             # Low temperature and sampling for deterministic classification
@@ -67,34 +126,117 @@ def make_hf_api_call(messages, is_classification=False):
             "do_sample": True,
         }
 
-    payload = {
+    return {
         "messages": messages,
         "parameters": params,
-        "stream": False 
+        "stream": stream
     }
 
+
+def _cached_completion(payload):
+    """ Returns (cache_key, cached_text) for a request; only greedy completions are cacheable. """
+    # Greedy completions are a pure function of the request body
+    if cache is None or payload["parameters"]["do_sample"]:
+        return None, None
+    cache_key = cache.completion_key(payload)
+    return cache_key, cache.get(cache_key)
+
+
+def _completion_content(result, cache_key=None):
+    """ Extracts the reply text from a Chat Completion response body. """
+    if result and 'choices' in result and result['choices']:
+        content = result['choices'][0]['message']['content'].strip()
+        if cache_key is not None:
+            cache.set(cache_key, content)
+        return content
+    print(f"API Response Error: No content in result: {result}")
+    return INVALID_RESPONSE_MESSAGE
+
+
+def _record_completion_tokens(result):
+    """ Completion token count from the response's OpenAI-style `usage`, when the server reports one. """
+    if isinstance(result, dict):
+        metrics.record_tokens("completion", (result.get("usage") or {}).get("completion_tokens"))
+
+
+def make_hf_api_call(messages, is_classification=False):
+    """
+    Makes an authenticated POST request to the Hugging Face Chat Completion API
+    through the shared pooled client (keep-alive, retry/backoff, circuit breaker).
+    """
+    if not HF_API_KEY:
+        return MISSING_KEY_MESSAGE
+
+    payload = build_payload(messages, is_classification)
+    cache_key, cached = _cached_completion(payload)
+    if cached is not None:
+        return cached
+
     try:
-        # Use a timeout for robust network operations
-        response = requests.post(API_URL, headers=headers, json=payload, timeout=30)
-        response.raise_for_status()  # Raises an HTTPError for bad responses (4xx or 5xx)
-        
-        result = response.json()
-        
-        if result and 'choices' in result and result['choices']:
-            return result['choices'][0]['message']['content'].strip()
-        else:
-            print(f"API Response Error: No content in result: {result}")
-            return "Could not generate a valid response from the API."
+        # Retries, timeouts and HTTP errors (4xx or 5xx) are handled by the shared client
+        result = get_client(HF_API_KEY).post_json(API_URL, payload)
+        if not is_classification:
+            _record_completion_tokens(result)
+        return _completion_content(result, cache_key)
 
     except requests.exceptions.RequestException as e:
         print(f"Request Error during API call to {API_URL}: {e}")
-        return "The external AI service is currently unreachable or timed out."
+        return TIMEOUT_MESSAGE
     except Exception as e:
         print(f"An unexpected error occurred processing API response: {e}")
-        return "An internal error occurred while processing the AI response."
+        return INTERNAL_ERROR_MESSAGE
 
 
-def classify_intent(user_input, history):
+class StreamInterrupted(Exception):
+    """ The streamed reply broke off after part of it was sent; it must not be saved. """
+
+
+def stream_hf_api_call(messages):
+    """
+    Streams a conversational completion from the Chat Completion API.
+    Yields text fragments as the server-sent `data:` chunks arrive. A failure
+    before the first fragment yields the usual fallback text; one after it
+    raises StreamInterrupted, since the partial reply is not a whole answer.
+    """
+    if not HF_API_KEY:
+        yield MISSING_KEY_MESSAGE
+        return
+
+    payload = build_payload(messages, is_classification=False, stream=True)
+    sent = False
+
+    try:
+        with get_client(HF_API_KEY).post(API_URL, payload, stream=True) as response:
+            response.raise_for_status()
+            for line in response.iter_lines(decode_unicode=True):
+                if not line or not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                # OpenAI-style delta chunks, or TGI-style {"token": {"text": ...}}
+                if chunk.get("choices"):
+                    text = chunk["choices"][0].get("delta", {}).get("content")
+                else:
+                    text = chunk.get("token", {}).get("text")
+                if text:
+                    sent = True
+                    yield text
+
+    except requests.exceptions.RequestException as e:
+        print(f"Request Error during streaming API call to {API_URL}: {e}")
+        if sent:
+            raise StreamInterrupted(str(e)) from e
+        yield TIMEOUT_MESSAGE
+    except Exception as e:
+        print(f"An unexpected error occurred processing streamed API response: {e}")
+        if sent:
+            raise StreamInterrupted(str(e)) from e
+        yield INTERNAL_ERROR_MESSAGE
+
+
+def llm_classify_intent(user_input, history):
     """ Orchestrates the classification API call using the classification prompt. """
     # Use only recent history for context to save tokens and focus classification
     recent_history = history[-4:]
@@ -102,32 +244,271 @@ def classify_intent(user_input, history):
     
     raw_response = make_hf_api_call(messages, is_classification=True)
 
-    # Parse the response to extract the mood tag
+    # Parse the response to extract the mood tag (None lets the classifier fall back)
     match = re.search(r'\[(mood|intent):\s*([^\]]+)\]', raw_response)
-    tag = match.group(2).strip() if match else "neutral"
-    
+    return match.group(2).strip() if match else None
+
+
+# Keyword and linear tiers answer most messages locally; the API is only asked when they are unsure
+classifier = mood_classifier.build_classifier(llm_classify_intent, fallback=FALLBACK_MOOD, cache=cache)
+
+
+def classify_intent(user_input, history):
+    """ Classifies the user's message through the tiered mood classifier. """
+    with metrics.span("classify"):
+        tag = classifier.classify(user_input, history)
     print(f"--- Classified Intent: {tag} ---")
     return tag
 
 
-def generate_conversational_response(user_input, history):
+def build_conversation_messages(user_input, history, summary=None, usage=None):
+    """
+    Conversation prompt: system prompt (plus any rolling summary), as much recent
+    history as fits CONTEXT_TOKEN_BUDGET, current message. Token accounting is
+    written into `usage` when given.
+    """
+    prompt = context.build(CONVERSATION_PROMPT, history, user_input, summary)
+    if usage is not None:
+        usage.update(prompt.usage())
+    return prompt.messages
+
+
+def generate_conversational_response(user_input, history, summary=None, usage=None):
     """ Orchestrates the conversational API call using the conversation prompt. """
-    # Use full history for conversational context
-    messages = [CONVERSATION_PROMPT] + history + [{"role": "user", "content": user_input}]
+    # Use as much recent history as fits the token budget
+    messages = build_conversation_messages(user_input, history, summary, usage)
     
-    clean_message = make_hf_api_call(messages, is_classification=False)
+    with metrics.span("generate"):
+        clean_message = make_hf_api_call(messages, is_classification=False)
     
     # Clean up model prefixing if necessary (some models prepend the persona name)
     return clean_message.replace("Serenity:", "").strip()
 
 
-def get_response(user_input, history):
-    """ Orchestrates the two-step process: classify then respond. """
-    mood = classify_intent(user_input, history)
-    clean_message = generate_conversational_response(user_input, history)
+def _await_stage(future, deadline, fallback, stage):
+    """ Waits for a stage future until the shared deadline, returning the fallback on timeout or error. """
+    try:
+        return future.result(timeout=max(0.0, deadline - time.monotonic()))
+    except Exception as e:
+        # A timed-out stage keeps running in the pool; its result is simply discarded.
+        future.cancel()
+        print(f"--- {stage} stage did not complete ({type(e).__name__}); using fallback. ---")
+        return fallback
+
+
+def summarize_history(previous_summary, messages):
+    """ Folds `messages` (and any previous summary) into a short rolling summary. """
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Previous summary: {previous_summary}\n\n{transcript}"
+    summary = make_hf_api_call([SUMMARY_PROMPT, {"role": "user", "content": transcript}]).strip()
+    # An error message must not replace the stored summary
+    return None if is_fallback_reply(summary) else summary
+
+
+def get_response(user_input, history, concurrent=None, summary=None, usage=None, session_id=None):
+    """
+    Orchestrates the two-step process: classify and respond.
+    With concurrent orchestration (the default) both API calls run together in
+    the shared thread pool, so a turn costs one round-trip instead of two.
+    `session_id` only labels crisis escalations; the API backend keeps no
+    per-session state.
+    """
+    if concurrent is None:
+        concurrent = CONCURRENT_ORCHESTRATION
+
+    # High-risk messages get the vetted safety response without either API call
+    crisis = crisis_screen.intercept(user_input, history, session_id, "llm_service")
+    if crisis:
+        return crisis
+
+    if concurrent:
+        # Each stage gets its own snapshot so appending below can't race a queued call
+        start = time.monotonic()
+        # propagate() keeps the request ID (and stage trace) on the pool threads; the
+        # stage deadline stops the client retrying after the turn has moved on
+        mood_future = _executor.submit(
+            metrics.propagate(run_with_deadline), start + CLASSIFY_TIMEOUT, classify_intent, user_input, list(history)
+        )
+        reply_future = _executor.submit(
+            metrics.propagate(run_with_deadline), start + GENERATE_TIMEOUT,
+            generate_conversational_response, user_input, list(history), summary, usage
+        )
+        clean_message = _await_stage(reply_future, start + GENERATE_TIMEOUT, TIMEOUT_MESSAGE, "Generation")
+        mood = _await_stage(mood_future, start + CLASSIFY_TIMEOUT, FALLBACK_MOOD, "Classification")
+    else:
+        mood = classify_intent(user_input, history)
+        clean_message = generate_conversational_response(user_input, history, summary, usage)
 
     # Update history for saving
     history.append({"role": "user", "content": user_input})
     history.append({"role": "assistant", "content": clean_message})
 
     return mood, clean_message, history
+
+
+def stream_response(user_input, history, summary=None, usage=None, session_id=None):
+    """
+    Streaming variant of get_response. Classification runs in the thread pool
+    while the reply streams; yields {"token": text} events, then a final
+    {"done": True, "mood": ..., "response": ...} once history has been updated.
+    Raises StreamInterrupted (history untouched) if the reply breaks off midway.
+    """
+    crisis = crisis_screen.intercept(user_input, history, session_id, "llm_service")
+    if crisis:
+        mood, clean_message, _ = crisis
+        yield {"token": clean_message}
+        yield {"done": True, "mood": mood, "response": clean_message}
+        return
+
+    mood_future = _executor.submit(
+        metrics.propagate(run_with_deadline), time.monotonic() + CLASSIFY_TIMEOUT,
+        classify_intent, user_input, list(history)
+    )
+    messages = build_conversation_messages(user_input, history, summary, usage)
+
+    start = time.monotonic()
+    fragments = []
+    for text in stream_hf_api_call(messages):
+        if not fragments:
+            metrics.observe_stage("first_token", time.monotonic() - start)
+        fragments.append(text)
+        yield {"token": text}
+    metrics.observe_stage("generate", time.monotonic() - start)
+
+    clean_message = "".join(fragments).replace("Serenity:", "").strip()
+    mood = _await_stage(mood_future, start + CLASSIFY_TIMEOUT, FALLBACK_MOOD, "Classification")
+
+    history.append({"role": "user", "content": user_input})
+    history.append({"role": "assistant", "content": clean_message})
+
+    yield {"done": True, "mood": mood, "response": clean_message}
+
+
+def format_sse(event, data):
+    """ Serialises one Server-Sent Event frame with a JSON payload. """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# --- 4. asyncio variants (used by asgi_api.py) ---
+# Same prompts, cache and classifier as above; every network wait is awaited
+# on the event loop instead of holding a pool thread.
+
+async def make_hf_api_call_async(messages, is_classification=False):
+    """ Async make_hf_api_call through the shared aiohttp connection pool. """
+    if not HF_API_KEY:
+        return MISSING_KEY_MESSAGE
+
+    payload = build_payload(messages, is_classification)
+    cache_key, cached = _cached_completion(payload)
+    if cached is not None:
+        return cached
+
+    try:
+        result = await get_async_client(HF_API_KEY).post_json(API_URL, payload)
+        if not is_classification:
+            _record_completion_tokens(result)
+        return _completion_content(result, cache_key)
+
+    except (requests.exceptions.RequestException,) + ASYNC_HTTP_ERRORS as e:
+        print(f"Request Error during API call to {API_URL}: {e}")
+        return TIMEOUT_MESSAGE
+    except Exception as e:
+        print(f"An unexpected error occurred processing API response: {e}")
+        return INTERNAL_ERROR_MESSAGE
+
+
+async def llm_classify_intent_async(user_input, history):
+    """ Async LLM tier of the classifier; None when the completion has no tag. """
+    messages = [CLASSIFICATION_PROMPT] + history[-4:] + [{"role": "user", "content": user_input}]
+    raw_response = await make_hf_api_call_async(messages, is_classification=True)
+    match = re.search(r'\[(mood|intent):\s*([^\]]+)\]', raw_response)
+    return match.group(2).strip() if match else None
+
+
+async def classify_intent_async(user_input, history):
+    """ Local classifier tiers first; the API is only awaited when they are unsure. """
+    with metrics.span("classify"):
+        decision, best_guess = classifier.classify_local(user_input, history)
+        if decision is not None:
+            tag = decision.tag
+        else:
+            started = time.perf_counter()
+            try:
+                llm_tag = await llm_classify_intent_async(user_input, history)
+            except Exception as e:
+                print(f"--- LLM classification failed: {e} ---")
+                llm_tag = None
+            tag = classifier.resolve(user_input, history, llm_tag, best_guess, started)
+    print(f"--- Classified Intent: {tag} ---")
+    return tag
+
+
+async def generate_conversational_response_async(user_input, history, summary=None, usage=None):
+    messages = build_conversation_messages(user_input, history, summary, usage)
+    with metrics.span("generate"):
+        clean_message = await make_hf_api_call_async(messages, is_classification=False)
+    return clean_message.replace("Serenity:", "").strip()
+
+
+async def summarize_history_async(previous_summary, messages):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Previous summary: {previous_summary}\n\n{transcript}"
+    summary = (await make_hf_api_call_async([SUMMARY_PROMPT, {"role": "user", "content": transcript}])).strip()
+    return None if is_fallback_reply(summary) else summary
+
+
+async def _await_task(task, timeout, fallback, stage):
+    """ Awaits a stage task for up to `timeout` seconds, returning the fallback on timeout or error. """
+    try:
+        return await asyncio.wait_for(task, timeout=max(0.0, timeout))
+    except Exception as e:
+        print(f"--- {stage} stage did not complete ({type(e).__name__}); using fallback. ---")
+        return fallback
+
+
+async def get_response_async(user_input, history, concurrent=None, summary=None, usage=None, session_id=None):
+    """ asyncio variant of get_response: both stages run as tasks on the event loop. """
+    if concurrent is None:
+        concurrent = CONCURRENT_ORCHESTRATION
+
+    crisis = crisis_screen.intercept(user_input, history, session_id, "asgi_api")
+    if crisis:
+        return crisis
+
+    start = time.monotonic()
+    # The stage deadline also stops the client retrying or backing off past the stage timeout
+    if concurrent:
+        mood_task = asyncio.ensure_future(run_with_deadline_async(
+            start + CLASSIFY_TIMEOUT, classify_intent_async(user_input, list(history))))
+        reply_task = asyncio.ensure_future(run_with_deadline_async(
+            start + GENERATE_TIMEOUT, generate_conversational_response_async(user_input, list(history), summary, usage)))
+        clean_message = await _await_task(reply_task, GENERATE_TIMEOUT, TIMEOUT_MESSAGE, "Generation")
+        mood = await _await_task(mood_task, start + CLASSIFY_TIMEOUT - time.monotonic(), FALLBACK_MOOD, "Classification")
+    else:
+        mood = await _await_task(run_with_deadline_async(
+            start + CLASSIFY_TIMEOUT, classify_intent_async(user_input, history)), CLASSIFY_TIMEOUT, FALLBACK_MOOD, "Classification")
+        started = time.monotonic()
+        clean_message = await _await_task(run_with_deadline_async(
+            started + GENERATE_TIMEOUT, generate_conversational_response_async(user_input, history, summary, usage)),
+            GENERATE_TIMEOUT, TIMEOUT_MESSAGE, "Generation")
+
+    history.append({"role": "user", "content": user_input})
+    history.append({"role": "assistant", "content": clean_message})
+
+    return mood, clean_message, history
+
+
+def stats():
+    """ Classifier tier decisions and response cache counters, for a server's stats endpoint. """
+    return {
+        "classifier": classifier.stats(),
+        "response_cache": cache.stats() if cache else None,
+    }
+
+
+# Component counters (classifier tiers, cache hits) on /metrics
+metrics.register_stats("classifier", classifier.stats)
+metrics.register_stats("response_cache", lambda: cache.stats() if cache else None)
+metrics.register_stats("context", context.stats)
@@ -0,0 +1,261 @@
+import os
+import queue
+import threading
+import batch_scheduler
+import kv_cache
+import metrics
+import model_manager
+
+# The local model, the system prompts it runs and the per-model state built on
+# top of it (prefix KV caches, session caches, the batch scheduler). Nothing
+# here touches Flask or Firestore, and importing it only creates the
+# ModelManager: bot.py serves the model to its own routes, and model_server.py
+# imports this module alone to serve it to web workers. torch and transformers
+# are only imported by the functions that run the model.
+
+# --- 1. Configuration ---
+# MODEL_PRESET=tiny swaps in a small CPU model for tests (see model_manager.py)
+MODEL_ID = model_manager.MODEL_ID
+
+# Wall-clock budget of a classification and of a conversation (or summary) generate call
+CLASSIFY_TIMEOUT = float(os.getenv("CLASSIFY_TIMEOUT_SECONDS", "10"))
+GENERATE_TIMEOUT = float(os.getenv("GENERATE_TIMEOUT_SECONDS", "30"))
+CLASSIFY_MAX_TOKENS = 15
+CONVERSATION_MAX_TOKENS = 128
+
+# Dynamic micro-batching: concurrent requests are gathered for up to
+# BATCH_MAX_WAIT_MS (or BATCH_MAX_SIZE prompts) and run as one generate call.
+USE_BATCH_SCHEDULER = os.getenv("BATCH_SCHEDULER", "1") == "1"
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_MAX_WAIT_MS = float(os.getenv("BATCH_MAX_WAIT_MS", "10"))
+
+# KV-cache reuse for single-sequence generation: the system-prompt prefixes are
+# prefilled once at startup, and each session's last conversation turn is kept
+# (up to SESSION_KV_CACHE_MB) so the next turn only prefills the new messages.
+# The session caches are used by the sequential and streaming paths only. With
+# the batch scheduler (the /chat default), a batch holding a single prompt
+# starts from its cached prefix; padded batches of several prompts still
+# prefill in full, since left padding shifts where each row's prefix sits.
+PREFIX_CACHE = os.getenv("PREFIX_CACHE", "1") == "1"
+SESSION_KV_CACHE_MB = int(os.getenv("SESSION_KV_CACHE_MB", "512"))
+
+
+# --- 2. System Prompts ---
+CLASSIFICATION_PROMPT = {
+    "role": "system",
+    "content": (
+        "You are a classification expert. Analyze the user's message and respond with ONLY ONE of the following tags that best fits the user's current emotion. Do not add any other text. "
+        "The available tags are: [mood: happy], [mood: neutral], [mood: sad], [mood: anxious], [intent: seeking_community], [intent: serious_distress]."
+        "\n\nHere are some examples:\n"
+        "User: I'm so happy today, everything is going great!\nAssistant: [mood: happy]\n"
+        "User: what's up\nAssistant: [mood: neutral]\n"
+        "Your response must strictly contain ONLY the tag, e.g., [mood: happy]."
+    )
+}
+
+# 🛠️ CHANGE APPLIED HERE: Explicitly reinforcing 'Serenity' and forbidding 'Aura'.
+CONVERSATION_PROMPT = {
+    "role": "system",
+    "content": "You are Serenity, a compassionate and supportive mental health chatbot. Never refer to yourself as Aura or any other name. You are NOT a therapist. DO NOT provide medical advice. Keep your responses concise, warm, and non-judgemental. Use less than 50 words."
+}
+
+SUMMARY_PROMPT = {
+    "role": "system",
+    "content": "Summarize the conversation below between a user and Serenity, a supportive mental health chatbot, in under 80 words. Keep the user's main concerns, feelings and anything they asked to remember. If a previous summary is given, merge it in."
+}
+
+
+# --- 3. Model State ---
+# Loading happens off the import path (see warm_up); until then `model` and
+# `tokenizer` are None, and so is everything built from them.
+models = model_manager.ModelManager()
+model = None
+tokenizer = None
+
+# Prefilled system prompts and per-session turns; generation continues from these caches
+prefix_cache = None
+session_kv_cache = None
+
+# Background inference worker shared by all request threads
+scheduler = None
+
+
+# --- 4. Inference ---
+
+def generate_single(input_ids, session_id=None, **generate_args):
+    """
+    model.generate for one prompt, continuing from the session's cached turn or
+    a cached system-prompt prefix when available (see kv_cache.generate_with_cache).
+    """
+    if prefix_cache is None:
+        import torch
+        with torch.inference_mode():
+            return model.generate(input_ids, **generate_args)
+    return kv_cache.generate_with_cache(
+        model, input_ids, prefix_cache, session_kv_cache, session_id, **generate_args
+    )
+
+
+def complete(kind, messages, session_id=None):
+    """
+    Runs one prompt and returns the decoded completion. `kind` picks the decoding:
+    "classify" (greedy tag), "conversation" (sampled reply, continuing the
+    session's KV cache) or "summary" (greedy, up to 120 tokens).
+    """
+    input_ids = tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_tensors="pt"
+    ).to(model.device)
+
+    if kind == "classify":
+        outputs = generate_single(
+            input_ids, max_new_tokens=CLASSIFY_MAX_TOKENS, eos_token_id=tokenizer.eos_token_id,
+            do_sample=False, temperature=0.0, # Force deterministic output
+            max_time=CLASSIFY_TIMEOUT
+        )
+    elif kind == "summary":
+        import torch
+        with torch.inference_mode():
+            outputs = model.generate(
+                input_ids, max_new_tokens=120, do_sample=False,
+                eos_token_id=tokenizer.eos_token_id, max_time=GENERATE_TIMEOUT,
+            )
+    else:
+        outputs = generate_single(
+            input_ids,
+            session_id=session_id,
+            max_new_tokens=CONVERSATION_MAX_TOKENS,
+            temperature=0.7,
+            do_sample=True,
+            eos_token_id=tokenizer.eos_token_id,
+            max_time=GENERATE_TIMEOUT,
+        )
+
+    response_ids = outputs[0][input_ids.shape[-1]:]
+    if kind == "conversation":
+        metrics.record_tokens("completion", len(response_ids))
+    return tokenizer.decode(response_ids, skip_special_tokens=True).strip()
+
+
+class CancelledCriteria:
+    """ Stopping criterion (any callable will do) that stops generate() after the current token once `event` is set. """
+
+    def __init__(self, event):
+        self.event = event
+
+    def __call__(self, input_ids, scores, **kwargs):
+        return input_ids.new_full((input_ids.shape[0],), self.event.is_set()).bool()
+
+
+class StreamInterrupted(Exception):
+    """ The streamed reply stalled or its generate call failed; the partial reply must not be saved. """
+
+
+def _generate_in_background(failures, **generate_args):
+    """
+    Thread target for streamed generation (inference mode is per-thread). An
+    exception is handed to the consumer through `failures` and the streamer is
+    closed, so the consumer isn't left waiting out GENERATE_TIMEOUT.
+    """
+    try:
+        generate_single(**generate_args)
+    except Exception as e:
+        failures.append(e)
+        generate_args["streamer"].end()
+
+
+def complete_stream(messages, session_id=None, cancelled=None):
+    """
+    Streaming "conversation" completion: model.generate runs on a background
+    thread and decoded text is yielded through a TextIteratorStreamer. Setting
+    `cancelled` (a threading.Event) stops generation early. Raises
+    StreamInterrupted if generation stalls or fails.
+    """
+    from transformers import TextIteratorStreamer, StoppingCriteriaList
+    input_ids = tokenizer.apply_chat_template(
+        messages, add_generation_prompt=True, return_tensors="pt"
+    ).to(model.device)
+
+    fragments = TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=GENERATE_TIMEOUT
+    )
+    generate_args = {
+        "input_ids": input_ids,
+        "session_id": session_id,
+        "max_new_tokens": CONVERSATION_MAX_TOKENS,
+        "temperature": 0.7,
+        "do_sample": True,
+        "eos_token_id": tokenizer.eos_token_id,
+        "max_time": GENERATE_TIMEOUT,
+        "streamer": fragments,
+    }
+    if cancelled is not None:
+        generate_args["stopping_criteria"] = StoppingCriteriaList([CancelledCriteria(cancelled)])
+    failures = []
+    threading.Thread(
+        target=_generate_in_background, args=(failures,), daemon=True, kwargs=generate_args
+    ).start()
+
+    try:
+        for text in fragments:
+            if text:
+                yield text
+    except queue.Empty:
+        print("--- Streamed generation stalled; abandoning the reply. ---")
+        raise StreamInterrupted("generation stalled")
+    if failures:
+        print(f"--- Streamed generation failed: {failures[0]} ---")
+        raise StreamInterrupted(str(failures[0])) from failures[0]
+
+
+def generate_batch(items, max_time=None):
+    """
+    Runs several (messages, is_classification) prompts through one padded
+    model.generate call; see batch_scheduler.generate_batch. A batch of one
+    prompt goes through complete() instead, to start from its cached prefix.
+    """
+    if len(items) == 1 and prefix_cache is not None:
+        messages, is_classification = items[0]
+        return [complete("classify" if is_classification else "conversation", messages)]
+    return batch_scheduler.generate_batch(
+        model, tokenizer, items, max_time=max_time,
+        classify_max_tokens=CLASSIFY_MAX_TOKENS,
+        conversation_max_tokens=CONVERSATION_MAX_TOKENS,
+    )
+
+
+@models.on_load
+def _setup_model(loaded_model, loaded_tokenizer):
+    """ Runs on the loading thread: publishes the model and builds the state that depends on it. """
+    global model, tokenizer, prefix_cache, session_kv_cache, scheduler
+    model, tokenizer = loaded_model, loaded_tokenizer
+
+    if PREFIX_CACHE:
+        try:
+            prefix_cache = kv_cache.PrefixCache(model, tokenizer)
+            prefix_cache.add("classification", CLASSIFICATION_PROMPT)
+            prefix_cache.add("conversation", CONVERSATION_PROMPT)
+            session_kv_cache = kv_cache.SessionKVCache(SESSION_KV_CACHE_MB * 1024 * 1024)
+        except Exception as e:
+            print(f"--- Prefix KV cache unavailable: {e} ---")
+            prefix_cache = None
+            session_kv_cache = None
+
+    if USE_BATCH_SCHEDULER:
+        scheduler = batch_scheduler.BatchScheduler(
+            lambda items: generate_batch(items, max_time=max(CLASSIFY_TIMEOUT, GENERATE_TIMEOUT)),
+            max_batch_size=BATCH_MAX_SIZE,
+            max_wait_ms=BATCH_MAX_WAIT_MS,
+        )
+        print(f"--- Batch scheduler started (max batch {BATCH_MAX_SIZE}, window {BATCH_MAX_WAIT_MS}ms) ---")
+
+
+def warm_up(mode=model_manager.MODEL_WARMUP):
+    """
+    Starts loading as MODEL_WARMUP says: on a background thread right away
+    ("background", the default), not until the first request ("lazy"), or
+    before returning ("eager").
+    """
+    if mode == "eager":
+        models.ensure_loaded(timeout=None)
+    elif mode == "background":
+        models.start()
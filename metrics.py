@@ -0,0 +1,389 @@
+import os
+import re
+import sys
+import time
+import uuid
+import bisect
+import threading
+import contextlib
+import contextvars
+
+# Per-stage latency histograms, token counts and component statistics, exported
+# in the Prometheus text format on /metrics. Every request gets an ID (taken
+# from X-Request-ID or generated) that prefixes its log lines and is echoed in
+# the response, along with a Server-Timing header listing its stages.
+
+# --- 1. Configuration ---
+REQUEST_ID_HEADER = "X-Request-ID"
+# A request sent with `X-Profile: 1` is sampled by a stack profiler. Off unless
+# PROFILE_REQUESTS=1, since it slows the request down and writes a file per request.
+PROFILE_HEADER = "X-Profile"
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+# --- 2. Metric types ---
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (list(extra.items()) if extra else [])
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """ Monotonic counter with a fixed set of label names. """
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+
+class Histogram:
+    """ Cumulative-bucket histogram, one series per label combination. """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def collect(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = sorted((key, list(values)) for key, values in self._series.items())
+        for key, values in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': bound})} {cumulative}"
+            yield f"{self.name}_bucket{_format_labels(self.labelnames, key, {'le': '+Inf'})} {values[-1]}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {round(values[-2], 6)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {values[-1]}"
+
+
+REGISTRY = []
+# component -> callable returning its stats() dict, read at scrape time
+_stats_sources = {}
+
+REQUEST_SECONDS = Histogram(
+    "serenity_request_seconds", "HTTP request latency.", ("endpoint", "method", "status"))
+STAGE_SECONDS = Histogram(
+    "serenity_stage_seconds", "Time spent in one stage of the chat pipeline.", ("stage",))
+TOKENS = Histogram(
+    "serenity_tokens", "Tokens per conversation prompt or completion.", ("kind",), TOKEN_BUCKETS)
+FIRESTORE_RPCS = Counter(
+    "serenity_firestore_rpcs_total", "Firestore round-trips made while serving chat turns.", ("kind",))
+
+
+# --- 3. Request context and stage spans ---
+
+_request_id = contextvars.ContextVar("serenity_request_id", default=None)
+_trace = contextvars.ContextVar("serenity_trace", default=None)
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def begin_request(request_id=None):
+    """ Starts a request's context; returns (request_id, reset token for end_request). """
+    if not request_id or not _REQUEST_ID_RE.match(request_id):
+        request_id = uuid.uuid4().hex[:16]
+    return request_id, (_request_id.set(request_id), _trace.set([]))
+
+
+def end_request(tokens):
+    request_token, trace_token = tokens
+    _trace.reset(trace_token)
+    _request_id.reset(request_token)
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append((stage, seconds))
+
+
+@contextlib.contextmanager
+def span(stage):
+    """ Times the enclosed block as one `stage` of the current request (works around awaits too). """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def time_future(stage, future):
+    """ Records `stage` from now until the future resolves (for work running on another thread). """
+    started = time.perf_counter()
+    trace = _trace.get()
+
+    def done(_):
+        seconds = time.perf_counter() - started
+        STAGE_SECONDS.observe(seconds, stage=stage)
+        if trace is not None:
+            trace.append((stage, seconds))
+
+    future.add_done_callback(done)
+    return future
+
+
+def propagate(fn):
+    """ Wraps `fn` to run in a copy of the caller's context, so pool threads keep the request ID and trace. """
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
+
+
+def record_tokens(kind, count):
+    if count is not None:
+        TOKENS.observe(count, kind=kind)
+
+
+def record_rpc(kind):
+    FIRESTORE_RPCS.inc(kind=kind)
+
+
+def server_timing():
+    """ Server-Timing header value for the current request's stages (durations in ms). """
+    trace = _trace.get() or []
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in trace)
+
+
+def register_stats(component, stats_fn):
+    """ Exposes the numeric leaves of stats_fn() (read at scrape time) as serenity_<component>_* gauges. """
+    _stats_sources[component] = stats_fn
+
+
+# --- 4. Request IDs in log lines ---
+
+class _RequestIdWriter:
+    """ Wraps sys.stdout so every line printed while handling a request starts with its ID. """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._line_start = threading.local()
+
+    def write(self, text):
+        request_id = _request_id.get()
+        if request_id and text:
+            at_start = getattr(self._line_start, "value", True)
+            lines = text.split("\n")
+            text = "\n".join(
+                f"[{request_id}] {line}" if line and (i > 0 or at_start) else line
+                for i, line in enumerate(lines)
+            )
+        if text:
+            self._line_start.value = text.endswith("\n")
+        return self._stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def install_log_prefix():
+    if not isinstance(sys.stdout, _RequestIdWriter):
+        sys.stdout = _RequestIdWriter(sys.stdout)
+
+
+# --- 5. Per-request sampling profiler ---
+
+class SamplingProfiler:
+    """
+    Samples one thread's Python stack every `interval_ms` from a background
+    thread. stop() returns collapsed stacks ("outer;inner;leaf count" lines),
+    the input format of flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, thread_id=None, interval_ms=PROFILE_INTERVAL_MS):
+        self.thread_id = thread_id or threading.get_ident()
+        self.interval = interval_ms / 1000.0
+        self.samples = {}
+        self._stopping = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="serenity-profiler", daemon=True)
+
+    def start(self):
+        self._sampler.start()
+        return self
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def stop(self):
+        self._stopping.set()
+        self._sampler.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.samples.items())) + "\n"
+
+    def dump(self, name):
+        """ Stops sampling and writes PROFILE_DIR/<name>.collapsed; returns the path. """
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}.collapsed")
+        with open(path, "w") as f:
+            f.write(self.stop())
+        return path
+
+
+def profiling_requested(header_value):
+    return PROFILE_REQUESTS and header_value == "1"
+
+
+# --- 6. Exposition ---
+
+def _flatten(prefix, value):
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            yield from _flatten(f"{prefix}_{key}", inner)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+    elif isinstance(value, bool):
+        yield prefix, int(value)
+
+
+def render():
+    """ All metrics in the Prometheus text exposition format. """
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    for component, stats_fn in list(_stats_sources.items()):
+        try:
+            stats = stats_fn() or {}
+        except Exception as e:
+            print(f"--- Could not collect {component} stats: {e} ---")
+            continue
+        for name, value in _flatten(f"serenity_{component}", stats):
+            name = re.sub(r"[^a-zA-Z0-9_]", "_", name)
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# --- 7. Framework integration ---
+
+def init_flask(app):
+    """ Adds request IDs, request/stage timing headers, the opt-in profiler and GET /metrics to a Flask app. """
+    from flask import Response, g, request
+
+    install_log_prefix()
+
+    @app.before_request
+    def _metrics_begin():
+        g.metrics_started = time.perf_counter()
+        g.request_id, g.metrics_tokens = begin_request(request.headers.get(REQUEST_ID_HEADER))
+        g.profiler = SamplingProfiler().start() if profiling_requested(request.headers.get(PROFILE_HEADER)) else None
+
+    @app.after_request
+    def _metrics_finish(response):
+        if "metrics_started" not in g:
+            return response
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(time.perf_counter() - g.metrics_started,
+                                endpoint=endpoint, method=request.method, status=response.status_code)
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+        timing = server_timing()
+        if timing:
+            response.headers["Server-Timing"] = timing
+        if g.profiler is not None:
+            response.headers["X-Profile-Output"] = g.profiler.dump(g.request_id)
+        return response
+
+    @app.teardown_request
+    def _metrics_end(exc):
+        tokens = g.pop("metrics_tokens", None)
+        if tokens is not None:
+            try:
+                end_request(tokens)
+            except ValueError:
+                pass  # Streamed responses finish in a different context
+
+    app.add_url_rule("/metrics", "metrics", lambda: Response(render(), mimetype=CONTENT_TYPE))
+    return app
+
+
+class ASGIMetricsMiddleware:
+    """ ASGI counterpart of init_flask (request IDs, timing headers, profiler); serve render() on /metrics yourself. """
+
+    def __init__(self, app):
+        self.app = app
+        install_log_prefix()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope.get("headers", [])}
+        started = time.perf_counter()
+        request_id, tokens = begin_request(headers.get(REQUEST_ID_HEADER.lower()))
+        # The profiler samples the event-loop thread, i.e. every request running concurrently
+        profiler = SamplingProfiler().start() if profiling_requested(headers.get(PROFILE_HEADER.lower())) else None
+        status = {}
+
+        async def send_with_headers(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                extra = [(REQUEST_ID_HEADER.encode(), request_id.encode())]
+                timing = server_timing()
+                if timing:
+                    extra.append((b"server-timing", timing.encode()))
+                if profiler is not None:
+                    extra.append((b"x-profile-output", profiler.dump(request_id).encode()))
+                message = dict(message, headers=list(message.get("headers", [])) + extra)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_headers)
+        finally:
+            route = scope.get("route")
+            REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint=getattr(route, "path", scope["path"]),
+                                    method=scope.get("method", ""), status=status.get("code", 500))
+            end_request(tokens)
@@ -0,0 +1,51 @@
+import argparse
+from google.cloud.firestore_v1.field_path import FieldPath
+import firestore_db
+import history_codec
+
+
+def iter_user_docs(db, page_size):
+    """ Streams every user document, one cursor-paginated page at a time. """
+    query = db.collection('users').order_by(FieldPath.document_id()).limit(page_size)
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc else query
+        docs = list(page_query.stream())
+        if not docs:
+            return
+        yield from docs
+        last_doc = docs[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Move legacy chat_history arrays and packed histories into the per-user messages subcollection."
+    )
+    parser.add_argument("--page-size", type=int, default=200, help="user documents read per page")
+    parser.add_argument("--dry-run", action="store_true", help="only report what would be migrated")
+    args = parser.parse_args()
+
+    db = firestore_db.init_db()
+    if db is None:
+        raise SystemExit("Could not connect to Firestore.")
+
+    users = migrated_users = migrated_messages = 0
+    for doc in iter_user_docs(db, args.page_size):
+        users += 1
+        data = doc.to_dict() or {}
+        if 'message_count' in data:
+            continue
+        if args.dry_run:
+            migrated_users += 1
+            migrated_messages += history_codec.stored_count(data)
+            continue
+        moved = firestore_db.migrate_user_history(doc.reference)
+        migrated_users += 1
+        migrated_messages += moved
+
+    verb = "Would migrate" if args.dry_run else "Migrated"
+    print(f"--- Scanned {users} users. {verb} {migrated_messages} messages for {migrated_users} users. ---")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+import os
+import re
+import time
+import shutil
+import threading
+
+# Loads the local model off the import path. bot.py creates one ModelManager at
+# import (cheap), and the tokenizer, quantized weights and torch.compile only
+# happen on the first request that needs them or on a background warmup thread.
+
+# --- 1. Configuration ---
+
+# MODEL_PRESET picks a bundle of defaults; any single MODEL_* variable overrides it.
+# "tiny" is a randomly initialised GPT-2 that loads in about a second on a CPU,
+# meant for tests and local development (its replies are gibberish).
+PRESETS = {
+    "phi3": {
+        "MODEL_ID": "microsoft/Phi-3-mini-4k-instruct",
+        "MODEL_QUANTIZATION": "4bit",
+        "MODEL_DEVICE_MAP": "auto",
+        "MODEL_COMPILE": "1",
+    },
+    "tiny": {
+        "MODEL_ID": "sshleifer/tiny-gpt2",
+        "MODEL_QUANTIZATION": "none",
+        "MODEL_DEVICE_MAP": "cpu",
+        "MODEL_COMPILE": "0",
+    },
+}
+
+MODEL_PRESET = os.getenv("MODEL_PRESET", "phi3")
+
+def _setting(name):
+    return os.getenv(name, PRESETS.get(MODEL_PRESET, PRESETS["phi3"])[name])
+
+MODEL_ID = _setting("MODEL_ID")
+MODEL_QUANTIZATION = _setting("MODEL_QUANTIZATION")  # "4bit", "8bit" or "none"
+MODEL_DEVICE_MAP = _setting("MODEL_DEVICE_MAP")
+MODEL_COMPILE = _setting("MODEL_COMPILE") == "1"
+
+# "background" starts loading as soon as the app is imported, "lazy" waits for
+# the first request (or readiness probe), "eager" blocks the import until loaded.
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "background")
+# How long a request waits for a load in progress before it gets a 503 with Retry-After;
+# a cold load takes minutes, so holding a worker thread for all of it helps nobody
+MODEL_LOAD_WAIT = float(os.getenv("MODEL_LOAD_WAIT_SECONDS", "5"))
+
+# Downloaded weights, the quantized checkpoint and the inductor (torch.compile)
+# cache all live here, so a restart skips download, quantization and most of compilation.
+# Several GB, so it defaults to the git-ignored data/ directory.
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", os.path.join("data", "models"))
+
+# Used when the tokenizer ships without a chat template (e.g. the tiny preset)
+FALLBACK_CHAT_TEMPLATE = (
+    "{% for message in messages %}<|{{ message['role'] }}|>\n{{ message['content'] }}\n{% endfor %}"
+    "{% if add_generation_prompt %}<|assistant|>\n{% endif %}"
+)
+
+
+# --- 2. Model manager ---
+
+class ModelManager:
+    """
+    Owns the tokenizer and model. load() runs once, on whichever thread gets
+    there first; later callers wait for it. Callbacks registered with on_load()
+    run on the loading thread before the model is reported ready, so per-model
+    state (KV prefix caches, the batch scheduler) is in place for the first request.
+    """
+
+    def __init__(self, model_id=MODEL_ID, quantization=MODEL_QUANTIZATION, device_map=MODEL_DEVICE_MAP,
+                 compile_model=MODEL_COMPILE, cache_dir=MODEL_CACHE_DIR):
+        self.model_id = model_id
+        self.quantization = quantization
+        self.device_map = device_map
+        self.compile_model = compile_model
+        self.cache_dir = cache_dir
+        self.model = None
+        self.tokenizer = None
+        self.state = "idle"  # idle -> loading -> ready | failed
+        self.error = None
+        self.timings = {}
+        self.from_disk_cache = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._created = time.perf_counter()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def on_load(self, callback):
+        """ Registers callback(model, tokenizer), run once the model has loaded. """
+        self._callbacks.append(callback)
+        return callback
+
+    def start(self):
+        """ Starts loading on a background thread (no-op if a load was already started). """
+        with self._lock:
+            if self.state != "idle":
+                return
+            self.state = "loading"
+        threading.Thread(target=self._load, name="serenity-model-load", daemon=True).start()
+
+    def ensure_loaded(self, timeout=MODEL_LOAD_WAIT):
+        """
+        Starts the load if needed and waits up to `timeout` seconds for it.
+        Returns True when the model is ready; False while it is still loading
+        or when loading failed (check `state`).
+        """
+        if self.state == "ready":
+            return True
+        self.start()
+        self._done.wait(timeout)
+        return self.ready
+
+    def quantized_path(self):
+        """ Directory of the locally saved quantized checkpoint for this model and quantization. """
+        name = re.sub(r"[^A-Za-z0-9_.-]+", "--", self.model_id)
+        return os.path.join(self.cache_dir, "quantized", f"{name}-{self.quantization}")
+
+    def _quantization_config(self):
+        import torch
+        from transformers import BitsAndBytesConfig
+        if self.quantization == "4bit":
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.float16
+            )
+        if self.quantization == "8bit":
+            return BitsAndBytesConfig(load_in_8bit=True)
+        return None
+
+    def _load(self):
+        started = time.perf_counter()
+        try:
+            # Read when torch._inductor is first imported, i.e. at the first compile
+            os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(self.cache_dir, "inductor"))
+            os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+            import torch
+            from transformers import AutoTokenizer, AutoModelForCausalLM
+            self.timings["import_s"] = round(time.perf_counter() - started, 3)
+
+            print(f"--- Loading Local Model and Tokenizer ({self.model_id}, {self.quantization})... ---")
+            step = time.perf_counter()
+            local_path = self.quantized_path()
+            self.from_disk_cache = self.quantization != "none" and os.path.isdir(local_path)
+            source = local_path if self.from_disk_cache else self.model_id
+
+            tokenizer = AutoTokenizer.from_pretrained(source, cache_dir=self.cache_dir)
+            # Left padding keeps every prompt flush against its generated tokens in a batch
+            tokenizer.padding_side = "left"
+            if tokenizer.pad_token is None:
+                tokenizer.pad_token = tokenizer.eos_token
+            if not getattr(tokenizer, "chat_template", None):
+                tokenizer.chat_template = FALLBACK_CHAT_TEMPLATE
+            self.timings["tokenizer_s"] = round(time.perf_counter() - step, 3)
+
+            step = time.perf_counter()
+            model_load_args = {"device_map": self.device_map, "cache_dir": self.cache_dir}
+            quantization_config = None if self.from_disk_cache else self._quantization_config()
+            if quantization_config is not None:
+                # A saved quantized checkpoint carries its own quantization config
+                model_load_args["quantization_config"] = quantization_config
+            model = AutoModelForCausalLM.from_pretrained(source, **model_load_args)
+            self.timings["model_s"] = round(time.perf_counter() - step, 3)
+
+            if self.quantization != "none" and not self.from_disk_cache:
+                self._save_quantized(model, tokenizer, local_path)
+
+            if self.compile_model:
+                step = time.perf_counter()
+                try:
+                    model = torch.compile(model)
+                    print("--- Model compiled with torch.compile for extra speed ---")
+                except Exception:
+                    print("--- torch.compile not available or failed. ---")
+                self.timings["compile_s"] = round(time.perf_counter() - step, 3)
+
+            # One short greedy generate pays for kernel selection and the actual
+            # compilation (torch.compile is lazy) before the first user does
+            step = time.perf_counter()
+            input_ids = tokenizer.apply_chat_template(
+                [{"role": "user", "content": "hello"}], add_generation_prompt=True, return_tensors="pt"
+            ).to(model.device)
+            with torch.inference_mode():
+                model.generate(input_ids, max_new_tokens=2, do_sample=False, pad_token_id=tokenizer.pad_token_id)
+            self.timings["warmup_s"] = round(time.perf_counter() - step, 3)
+
+            step = time.perf_counter()
+            for callback in self._callbacks:
+                callback(model, tokenizer)
+            self.timings["setup_s"] = round(time.perf_counter() - step, 3)
+
+            self.model, self.tokenizer = model, tokenizer
+            self.state = "ready"
+            print("--- Model and Tokenizer Loaded Successfully ---")
+        except Exception as e:
+            print(f"--- Failed to load model: {e}. Running in degraded mode. ---")
+            self.error = str(e)
+            self.state = "failed"
+        finally:
+            self.timings["load_s"] = round(time.perf_counter() - started, 3)
+            # Cold start: from creating the manager (app import) until the model is usable
+            self.timings["cold_start_s"] = round(time.perf_counter() - self._created, 3)
+            print(f"--- Model {self.state} after {self.timings['cold_start_s']}s ({self.timings}) ---")
+            self._done.set()
+
+    def _save_quantized(self, model, tokenizer, path):
+        """ Saves the quantized checkpoint so later starts skip quantizing the full-precision weights. """
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        try:
+            step = time.perf_counter()
+            model.save_pretrained(tmp_path)
+            tokenizer.save_pretrained(tmp_path)
+            # Rename last, so a crash mid-save never leaves a half-written checkpoint behind
+            os.replace(tmp_path, path)
+            self.timings["save_quantized_s"] = round(time.perf_counter() - step, 3)
+            print(f"--- Quantized checkpoint saved to {path} ---")
+        except Exception as e:
+            print(f"--- Could not save quantized checkpoint: {e} ---")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def stats(self):
+        return {
+            "model_id": self.model_id,
+            "quantization": self.quantization,
+            "state": self.state,
+            "error": self.error,
+            "from_disk_cache": self.from_disk_cache,
+            "timings": self.timings,
+        }
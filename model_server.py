@@ -0,0 +1,546 @@
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import argparse
+import itertools
+import threading
+import socketserver
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from model_manager import MODEL_LOAD_WAIT
+
+# One process owns the model; any number of web workers (e.g. gunicorn -w N bot:app
+# with MODEL_SERVER_SOCKET set) forward prompts to it over a Unix socket instead of
+# each loading their own copy. Frames are 4-byte big-endian length + JSON.
+#
+#   python model_server.py --socket /tmp/serenity-model.sock
+#   MODEL_SERVER_SOCKET=/tmp/serenity-model.sock gunicorn -w 4 --threads 8 bot:app
+
+# --- 1. Configuration ---
+MODEL_SERVER_SOCKET = os.getenv("MODEL_SERVER_SOCKET", "")
+# Backpressure: prompts a single web worker may have queued before new ones are refused
+MODEL_SERVER_MAX_PENDING = int(os.getenv("MODEL_SERVER_MAX_PENDING", "32"))
+# Prompts handed to the model at once; the rest wait in the per-worker queues so
+# the fair queue, not the batch scheduler's FIFO, decides who goes next
+MODEL_SERVER_MAX_IN_FLIGHT = int(os.getenv("MODEL_SERVER_MAX_IN_FLIGHT", os.getenv("BATCH_MAX_SIZE", "8")))
+MODEL_SERVER_CONNECT_TIMEOUT = float(os.getenv("MODEL_SERVER_CONNECT_TIMEOUT", "5"))
+
+_HEADER = struct.Struct(">I")
+
+
+class ModelServerBusy(RuntimeError):
+    """ The model server refused a prompt because this worker's queue is full. """
+
+
+class ModelServerError(RuntimeError):
+    """ The model server failed a prompt, or the connection to it was lost. """
+
+
+def send_frame(sock, frame):
+    data = json.dumps(frame).encode("utf-8")
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def recv_frame(rfile):
+    """ Reads one frame from a socket file; None once the peer has closed the connection. """
+    header = rfile.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    (length,) = _HEADER.unpack(header)
+    data = rfile.read(length)
+    if len(data) < length:
+        return None
+    return json.loads(data)
+
+
+# --- 2. Per-worker fair queue ---
+
+class FairQueue:
+    """
+    One FIFO per web worker, served round-robin: a worker with a burst of
+    prompts gets one turn per round like everyone else. Each FIFO holds at most
+    `max_pending` prompts; put() raises ModelServerBusy beyond that.
+    """
+
+    def __init__(self, max_pending=MODEL_SERVER_MAX_PENDING):
+        self.max_pending = max_pending
+        self._queues = OrderedDict()  # worker -> deque, in round-robin order; empty ones are removed
+        self._cond = threading.Condition()
+
+    def put(self, worker, job):
+        with self._cond:
+            pending = self._queues.setdefault(worker, deque())
+            if len(pending) >= self.max_pending:
+                raise ModelServerBusy(f"{len(pending)} prompts already queued for this worker")
+            pending.append(job)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """ Next job, taking turns between workers; None if nothing arrives within `timeout`. """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._queues, timeout):
+                return None
+            worker, pending = next(iter(self._queues.items()))
+            job = pending.popleft()
+            if pending:
+                self._queues.move_to_end(worker)
+            else:
+                del self._queues[worker]
+            return job
+
+    def remove(self, worker, job):
+        """ Takes a job out of its queue; False if it has already been handed out. """
+        with self._cond:
+            pending = self._queues.get(worker)
+            if pending is None or job not in pending:
+                return False
+            pending.remove(job)
+            if not pending:
+                del self._queues[worker]
+            return True
+
+    def depths(self):
+        with self._cond:
+            return {str(worker): len(pending) for worker, pending in self._queues.items()}
+
+
+# --- 3. Server ---
+
+class _Job:
+    __slots__ = ("id", "kind", "messages", "session_id", "stream", "connection", "cancelled", "future", "enqueued_at")
+
+    def __init__(self, frame, connection):
+        self.id = frame["id"]
+        self.kind = frame.get("kind", "conversation")
+        self.messages = frame["messages"]
+        self.session_id = frame.get("session_id")
+        self.stream = frame["op"] == "stream"
+        self.connection = connection
+        self.cancelled = threading.Event()
+        self.future = None
+        self.enqueued_at = time.monotonic()
+
+
+class _Connection:
+    """ Server side of one web-worker connection; replies are written from several threads. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.worker = None
+        self.jobs = {}
+        self._lock = threading.Lock()
+
+    def send(self, frame):
+        try:
+            with self._lock:
+                send_frame(self.sock, frame)
+        except OSError:
+            pass  # The worker went away; its jobs are cancelled by the handler
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        connection = _Connection(self.request)
+        connection.worker = f"conn-{id(connection)}"
+        try:
+            while True:
+                frame = recv_frame(self.rfile)
+                if frame is None:
+                    break
+                op = frame.get("op")
+                if op == "hello":
+                    # Connections from the same worker process share one fair-queue slot
+                    connection.worker = frame.get("worker") or connection.worker
+                elif op in ("complete", "stream"):
+                    server.enqueue(_Job(frame, connection))
+                elif op == "cancel":
+                    server.cancel(connection, frame.get("id"))
+                elif op == "stats":
+                    connection.send({"id": frame.get("id"), "stats": server.stats()})
+        except (OSError, ValueError) as e:
+            print(f"--- Model server connection error: {e} ---")
+        finally:
+            # The worker disconnected (or died): nobody is waiting for its prompts any more
+            for job_id in list(connection.jobs):
+                server.cancel(connection, job_id)
+
+
+class ModelServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves prompts from web workers on one local model. `backend` is local_model.py
+    (or anything with the same `models`, `scheduler`, `complete` and `complete_stream`).
+    Classification and conversation prompts go through the backend's batch
+    scheduler; summaries and streams run on a thread each. A dispatcher thread
+    moves jobs from the fair queue to the model, at most `max_in_flight` at a time.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, path, backend, max_pending=MODEL_SERVER_MAX_PENDING, max_in_flight=MODEL_SERVER_MAX_IN_FLIGHT):
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by a previous run
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.backend = backend
+        self.queue = FairQueue(max_pending)
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix="serenity-model-server")
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.accepted = 0
+        self.rejected = 0
+        self.cancelled = 0
+        self.completed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.total_queue_wait = 0.0
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name="serenity-model-dispatch", daemon=True)
+        self._dispatcher.start()
+
+    def enqueue(self, job):
+        job.connection.jobs[job.id] = job
+        try:
+            self.queue.put(job.connection.worker, job)
+        except ModelServerBusy as e:
+            job.connection.jobs.pop(job.id, None)
+            with self._lock:
+                self.rejected += 1
+            job.connection.send({"id": job.id, "error": str(e), "busy": True})
+            return
+        with self._lock:
+            self.accepted += 1
+
+    def cancel(self, connection, job_id):
+        job = connection.jobs.pop(job_id, None)
+        if job is None:
+            return
+        job.cancelled.set()
+        # Still queued: just drop it. Already batched: the scheduler skips cancelled futures.
+        # Streaming: the backend's stopping criteria sees `cancelled` after the next token.
+        if not self.queue.remove(connection.worker, job) and job.future is not None:
+            job.future.cancel()
+        with self._lock:
+            self.cancelled += 1
+
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            self._slots.acquire()
+            job = self.queue.get(timeout=0.5)
+            if job is None or job.cancelled.is_set():
+                self._slots.release()
+                continue
+            with self._lock:
+                self.in_flight += 1
+                self.total_queue_wait += time.monotonic() - job.enqueued_at
+
+            # Jobs that arrive while the model is still loading wait here (web workers
+            # only send prompts once the server reports it ready, so this is rare)
+            if not self.backend.models.ensure_loaded(timeout=None):
+                job.connection.send({"id": job.id, "error": f"model is {self.backend.models.state}"})
+                self._done(job, ok=False)
+                continue
+
+            scheduler = self.backend.scheduler
+            if job.stream or job.kind == "summary" or scheduler is None:
+                self._executor.submit(self._run, job)
+            else:
+                try:
+                    job.future = scheduler.submit(job.messages, job.kind == "classify")
+                except Exception as e:
+                    job.connection.send({"id": job.id, "error": str(e)})
+                    self._done(job, ok=False)
+                    continue
+                job.future.add_done_callback(lambda future, job=job: self._finish(job, future))
+                if job.cancelled.is_set():
+                    # cancel() ran between queue.get and the assignment above and found no future
+                    job.future.cancel()
+
+    def _run(self, job):
+        """ Runs a job that bypasses the batch scheduler, on an executor thread. """
+        if job.cancelled.is_set():
+            self._done(job, ok=False)
+            return
+        try:
+            if job.stream:
+                for text in self.backend.complete_stream(job.messages, job.session_id, job.cancelled):
+                    job.connection.send({"id": job.id, "token": text})
+                job.connection.send({"id": job.id, "done": True})
+            else:
+                job.connection.send({"id": job.id, "text": self.backend.complete(job.kind, job.messages, job.session_id)})
+            self._done(job, ok=True)
+        except Exception as e:
+            job.connection.send({"id": job.id, "error": str(e)})
+            self._done(job, ok=False)
+
+    def _finish(self, job, future):
+        """ Done-callback for jobs that went through the batch scheduler. """
+        if future.cancelled():
+            self._done(job, ok=False)
+            return
+        try:
+            job.connection.send({"id": job.id, "text": future.result()})
+            self._done(job, ok=True)
+        except Exception as e:
+            job.connection.send({"id": job.id, "error": str(e)})
+            self._done(job, ok=False)
+
+    def _done(self, job, ok):
+        job.connection.jobs.pop(job.id, None)
+        with self._lock:
+            self.in_flight -= 1
+            if ok:
+                self.completed += 1
+            elif not job.cancelled.is_set():
+                self.failed += 1
+        self._slots.release()
+
+    def stats(self):
+        """ Model load state, batch scheduler metrics and queueing/backpressure counters. """
+        scheduler = self.backend.scheduler
+        with self._lock:
+            server = {
+                "accepted": self.accepted,
+                "rejected": self.rejected,
+                "cancelled": self.cancelled,
+                "completed": self.completed,
+                "failed": self.failed,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queued": self.queue.depths(),
+                "avg_queue_wait_ms": round(1000 * self.total_queue_wait / (self.completed + self.failed), 2)
+                if self.completed + self.failed else 0.0,
+            }
+        return {
+            "model": self.backend.models.stats(),
+            "batching": scheduler.stats() if scheduler else None,
+            "server": server,
+        }
+
+    def server_close(self):
+        self._stopping.set()
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+# --- 4. Web-worker client ---
+
+class ModelServerClient:
+    """
+    Web-worker side of the model server. Every request thread in the process
+    shares one connection; a reader thread hands replies to the waiting Future
+    (completions) or queue (streams) by request id. Stands in for both the
+    ModelManager (readiness) and the BatchScheduler (submit) in bot.py.
+    Cancelling a Future, or closing a stream early, cancels the prompt on the server.
+    """
+
+    def __init__(self, path=MODEL_SERVER_SOCKET, connect_timeout=MODEL_SERVER_CONNECT_TIMEOUT):
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self.state = "idle"  # idle -> loading | unavailable -> ready | failed, as reported by the server
+        self.error = None
+        self._sock = None
+        self._pending = {}  # request id -> (socket it was sent on, Future or Queue)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    # ModelManager interface
+
+    def on_load(self, callback):
+        return callback  # The model never loads in this process
+
+    def start(self):
+        pass  # Connects on first use
+
+    def ensure_loaded(self, timeout=MODEL_LOAD_WAIT):
+        """ Waits up to `timeout` seconds for the server to report its model ready. """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.ready:
+            try:
+                self.state = self.server_stats(timeout=self.connect_timeout)["model"]["state"]
+                self.error = None
+            except (OSError, ModelServerError, TimeoutError) as e:
+                self.state, self.error = "unavailable", str(e)
+            if self.ready or self.state == "failed" or (deadline is not None and time.monotonic() >= deadline):
+                break
+            time.sleep(0.5)
+        return self.ready
+
+    # BatchScheduler interface
+
+    def submit(self, messages, is_classification=False):
+        """ Queues one prompt on the server and returns a Future that resolves to its completion. """
+        return self._request("classify" if is_classification else "conversation", messages)
+
+    def complete(self, kind, messages, session_id=None, timeout=None):
+        """ Runs one "classify", "conversation" or "summary" prompt and waits for the text. """
+        future = self._request(kind, messages, session_id)
+        try:
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stream(self, messages, session_id=None, timeout=None):
+        """ Yields the fragments of a streamed conversation reply. """
+        request_id = next(self._ids)
+        fragments = queue.Queue()
+        self._send({"op": "stream", "id": request_id, "messages": messages, "session_id": session_id}, fragments)
+        finished = False
+        try:
+            while True:
+                frame = fragments.get(timeout=timeout)
+                if "token" in frame:
+                    yield frame["token"]
+                elif frame.get("done"):
+                    finished = True
+                    return
+                else:
+                    finished = True
+                    raise (ModelServerBusy if frame.get("busy") else ModelServerError)(frame.get("error"))
+        finally:
+            self._pending.pop(request_id, None)
+            if not finished:
+                # The HTTP client went away (or timed out): stop generating for it
+                self._cancel(request_id)
+
+    def server_stats(self, timeout=None):
+        request_id = next(self._ids)
+        future = Future()
+        self._send({"op": "stats", "id": request_id}, future)
+        try:
+            return future.result(timeout=timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    def stats(self):
+        try:
+            return dict(self.server_stats(timeout=self.connect_timeout), socket=self.path)
+        except (OSError, ModelServerError, TimeoutError) as e:
+            return {"state": "unavailable", "error": str(e), "socket": self.path}
+
+    # Connection handling
+
+    def _request(self, kind, messages, session_id=None):
+        request_id = next(self._ids)
+        future = Future()
+        self._send({"op": "complete", "id": request_id, "kind": kind, "messages": messages, "session_id": session_id}, future)
+        future.add_done_callback(lambda f: f.cancelled() and self._cancel(request_id))
+        return future
+
+    def _connect(self):
+        with self._lock:
+            if self._sock is None:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.settimeout(self.connect_timeout)
+                sock.connect(self.path)
+                sock.settimeout(None)
+                send_frame(sock, {"op": "hello", "worker": f"pid-{os.getpid()}"})
+                threading.Thread(target=self._read, args=(sock,), name="serenity-model-client", daemon=True).start()
+                self._sock = sock
+            return self._sock
+
+    def _send(self, frame, waiter):
+        try:
+            sock = self._connect()
+            # Registered before sending, so the reply can't beat it; if the reader has
+            # already torn this socket down, the send below fails instead
+            self._pending[frame["id"]] = (sock, waiter)
+            with self._send_lock:
+                send_frame(sock, frame)
+        except OSError as e:
+            self._pending.pop(frame["id"], None)
+            raise ModelServerError(f"model server unreachable at {self.path}: {e}") from e
+
+    def _cancel(self, request_id):
+        self._pending.pop(request_id, None)
+        try:
+            with self._send_lock:
+                if self._sock is not None:
+                    send_frame(self._sock, {"op": "cancel", "id": request_id})
+        except OSError:
+            pass
+
+    def _read(self, sock):
+        rfile = sock.makefile("rb")
+        try:
+            while True:
+                frame = recv_frame(rfile)
+                if frame is None:
+                    break
+                _, waiter = self._pending.get(frame.get("id"), (None, None))
+                if isinstance(waiter, queue.Queue):
+                    waiter.put(frame)
+                elif waiter is not None:
+                    self._pending.pop(frame["id"], None)
+                    self._resolve(waiter, frame)
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._lock:
+                if self._sock is sock:
+                    self._sock = None
+            sock.close()
+            # Fail everything still waiting on this connection; the next request reconnects.
+            # Requests already sent on a newer connection are left to its reader.
+            lost = {"error": f"connection to the model server at {self.path} was lost"}
+            for request_id, (owner, _) in list(self._pending.items()):
+                if owner is not sock:
+                    continue
+                _, waiter = self._pending.pop(request_id, (None, None))
+                if isinstance(waiter, queue.Queue):
+                    waiter.put(lost)
+                elif waiter is not None:
+                    self._resolve(waiter, lost)
+
+    @staticmethod
+    def _resolve(future, frame):
+        if future.done():
+            return  # Cancelled by the caller in the meantime
+        if "error" in frame:
+            future.set_exception((ModelServerBusy if frame.get("busy") else ModelServerError)(frame["error"]))
+        else:
+            future.set_result(frame["stats"] if "stats" in frame else frame.get("text"))
+
+
+# --- 5. Entry point ---
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the local model to web workers over a Unix socket.")
+    parser.add_argument("--socket", default=MODEL_SERVER_SOCKET or "/tmp/serenity-model.sock")
+    parser.add_argument("--max-pending", type=int, default=MODEL_SERVER_MAX_PENDING)
+    parser.add_argument("--max-in-flight", type=int, default=MODEL_SERVER_MAX_IN_FLIGHT)
+    args = parser.parse_args()
+
+    # Only the model and its prompts: no Flask app, no Firestore client
+    import local_model
+    local_model.warm_up()
+
+    server = ModelServer(args.socket, local_model, max_pending=args.max_pending, max_in_flight=args.max_in_flight)
+    print(f"--- Model server listening on {args.socket} ---")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
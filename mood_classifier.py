@@ -0,0 +1,293 @@
+import os
+import re
+import csv
+import time
+import pickle
+import argparse
+import threading
+
+try:
+    from sklearn.pipeline import make_pipeline
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.linear_model import LogisticRegression
+    SKLEARN_AVAILABLE = True
+except ImportError:
+    SKLEARN_AVAILABLE = False
+
+# --- Configuration ---
+# Tiers run cheapest first; the first confident answer wins and the LLM is only
+# asked when every local tier is unsure. The keyword tier settles serious_distress
+# on one match, and any other tag only when the message is unambiguous (see KeywordTier).
+MOOD_CLASSIFIER_TIERS = os.getenv("MOOD_CLASSIFIER_TIERS", "keyword,linear,llm")
+MOOD_CONFIDENCE_THRESHOLD = float(os.getenv("MOOD_CONFIDENCE_THRESHOLD", "0.75"))
+# Trained linear tier (see __main__); data/ is git-ignored
+MOOD_MODEL_PATH = os.getenv("MOOD_MODEL_PATH", "data/mood_tfidf.pkl")
+
+TAGS = ("happy", "neutral", "sad", "anxious", "seeking_community", "serious_distress")
+DISTRESS = "serious_distress"
+
+
+class Prediction:
+    """ One tier's answer: tag, confidence in [0, 1] and the tier that produced it. """
+
+    __slots__ = ("tag", "confidence", "tier")
+
+    def __init__(self, tag, confidence, tier):
+        self.tag = tag
+        self.confidence = confidence
+        self.tier = tier
+
+    def __repr__(self):
+        return f"Prediction({self.tag!r}, {self.confidence:.2f}, {self.tier!r})"
+
+
+# --- 1. Keyword tier ---
+
+# Patterns are matched as whole words; stems end in \w* to take any ending
+KEYWORDS = {
+    "serious_distress": [
+        r"kill(ing)? myself", r"suicid\w*", r"end(ing)? (it all|my life|things)", r"want(ed)? to die",
+        r"(self[- ]?harm\w*|hurt(ing)? myself|cut(ting)? myself)", r"no reason to live",
+        r"better off dead", r"can'?t go on", r"don'?t want to (live|be here)",
+        r"overdos\w*", r"(want(ed)? to|wish i could) disappear", r"sleep forever",
+    ],
+    "anxious": [
+        r"anxious", r"anxiety", r"nervous", r"panic\w*", r"worried", r"worry(ing)?",
+        r"stress(ed|ful)?", r"overwhelmed", r"on edge", r"scared", r"afraid",
+    ],
+    # No "down" or "low": "calm down", "down to meet up" and "a low opinion" aren't sad
+    "sad": [
+        r"sad", r"depressed", r"feeling (down|low)", r"lonely", r"unhappy", r"miserable",
+        r"heartbroken", r"hopeless", r"crying", r"cried", r"upset", r"empty",
+    ],
+    "happy": [
+        r"happy", r"great", r"amazing", r"awesome", r"excited", r"wonderful", r"glad",
+        r"fantastic", r"joy(ful)?", r"good day", r"grateful",
+    ],
+    "seeking_community": [
+        r"talk to (someone|people|others)", r"support group", r"community",
+        r"people like me", r"meet (people|others)", r"anyone else (feel|going through)",
+        r"make friends",
+    ],
+    "neutral": [
+        r"hello", r"hey", r"what'?s up", r"how are you", r"ok(ay)?", r"thanks?( you)?",
+    ],
+}
+
+# "not happy", "never felt great": the next keyword is discounted
+NEGATORS = re.compile(r"\b(not|no|never|n't|hardly|isn'?t|wasn'?t|don'?t|didn'?t)\W+(\w+\W+){0,2}$")
+
+
+class KeywordTier:
+    """
+    One compiled alternation over every tag's keyword patterns; a single
+    finditer pass scores all tags. Confidence is the winning tag's share of
+    the matches, scaled by 1 - 0.5 ** (its match count). A negated keyword
+    counts against every tag. One keyword gives at most 0.5, so a lone word
+    still goes to the LLM; two or more of one tag and nothing else (0.75 and
+    up) is clear enough to settle without it. Distress phrases are never
+    discounted by negation, and one is always final.
+    """
+
+    name = "keyword"
+    decides = None  # Any tag, when confident
+
+    def __init__(self, keywords=KEYWORDS):
+        groups = [
+            f"(?P<{tag}>{'|'.join(f'(?:{p})' for p in patterns)})"
+            for tag, patterns in keywords.items()
+        ]
+        self.pattern = re.compile(r"\b(?:" + "|".join(groups) + r")\b", re.IGNORECASE)
+
+    def predict(self, text):
+        text = text.replace("\u2019", "'")  # Phone keyboards send curly apostrophes
+        scores = {}
+        negated = 0
+        for match in self.pattern.finditer(text):
+            tag = match.lastgroup
+            if tag != DISTRESS and NEGATORS.search(text[:match.start()].lower()):
+                negated += 1
+                continue
+            scores[tag] = scores.get(tag, 0) + 1
+        if not scores:
+            return None
+        if DISTRESS in scores:
+            return Prediction(DISTRESS, 1.0, self.name)
+        tag = max(scores, key=scores.get)
+        confidence = (1 - 0.5 ** scores[tag]) * scores[tag] / (sum(scores.values()) + negated)
+        return Prediction(tag, confidence, self.name)
+
+
+# --- 2. TF-IDF + linear tier (optional, needs scikit-learn and a trained model) ---
+
+class LinearTier:
+    """ TF-IDF features into a logistic regression, trained offline with `train`. """
+
+    name = "linear"
+    decides = None  # Any tag, when confident
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    @classmethod
+    def train(cls, texts, labels):
+        if not SKLEARN_AVAILABLE:
+            raise RuntimeError("scikit-learn is required to train the linear mood classifier")
+        pipeline = make_pipeline(
+            TfidfVectorizer(ngram_range=(1, 2), sublinear_tf=True, min_df=1),
+            LogisticRegression(max_iter=1000, class_weight="balanced"),
+        )
+        pipeline.fit(texts, labels)
+        return cls(pipeline)
+
+    @classmethod
+    def load(cls, path=MOOD_MODEL_PATH):
+        """ Returns the saved tier, or None when scikit-learn or the model file is missing. """
+        if not SKLEARN_AVAILABLE or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return cls(pickle.load(f))
+
+    def save(self, path=MOOD_MODEL_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "wb") as f:
+            pickle.dump(self.pipeline, f)
+
+    def predict(self, text):
+        probabilities = self.pipeline.predict_proba([text])[0]
+        best = probabilities.argmax()
+        return Prediction(str(self.pipeline.classes_[best]), float(probabilities[best]), self.name)
+
+
+# --- 3. The cascade ---
+
+class TieredClassifier:
+    """
+    Runs local tiers cheapest first and returns the first prediction at or
+    above `threshold` whose tag the tier may decide (its `decides` set; None
+    for any). A serious_distress prediction from any tier is final, whatever
+    its confidence, so neither a later tier nor the LLM can downgrade it. When no local
+    tier decides, `llm_fn(user_input, history)` decides; if it is
+    missing or fails, the most confident local guess (or `fallback`) is used.
+    LLM answers are stored in `cache` (a response_cache.ResponseCache), keyed
+    on the normalized message and recent history, and reused before asking again.
+    """
+
+    def __init__(self, tiers, llm_fn=None, threshold=MOOD_CONFIDENCE_THRESHOLD, fallback="neutral", cache=None):
+        self.tiers = [t for t in tiers if t is not None]
+        self.llm_fn = llm_fn
+        self.cache = cache
+        self.threshold = threshold
+        self.fallback = fallback
+        self._lock = threading.Lock()
+        self.decisions = {}
+        self.total_ms = {}
+
+    def _record(self, tier, started):
+        elapsed = 1000 * (time.perf_counter() - started) if started else 0.0
+        with self._lock:
+            self.decisions[tier] = self.decisions.get(tier, 0) + 1
+            self.total_ms[tier] = self.total_ms.get(tier, 0.0) + elapsed
+
+    def decides(self, tier, prediction):
+        """ True if `prediction` from `tier` settles the message without asking later tiers. """
+        if prediction.tag == DISTRESS:
+            return True
+        decides = getattr(tier, "decides", None)
+        return prediction.confidence >= self.threshold and (decides is None or prediction.tag in decides)
+
+    def classify_local(self, user_input, history=None):
+        """
+        Runs only the local tiers, then the cache of earlier LLM answers.
+        Returns (decision, best_guess): `decision` is the confident Prediction
+        or None when the LLM should be asked.
+        """
+        started = time.perf_counter()
+        best = None
+        for tier in self.tiers:
+            prediction = tier.predict(user_input)
+            if prediction is None:
+                continue
+            if self.decides(tier, prediction):
+                self._record(prediction.tier, started)
+                return prediction, prediction
+            if best is None or prediction.confidence > best.confidence:
+                best = prediction
+
+        if self.cache is not None and self.llm_fn is not None:
+            tag = self.cache.get(self.cache.classification_key(user_input, history))
+            if tag in TAGS:
+                self._record("cache", started)
+                return Prediction(tag, 1.0, "cache"), best
+        return None, best
+
+    def resolve(self, user_input, history, llm_tag, best_guess, started=None):
+        """
+        Picks the final tag once the LLM has answered (llm_tag is None if it
+        failed or was unparsable). `started` is the perf_counter() at which the
+        LLM call began, for the per-tier latency stats.
+        """
+        if llm_tag in TAGS:
+            if self.cache is not None:
+                self.cache.set(self.cache.classification_key(user_input, history), llm_tag)
+            self._record("llm", started)
+            return llm_tag
+        self._record("fallback", started)
+        return best_guess.tag if best_guess else self.fallback
+
+    def classify(self, user_input, history=None):
+        """ Returns the mood/intent tag for `user_input`. """
+        decision, best = self.classify_local(user_input, history)
+        if decision is not None:
+            return decision.tag
+
+        started = time.perf_counter()
+        llm_tag = None
+        if self.llm_fn is not None:
+            try:
+                llm_tag = self.llm_fn(user_input, history or [])
+            except Exception as e:
+                print(f"--- LLM classification failed: {e} ---")
+        return self.resolve(user_input, history, llm_tag, best, started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "tiers": [t.name for t in self.tiers] + (["llm"] if self.llm_fn else []),
+                "threshold": self.threshold,
+                "decisions": dict(self.decisions),
+                "avg_ms": {k: round(v / self.decisions[k], 3) for k, v in self.total_ms.items()},
+            }
+
+
+def build_classifier(llm_fn=None, fallback="neutral", cache=None):
+    """ Builds the cascade described by MOOD_CLASSIFIER_TIERS (e.g. "keyword,linear,llm"). """
+    names = [n.strip() for n in MOOD_CLASSIFIER_TIERS.split(",") if n.strip()]
+    tiers = []
+    if "keyword" in names:
+        tiers.append(KeywordTier())
+    if "linear" in names:
+        linear = LinearTier.load()
+        if linear is None:
+            print(f"--- Linear mood model not available at {MOOD_MODEL_PATH}; skipping that tier. ---")
+        tiers.append(linear)
+    return TieredClassifier(tiers, llm_fn if "llm" in names else None, fallback=fallback, cache=cache)
+
+
+def read_labeled_csv(path):
+    """ Reads (text, label) rows from a CSV with `text` and `label` columns. """
+    with open(path, newline="", encoding="utf-8") as f:
+        return [(row["text"], row["label"].strip()) for row in csv.DictReader(f)]
+
+
+if __name__ == "__main__":
+    # Train the linear tier: python mood_classifier.py labeled.csv [--out data/mood_tfidf.pkl]
+    parser = argparse.ArgumentParser(description="Train the TF-IDF + linear mood classifier.")
+    parser.add_argument("csv", help="labeled CSV with text,label columns")
+    parser.add_argument("--out", default=MOOD_MODEL_PATH)
+    args = parser.parse_args()
+
+    rows = read_labeled_csv(args.csv)
+    tier = LinearTier.train([text for text, _ in rows], [label for _, label in rows])
+    tier.save(args.out)
+    print(f"--- Trained on {len(rows)} examples; saved to {args.out} ---")
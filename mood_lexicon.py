@@ -0,0 +1,107 @@
+import re
+
+# Weighted mood lexicon. A message is split into words with one compiled
+# regex and the words are mapped through a single table that holds every
+# mood's terms, so all moods are scored in one pass and the cost doesn't
+# grow with the size of the lexicon. Terms are whole words ("mad" no
+# longer matches "made"); a trailing * makes a term a prefix ("stress*"
+# matches stressed, stressful). A term within NEGATION_WINDOW words after a
+# negator ("not happy", "never felt calm") is not counted.
+
+NEGATION_WINDOW = 3
+NEGATORS = ("not", "no", "never", "hardly", "nothing", "without")  # Plus any word ending in n't
+
+# Words with their apostrophes; a lone \x00 separates messages in a batch
+_TOKENS = re.compile(r"[a-z0-9'\x00]+")
+# Table markers besides (mood, weight) entries; None means a word not seen yet
+_MISS = False
+_NEGATE = "negate"
+_NEXT = "next"
+# Words resolved at run time are remembered, up to this many
+_MEMO_LIMIT = 50000
+
+
+class MoodLexicon:
+    """
+    {mood: {term: weight}} (or {mood: [terms]}, weight 1) compiled once.
+    scores() and classify() handle one message; the *_batch variants
+    tokenize a whole list of messages with one regex call.
+    """
+
+    def __init__(self, lexicon, default="neutral"):
+        self.default = default
+        self.moods = list(lexicon)  # Ties go to the mood listed first
+        self._prefixes = []
+        base = dict.fromkeys(NEGATORS, _NEGATE)
+        base["\x00"] = _NEXT
+        for mood, terms in lexicon.items():
+            weights = terms if isinstance(terms, dict) else dict.fromkeys(terms, 1.0)
+            for term, weight in weights.items():
+                term = term.lower()
+                if term.endswith("*"):
+                    self._prefixes.append((term[:-1], (mood, float(weight))))
+                else:
+                    base[term] = (mood, float(weight))
+        # Longest prefix wins; exact terms always win over prefixes
+        self._prefixes.sort(key=lambda entry: len(entry[0]), reverse=True)
+        self._base = base
+        self._table = dict(base)
+
+    def _resolve(self, word):
+        """ Table entry for a word not seen before: a quoted term, a prefix term, a negator, or a miss. """
+        stripped = word.strip("'")
+        if stripped != word:
+            entry = self._table.get(stripped) or self._resolve(stripped)
+        elif word.endswith("n't"):
+            entry = _NEGATE
+        else:
+            entry = next((value for prefix, value in self._prefixes if word.startswith(prefix)), _MISS)
+        if len(self._table) >= len(self._base) + _MEMO_LIMIT:
+            self._table = dict(self._base)
+        self._table[word] = entry
+        return entry
+
+    def _score_tokens(self, tokens, results):
+        """ Adds each un-negated term's weight to its message's scores; "\\x00" starts the next message. """
+        index, negated_until = 0, -1
+        scores = results[0]
+        for position, entry in enumerate(map(self._table.get, tokens)):
+            if entry is _MISS:
+                continue
+            if entry is None:
+                entry = self._resolve(tokens[position])
+                if entry is _MISS:
+                    continue
+            if entry is _NEGATE:
+                negated_until = position + NEGATION_WINDOW
+            elif entry is _NEXT:
+                index += 1
+                scores = results[index]
+                negated_until = -1
+            elif position > negated_until:
+                mood, weight = entry
+                scores[mood] = scores.get(mood, 0.0) + weight
+        return results
+
+    def scores(self, text):
+        """ {mood: summed weight} of the terms found in `text` (moods with no terms omitted). """
+        return self._score_tokens(_TOKENS.findall(text.lower()), [{}])[0]
+
+    def scores_batch(self, texts):
+        """ scores() for every message in `texts`, tokenized together. """
+        if not texts:
+            return []
+        tokens = _TOKENS.findall(" \x00 ".join(text.replace("\x00", " ") for text in texts).lower())
+        return self._score_tokens(tokens, [{} for _ in texts])
+
+    def classify(self, text):
+        """ The mood with the highest score, or the default when no term matched. """
+        return self._best(self.scores(text))
+
+    def classify_batch(self, texts):
+        return [self._best(scores) for scores in self.scores_batch(texts)]
+
+    def _best(self, scores):
+        if not scores:
+            return self.default
+        return max(self.moods, key=lambda mood: scores.get(mood, 0.0))
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# --- Configuration ---
+# Classification tags and deterministic (do_sample=False) completions are cached;
+# sampled conversation replies never are.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+# "memory" is per process; "sqlite" is a file shared by every worker on the host
+# (keys and values include user text, so it defaults to the git-ignored data/ directory)
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "data/response_cache.sqlite3")
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+# Messages of context that take part in a classification key (the classifier prompt sees 4)
+HISTORY_KEY_MESSAGES = 4
+
+
+def normalize_text(text):
+    """ Case-folds, collapses whitespace and trims punctuation, so "Hi!" and "hi" share a key. """
+    text = re.sub(r"\s+", " ", (text or "").lower()).strip()
+    return text.strip(" .,!?;:~")
+
+
+def history_hash(history, messages=HISTORY_KEY_MESSAGES):
+    """ Short digest of the last `messages` history entries (role and normalized content). """
+    recent = [(m.get("role"), normalize_text(m.get("content"))) for m in (history or [])[-messages:]]
+    return hashlib.sha1(json.dumps(recent).encode("utf-8")).hexdigest()[:16]
+
+
+# --- 1. Backends ---
+# A backend stores JSON-serialisable values with an absolute expiry time and
+# evicts least-recently-used entries past `max_entries`:
+#   get(key) -> value or None, set(key, value, expires_at), clear(), size()
+
+class MemoryBackend:
+    """ In-process LRU dictionary. """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    Cache table in a local SQLite file, shared by every worker process on the
+    host (a stand-in for a networked cache such as Redis). Each thread keeps
+    its own connection; WAL mode lets readers proceed during writes.
+    """
+
+    # Trim expired and least-recently-used rows every this many writes
+    EVICT_EVERY = 100
+
+    def __init__(self, path=RESPONSE_CACHE_PATH, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        self._writes = 0
+        self.evictions = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires_at > ?", (key, now)
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, expires_at):
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+            (key, json.dumps(value), expires_at, time.time()),
+        )
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY == 0:
+            self._evict(conn)
+
+    def _evict(self, conn):
+        deleted = conn.execute("DELETE FROM response_cache WHERE expires_at <= ?", (time.time(),)).rowcount
+        deleted += conn.execute(
+            "DELETE FROM response_cache WHERE key IN (SELECT key FROM response_cache "
+            "ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)", (self.max_entries,)
+        ).rowcount
+        self.evictions += deleted
+
+    def clear(self):
+        self._connect().execute("DELETE FROM response_cache")
+
+    def size(self):
+        return self._connect().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+# --- 2. The cache ---
+
+class ResponseCache:
+    """ TTL cache for model outputs on top of a backend, with hit/miss counters. """
+
+    def __init__(self, backend, ttl=RESPONSE_CACHE_TTL_SECONDS, namespace=""):
+        self.backend = backend
+        self.ttl = ttl
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.sets = 0
+        self.errors = 0
+
+    def classification_key(self, user_input, history):
+        return f"{self.namespace}cls:{history_hash(history)}:{normalize_text(user_input)}"
+
+    def completion_key(self, payload):
+        """ Key for a deterministic completion request (the full request body). """
+        digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{self.namespace}gen:{digest}"
+
+    def get(self, key):
+        # A failing shared backend must never fail the request; it just misses
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            print(f"--- Response cache read failed: {e} ---")
+            value = None
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            self.backend.set(key, value, time.time() + self.ttl)
+        except Exception as e:
+            print(f"--- Response cache write failed: {e} ---")
+            with self._lock:
+                self.errors += 1
+            return
+        with self._lock:
+            self.sets += 1
+
+    def stats(self):
+        try:
+            entries = self.backend.size()
+        except Exception:
+            entries = None
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "backend": type(self.backend).__name__,
+                "entries": entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "sets": self.sets,
+                "evictions": getattr(self.backend, "evictions", 0),
+                "errors": self.errors,
+            }
+
+
+def build_cache(namespace=""):
+    """ The cache described by RESPONSE_CACHE_*, or None when caching is disabled. """
+    if not RESPONSE_CACHE:
+        return None
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        backend = SQLiteBackend(RESPONSE_CACHE_PATH)
+    else:
+        backend = MemoryBackend()
+    print(f"--- Response cache: {type(backend).__name__}, ttl {RESPONSE_CACHE_TTL_SECONDS:.0f}s ---")
+    return ResponseCache(backend, namespace=namespace)
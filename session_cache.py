@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+# Hot-session cache in front of Firestore user documents. An active
+# conversation reads its user document and message tail once; later turns are
+# served from here, and every commit writes the new state through. Entries
+# expire after SESSION_CACHE_TTL_SECONDS and the least recently used are
+# evicted past SESSION_CACHE_MB. With several instances, SESSION_CACHE_LISTEN=1
+# attaches a Firestore snapshot listener to each cached document and drops the
+# entry when another instance changes it; otherwise the TTL bounds staleness
+# (and ChatTurnRepository.commit still detects conflicting writes).
+
+# --- Configuration ---
+SESSION_CACHE = os.getenv("SESSION_CACHE", "1") == "1"
+SESSION_CACHE_MB = float(os.getenv("SESSION_CACHE_MB", "64"))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "300"))
+SESSION_CACHE_LISTEN = os.getenv("SESSION_CACHE_LISTEN", "0") == "1"
+
+
+def _size(data, history):
+    """ Approximate memory footprint of an entry, from its JSON length. """
+    return len(json.dumps(data, default=str)) + len(json.dumps(history, default=str)) + 200
+
+
+class _Entry:
+    __slots__ = ("data", "history", "total", "size", "expires_at", "unsubscribe")
+
+    def __init__(self, data, history, total, ttl):
+        self.data = data
+        self.history = history
+        self.total = total  # Messages in the whole conversation; history is its tail
+        self.size = _size(data, history)
+        self.expires_at = time.monotonic() + ttl
+        self.unsubscribe = None
+
+
+class SessionCache:
+    """
+    session_id -> (user document data, most recent messages, message count).
+    get() returns copies, so callers may append to the history they are given.
+    """
+
+    def __init__(self, max_mb=SESSION_CACHE_MB, ttl=SESSION_CACHE_TTL_SECONDS, listen=SESSION_CACHE_LISTEN):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.listen = listen
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, session_id, history_limit):
+        """
+        (data, history, total) if cached with at least `history_limit` messages
+        of tail (or the whole conversation); else None. 0 returns whatever is cached.
+        """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry.expires_at <= time.monotonic():
+                self._drop(session_id)
+                self.expirations += 1
+                entry = None
+            if entry is None or (len(entry.history) < history_limit and len(entry.history) < entry.total):
+                self.misses += 1
+                return None
+            self._entries.move_to_end(session_id)
+            self.hits += 1
+            history = entry.history[-history_limit:] if history_limit else entry.history
+            return dict(entry.data), list(history), entry.total
+
+    def put(self, session_id, data, history, total, ref=None):
+        """ Caches the state of a session as just read from or written to Firestore. """
+        entry = _Entry(dict(data), list(history), total, self.ttl)
+        if entry.size > self.max_bytes:
+            self.invalidate(session_id)
+            return
+        with self._lock:
+            previous = self._entries.pop(session_id, None)
+            if previous is not None:
+                self.bytes -= previous.size
+                entry.unsubscribe = previous.unsubscribe
+            self._entries[session_id] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+            subscribe = self.listen and ref is not None and entry.unsubscribe is None and session_id in self._entries
+        if subscribe:
+            self._subscribe(session_id, ref)
+
+    def update(self, session_id, fields):
+        """ Writes changed document fields through to a cached session (no-op if not cached). """
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                entry.data = dict(entry.data, **fields)
+
+    def invalidate(self, session_id):
+        with self._lock:
+            if self._drop(session_id):
+                self.invalidations += 1
+
+    def _drop(self, session_id):
+        entry = self._entries.pop(session_id, None)
+        if entry is None:
+            return False
+        self.bytes -= entry.size
+        if entry.unsubscribe is not None:
+            # Closing a watch can wait on its callback thread, which takes this lock
+            threading.Thread(target=entry.unsubscribe, daemon=True).start()
+        return True
+
+    def _subscribe(self, session_id, ref):
+        """ Drops the entry when the document changes to something this process didn't write. """
+        def on_snapshot(snapshots, changes, read_time):
+            for snapshot in snapshots:
+                data = snapshot.to_dict() or {}
+                with self._lock:
+                    entry = self._entries.get(session_id)
+                    stale = entry is not None and (
+                        data.get('message_count') != entry.data.get('message_count')
+                        or data.get('summary_covers', 0) != entry.data.get('summary_covers', 0)
+                    )
+                if stale:
+                    self.invalidate(session_id)
+
+        try:
+            watch = ref.on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"--- Session cache: snapshot listener unavailable ({e}); relying on TTL ---")
+            self.listen = False
+            return
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and entry.unsubscribe is None:
+                entry.unsubscribe = watch.unsubscribe
+                return
+        watch.unsubscribe()  # Evicted meanwhile
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
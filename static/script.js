@@ -5,6 +5,10 @@ class ChatInterface {
         this.sendButton = document.getElementById('sendButton');
         this.typingIndicator = document.getElementById('typingIndicator');
         this.conversationHistory = [];
+        // Version of the history the server holds for this session; it then needs only the new message
+        this.historyVersion = null;
+        this.resendHistory = false;
+        this.sessionId = this.getSessionId();
         
         this.initializeEventListeners();
         this.setInitialTime();
@@ -31,6 +35,22 @@ class ChatInterface {
         }, 500);
     }
 
+    getSessionId() {
+        // Per tab, so the server doesn't repeat an opening or tip this conversation just showed
+        let sessionId = sessionStorage.getItem('serenitySessionId');
+        if (!sessionId) {
+            sessionId = this.newId();
+            sessionStorage.setItem('serenitySessionId', sessionId);
+        }
+        return sessionId;
+    }
+
+    newId() {
+        return window.crypto && crypto.randomUUID
+            ? crypto.randomUUID()
+            : Date.now().toString(36) + Math.random().toString(36).slice(2);
+    }
+
     setInitialTime() {
         const initialTime = document.getElementById('initialTime');
         initialTime.textContent = this.getCurrentTime();
@@ -70,8 +90,10 @@ class ChatInterface {
             // Hide typing indicator
             this.hideTypingIndicator();
             
-            // Add bot response
-            this.addMessage(response.response, 'bot', response.mood);
+            // Add bot response (a streamed reply is already on screen)
+            if (!response.rendered) {
+                this.addMessage(response.response, 'bot', response.mood);
+            }
             
             // Add suggestion if available
             if (response.suggestion) {
@@ -89,23 +111,29 @@ class ChatInterface {
     }
 
     async getBotResponse(message) {
-        const response = await fetch('/chat', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-            },
-            body: JSON.stringify({
-                message: message,
-                history: this.conversationHistory
-            })
-        });
-
-        if (!response.ok) {
-            throw new Error('Network response was not ok');
+        // One id per message, kept across retries, so the server answers it only once
+        const messageId = this.newId();
+        let data;
+        try {
+            data = await this.requestBotResponse(message, messageId);
+        } catch (error) {
+            if (!error.historyConflict) {
+                throw error;
+            }
+            // The server lost or has a different copy of this conversation: send ours once
+            this.resendHistory = true;
+            data = await this.requestBotResponse(message, messageId);
+        }
+        if (typeof data.history_version === 'number') {
+            this.historyVersion = data.history_version;
+            this.resendHistory = false;
         }
-
-        const data = await response.json();
         
+        // A canned fallback isn't stored on the server, so it mustn't come back in a resent history either
+        if (data.fallback) {
+            return data;
+        }
+
         // Update conversation history
         this.conversationHistory.push({
             user: message,
@@ -120,6 +148,162 @@ class ChatInterface {
         return data;
     }
 
+    async requestBotResponse(message, messageId) {
+        try {
+            return await this.streamBotResponse(message, messageId);
+        } catch (error) {
+            // Fall back to the plain JSON endpoint only if streaming never started
+            if (!error.canFallback) {
+                throw error;
+            }
+            return this.fetchBotResponse(message, messageId);
+        }
+    }
+
+    requestBody(message, messageId) {
+        const body = {
+            message: message,
+            message_id: messageId,
+            session_id: this.sessionId,
+            history_version: this.historyVersion
+        };
+        // Our own copy goes along only when the server doesn't hold one (yet)
+        if (this.resendHistory || (this.historyVersion === null && this.conversationHistory.length)) {
+            body.history = this.conversationHistory;
+        }
+        return JSON.stringify(body);
+    }
+
+    checkHistoryConflict(response) {
+        if (response.status === 409) {
+            const error = new Error('Conversation history out of date');
+            error.historyConflict = true;
+            throw error;
+        }
+    }
+
+    async fetchBotResponse(message, messageId, retries = 1) {
+        let response;
+        try {
+            response = await fetch('/chat', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                },
+                body: this.requestBody(message, messageId)
+            });
+        } catch (error) {
+            // A resend with the same message id gets the stored reply if the first one got through
+            if (retries > 0) {
+                return this.fetchBotResponse(message, messageId, retries - 1);
+            }
+            throw error;
+        }
+
+        this.checkHistoryConflict(response);
+        if (response.status === 503 && retries > 0) {
+            // The same message is still being answered elsewhere
+            const wait = parseInt(response.headers.get('Retry-After'), 10) || 1;
+            await new Promise((resolve) => setTimeout(resolve, wait * 1000));
+            return this.fetchBotResponse(message, messageId, retries - 1);
+        }
+        if (!response.ok) {
+            throw new Error('Network response was not ok');
+        }
+
+        return response.json();
+    }
+
+    async streamBotResponse(message, messageId) {
+        let response;
+        try {
+            response = await fetch('/chat/stream', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json',
+                    'Accept': 'text/event-stream'
+                },
+                body: this.requestBody(message, messageId)
+            });
+        } catch (error) {
+            error.canFallback = true;
+            throw error;
+        }
+
+        this.checkHistoryConflict(response);
+        if (!response.ok || !response.body) {
+            const error = new Error('Streaming not available');
+            error.canFallback = true;
+            throw error;
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let text = '';
+        let bubble = null;
+        let result = null;
+
+        // Render each token as it arrives; the `done` event carries mood and suggestion
+        while (result === null) {
+            const { value, done } = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, { stream: true });
+            const frames = buffer.split('\n\n');
+            buffer = frames.pop();
+
+            for (const frame of frames) {
+                const event = this.parseServerEvent(frame);
+                if (!event) continue;
+
+                if (event.type === 'token') {
+                    if (!bubble) {
+                        this.hideTypingIndicator();
+                        bubble = this.addMessage('', 'bot');
+                    }
+                    text += event.data.token;
+                    this.renderContent(bubble.querySelector('.message-content'), text);
+                    this.scrollToBottom();
+                } else if (event.type === 'done') {
+                    result = event.data;
+                } else if (event.type === 'error') {
+                    throw new Error(event.data.error || 'Streaming error');
+                }
+            }
+        }
+
+        if (result === null) {
+            throw new Error('Stream ended unexpectedly');
+        }
+
+        result.response = result.response || text;
+        if (bubble) {
+            if (result.mood) {
+                bubble.setAttribute('data-mood', result.mood);
+            }
+            this.renderContent(bubble.querySelector('.message-content'), result.response);
+        } else {
+            this.addMessage(result.response, 'bot', result.mood);
+        }
+        result.rendered = true;
+        return result;
+    }
+
+    parseServerEvent(frame) {
+        let type = 'message';
+        const dataLines = [];
+        frame.split('\n').forEach((line) => {
+            if (line.startsWith('event:')) {
+                type = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                dataLines.push(line.slice(5).trim());
+            }
+        });
+        if (dataLines.length === 0) return null;
+        return { type: type, data: JSON.parse(dataLines.join('\n')) };
+    }
+
     addMessage(content, sender, mood = 'neutral') {
         const messageDiv = document.createElement('div');
         messageDiv.className = `message ${sender}-message message-loading`;
@@ -135,6 +319,19 @@ class ChatInterface {
         messageTime.className = 'message-time';
         messageTime.textContent = this.getCurrentTime();
 
+        this.renderContent(messageContent, content);
+
+        messageDiv.appendChild(messageContent);
+        messageDiv.appendChild(messageTime);
+        
+        this.chatMessages.appendChild(messageDiv);
+        this.scrollToBottom();
+        return messageDiv;
+    }
+
+    renderContent(messageContent, content) {
+        messageContent.textContent = '';
+
         // Handle line breaks in message content
         const paragraphs = content.split('\n\n');
         paragraphs.forEach((paragraph, index) => {
@@ -145,12 +342,6 @@ class ChatInterface {
             }
             messageContent.appendChild(p);
         });
-
-        messageDiv.appendChild(messageContent);
-        messageDiv.appendChild(messageTime);
-        
-        this.chatMessages.appendChild(messageDiv);
-        this.scrollToBottom();
     }
 
     addSuggestion(suggestion) {
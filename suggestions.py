@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import random
+import threading
+from types import MappingProxyType
+
+# Coping suggestions and response openings for app.py. They are loaded once
+# from a JSON data file (SUGGESTIONS_PATH) into immutable pools, one per kind:
+# "opening", or a mood. A pool holds its texts and a table in which each text
+# fills slots in proportion to its weight, so a request costs a dict lookup
+# and one index into the table. Draws don't repeat within a session: the
+# texts shown for that session in the last SUGGESTIONS_AVOID picks of a kind
+# are skipped, while the pool has others left. The file is checked at most
+# every SUGGESTIONS_RELOAD_SECONDS, and a changed one is swapped in whole. A
+# file that fails to load leaves the current set in place.
+#
+#   {"openings": ["I understand...", ...],
+#    "suggestions": {"stressed": ["...", {"text": "...", "weight": 2}], "neutral": [...], ...}}
+
+# --- Configuration ---
+SUGGESTIONS_PATH = os.getenv(
+    "SUGGESTIONS_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "suggestions.json"))
+# How often the data file's mtime is checked; 0 turns hot reload off
+SUGGESTIONS_RELOAD_SECONDS = float(os.getenv("SUGGESTIONS_RELOAD_SECONDS", "5"))
+# Recent picks per session and kind that are not shown again
+SUGGESTIONS_AVOID = int(os.getenv("SUGGESTIONS_AVOID", "2"))
+# (session, kind) pairs whose recent picks are remembered; least recently used are dropped
+SUGGESTIONS_MAX_TRACKED = int(os.getenv("SUGGESTIONS_MAX_TRACKED", "200000"))
+
+OPENING = "opening"
+# Kind used for a mood without its own suggestions
+FALLBACK_MOOD = "neutral"
+
+
+class Pool:
+    """
+    Texts of one kind and a draw table, in which each text has a share of
+    about TABLE_SLOTS slots in proportion to its weight (at least one).
+    A draw is a single index into the table.
+    """
+
+    __slots__ = ("texts", "weights", "table")
+
+    TABLE_SLOTS = 1024
+
+    def __init__(self, entries):
+        if not isinstance(entries, list):
+            raise ValueError(f"Suggestions must be a list, not {type(entries).__name__}")
+        texts, weights = [], []
+        for entry in entries:
+            if isinstance(entry, str):
+                text, weight = entry, 1.0
+            else:
+                text, weight = entry["text"], float(entry.get("weight", 1.0))
+            if not isinstance(text, str) or not text or not weight > 0:
+                raise ValueError(f"Invalid suggestion entry {entry!r}")
+            texts.append(text)
+            weights.append(weight)
+        if not texts:
+            raise ValueError("Suggestion pool is empty")
+        self.texts = tuple(texts)
+        self.weights = tuple(weights)
+        # A multiple of the pool size, so equal weights get exactly equal shares
+        slots = len(texts) * -(-self.TABLE_SLOTS // len(texts))
+        shares = [weight * slots / sum(weights) for weight in weights]
+        counts = [max(1, int(share)) for share in shares]
+        by_remainder = sorted(range(len(texts)), key=lambda i: shares[i] - int(shares[i]), reverse=True)
+        for i in by_remainder[:max(0, slots - sum(counts))]:
+            counts[i] += 1
+        self.table = tuple(text for text, count in zip(texts, counts) for _ in range(count))
+
+    def draw(self, rng, avoid=()):
+        """ A weighted pick that skips texts in `avoid` (oldest first); only its newest len(texts) - 1 count. """
+        table = self.table
+        text = table[int(rng.random() * len(table))]
+        if text not in avoid:
+            return text
+        last = len(self.texts) - 1
+        avoid = tuple(avoid)[len(avoid) - last:] if len(avoid) > last else avoid
+        for _ in range(8):
+            text = table[int(rng.random() * len(table))]
+            if text not in avoid:
+                return text
+        # Most of the weight is on avoided texts: draw among the rest directly
+        allowed = [i for i, text in enumerate(self.texts) if text not in avoid]
+        if not allowed:
+            return text
+        return self.texts[rng.choices(allowed, [self.weights[i] for i in allowed])[0]]
+
+
+class SuggestionSet:
+    """ Immutable snapshot of the data file: kind -> Pool. """
+
+    def __init__(self, data, version=None):
+        pools = {OPENING: Pool(data["openings"])}
+        for mood, entries in data["suggestions"].items():
+            pools[mood] = Pool(entries)
+        if FALLBACK_MOOD not in pools:
+            raise ValueError(f"Suggestions need a {FALLBACK_MOOD!r} pool")
+        self.pools = MappingProxyType(pools)
+        self.version = version
+
+    def pool(self, kind):
+        pool = self.pools.get(kind)
+        return pool if pool is not None else self.pools[FALLBACK_MOOD]
+
+    @classmethod
+    def load(cls, path):
+        """ (SuggestionSet, file mtime) from a JSON data file. """
+        version = os.stat(path).st_mtime_ns  # Taken first, so a write during the read is picked up next time
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f), version), version
+
+
+class SuggestionEngine:
+    """
+    Weighted, per-session non-repeating picks from a hot-reloaded SuggestionSet.
+    pick() takes the kind ("opening" or a mood) and an optional session key.
+    """
+
+    def __init__(self, path=SUGGESTIONS_PATH, reload_seconds=SUGGESTIONS_RELOAD_SECONDS,
+                 avoid=SUGGESTIONS_AVOID, max_tracked=SUGGESTIONS_MAX_TRACKED, rng=None):
+        self.path = path
+        self.reload_seconds = reload_seconds
+        self.avoid = avoid
+        self.max_tracked = max_tracked
+        self._rng = rng or random.Random()
+        self.current, self._version = SuggestionSet.load(path)
+        self._next_check = time.monotonic() + reload_seconds
+        self._failed_version = None  # mtime of a file that didn't load, so it's only reported once
+        self._reload_lock = threading.Lock()
+        # (session, kind) -> texts recently shown, oldest first; dict order is recency of use
+        self._recent = {}
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.reload_errors = 0
+
+    def maybe_reload(self):
+        """ Swaps in the data file if it changed; checked at most every reload_seconds. """
+        if not self.reload_seconds or time.monotonic() < self._next_check:
+            return False
+        if not self._reload_lock.acquire(blocking=False):
+            return False  # Another thread is checking
+        try:
+            self._next_check = time.monotonic() + self.reload_seconds
+            version = None
+            try:
+                version = os.stat(self.path).st_mtime_ns
+                if version in (self._version, self._failed_version):
+                    return False
+                self.current, self._version = SuggestionSet.load(self.path)
+            except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+                if version is None or version == self._failed_version:
+                    return False  # File missing (mid-replace) or already reported
+                self._failed_version = version
+                self.reload_errors += 1
+                print(f"--- Could not reload suggestions from {self.path}; keeping the current set. {e} ---")
+                return False
+            self.reloads += 1
+            print(f"--- Reloaded suggestions from {self.path} ---")
+            return True
+        finally:
+            self._reload_lock.release()
+
+    def suggestions(self, kind):
+        """ All texts of a kind (a mood falls back to neutral). """
+        self.maybe_reload()
+        return self.current.pool(kind).texts
+
+    def pick(self, kind, session_id=None):
+        if self.reload_seconds and time.monotonic() >= self._next_check:
+            self.maybe_reload()
+        pool = self.current.pool(kind)
+        if session_id is None or self.avoid <= 0:
+            return pool.draw(self._rng)
+        key = (session_id, kind)
+        recent = self._recent
+        with self._lock:
+            shown = recent.pop(key, ())  # Re-inserted below, at the most recent end
+            text = pool.draw(self._rng, shown)
+            recent[key] = (shown + (text,))[-self.avoid:]
+            if len(recent) > self.max_tracked:
+                del recent[next(iter(recent))]
+        return text
+
+    def stats(self):
+        return {
+            "version": self._version,
+            "kinds": len(self.current.pools),
+            "tracked": len(self._recent),
+            "reloads": self.reloads,
+            "reload_errors": self.reload_errors,
+        }
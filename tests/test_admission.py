@@ -0,0 +1,147 @@
+"""
+Admission control: token buckets in memory and in SQLite, the in-flight gate
+and its queue, and the 429 + Retry-After answer on a Flask app.
+"""
+import time
+import threading
+
+import pytest
+from flask import Flask, jsonify
+
+import admission
+import crisis_screen
+from admission import AdmissionController, ConcurrencyGate, MemoryBuckets, SQLiteBuckets
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def buckets(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteBuckets(str(tmp_path / "admission.sqlite3"))
+    return MemoryBuckets()
+
+
+def test_bucket_allows_its_burst_then_refills_at_its_rate(buckets):
+    limits = [("session:a", 0.5, 2)]
+    assert buckets.take(limits, now=100.0) is None
+    assert buckets.take(limits, now=100.0) is None
+    assert buckets.take(limits, now=100.0) == (0, pytest.approx(2.0))
+    assert buckets.take(limits, now=101.0) == (0, pytest.approx(1.0))
+    assert buckets.take(limits, now=102.0) is None
+
+
+def test_refused_request_draws_from_no_bucket(buckets):
+    ip, session = ("ip:1.2.3.4", 1.0, 2), ("session:a", 0.1, 1)
+    assert buckets.take([ip, session], now=100.0) is None
+    assert buckets.take([ip, session], now=100.0) == (1, pytest.approx(10.0))
+    # The IP still has the token the refused request would have used
+    assert buckets.take([ip], now=100.0) is None
+    assert buckets.take([ip], now=100.0) == (0, pytest.approx(1.0))
+
+
+def test_sqlite_buckets_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "data" / "admission.sqlite3")
+    first, second = SQLiteBuckets(path), SQLiteBuckets(path)
+    assert first.take([("ip:x", 1.0, 1)], now=100.0) is None
+    assert second.take([("ip:x", 1.0, 1)], now=100.0) == (0, pytest.approx(1.0))
+
+
+def test_gate_queues_up_to_its_limit_and_admits_on_release():
+    gate = ConcurrencyGate(max_in_flight=1, max_queue=1, timeout=5)
+    assert gate.acquire() == "ok"
+
+    outcomes = []
+    waiter = threading.Thread(target=lambda: outcomes.append(gate.acquire()))
+    waiter.start()
+    while gate.waiting == 0:
+        time.sleep(0.001)
+    assert gate.acquire() == "queue_full"
+
+    gate.release(0.5)
+    waiter.join(timeout=5)
+    assert outcomes == ["ok"]
+    assert gate.in_flight == 1
+
+
+def test_gate_turns_away_a_request_that_waited_too_long():
+    gate = ConcurrencyGate(max_in_flight=1, max_queue=1, timeout=0.05)
+    assert gate.acquire() == "ok"
+    assert gate.acquire() == "queue_timeout"
+    assert gate.waiting == 0
+
+
+def test_controller_reports_the_limit_that_refused():
+    controller = AdmissionController(
+        MemoryBuckets(), ConcurrencyGate(max_in_flight=5), session_limit=(0.5, 1), ip_limit=(5, 30))
+    assert controller.admit("a", "1.2.3.4") is None
+    assert controller.admit("a", "1.2.3.4") == ("session", 2)
+    assert controller.admit("b", "1.2.3.4") is None
+    assert controller.stats()["admitted"] == 2
+    assert controller.stats()["rejected"] == {"session": 1}
+
+
+def test_controller_counts_concurrent_admissions():
+    controller = AdmissionController(
+        MemoryBuckets(), ConcurrencyGate(max_in_flight=1000), session_limit=(1, 1000), ip_limit=(1, 1000))
+
+    def admit_many():
+        for _ in range(200):
+            controller.admit("a", "1.2.3.4")
+    threads = [threading.Thread(target=admit_many) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert controller.stats()["admitted"] == 800
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION", True)
+    # Crisis matching only; keep the escalation log in memory
+    monkeypatch.setattr(crisis_screen, "_screen", crisis_screen.CrisisScreen(log=crisis_screen.EscalationLog("")))
+    app = Flask(__name__)
+
+    @app.route("/chat", methods=["POST"])
+    def chat():
+        return jsonify({"response": "hi"})
+
+    controller = AdmissionController(
+        MemoryBuckets(), ConcurrencyGate(max_in_flight=2), session_limit=(0.5, 1), ip_limit=(5, 30))
+    admission.init_flask(app, controller)
+    return app.test_client()
+
+
+def test_over_the_limit_gets_429_with_retry_after(client):
+    assert client.post("/chat", json={"prompt": "hi", "session_id": "a"}).status_code == 200
+    response = client.post("/chat", json={"prompt": "hi again", "session_id": "a"})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "2"
+    assert response.get_json()["reason"] == "session"
+
+
+def test_crisis_messages_are_never_turned_away(client):
+    client.post("/chat", json={"prompt": "hi", "session_id": "a"})
+    response = client.post("/chat", json={"prompt": "I want to end it all", "session_id": "a"})
+    assert response.status_code == 200
+    assert response.get_json()["response"] == crisis_screen.SAFETY_RESPONSE
+
+
+def test_crisis_messages_still_use_up_the_limit(client):
+    assert client.post("/chat", json={"prompt": "I want to end it all", "session_id": "a"}).get_json() == {"response": "hi"}
+    # Over the limit: the canned reply, without reaching the handler
+    for _ in range(3):
+        response = client.post("/chat", json={"prompt": "I want to end it all", "session_id": "a"})
+        assert response.get_json()["response"] == crisis_screen.SAFETY_RESPONSE
+    assert client.post("/chat", json={"prompt": "hi", "session_id": "a"}).status_code == 429
+
+
+def test_crisis_reply_on_a_streaming_path_is_server_sent_events(client):
+    client.post("/chat", json={"prompt": "hi", "session_id": "a"})
+    response = client.post("/chat/stream", json={"prompt": "I want to end it all", "session_id": "a"})
+    assert response.mimetype == "text/event-stream"
+    assert response.get_data(as_text=True).startswith("event: token\n")
+
+
+def test_in_flight_slot_is_released_after_the_request(client):
+    for session_id in "abcd":
+        assert client.post("/chat", json={"prompt": "hi", "session_id": session_id}).status_code == 200
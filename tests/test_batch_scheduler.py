@@ -0,0 +1,132 @@
+"""
+BatchScheduler with a fake generate_fn: prompts that arrive while a batch is
+running go out together and in order, batches stay within max_batch_size,
+cancelled requests are skipped, and a failed or short batch fails every one of
+its futures instead of leaving some unresolved.
+"""
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+
+from batch_scheduler import BatchScheduler, GreedyRowsLogitsProcessor
+
+
+class _Backend:
+    """ generate_fn that records each batch and holds the first one until `release` is set. """
+
+    def __init__(self, results=None):
+        self.batches = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.results = results
+
+    def __call__(self, items):
+        self.batches.append([messages for messages, _ in items])
+        self.started.set()
+        self.release.wait(5)
+        if self.results is not None:
+            return self.results(items)
+        return [f"reply to {messages}" for messages, _ in items]
+
+
+@pytest.fixture
+def backend():
+    return _Backend()
+
+
+def test_prompts_queued_behind_a_batch_share_the_next_one_in_order(backend):
+    scheduler = BatchScheduler(backend, max_batch_size=8, max_wait_ms=1)
+    first = scheduler.submit("a")
+    assert backend.started.wait(5)
+    futures = [scheduler.submit(m, is_classification=(m == "c")) for m in "bcd"]
+    backend.release.set()
+
+    assert first.result(5) == "reply to a"
+    assert [f.result(5) for f in futures] == ["reply to b", "reply to c", "reply to d"]
+    assert backend.batches == [["a"], ["b", "c", "d"]]
+    assert scheduler.stats()["batch_size_counts"] == {1: 1, 3: 1}
+    scheduler.shutdown()
+
+
+def test_batches_stay_within_max_batch_size(backend):
+    scheduler = BatchScheduler(backend, max_batch_size=2, max_wait_ms=1)
+    scheduler.submit("a")
+    assert backend.started.wait(5)
+    futures = [scheduler.submit(m) for m in "bcde"]
+    backend.release.set()
+
+    assert [f.result(5) for f in futures] == [f"reply to {m}" for m in "bcde"]
+    assert backend.batches[1:] == [["b", "c"], ["d", "e"]]
+    scheduler.shutdown()
+
+
+def test_cancelled_request_is_left_out_of_the_batch(backend):
+    scheduler = BatchScheduler(backend, max_batch_size=8, max_wait_ms=1)
+    scheduler.submit("a")
+    assert backend.started.wait(5)
+    gone = scheduler.submit("b")
+    kept = scheduler.submit("c")
+    assert gone.cancel()
+    backend.release.set()
+
+    assert kept.result(5) == "reply to c"
+    assert backend.batches[1] == ["c"]
+    with pytest.raises(CancelledError):
+        gone.result(0)
+    scheduler.shutdown()
+
+
+def test_failed_batch_fails_every_future():
+    def explode(items):
+        raise RuntimeError("out of memory")
+
+    backend = _Backend(results=explode)
+    backend.release.set()
+    scheduler = BatchScheduler(backend, max_batch_size=8, max_wait_ms=50)
+    futures = [scheduler.submit(m) for m in "ab"]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            future.result(5)
+    assert scheduler.stats()["failed_batches"] == 1
+    scheduler.shutdown()
+
+
+def test_short_result_list_fails_every_future_of_the_batch():
+    backend = _Backend(results=lambda items: ["only one"])
+    scheduler = BatchScheduler(backend, max_batch_size=8, max_wait_ms=1)
+    first = scheduler.submit("a")
+    assert backend.started.wait(5)
+    futures = [scheduler.submit(m) for m in "bc"]
+    backend.release.set()
+
+    assert first.result(5) == "only one"
+    for future in futures:
+        with pytest.raises(RuntimeError, match="1 results for 2 requests"):
+            future.result(5)
+    scheduler.shutdown()
+
+
+def test_shutdown_fails_requests_still_queued(backend):
+    scheduler = BatchScheduler(backend, max_batch_size=1, max_wait_ms=1)
+    scheduler.submit("a")
+    assert backend.started.wait(5)
+    queued = scheduler.submit("b")
+    scheduler._stopping.set()  # Before the worker comes back for "b"
+    backend.release.set()
+    scheduler.shutdown()
+
+    with pytest.raises(RuntimeError, match="shut down"):
+        queued.result(1)
+    with pytest.raises(RuntimeError, match="shut down"):
+        scheduler.submit("c")
+
+
+def test_greedy_rows_keep_only_their_argmax():
+    torch = pytest.importorskip("torch")
+    scores = torch.tensor([[0.1, 0.9, 0.3], [0.5, 0.2, 0.4]])
+    masked = GreedyRowsLogitsProcessor([1])(None, scores.clone())
+
+    assert torch.equal(masked[0], scores[0])  # Sampled row untouched
+    assert masked[1, 0] == 0.5
+    assert torch.isinf(masked[1, 1:]).all()
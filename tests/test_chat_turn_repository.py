@@ -0,0 +1,115 @@
+"""
+ChatTurnRepository against the in-memory Firestore (fake_firestore.py): the
+RPC budget of a turn, and how a commit that collides with a concurrent turn
+for the same session is reloaded and retried.
+"""
+import pytest
+from google.api_core import exceptions as gcp_exceptions
+
+import fake_firestore
+import firestore_db
+import session_cache
+from firestore_db import ChatTurnRepository
+
+
+def turn(i):
+    return [{'role': 'user', 'content': f"user {i}"}, {'role': 'assistant', 'content': f"bot {i}"}]
+
+
+def stored_messages(db, session_id):
+    return firestore_db.get_chat_history(db.collection('users').document(session_id))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(firestore_db, "HISTORY_LAYOUT", "messages")
+    monkeypatch.setattr(firestore_db, "sessions", None)
+    return fake_firestore.FakeClient()
+
+
+def test_new_user_turn_is_one_get_one_commit(db):
+    repo = ChatTurnRepository(db, "alice")
+    assert repo.load() == []
+    repo.commit(turn(0), "calm")
+
+    assert repo.rpc_log == ['get', 'commit']
+    assert stored_messages(db, "alice") == turn(0)
+    data = db.collection('users').document("alice").get().to_dict()
+    assert data['message_count'] == 2
+    assert data['days_active'] == 1
+
+
+def test_existing_user_turn_is_get_query_commit(db):
+    ChatTurnRepository(db, "alice").commit(turn(0), "calm")
+
+    repo = ChatTurnRepository(db, "alice")
+    assert repo.load() == turn(0)
+    repo.commit(turn(1), "sad")
+
+    assert repo.rpc_log == ['get', 'query', 'commit']
+    assert stored_messages(db, "alice") == turn(0) + turn(1)
+
+
+def test_concurrent_turn_is_reloaded_and_retried(db):
+    ChatTurnRepository(db, "alice").commit(turn(0), "calm")
+    first, second = ChatTurnRepository(db, "alice"), ChatTurnRepository(db, "alice")
+    first.load()
+    second.load()
+
+    first.commit(turn(1), "calm")
+    # second still holds message_count 2, so its create() of seq 2 collides
+    second.commit(turn(2), "calm")
+
+    assert second.rpc_log == ['get', 'query', 'commit', 'get', 'query', 'commit']
+    assert stored_messages(db, "alice") == turn(0) + turn(1) + turn(2)
+    data = db.collection('users').document("alice").get().to_dict()
+    assert data['message_count'] == 6
+
+
+def test_second_conflict_is_raised_and_drops_the_cached_session(db, monkeypatch):
+    cache = session_cache.SessionCache(max_mb=1, ttl=60)
+    monkeypatch.setattr(firestore_db, "sessions", cache)
+    ChatTurnRepository(db, "alice").commit(turn(0), "calm")
+    stale = ChatTurnRepository(db, "alice")
+    stale.load(refresh=True)
+    ChatTurnRepository(db, "alice").commit(turn(1), "calm")
+    assert cache.get("alice", 0) is not None
+
+    # A reload that keeps returning the old snapshot makes the retry collide too
+    snapshot = (dict(stale.data), list(stale.history))
+    def reload(refresh=False):
+        stale.data, stale.history = dict(snapshot[0]), list(snapshot[1])
+    monkeypatch.setattr(stale, "load", reload)
+
+    with pytest.raises(gcp_exceptions.AlreadyExists):
+        stale.commit(turn(2), "calm")
+    assert cache.get("alice", 0) is None
+    assert stored_messages(db, "alice") == turn(0) + turn(1)
+
+
+def test_cached_follow_up_turn_costs_one_commit(db, monkeypatch):
+    monkeypatch.setattr(firestore_db, "sessions", session_cache.SessionCache(max_mb=1, ttl=60))
+    ChatTurnRepository(db, "alice").commit(turn(0), "calm")
+
+    repo = ChatTurnRepository(db, "alice")
+    assert repo.load() == turn(0)
+    repo.commit(turn(1), "calm")
+
+    assert repo.rpc_log == ['commit']
+    assert stored_messages(db, "alice") == turn(0) + turn(1)
+
+
+@pytest.mark.parametrize("layout", ["array", "packed"])
+def test_overlapping_turns_keep_every_message_in_the_document_layouts(db, monkeypatch, layout):
+    monkeypatch.setattr(firestore_db, "HISTORY_LAYOUT", layout)
+    ChatTurnRepository(db, "alice").commit(turn(0), "calm")
+    first, second = ChatTurnRepository(db, "alice"), ChatTurnRepository(db, "alice")
+    first.load()
+    second.load()
+
+    first.commit(turn(1), "calm")
+    # second's snapshot predates turn 1, so rewriting the history from it fails the precondition
+    second.commit(turn(2), "calm")
+
+    assert second.rpc_log == ['get', 'commit', 'get', 'commit']
+    assert stored_messages(db, "alice") == turn(0) + turn(1) + turn(2)
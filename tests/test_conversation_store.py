@@ -0,0 +1,151 @@
+"""
+ConversationStore: a message_id is answered once however often it is sent,
+history_version mismatches ask the client to resend its history, and sessions
+are dropped when idle or least recently used.
+"""
+import time
+import threading
+
+import pytest
+
+from conversation_store import ConversationStore
+
+
+def reply(text):
+    return {'response': text}
+
+
+def test_first_message_starts_an_empty_session():
+    store = ConversationStore()
+    turn = store.begin("alice", "m1", None)
+    assert turn.history == [] and turn.version == 0
+    assert store.finish(turn, "hi", reply("hello")) == 1
+
+    turn = store.begin("alice", "m2", 1)
+    assert turn.history == [{'user': "hi", 'bot': "hello"}]
+    assert turn.version == 1
+
+
+def test_retried_message_gets_the_stored_reply():
+    store = ConversationStore()
+    turn = store.begin("alice", "m1", None)
+    answer = reply("hello")
+    store.finish(turn, "hi", answer)
+
+    # The retry still carries the version it had before the first reply
+    again = store.begin("alice", "m1", None)
+    assert again.replay is answer
+    assert again.replay['history_version'] == 1
+    assert store.stats()["replays"] == 1
+    assert store.stats()["turns"] == 1
+
+
+def test_duplicate_waits_for_the_original_reply():
+    store = ConversationStore()
+    turn = store.begin("alice", "m1", None)
+
+    results = []
+    duplicate = threading.Thread(target=lambda: results.append(store.begin("alice", "m1", None)))
+    duplicate.start()
+    time.sleep(0.05)
+    assert results == []  # Still waiting
+
+    store.finish(turn, "hi", reply("hello"))
+    duplicate.join(timeout=5)
+    assert results[0].replay == {'response': "hello", 'history_version': 1}
+
+
+def test_duplicate_is_busy_once_the_wait_runs_out():
+    store = ConversationStore(wait_seconds=0.05)
+    store.begin("alice", "m1", None)
+    turn = store.begin("alice", "m1", None)
+    assert turn.busy and turn.history is None
+
+
+def test_aborted_turn_lets_the_waiting_duplicate_run_it():
+    store = ConversationStore()
+    turn = store.begin("alice", "m1", None)
+
+    results = []
+    duplicate = threading.Thread(target=lambda: results.append(store.begin("alice", "m1", 0)))
+    duplicate.start()
+    time.sleep(0.05)
+    store.abort(turn)
+    duplicate.join(timeout=5)
+
+    assert results[0].history == [] and results[0].replay is None
+    # abort() after finish() leaves the stored reply alone
+    store.finish(results[0], "hi", reply("hello"))
+    store.abort(results[0])
+    assert store.begin("alice", "m1", 0).replay['response'] == "hello"
+
+
+def test_stale_version_is_a_conflict():
+    store = ConversationStore()
+    store.finish(store.begin("alice", "m1", None), "hi", reply("hello"))
+
+    turn = store.begin("alice", "m2", 0)
+    assert turn.conflict and turn.version == 1
+    assert store.stats()["conflicts"] == 1
+
+
+def test_unknown_session_with_a_version_is_a_conflict():
+    # The server restarted, or another worker holds the session
+    store = ConversationStore()
+    turn = store.begin("alice", "m1", 4)
+    assert turn.conflict and turn.version is None
+
+
+def test_resent_history_reseeds_the_session():
+    store = ConversationStore(history_turns=2)
+    history = [{'user': f"u{i}", 'bot': f"b{i}"} for i in range(3)] + ["not a turn"]
+    turn = store.begin("alice", "m1", 4, history=history)
+    assert not turn.conflict
+    assert turn.history == history[1:3]
+    assert store.finish(turn, "u3", reply("b3")) == 5
+    assert store.stats()["resyncs"] == 1
+
+    assert store.begin("alice", "m2", 5).history == [{'user': "u2", 'bot': "b2"}, {'user': "u3", 'bot': "b3"}]
+
+
+def test_history_and_replies_are_bounded():
+    store = ConversationStore(history_turns=2, keys_per_session=2)
+    version = None
+    for i in range(4):
+        turn = store.begin("alice", f"m{i}", version)
+        version = store.finish(turn, f"u{i}", reply(f"b{i}"))
+
+    assert store.begin("alice", "m3", version).replay['response'] == "b3"
+    # m0 has been forgotten, so it runs as a new turn
+    turn = store.begin("alice", "m0", version)
+    assert turn.replay is None
+    assert [exchange['user'] for exchange in turn.history] == ["u2", "u3"]
+
+
+def test_idle_sessions_expire():
+    store = ConversationStore(ttl=0.05)
+    store.finish(store.begin("alice", "m1", None), "hi", reply("hello"))
+    time.sleep(0.1)
+    assert store.begin("alice", "m2", 1).conflict
+    assert store.stats()["sessions"] == 0
+
+
+def test_least_recently_used_session_is_dropped():
+    store = ConversationStore(max_sessions=2)
+    for session_id in ("alice", "bob"):
+        store.finish(store.begin(session_id, "m1", None), "hi", reply("hello"))
+    store.begin("alice", "m2", 1)  # alice is now the most recent
+    store.finish(store.begin("carol", "m1", None), "hi", reply("hello"))
+
+    assert store.stats()["sessions"] == 2
+    assert store.begin("bob", "m2", 1).conflict
+    assert not store.begin("alice", "m3", 1).conflict
+
+
+@pytest.mark.parametrize("message_id", [None, ""])
+def test_messages_without_an_id_are_not_deduplicated(message_id):
+    store = ConversationStore()
+    first = store.begin("alice", message_id, None)
+    store.finish(first, "hi", reply("hello"))
+    second = store.begin("alice", message_id, 1)
+    assert second.replay is None and second.history is not None
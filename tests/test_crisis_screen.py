@@ -0,0 +1,36 @@
+"""
+CrisisMatcher: phrasings that must reach the safety response, including word
+endings on stems and the curly apostrophes phone keyboards send.
+"""
+import pytest
+
+from crisis_screen import CrisisMatcher
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return CrisisMatcher()
+
+
+@pytest.mark.parametrize("text", [
+    "I overdosed last year",
+    "I keep self-harming",
+    "self harming is the only thing that helps",
+    "I can’t go on",
+    "I don’t want to live",
+    "I just want to disappear",
+    "I've been thinking about ending things",
+    "I want to sleep forever",
+    "I wish I could disappear",
+])
+def test_high_risk_phrasings_match(matcher, text):
+    assert matcher.match(text) is not None
+
+
+@pytest.mark.parametrize("text", [
+    "This exam is killing me, I've been revising all day",
+    "I'm dying to go on holiday",
+    "calm down, it's fine",
+])
+def test_ordinary_messages_do_not_match(matcher, text):
+    assert matcher.match(text) is None
@@ -0,0 +1,96 @@
+"""
+history_codec: round trips, appending to the last block, decoding a range
+without inflating the other blocks, and documents still on the legacy
+`chat_history` array.
+"""
+import pytest
+
+import history_codec
+
+
+def conversation(n):
+    return [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': f"message {i} " + "ünïcødé 🙂 " * (i % 5)}
+        for i in range(n)
+    ]
+
+
+CODECS = ["none", "zlib"] + (["zstd"] if history_codec.ZSTD_AVAILABLE else [])
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip(codec):
+    messages = conversation(150) + [
+        {'role': 'user', 'content': ""},
+        {'role': 'tool', 'content': "unknown role"},
+        {'role': 'user', 'content': "extra keys", 'seq': 7},
+        {'role': 'assistant', 'content': ["not", "text"]},
+    ]
+    blob = history_codec.encode(messages, codec, block_messages=16)
+    assert history_codec.decode(blob) == messages
+    assert history_codec.count(blob) == len(messages)
+
+
+def test_append_re_encodes_only_the_last_block():
+    messages = conversation(10)
+    blob = history_codec.encode(messages[:6], "zlib", block_messages=4)
+    appended = history_codec.append(blob, messages[6:], "zlib", block_messages=4)
+
+    assert appended == history_codec.encode(messages, "zlib", block_messages=4)
+    # The full first block is carried over byte for byte
+    _, _, start, end = history_codec._index(blob)[0]
+    _, _, new_start, new_end = history_codec._index(appended)[0]
+    assert bytes(appended[new_start:new_end]) == bytes(blob[start:end])
+
+
+def test_append_to_nothing_encodes():
+    assert history_codec.decode(history_codec.append(b"", conversation(3))) == conversation(3)
+
+
+@pytest.mark.parametrize("start, end", [(0, None), (0, 1), (3, 9), (4, 8), (7, 8), (11, None), (12, None), (5, 100)])
+def test_decode_range_matches_slicing(start, end):
+    messages = conversation(12)
+    blob = history_codec.encode(messages, "zlib", block_messages=4)
+    assert history_codec.decode_range(blob, start, end) == messages[start:end]
+
+
+def test_tail_inflates_only_the_blocks_it_needs(monkeypatch):
+    blob = history_codec.encode(conversation(40), "zlib", block_messages=8)
+    inflated = []
+    unpack = history_codec._unpack_block
+
+    def counting_unpack(method, count, payload):
+        inflated.append(count)
+        return unpack(method, count, payload)
+    monkeypatch.setattr(history_codec, "_unpack_block", counting_unpack)
+
+    assert history_codec.tail(blob, 10) == (conversation(40)[-10:], 40)
+    assert len(inflated) == 2
+    inflated.clear()
+    assert history_codec.count(blob) == 40
+    assert inflated == []
+
+
+def test_damaged_blobs_are_rejected():
+    blob = history_codec.encode(conversation(5), "zlib")
+    with pytest.raises(ValueError):
+        history_codec.decode(blob[:-3])
+    with pytest.raises(ValueError):
+        history_codec.decode(b"not a history")
+
+
+def test_legacy_array_is_read_through_the_same_helpers():
+    legacy = {'chat_history': conversation(7)}
+    assert history_codec.stored_count(legacy) == 7
+    assert history_codec.stored_history(legacy, 2, 5) == conversation(7)[2:5]
+    assert history_codec.stored_tail(legacy, 3) == (conversation(7)[-3:], 7)
+    assert history_codec.stored_tail({}, 3) == ([], 0)
+
+
+def test_packed_field_wins_over_the_legacy_array():
+    data = {
+        'chat_history': conversation(2),
+        history_codec.PACKED_FIELD: history_codec.encode(conversation(5)),
+    }
+    assert history_codec.stored_count(data) == 5
+    assert history_codec.stored_tail(data, 2) == (conversation(5)[-2:], 5)
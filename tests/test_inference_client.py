@@ -0,0 +1,183 @@
+"""
+InferenceClient against a scripted HTTP server on localhost: which responses
+and errors are retried and for how long, the circuit breaker, and the stage
+deadline set by run_with_deadline.
+"""
+import json
+import time
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+import inference_client
+from inference_client import CircuitBreaker, CircuitOpenError, InferenceClient, run_with_deadline
+
+OK = (200, {}, {"choices": [{"message": {"content": "hi"}}]}, 0)
+
+
+class ScriptedServer(ThreadingHTTPServer):
+    """ Answers each POST with the next (status, headers, body, delay) of `script`, then with OK. """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.script = []
+        self.requests = 0
+        self.url = f"http://127.0.0.1:{self.server_port}/models/test"
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests += 1
+        status, headers, body, delay = self.server.script.pop(0) if self.server.script else OK
+        time.sleep(delay)
+        data = json.dumps(body).encode("utf-8")
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except OSError:
+            pass  # The client timed out and hung up
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ScriptedServer()
+    threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True).start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def client(**kwargs):
+    kwargs.setdefault("backoff_base", 0.001)
+    kwargs.setdefault("breaker", CircuitBreaker(threshold=3, cooldown=60))
+    return InferenceClient(pool_size=2, **kwargs)
+
+
+def test_429_is_retried_after_retry_after(server):
+    server.script = [(429, {"Retry-After": "0.3"}, {}, 0)]
+    started = time.monotonic()
+    assert client().post_json(server.url, {})["choices"]
+    assert time.monotonic() - started >= 0.3
+    assert server.requests == 2
+
+
+def test_503_from_a_loading_model_waits_its_estimated_time(server):
+    server.script = [(503, {}, {"error": "loading", "estimated_time": 0.3}, 0)] * 2
+    started = time.monotonic()
+    assert client().post(server.url, {}).status_code == 200
+    assert time.monotonic() - started >= 0.6
+    assert server.requests == 3
+
+
+def test_retries_stop_at_max_retries(server):
+    server.script = [(503, {}, {}, 0)] * 5
+    response = client(max_retries=2).post(server.url, {})
+    assert response.status_code == 503
+    assert server.requests == 3
+
+
+def test_read_timeout_is_not_retried(server):
+    server.script = [(200, {}, {}, 1.0)]
+    api = client()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        api.post(server.url, {}, timeout=0.2)
+    assert server.requests == 1
+    assert api.breaker.failures == 1
+
+
+def test_connection_errors_are_retried_then_counted_once(server):
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    api = client(max_retries=2)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        api.post(url, {})
+    assert api.breaker.failures == 1
+
+
+def test_breaker_opens_after_threshold_failures(server):
+    server.script = [(500, {}, {}, 0)] * 2
+    api = client(breaker=CircuitBreaker(threshold=2, cooldown=60))
+    for _ in range(2):
+        assert api.post(server.url, {}).status_code == 500
+    assert api.breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        api.post(server.url, {})
+    assert server.requests == 2
+
+
+def test_half_open_breaker_lets_one_probe_through(server):
+    server.script = [(500, {}, {}, 0)] * 3
+    api = client(breaker=CircuitBreaker(threshold=2, cooldown=0.2))
+    for _ in range(2):
+        api.post(server.url, {})
+    time.sleep(0.25)
+    assert api.breaker.state == "half_open"
+
+    # A failed probe re-opens the circuit for another cooldown...
+    assert api.post(server.url, {}).status_code == 500
+    assert api.breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        api.post(server.url, {})
+
+    # ...and a successful one closes it
+    time.sleep(0.25)
+    assert api.post(server.url, {}).status_code == 200
+    assert api.breaker.state == "closed"
+    assert server.requests == 4
+
+
+def test_deadline_skips_a_backoff_it_cannot_wait_out(server):
+    server.script = [(503, {"Retry-After": "5"}, {}, 0)]
+    started = time.monotonic()
+    response = run_with_deadline(time.monotonic() + 1, client().post, server.url, {})
+    assert response.status_code == 503
+    assert time.monotonic() - started < 1
+    assert server.requests == 1
+
+
+def test_deadline_cuts_the_attempt_timeout(server):
+    server.script = [(200, {}, {}, 2.0)]
+    started = time.monotonic()
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        run_with_deadline(time.monotonic() + 0.3, client().post, server.url, {}, timeout=30)
+    assert time.monotonic() - started < 1.5
+
+
+def test_passed_deadline_sends_nothing(server):
+    with pytest.raises(requests.exceptions.Timeout):
+        run_with_deadline(time.monotonic() - 1, client().post, server.url, {})
+    assert server.requests == 0
+
+
+def test_async_client_follows_the_same_deadline(server):
+    pytest.importorskip("aiohttp")
+    server.script = [(503, {}, {}, 0), (503, {"Retry-After": "5"}, {}, 0)]
+
+    async def post():
+        api = inference_client.AsyncInferenceClient(backoff_base=0.001, breaker=CircuitBreaker(threshold=3))
+        try:
+            return await inference_client.run_with_deadline_async(time.monotonic() + 1, api.post(server.url, {}))
+        finally:
+            await api.close()
+
+    started = time.monotonic()
+    assert asyncio.run(post()).status_code == 503
+    assert time.monotonic() - started < 1
+    assert server.requests == 2
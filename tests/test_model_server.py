@@ -0,0 +1,163 @@
+"""
+The model server with a fake backend: the fair queue takes turns between
+workers and refuses prompts past a worker's limit, a full queue reaches the
+client as ModelServerBusy, a prompt cancelled while queued never reaches the
+model, and a lost connection fails only the requests that were sent on it.
+"""
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from model_server import FairQueue, ModelServer, ModelServerBusy, ModelServerClient, ModelServerError
+
+
+class _Models:
+    state = "ready"
+
+    def ensure_loaded(self, timeout=None):
+        return True
+
+    def stats(self):
+        return {"state": self.state}
+
+
+class _Backend:
+    """ local_model stand-in: records prompts and holds each completion until `release` is set. """
+
+    def __init__(self):
+        self.models = _Models()
+        self.scheduler = None
+        self.seen = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def complete(self, kind, messages, session_id=None):
+        self.seen.append(messages)
+        self.started.set()
+        self.release.wait(5)
+        return f"reply to {messages}"
+
+    def complete_stream(self, messages, session_id=None, cancelled=None):
+        self.seen.append(messages)
+        yield from messages.split()
+
+
+@pytest.fixture
+def backend():
+    return _Backend()
+
+
+@pytest.fixture
+def serve(backend):
+    """ Starts a server on a fresh socket (AF_UNIX paths must stay short) and returns a client for it. """
+    directory = tempfile.mkdtemp(prefix="serenity-")
+    servers = []
+
+    def start(**limits):
+        server = ModelServer(f"{directory}/model.sock", backend, **limits)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server, ModelServerClient(server.path, connect_timeout=5)
+
+    yield start
+    backend.release.set()
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        time.sleep(0.005)
+
+
+def test_fair_queue_takes_turns_between_workers():
+    fair = FairQueue(max_pending=8)
+    for job in ("a1", "a2", "a3"):
+        fair.put("a", job)
+    fair.put("b", "b1")
+    assert [fair.get(0) for _ in range(4)] == ["a1", "b1", "a2", "a3"]
+    assert fair.get(0) is None
+
+
+def test_fair_queue_refuses_past_a_workers_limit():
+    fair = FairQueue(max_pending=2)
+    fair.put("a", "a1")
+    fair.put("a", "a2")
+    with pytest.raises(ModelServerBusy):
+        fair.put("a", "a3")
+    fair.put("b", "b1")  # Other workers are unaffected
+    assert fair.depths() == {"a": 2, "b": 1}
+
+
+def test_fair_queue_remove_only_takes_queued_jobs():
+    fair = FairQueue()
+    fair.put("a", "a1")
+    fair.put("a", "a2")
+    assert fair.get(0) == "a1"
+    assert not fair.remove("a", "a1")
+    assert fair.remove("a", "a2")
+    assert fair.depths() == {}
+
+
+def test_completion_and_stream_round_trip(serve, backend):
+    backend.release.set()
+    _, client = serve()
+    assert client.complete("conversation", "hello there", timeout=5) == "reply to hello there"
+    assert list(client.stream("one two three", timeout=5)) == ["one", "two", "three"]
+
+
+def test_full_queue_reaches_the_client_as_busy(serve, backend):
+    server, client = serve(max_pending=1, max_in_flight=1)
+    running = client.submit("a")
+    assert backend.started.wait(5)
+    queued = client.submit("b")
+    wait_for(lambda: server.queue.depths())
+    with pytest.raises(ModelServerBusy):
+        client.submit("c").result(5)
+
+    backend.release.set()
+    assert running.result(5) == "reply to a"
+    assert queued.result(5) == "reply to b"
+    assert server.stats()["server"]["rejected"] == 1
+
+
+def test_prompt_cancelled_while_queued_never_reaches_the_model(serve, backend):
+    server, client = serve(max_in_flight=1)
+    running = client.submit("a")
+    assert backend.started.wait(5)
+    queued = client.submit("b")
+    wait_for(lambda: server.queue.depths())
+    assert queued.cancel()
+    wait_for(lambda: server.stats()["server"]["cancelled"] == 1)
+
+    backend.release.set()
+    assert running.result(5) == "reply to a"
+    assert client.complete("conversation", "c", timeout=5) == "reply to c"
+    assert backend.seen == ["a", "c"]
+
+
+def test_lost_connection_fails_only_its_own_requests():
+    client = ModelServerClient("unused")
+    old, old_peer = socket.socketpair()
+    new, new_peer = socket.socketpair()
+    on_old, on_new = Future(), Future()
+    client._pending = {1: (old, on_old), 2: (new, on_new)}
+
+    old_peer.close()
+    client._read(old)  # Returns once it sees the connection close
+
+    with pytest.raises(ModelServerError):
+        on_old.result(0)
+    assert not on_new.done()
+    assert client._pending == {2: (new, on_new)}
+    new.close()
+    new_peer.close()
@@ -0,0 +1,112 @@
+"""
+The tiered mood classifier: distress phrasings the keyword tier must catch,
+ambiguous words it must not misread, which messages it settles on its own and
+which still go to the LLM.
+"""
+import pytest
+
+import mood_classifier
+from mood_classifier import DISTRESS, KeywordTier, Prediction, TieredClassifier
+
+
+@pytest.fixture(scope="module")
+def keywords():
+    return KeywordTier()
+
+
+@pytest.mark.parametrize("text", [
+    "I feel hopeless and want to sleep forever",
+    "I feel hopeless but I want to disappear",
+    "thinking about ending things, so sad",
+    "I overdosed last year and I might again",
+    "self-harming is the only thing that helps",
+    "I keep self harming",
+    "I can’t go on",
+    "I don’t want to live anymore",
+])
+def test_distress_phrasings_are_caught(keywords, text):
+    prediction = keywords.predict(text)
+    assert prediction is not None and prediction.tag == DISTRESS
+
+
+@pytest.mark.parametrize("text", ["calm down", "I am down to meet up", "a low opinion", "hi there"])
+def test_ambiguous_words_are_not_matched(keywords, text):
+    assert keywords.predict(text) is None
+
+
+def test_one_keyword_stays_below_the_threshold(keywords):
+    prediction = keywords.predict("I am sad")
+    assert prediction.tag == "sad"
+    assert prediction.confidence < mood_classifier.MOOD_CONFIDENCE_THRESHOLD
+
+
+class _Tier:
+    """ A local tier that always gives the same answer. """
+
+    def __init__(self, prediction, decides=None):
+        self.name = prediction.tier
+        self.decides = decides
+        self.prediction = prediction
+
+    def predict(self, text):
+        return self.prediction
+
+
+def classifier(*tiers, llm_tag="anxious"):
+    asked = []
+
+    def llm_fn(user_input, history):
+        asked.append(user_input)
+        return llm_tag
+    return TieredClassifier(list(tiers), llm_fn), asked
+
+
+@pytest.mark.parametrize("text, tag", [
+    ("hey, how are you", "neutral"),
+    ("I'm so stressed and worried about tomorrow", "anxious"),
+    ("feeling lonely and miserable", "sad"),
+])
+def test_clear_keyword_answer_skips_the_llm(text, tag):
+    cascade, asked = classifier(KeywordTier())
+    assert cascade.classify(text) == tag
+    assert asked == []
+
+
+@pytest.mark.parametrize("text", [
+    "I'm so sad",
+    "I'm sad but also excited",
+    "I'm not happy, just feeling empty and lonely",
+])
+def test_unclear_keyword_answer_goes_to_the_llm(text):
+    cascade, asked = classifier(KeywordTier())
+    assert cascade.classify(text) == "anxious"
+    assert asked == [text]
+
+
+def test_keyword_distress_skips_the_llm():
+    cascade, asked = classifier(KeywordTier())
+    assert cascade.classify("I want to disappear") == DISTRESS
+    assert asked == []
+
+
+def test_keyword_guess_is_the_fallback_when_the_llm_fails():
+    cascade, _ = classifier(KeywordTier(), llm_tag=None)
+    assert cascade.classify("I'm so sad") == "sad"
+
+
+def test_confident_linear_tier_decides_any_tag():
+    cascade, asked = classifier(KeywordTier(), _Tier(Prediction("happy", 0.9, "linear")))
+    assert cascade.classify("what a day") == "happy"
+    assert asked == []
+
+
+def test_later_tier_cannot_downgrade_distress():
+    cascade, _ = classifier(KeywordTier(), _Tier(Prediction("sad", 0.99, "linear")))
+    assert cascade.classify("thinking about ending things, so sad") == DISTRESS
+
+
+@pytest.mark.parametrize("confidence", [0.3, 0.95])
+def test_linear_distress_is_final_at_any_confidence(confidence):
+    cascade, asked = classifier(_Tier(Prediction(DISTRESS, confidence, "linear")))
+    assert cascade.classify("rough week at work") == DISTRESS
+    assert asked == []
@@ -0,0 +1,82 @@
+"""
+Mood counters and the streak against the in-memory Firestore: the streak is
+counted from the monthly mood_stats buckets, and the backfill rebuilds the
+counters from mood_logs in one transaction.
+"""
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+import fake_firestore
+import firestore_db
+from firestore_db import ChatTurnRepository
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(firestore_db, "HISTORY_LAYOUT", "messages")
+    monkeypatch.setattr(firestore_db, "sessions", None)
+    return fake_firestore.FakeClient()
+
+
+def log_days(user_ref, days):
+    for day in days:
+        user_ref.collection('mood_stats').document(day.strftime('%Y-%m')).set(
+            {'month': day.strftime('%Y-%m'), 'days': {day.strftime('%d'): {'sad': 1}}}, merge=True)
+
+
+def test_streak_is_counted_from_the_buckets_across_months(db):
+    user_ref = db.collection('users').document("alice")
+    today = date(2024, 3, 2)
+    log_days(user_ref, [today - timedelta(days=n) for n in range(4)] + [today - timedelta(days=6)])
+
+    assert firestore_db.get_mood_streak(user_ref, today=today) == 4
+    # No log yet today: the run up to yesterday still counts
+    assert firestore_db.get_mood_streak(user_ref, today=today + timedelta(days=1)) == 4
+    assert firestore_db.get_mood_streak(user_ref, today=today + timedelta(days=2)) == 0
+
+
+def test_broken_streak_costs_no_read(db):
+    user_ref = db.collection('users').document("alice")
+    db.reset_rpc_counts()
+    assert firestore_db.get_mood_streak(user_ref, {'mood_last_day': '2024-01-01'}, date(2024, 3, 2)) == 0
+    assert db.rpc_counts == {}
+
+
+def test_overlapping_turns_from_stale_snapshots_keep_counters_and_streak(db):
+    first, second = ChatTurnRepository(db, "alice"), ChatTurnRepository(db, "alice")
+    first.load()
+    first.commit([{'role': 'user', 'content': "hi"}], "sad")
+    second.load()
+    first.commit([{'role': 'user', 'content': "again"}], "sad")
+    # `second` still holds the snapshot from before the second mood log (no messages, so no seq conflict)
+    second.commit([], "anxious")
+
+    user_ref = db.collection('users').document("alice")
+    data = user_ref.get().to_dict()
+    assert data['mood_total'] == 3
+    assert data['mood_counts'] == {'sad': 2, 'anxious': 1}
+    assert 'mood_streak' not in data
+    assert firestore_db.get_mood_streak(user_ref, data) == 1
+
+
+def test_backfill_rebuilds_counters_from_mood_logs(db):
+    user_ref = db.collection('users').document("alice")
+    user_ref.set({'name': "Alice", 'mood_streak': 9, 'mood_total': 0})
+    for day, mood in ((1, 'sad'), (2, 'sad'), (2, 'anxious'), (3, 'neutral')):
+        user_ref.collection('mood_logs').document().set(
+            {'mood': mood, 'timestamp': datetime(2024, 2, day, 12, tzinfo=timezone.utc)})
+
+    assert firestore_db.backfill_mood_stats(user_ref) == 3
+    data = user_ref.get().to_dict()
+    assert data['mood_counts'] == {'sad': 2, 'anxious': 1}
+    assert data['mood_last_day'] == '2024-02-02'
+    assert 'mood_streak' not in data
+    assert firestore_db.get_mood_streak(user_ref, data, date(2024, 2, 2)) == 2
+
+
+def test_transaction_get_rejects_a_collection_reference(db):
+    transaction = db.transaction()
+    with pytest.raises(ValueError):
+        transaction.get(db.collection('users'))
+    assert list(transaction.get(db.collection('users').order_by('name'))) == []
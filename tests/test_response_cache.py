@@ -0,0 +1,75 @@
+"""
+ResponseCache over both backends: keys ignore case, spacing and punctuation,
+entries expire after their TTL, the least recently used entry is evicted
+first, the SQLite file is shared between instances, and a failing backend
+only turns lookups into misses.
+"""
+import time
+
+import pytest
+
+from response_cache import MemoryBackend, ResponseCache, SQLiteBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend(max_entries=2)
+    sqlite = SQLiteBackend(str(tmp_path / "cache.sqlite3"), max_entries=2)
+    sqlite.EVICT_EVERY = 1
+    return sqlite
+
+
+def test_classification_key_ignores_case_spacing_and_punctuation():
+    cache = ResponseCache(MemoryBackend())
+    history = [{"role": "user", "content": "Hello"}]
+    assert cache.classification_key("Hi  there!", history) == cache.classification_key("hi there", history)
+    assert cache.classification_key("hi there", history) != cache.classification_key("hi there", [])
+
+
+def test_hit_miss_and_expiry(backend):
+    cache = ResponseCache(backend, ttl=0.05)
+    assert cache.get("k") is None
+    cache.set("k", "anxious")
+    assert cache.get("k") == "anxious"
+    time.sleep(0.1)
+    assert cache.get("k") is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["sets"]) == (1, 2, 1)
+
+
+def test_least_recently_used_entry_is_evicted(backend):
+    cache = ResponseCache(backend)
+    cache.set("a", 1)
+    time.sleep(0.01)
+    cache.set("b", 2)
+    time.sleep(0.01)
+    assert cache.get("a") == 1  # "b" is now the least recently used
+    time.sleep(0.01)
+    cache.set("c", 3)
+    assert [cache.get(k) for k in "abc"] == [1, None, 3]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_sqlite_entries_are_shared_through_the_file(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    ResponseCache(SQLiteBackend(path)).set("k", {"tag": "sad"})
+    assert ResponseCache(SQLiteBackend(path)).get("k") == {"tag": "sad"}
+
+
+def test_failing_backend_misses_instead_of_raising():
+    class Broken:
+        def get(self, key):
+            raise OSError("cache server down")
+
+        def set(self, key, value, expires_at):
+            raise OSError("cache server down")
+
+        def size(self):
+            raise OSError("cache server down")
+
+    cache = ResponseCache(Broken())
+    cache.set("k", "v")
+    assert cache.get("k") is None
+    stats = cache.stats()
+    assert stats["errors"] == 2 and stats["entries"] is None and stats["sets"] == 0
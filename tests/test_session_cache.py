@@ -0,0 +1,76 @@
+"""
+SessionCache eviction: least recently used entries past the byte budget, and
+entries past their TTL.
+"""
+import session_cache
+from session_cache import SessionCache
+
+
+def history(n, size=10):
+    return [{'role': 'user', 'content': "x" * size} for _ in range(n)]
+
+
+def test_get_returns_copies_and_the_requested_tail():
+    cache = SessionCache(max_mb=1, ttl=60)
+    cache.put("a", {'message_count': 5}, history(5), 5)
+
+    data, tail, total = cache.get("a", 2)
+    assert (len(tail), total) == (2, 5)
+    tail.append({'role': 'assistant', 'content': "added"})
+    data['message_count'] = 99
+    assert cache.get("a", 0) == ({'message_count': 5}, history(5), 5)
+
+
+def test_get_misses_when_the_tail_is_too_short():
+    cache = SessionCache(max_mb=1, ttl=60)
+    cache.put("a", {}, history(3), 10)
+    assert cache.get("a", 5) is None
+    # The whole conversation is cached, so any limit is served
+    cache.put("b", {}, history(3), 3)
+    assert cache.get("b", 5) is not None
+
+
+def test_least_recently_used_entry_is_evicted_past_the_byte_budget():
+    entry_size = session_cache._size({}, history(1, 1000))
+    cache = SessionCache(max_mb=(2.5 * entry_size) / (1024 * 1024), ttl=60)
+    cache.put("a", {}, history(1, 1000), 1)
+    cache.put("b", {}, history(1, 1000), 1)
+    assert cache.get("a", 0) is not None  # "a" is now the most recently used
+
+    cache.put("c", {}, history(1, 1000), 1)
+
+    assert cache.get("b", 0) is None
+    assert cache.get("a", 0) is not None and cache.get("c", 0) is not None
+    assert cache.evictions == 1
+    assert cache.bytes == 2 * entry_size <= cache.max_bytes
+
+
+def test_entry_larger_than_the_budget_is_not_cached():
+    cache = SessionCache(max_mb=1000 / (1024 * 1024), ttl=60)
+    cache.put("a", {}, history(1), 1)
+    cache.put("a", {}, history(1, 5000), 1)
+    assert cache.get("a", 0) is None
+    assert cache.bytes == 0
+
+
+def test_replacing_an_entry_keeps_the_byte_count_exact():
+    cache = SessionCache(max_mb=1, ttl=60)
+    cache.put("a", {}, history(1), 1)
+    cache.put("a", {}, history(4), 4)
+    assert cache.bytes == session_cache._size({}, history(4))
+    cache.invalidate("a")
+    assert cache.bytes == 0 and cache.invalidations == 1
+
+
+def test_expired_entry_is_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(session_cache.time, "monotonic", lambda: now[0])
+    cache = SessionCache(max_mb=1, ttl=30)
+    cache.put("a", {}, history(1), 1)
+
+    now[0] += 29
+    assert cache.get("a", 0) is not None
+    now[0] += 2
+    assert cache.get("a", 0) is None
+    assert cache.expirations == 1
+    assert cache.bytes == 0
@@ -0,0 +1,127 @@
+"""
+Suggestions: weighted draw tables, per-session picks that don't repeat, the
+neutral fallback for unknown moods, and hot reload of the data file.
+"""
+import os
+import json
+import random
+from collections import Counter
+
+import pytest
+
+from suggestions import OPENING, Pool, SuggestionEngine, SuggestionSet
+
+DATA = {
+    "openings": ["I understand...", "Thank you for sharing..."],
+    "suggestions": {
+        "stressed": ["Breathe in for 4, out for 6.", "Take a short walk.", "Write down one small next step."],
+        "neutral": ["How has your day been?", {"text": "Tell me more.", "weight": 3}],
+    },
+}
+
+
+def write(path, data, mtime_ns):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    # An explicit mtime, since two writes in a row can share one
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / "suggestions.json")
+    write(path, DATA, 1_000_000_000)
+    return path
+
+
+def engine(path, **kwargs):
+    kwargs.setdefault("reload_seconds", 0)
+    return SuggestionEngine(path, rng=random.Random(7), **kwargs)
+
+
+def test_table_shares_follow_the_weights():
+    pool = Pool(["a", {"text": "b", "weight": 3}])
+    counts = Counter(pool.table)
+    assert counts["b"] == 3 * counts["a"]
+
+    equal = Pool(["a", "b", "c"])
+    assert len(set(Counter(equal.table).values())) == 1
+
+
+def test_every_text_gets_a_slot_however_small_its_weight():
+    pool = Pool([{"text": "rare", "weight": 0.0001}, {"text": "common", "weight": 1000}])
+    assert "rare" in pool.table
+    assert len(pool.table) == 1024
+
+
+@pytest.mark.parametrize("entries", [[], ["ok", ""], [{"text": "x", "weight": 0}], [{"weight": 1}], "not a list"])
+def test_invalid_pools_are_rejected(entries):
+    with pytest.raises((ValueError, KeyError)):
+        Pool(entries)
+
+
+def test_a_set_needs_a_neutral_pool():
+    with pytest.raises(ValueError):
+        SuggestionSet({"openings": ["hi"], "suggestions": {"sad": ["x"]}})
+
+
+def test_unknown_mood_falls_back_to_neutral(path):
+    chatbot = engine(path)
+    assert chatbot.suggestions("confused") == chatbot.suggestions("neutral")
+    assert chatbot.pick("confused") in chatbot.suggestions("neutral")
+
+
+def test_session_picks_do_not_repeat_the_last_few(path):
+    chatbot = engine(path, avoid=2)
+    picks = [chatbot.pick("stressed", "alice") for _ in range(30)]
+    for i in range(2, len(picks)):
+        assert picks[i] not in picks[i - 2:i]
+
+
+def test_avoid_never_exhausts_a_small_pool(path):
+    # Two texts and avoid=2: only the last pick is skipped, so they alternate
+    chatbot = engine(path, avoid=2)
+    picks = [chatbot.pick(OPENING, "alice") for _ in range(10)]
+    assert all(a != b for a, b in zip(picks, picks[1:]))
+
+
+def test_sessions_are_tracked_separately_and_least_recent_dropped(path):
+    chatbot = engine(path, max_tracked=2)
+    chatbot.pick("stressed", "alice")
+    chatbot.pick("stressed", "bob")
+    chatbot.pick("stressed", "alice")
+    chatbot.pick("stressed", "carol")
+    assert set(chatbot._recent) == {("alice", "stressed"), ("carol", "stressed")}
+    assert chatbot.stats()["tracked"] == 2
+
+
+def test_changed_file_is_swapped_in(path):
+    chatbot = engine(path, reload_seconds=60)
+    assert not chatbot.maybe_reload()  # Not due yet
+
+    changed = dict(DATA, suggestions=dict(DATA["suggestions"], stressed=["Stretch for a minute."]))
+    write(path, changed, 2_000_000_000)
+    chatbot._next_check = 0
+    assert chatbot.maybe_reload()
+    assert chatbot.pick("stressed", "alice") == "Stretch for a minute."
+    assert chatbot.stats()["version"] == 2_000_000_000
+    assert chatbot.stats()["reloads"] == 1
+
+
+def test_broken_file_keeps_the_current_set_and_is_reported_once(path):
+    chatbot = engine(path, reload_seconds=60)
+    before = chatbot.current
+
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{not json")
+    os.utime(path, ns=(2_000_000_000, 2_000_000_000))
+    for _ in range(2):
+        chatbot._next_check = 0
+        assert not chatbot.maybe_reload()
+    assert chatbot.current is before
+    assert chatbot.stats()["reload_errors"] == 1
+
+    os.remove(path)  # Mid-replace: nothing to report
+    chatbot._next_check = 0
+    assert not chatbot.maybe_reload()
+    assert chatbot.stats()["reload_errors"] == 1
@@ -0,0 +1,121 @@
+"""
+WriteBehindQueue against the in-memory Firestore: turns queued while a
+session is being flushed go out together, queued turns are visible to the next
+request, failed commits are retried, and turns left in the spill file by a
+process that died are committed by the next one.
+"""
+import sys
+import threading
+import subprocess
+
+import pytest
+
+import fake_firestore
+import firestore_db
+import write_behind
+from firestore_db import ChatTurnRepository
+from write_behind import SpillFile, WriteBehindQueue, _PendingTurn
+
+
+def turn(i):
+    return [{'role': 'user', 'content': f"user {i}"}, {'role': 'assistant', 'content': f"bot {i}"}]
+
+
+def stored_messages(db, session_id):
+    return firestore_db.get_chat_history(db.collection('users').document(session_id))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setattr(firestore_db, "HISTORY_LAYOUT", "messages")
+    monkeypatch.setattr(firestore_db, "sessions", None)
+    return fake_firestore.FakeClient()
+
+
+def test_turns_queued_during_a_flush_go_out_in_one_commit(db, monkeypatch):
+    calls = []
+    release = threading.Event()
+    original = ChatTurnRepository.commit
+
+    def slow_commit(self, new_messages, mood):
+        calls.append(len(new_messages))
+        release.wait(5)
+        return original(self, new_messages, mood)
+    monkeypatch.setattr(ChatTurnRepository, "commit", slow_commit)
+
+    queue = WriteBehindQueue(db, workers=2, spill_path="")
+    for i in range(3):
+        repo = ChatTurnRepository(db, "alice")
+        # The next request already sees the turns still in the queue
+        assert queue.load(repo) == [m for j in range(i) for m in turn(j)]
+        queue.commit(repo, turn(i), "sad")
+        while not calls:
+            release.wait(0.001)  # The first turn is being written before the others arrive
+
+    release.set()
+    assert queue.flush(5) == 0
+    assert calls == [2, 4]
+    assert stored_messages(db, "alice") == turn(0) + turn(1) + turn(2)
+    assert queue.stats()["commits"] == 2
+    assert queue.stats()["coalesced"] == 1
+    data = db.collection('users').document("alice").get().to_dict()
+    assert data['mood_counts'] == {'sad': 3}
+
+
+def test_failed_commit_is_retried_without_duplicating_messages(db, monkeypatch):
+    monkeypatch.setattr(write_behind, "WRITE_BEHIND_RETRY_SECONDS", 0.01)
+    original = ChatTurnRepository.commit
+    failed = []
+
+    def flaky_commit(self, new_messages, mood):
+        if not failed:
+            failed.append(True)
+            original(self, new_messages, mood)
+            raise RuntimeError("connection reset after the write landed")
+        return original(self, new_messages, mood)
+    monkeypatch.setattr(ChatTurnRepository, "commit", flaky_commit)
+
+    queue = WriteBehindQueue(db, workers=1, spill_path="")
+    repo = ChatTurnRepository(db, "alice")
+    queue.load(repo)
+    queue.commit(repo, turn(0), "sad")
+    assert queue.flush(5) == 0
+
+    assert stored_messages(db, "alice") == turn(0)
+    assert queue.stats()["failures"] == 1
+
+
+def dead_pid():
+    process = subprocess.Popen([sys.executable, "-c", ""])
+    process.wait()
+    return process.pid
+
+
+def test_turns_left_by_a_dead_process_are_recovered(db, tmp_path):
+    path = str(tmp_path / "data" / "write_behind.sqlite3")
+    # turn(0) reached Firestore before the crash, turn(1) did not
+    ChatTurnRepository(db, "alice").commit(turn(0), "sad")
+    crashed = SpillFile(path)
+    crashed.owner = dead_pid()
+    crashed.add(_PendingTurn("alice", None, turn(0), "sad", 0))
+    crashed.add(_PendingTurn("alice", None, turn(1), "anxious", 2))
+
+    queue = WriteBehindQueue(db, workers=1, spill_path=path)
+    assert queue.flush(5) == 0
+
+    assert queue.stats()["recovered"] == 2
+    assert stored_messages(db, "alice") == turn(0) + turn(1)
+    data = db.collection('users').document("alice").get().to_dict()
+    assert data['mood_counts'] == {'sad': 1, 'anxious': 1}
+    assert SpillFile(path).adopt_orphans() == []
+
+
+def test_live_process_keeps_its_own_spilled_turns(db, tmp_path):
+    path = str(tmp_path / "write_behind.sqlite3")
+    other = SpillFile(path)
+    other.owner = 1  # init never exits
+    other.add(_PendingTurn("alice", None, turn(0), "sad", 0))
+
+    queue = WriteBehindQueue(db, workers=1, spill_path=path)
+    assert queue.stats()["recovered"] == 0
+    assert stored_messages(db, "alice") == []
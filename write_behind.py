@@ -0,0 +1,392 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timezone
+import firestore_db
+import metrics
+
+# Write-behind persistence for chat turns. /chat hands the finished turn to a
+# queue and returns the reply straight away; background flushers commit it to
+# Firestore. Turns of the same session that pile up while one is being
+# written go out together in the next single batch. Each turn is also written
+# to a local SQLite spill file first and removed once committed, so turns
+# queued by a process that crashed are committed by the next one to start.
+# Reads through the queue (load(), pending_messages()) see queued turns.
+
+# --- 1. Configuration ---
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "1") == "1"
+# Turns waiting for Firestore; once full, a new session's turn is written in the request
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "1000"))
+WRITE_BEHIND_WORKERS = int(os.getenv("WRITE_BEHIND_WORKERS", "4"))
+# First retry delay after a failed commit, doubled per attempt up to WRITE_BEHIND_MAX_RETRY_SECONDS
+WRITE_BEHIND_RETRY_SECONDS = float(os.getenv("WRITE_BEHIND_RETRY_SECONDS", "1"))
+WRITE_BEHIND_MAX_RETRY_SECONDS = float(os.getenv("WRITE_BEHIND_MAX_RETRY_SECONDS", "30"))
+# How long process exit waits for the queue to drain (anything left stays in the spill file)
+WRITE_BEHIND_SHUTDOWN_SECONDS = float(os.getenv("WRITE_BEHIND_SHUTDOWN_SECONDS", "10"))
+# "" disables the spill file; the in-memory Firestore fake has nothing to recover into.
+# It holds raw chat turns, so it defaults to the git-ignored data/ directory.
+WRITE_BEHIND_SPILL = os.getenv(
+    "WRITE_BEHIND_SPILL", "" if os.getenv("FIRESTORE_BACKEND") == "memory" else "data/write_behind.sqlite3"
+)
+
+LAG_SECONDS = metrics.Histogram(
+    "serenity_write_behind_lag_seconds", "Time from a chat turn being queued to its Firestore commit.")
+
+
+# --- 2. Spill file ---
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by someone else
+    return True
+
+
+class SpillFile:
+    """
+    Queued turns in a local SQLite file (WAL, synchronous=NORMAL: survives a
+    process crash, not a power cut). Rows belong to the process that wrote
+    them; on startup a process adopts the rows of owners that are no longer running.
+    """
+
+    def __init__(self, path=WRITE_BEHIND_SPILL):
+        self.path = path
+        self.owner = os.getpid()
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS write_behind ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, owner INTEGER NOT NULL, session_id TEXT NOT NULL, "
+                "first_seq INTEGER NOT NULL, messages TEXT NOT NULL, mood TEXT, queued_at REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, entry):
+        """ Stores one queued turn; returns its row id. """
+        cursor = self._connect().execute(
+            "INSERT INTO write_behind (owner, session_id, first_seq, messages, mood, queued_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (self.owner, entry.session_id, entry.first_seq, json.dumps(entry.messages), entry.mood, time.time()),
+        )
+        return cursor.lastrowid
+
+    def remove(self, ids):
+        ids = [i for i in ids if i is not None]
+        if ids:
+            self._connect().execute(
+                f"DELETE FROM write_behind WHERE id IN ({','.join('?' * len(ids))})", ids
+            )
+
+    def adopt_orphans(self):
+        """ Takes over rows left by processes that have exited; returns them oldest first. """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            owners = [row[0] for row in conn.execute("SELECT DISTINCT owner FROM write_behind")]
+            dead = [owner for owner in owners if owner == self.owner or not _alive(owner)]
+            if dead:
+                conn.execute(
+                    f"UPDATE write_behind SET owner = ? WHERE owner IN ({','.join('?' * len(dead))})",
+                    [self.owner] + dead,
+                )
+            rows = conn.execute(
+                "SELECT id, session_id, first_seq, messages, mood FROM write_behind WHERE owner = ? ORDER BY id",
+                (self.owner,),
+            ).fetchall()
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+
+# --- 3. Queue ---
+
+class _PendingTurn:
+    __slots__ = ("session_id", "turn", "messages", "mood", "first_seq", "queued_at", "spill_id")
+
+    def __init__(self, session_id, turn, messages, mood, first_seq):
+        self.session_id = session_id
+        self.turn = turn  # The request's ChatTurnRepository; None when recovered from the spill file
+        self.messages = messages
+        self.mood = mood
+        self.first_seq = first_seq
+        self.queued_at = time.monotonic()
+        self.spill_id = None
+
+
+class _Session:
+    __slots__ = ("queued", "flushing", "attempts", "reload")
+
+    def __init__(self):
+        self.queued = []
+        self.flushing = []
+        self.attempts = 0
+        # Recovered or retried turns: re-read the user document before committing,
+        # since an earlier attempt may have landed
+        self.reload = False
+
+
+class WriteBehindQueue:
+    """
+    Bounded queue of chat turns with a pool of flusher threads. A session is
+    flushed by one thread at a time, so its turns are committed in order, and
+    everything it has queued by then goes out in one batch. Use load() and
+    commit() in place of ChatTurnRepository.load() and commit(); with
+    WRITE_BEHIND=0 they are exactly those.
+    """
+
+    def __init__(self, db, enabled=WRITE_BEHIND, max_pending=WRITE_BEHIND_MAX_PENDING,
+                 workers=WRITE_BEHIND_WORKERS, spill_path=WRITE_BEHIND_SPILL):
+        self.db = db
+        self.enabled = enabled
+        self.max_pending = max_pending
+        self.spill = SpillFile(spill_path) if enabled and spill_path else None
+        self._sessions = {}  # session_id -> _Session, while it has queued or in-flight turns
+        self._ready = deque()  # Sessions with queued turns and no flush in progress
+        # One lock: flushers wait on _cond for a ready session, flush() on _drained
+        # for commits, so a notify() meant for a flusher can't wake flush() instead
+        lock = threading.Lock()
+        self._cond = threading.Condition(lock)
+        self._drained = threading.Condition(lock)
+        self.pending = 0
+
+        # Metrics
+        self.queued = 0
+        self.commits = 0
+        self.coalesced = 0
+        self.failures = 0
+        self.write_through = 0
+        self.recovered = 0
+
+        if not enabled:
+            return
+        for i in range(workers):
+            threading.Thread(target=self._work, name=f"serenity-write-behind-{i}", daemon=True).start()
+        atexit.register(self.flush)
+        if self.spill:
+            self._recover()
+
+    # Request side
+
+    def load(self, turn):
+        """ turn.load(), plus this process's queued turns for the session that Firestore doesn't have yet. """
+        with self._cond:
+            session = self._sessions.get(turn.session_id)
+            pending = list(session.flushing + session.queued) if session else []
+        history = turn.load()
+        if not pending or not self._eligible(turn):
+            return history
+
+        committed = turn.data.get('message_count', 0) if turn.exists else 0
+        unseen = [entry for entry in pending if entry.first_seq >= committed]
+        if not unseen:
+            return history
+        for entry in unseen:
+            turn.history.extend(entry.messages)
+        total = unseen[-1].first_seq + len(unseen[-1].messages)
+        # As the snapshot will look once the queue is through: the next turn
+        # numbers its messages after the queued ones and counts today as active
+        turn.data = dict(turn.data or {}, message_count=total, last_active=datetime.now(timezone.utc))
+        turn.history = turn.history[-turn.history_limit:]
+        turn.history_offset = total - len(turn.history)
+        return turn.history
+
+    def commit(self, turn, new_messages, mood):
+        """ Queues the turn for Firestore (or writes it now, see WriteBehindQueue). """
+        if not self.enabled or not self._eligible(turn):
+            turn.commit(new_messages, mood)
+            return
+        first_seq = turn.data.get('message_count', 0) if turn.exists else 0
+        entry = _PendingTurn(turn.session_id, turn, list(new_messages), mood, first_seq)
+
+        with self._cond:
+            # A full queue still takes turns for sessions already in it, to keep them in order
+            write_through = self.pending >= self.max_pending and turn.session_id not in self._sessions
+            if write_through:
+                self.write_through += 1
+        if write_through:
+            turn.commit(new_messages, mood)
+            return
+
+        if self.spill:
+            entry.spill_id = self.spill.add(entry)
+        self._enqueue(entry)
+
+    def pending_messages(self, session_id, after_seq=-1):
+        """ Queued messages of a session numbered above `after_seq`, each with its `seq`. """
+        with self._cond:
+            session = self._sessions.get(session_id)
+            pending = list(session.flushing + session.queued) if session else []
+        return [
+            dict(message, seq=entry.first_seq + offset)
+            for entry in pending
+            for offset, message in enumerate(entry.messages)
+            if entry.first_seq + offset > after_seq
+        ]
+
+    @staticmethod
+    def _eligible(turn):
+        """ Only the messages layout: legacy array users are written (and migrated) in the request. """
+        return firestore_db.HISTORY_LAYOUT == 'messages' and (not turn.exists or 'message_count' in turn.data)
+
+    # Flusher side
+
+    def _enqueue(self, entry, front=False):
+        with self._cond:
+            session = self._sessions.get(entry.session_id)
+            if session is None:
+                session = self._sessions[entry.session_id] = _Session()
+            if front:
+                session.queued.insert(0, entry)
+            else:
+                session.queued.append(entry)
+            self.pending += 1
+            self.queued += 1
+            if not session.flushing and len(session.queued) == 1:
+                self._ready.append(entry.session_id)
+                self._cond.notify()
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                session_id = self._ready.popleft()
+                session = self._sessions[session_id]
+                batch, session.queued, session.flushing = session.queued, [], session.queued
+            self._flush_session(session_id, session, batch)
+
+    def _flush_session(self, session_id, session, batch):
+        try:
+            turn = batch[0].turn
+            done = []
+            if turn is None or session.reload:
+                turn = firestore_db.ChatTurnRepository(self.db, session_id)
+                turn.load(refresh=True)
+                committed = turn.data.get('message_count', 0) if turn.exists else 0
+                # Already committed by an attempt whose result we never saw
+                done = [entry for entry in batch if entry.first_seq + len(entry.messages) <= committed]
+                batch = [entry for entry in batch if entry not in done]
+            committed_now = bool(batch)
+            if batch:
+                turn.commit([m for entry in batch for m in entry.messages], [entry.mood for entry in batch])
+        except Exception as e:
+            print(f"--- Write-behind commit failed for a session ({len(batch)} turns): {e} ---")
+            with self._cond:
+                self.failures += 1
+                session.attempts += 1
+                session.reload = True
+                session.queued = session.flushing + session.queued
+                session.flushing = []
+            delay = min(WRITE_BEHIND_RETRY_SECONDS * 2 ** (session.attempts - 1), WRITE_BEHIND_MAX_RETRY_SECONDS)
+            timer = threading.Timer(delay, self._retry, (session_id,))
+            timer.daemon = True
+            timer.start()
+            return
+
+        batch = batch + done
+        if self.spill:
+            try:
+                self.spill.remove([entry.spill_id for entry in batch])
+            except sqlite3.Error as e:
+                # Committed already; a leftover row is skipped on recovery
+                print(f"--- Write-behind spill cleanup failed: {e} ---")
+        now = time.monotonic()
+        for entry in batch:
+            LAG_SECONDS.observe(now - entry.queued_at)
+
+        with self._cond:
+            if committed_now:
+                self.commits += 1
+                self.coalesced += len(batch) - len(done) - 1
+            self.pending -= len(batch)
+            session.flushing = []
+            session.attempts = 0
+            session.reload = False
+            if session.queued:
+                self._ready.append(session_id)
+                self._cond.notify()
+            else:
+                del self._sessions[session_id]
+            self._drained.notify_all()
+
+    def _retry(self, session_id):
+        with self._cond:
+            session = self._sessions.get(session_id)
+            if session and session.queued and not session.flushing:
+                self._ready.append(session_id)
+                self._cond.notify()
+
+    def _recover(self):
+        """ Queues turns left in the spill file by processes that have exited. """
+        rows = self.spill.adopt_orphans()
+        for spill_id, session_id, first_seq, messages, mood in rows:
+            entry = _PendingTurn(session_id, None, json.loads(messages), mood, first_seq)
+            entry.spill_id = spill_id
+            self._enqueue(entry)
+        if rows:
+            self.recovered += len(rows)
+            print(f"--- Write-behind: recovered {len(rows)} unsaved turns from {self.spill.path} ---")
+
+    def flush(self, timeout=WRITE_BEHIND_SHUTDOWN_SECONDS):
+        """ Waits up to `timeout` seconds for every queued turn to be committed; returns how many are left. """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.pending and time.monotonic() < deadline:
+                self._drained.wait(deadline - time.monotonic())
+            left = self.pending
+        if left:
+            where = f"kept in {self.spill.path}" if self.spill else "lost (no spill file)"
+            print(f"--- Write-behind: {left} turns not yet committed, {where} ---")
+        return left
+
+    def stats(self):
+        with self._cond:
+            oldest = min(
+                (entry.queued_at for session in self._sessions.values()
+                 for entry in session.flushing + session.queued),
+                default=None,
+            )
+            return {
+                "enabled": self.enabled,
+                "pending": self.pending,
+                "sessions": len(self._sessions),
+                "oldest_pending_s": round(time.monotonic() - oldest, 3) if oldest is not None else 0.0,
+                "queued": self.queued,
+                "commits": self.commits,
+                "coalesced": self.coalesced,
+                "failures": self.failures,
+                "write_through": self.write_through,
+                "recovered": self.recovered,
+            }
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue(db):
+    """ Returns the process-wide WriteBehindQueue, creating it on first use (api.py and bot.py share it). """
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = WriteBehindQueue(db)
+            metrics.register_stats("write_behind", _queue.stats)
+        return _queue